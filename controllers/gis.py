@@ -459,6 +459,21 @@ def ldata():
         if language == current.deployment_settings.get_L10n_default_language():
             translate = False
 
+    # Versioned URLs can be cached by browsers and proxies, otherwise
+    # clients need to revalidate their copy (ETag)
+    version = s3base.S3LocationSelectorWidget2.data_version(language if translate else None)
+    etag = '"%s-%s"' % (id, version)
+    headers = response.headers
+    headers["ETag"] = etag
+    if request.get_vars.get("v") == version:
+        headers["Cache-Control"] = "public, max-age=86400"
+    else:
+        headers["Cache-Control"] = "public, no-cache"
+    headers.pop("Pragma", None)
+    headers.pop("Expires", None)
+    if request.env.http_if_none_match == etag:
+        raise HTTP(304, **headers)
+
     table = s3db.gis_location
     query = (table.deleted == False) & \
             (table.end_date == None) & \
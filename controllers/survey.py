@@ -436,6 +436,7 @@ def export_all_responses():
                 cols[sheetName] = 0
     else:
         sheet = book.add_sheet(T("Responses"))
+    matrix = s3db.survey_getAnswerMatrix(series_id)
     for qstn in qstnList:
         if sectionBreak:
             sheetName = qstn["section"].split(" ")[0]
@@ -448,9 +449,13 @@ def export_all_responses():
         sheet.write(row,col,widgetObj.fullName())
         # For each question get the response
         allResponses = s3db.survey_getAllAnswersForQuestionInSeries(qstn["qstn_id"],
-                                                                  series_id)
+                                                                  series_id,
+                                                                  matrix=matrix)
         for answer in allResponses:
-            value = answer["value"]
+            # Write numeric answers as numbers
+            value = answer["typed"]
+            if not isinstance(value, (int, long, float)):
+                value = answer["value"]
             complete_id = answer["complete_id"]
             if complete_id in completeRow:
                 row = completeRow[complete_id]
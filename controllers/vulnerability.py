@@ -1571,7 +1571,13 @@ def approve_report(id):
         return False
     resource = s3db.resource(tablename, filter=query, unapproved=True)
     resource.approve()
-    if document_type in ("indicator", "demographic"):
+    if document_type == "demographic":
+        # Rebuild the relevant aggregates
+        rows = resource.select(fields=["data_id"], as_rows=True)
+        data_ids = [row[table.data_id] for row in rows]
+        s3task.async(agg_function,
+                     vars=dict(records=json.dumps(data_ids)))
+    elif document_type == "indicator":
         # Rebuild the relevant aggregates
         rows = resource.select(fields=["data_id",
                                        "parameter_id",
@@ -46,6 +46,21 @@ def crop_image(path, x1, y1, x2, y2, width):
 
 tasks["crop_image"] = crop_image
 
+# -----------------------------------------------------------------------------
+def s3_audit_flush(user_id=None):
+    """
+        Transfer spooled audit entries into the audit table
+
+        @param user_id: calling request's auth.user.id or None
+    """
+
+    # Run the Task & return the result
+    result = s3base.S3Audit.flush_spool()
+    db.commit()
+    return result
+
+tasks["s3_audit_flush"] = s3_audit_flush
+
 # -----------------------------------------------------------------------------
 if settings.has_module("doc"):
 
@@ -327,6 +342,22 @@ if settings.has_module("msg"):
 
     tasks["notify_notify"] = notify_notify
 
+    # -------------------------------------------------------------------------
+    def notify_notify_grouped(resource_ids, user_id=None):
+        """
+            Asynchronous task to notify the subscribers of a resource about
+            updates, in groups. This task is created by
+            notify_check_subscriptions (if msg.notify_engine is "grouped").
+
+            @param resource_ids: the pr_subscription_resource record IDs
+        """
+        if user_id:
+            auth.s3_impersonate(user_id)
+        notify = s3base.S3Notifications
+        return notify.notify_grouped(resource_ids)
+
+    tasks["notify_notify_grouped"] = notify_notify_grouped
+
 # -----------------------------------------------------------------------------
 if settings.has_module("req"):
 
@@ -351,8 +382,9 @@ if settings.has_module("stats"):
             Update the stats_demographic_aggregate table for the given
             stats_demographic_data record(s)
 
-            @param records: JSON of Rows of stats_demographic_data records to
-                            update aggregates for
+            @param records: JSON list of data_ids of the stats_demographic_data
+                            records to update aggregates for, None to
+                            rebuild the aggregates for all records
             @param user_id: calling request's auth.user.id or None
         """
         if user_id:
@@ -378,7 +410,7 @@ if settings.has_module("stats"):
             @param location_level: gis level at which the data needs to be accumulated
             @param root_location_id: id of the location
             @param parameter_id: parameter for which the stats are being updated
-            @param start_date: start date of the period in question
+            @param start_date: start date of the earliest period in question
             @param end_date: end date of the period in question
             @param user_id: calling request's auth.user.id or None
         """
@@ -137,6 +137,14 @@ if len(pop_list) > 0:
                              timeout=300,
                              repeats=0)
 
+    # Transfer spooled audit entries
+    if settings.get_security_audit_spool():
+        s3task.schedule_task("s3_audit_flush",
+                             period=60,   # seconds
+                             timeout=300, # seconds
+                             repeats=0    # unlimited
+                             )
+
     # Daily maintenance
     s3task.schedule_task("maintenance",
                          vars={"period":"daily"},
@@ -320,7 +328,14 @@ if len(pop_list) > 0:
         except AttributeError:
             # older Python
             print >> sys.stdout, "Pre-populate task completed in %s" % duration
+        # Report the slowest import tasks
+        timing_report = bi.timing_report()
+        if timing_report:
+            print >> sys.stdout, "Slowest import tasks:"
+            for line in timing_report:
+                print >> sys.stdout, line
         bi.resultList = []
+        bi.timings = []
     for errorLine in bi.errorList:
         try:
             print >> sys.stderr, errorLine
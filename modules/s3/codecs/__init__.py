@@ -28,6 +28,7 @@
 
 """
 
+from geojson import *
 from pdf import *
 from shp import *
 from svg import *
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+"""
+    S3 GeoJSON codec
+
+    @copyright: 2013 (c) Sahana Software Foundation
+    @license: MIT
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use,
+    copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following
+    conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+    OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+    OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__all__ = ["S3GeoJSON"]
+
+try:
+    import json # try stdlib (Python 2.6)
+except ImportError:
+    try:
+        import simplejson as json # try external module
+    except:
+        import gluon.contrib.simplejson as json # fallback to pure-Python module
+
+from gluon import *
+from gluon.http import HTTP
+
+from ..s3codec import S3Codec
+from ..s3utils import s3_unicode
+
+# =============================================================================
+class S3GeoJSON(S3Codec):
+    """
+        Native GeoJSON codec for Feature Layers
+
+        Encodes the location data from gis.get_location_data() directly
+        as a GeoJSON FeatureCollection, bypassing the S3XML tree and the
+        static/formats/geojson XSLT, and streams the result in chunks.
+    """
+
+    # Number of features per output chunk
+    CHUNK_SIZE = 500
+
+    # Tables which need the XSLT for their GeoJSON export
+    # (e.g. Shapefile Layers, Theme Layers, Feature Queries)
+    SKIP = ("gis_",)
+
+    # -------------------------------------------------------------------------
+    def __init__(self):
+        """
+            Constructor
+        """
+
+        pass
+
+    # -------------------------------------------------------------------------
+    def encode(self, resource, **attr):
+        """
+            Export a resource as GeoJSON FeatureCollection
+
+            @param resource: the S3Resource
+            @param attr: dictionary of parameters:
+                 * start:       index of the first record to export
+                 * limit:       maximum number of records to export
+
+            @return: an iterator over the output chunks, or None if
+                     the resource can not be encoded natively (in which
+                     case the caller should fall back to the XSLT export)
+        """
+
+        tablename = resource.tablename
+        if tablename.startswith(self.SKIP):
+            return None
+
+        table = resource.table
+        if "location_id" not in table.fields and \
+           "site_id" not in table.fields:
+            return None
+
+        xml = current.xml
+
+        # Filter for MCI >= 0 (setting)
+        if xml.filter_mci and "mci" in table.fields:
+            resource.add_filter(table.mci >= 0)
+
+        # Total number of results
+        results = resource.count()
+        if results > current.deployment_settings.get_gis_max_features():
+            headers = {"Content-Type": "application/json"}
+            message = "Too Many Records"
+            status = 509
+            raise HTTP(status,
+                       body=xml.json_message(success=False,
+                                             statuscode=status,
+                                             message=message),
+                       web2py_error=message,
+                       **headers)
+
+        # Load the records (required for markers and location lookups)
+        resource.load(start=attr.get("start", None),
+                      limit=attr.get("limit", None),
+                      virtual=False,
+                      cacheable=True)
+
+        # Lookup all location data in bulk
+        locations = current.gis.get_location_data(resource)
+        if locations is None:
+            return None
+
+        # Base URL for the onClick popups, using the current controller
+        # in order to apply the controller settings
+        request = current.request
+        popup_url = URL(request.controller,
+                        request.function).split(".", 1)[0]
+
+        # Assume being used within the Sahana Mapping client
+        # so use local URLs to keep filesize down
+        marker_url = "/%s/static/img/markers" % request.application
+
+        pkey = table._id.name
+        UID = xml.UID
+        rows = resource._rows
+        ids = [(row[pkey], row[UID] if UID in row else None) for row in rows]
+
+        # Lookup the geometries of records which have no pre-prepared
+        # location data, like gis_encode does
+        fallback = None
+        if "location_id" in table.fields:
+            latlons = locations.get("latlons")
+            if latlons and tablename in latlons:
+                _latlons = latlons[tablename]
+                missing = lambda record_id: not _latlons.get(record_id)
+            elif any(tablename in (locations.get(k) or {})
+                     for k in ("geojsons", "wkts")):
+                missing = None
+            else:
+                missing = lambda record_id: True
+            if missing:
+                location_ids = dict((row[pkey], row.location_id)
+                                    for row in rows
+                                    if row.location_id and missing(row[pkey]))
+                if location_ids:
+                    fallback = self.lookup_geometries(location_ids)
+
+        response = current.response
+        if response:
+            response.headers["Content-Type"] = "application/json"
+
+        return self.features(ids,
+                             tablename,
+                             locations,
+                             popup_url=popup_url,
+                             marker_url=marker_url,
+                             fallback=fallback)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def lookup_geometries(location_ids):
+        """
+            Lookup the geometries of records from their locations,
+            polygons only if requested (like gis_encode)
+
+            @param location_ids: dict {record_id: location_id}
+
+            @return: dict {record_id: (lat, lon) or GeoJSON geometry}
+        """
+
+        gtable = current.s3db.gis_location
+        fields = [gtable.id, gtable.lat, gtable.lon]
+        polygons = "polygons" in current.request.get_vars
+        if polygons:
+            fields.append(gtable.wkt)
+        query = (gtable.id.belongs(set(location_ids.values())))
+        rows = current.db(query).select(*fields)
+
+        gis = current.gis
+        geometries = {}
+        for row in rows:
+            wkt = row.wkt if polygons else None
+            if wkt:
+                # Simplify the polygon to reduce download size
+                geometries[row.id] = gis.simplify(wkt, output="geojson")
+            else:
+                geometries[row.id] = (row.lat, row.lon)
+
+        return dict((record_id, geometries[location_id])
+                    for record_id, location_id in location_ids.items()
+                    if location_id in geometries)
+
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def features(cls,
+                 ids,
+                 tablename,
+                 locations,
+                 popup_url=None,
+                 marker_url=None,
+                 fallback=None):
+        """
+            Generator for the FeatureCollection output chunks
+
+            @param ids: list of tuples (record_id, uuid) in output order
+            @param tablename: the tablename
+            @param locations: the location data as returned from
+                              gis.get_location_data()
+            @param popup_url: base URL for the onClick popups
+            @param marker_url: base URL for the marker images
+            @param fallback: geometries of records without pre-prepared
+                             location data, see lookup_geometries
+        """
+
+        encode_feature = cls.encode_feature
+        chunk_size = cls.CHUNK_SIZE
+
+        yield '{"type":"FeatureCollection","features":['
+
+        buffer = []
+        append = buffer.append
+        separator = ""
+        for record_id, uid in ids:
+            feature = encode_feature(record_id,
+                                     uid,
+                                     tablename,
+                                     locations,
+                                     popup_url=popup_url,
+                                     marker_url=marker_url,
+                                     fallback=fallback)
+            if feature is None:
+                # Cannot display on Map
+                continue
+            append(feature)
+            if len(buffer) >= chunk_size:
+                yield separator + ",".join(buffer)
+                separator = ","
+                del buffer[:]
+        if buffer:
+            yield separator + ",".join(buffer)
+
+        yield "]}"
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def encode_feature(record_id,
+                       uid,
+                       tablename,
+                       locations,
+                       popup_url=None,
+                       marker_url=None,
+                       fallback=None):
+        """
+            Encode a single record as GeoJSON Feature, with the same
+            properties as the XSLT export (id, popup, url, marker and
+            attributes)
+
+            @param record_id: the record ID
+            @param uid: the record UUID
+            @param tablename: the tablename
+            @param locations: the location data as returned from
+                              gis.get_location_data()
+            @param popup_url: base URL for the onClick popups
+            @param marker_url: base URL for the marker images
+            @param fallback: geometries of records without pre-prepared
+                             location data, see lookup_geometries
+
+            @return: the Feature as JSON string, or None if the record
+                     has no geometry
+        """
+
+        # Geometry
+        point = False
+        polygon = False
+        geometry = None
+        latlon = None
+        latlons = locations.get("latlons")
+        geojsons = locations.get("geojsons")
+        wkts = locations.get("wkts")
+        if latlons and tablename in latlons:
+            latlon = latlons[tablename].get(record_id)
+        elif geojsons and tablename in geojsons:
+            # Pre-simplified GeoJSON, can be dropped in as-is
+            polygon = True
+            geometry = geojsons[tablename].get(record_id)
+        elif wkts and tablename in wkts:
+            polygon = True
+            wkt = wkts[tablename].get(record_id)
+            if wkt:
+                geometry = current.gis.simplify(wkt, output="geojson")
+
+        if not latlon and not polygon and fallback:
+            # Geometry looked up from the location
+            value = fallback.get(record_id)
+            if isinstance(value, tuple):
+                latlon = value
+            else:
+                geometry = value
+
+        if latlon:
+            lat, lon = latlon
+            if lat is None or lon is None:
+                # Cannot display on Map
+                return None
+            point = True
+            geometry = '{"type":"Point","coordinates":[%.4f,%.4f]}' % \
+                       (lon, lat)
+        if not geometry:
+            return None
+
+        # Properties
+        properties = {}
+        if uid and uid[:9] == "urn:uuid:":
+            properties["id"] = uid[9:]
+
+        tooltips = locations.get("tooltips")
+        if tooltips and tablename in tooltips:
+            tooltip = tooltips[tablename].get(record_id)
+            if tooltip:
+                properties["popup"] = s3_unicode(tooltip)
+
+        if popup_url:
+            properties["url"] = "%s/%i.plain" % (popup_url, record_id)
+
+        markers = locations.get("markers")
+        if point and marker_url and markers and tablename in markers:
+            _markers = markers[tablename]
+            if _markers.get("image", None):
+                # Single Marker for all features
+                marker = _markers
+            else:
+                # Separate Marker per feature
+                marker = _markers.get(record_id)
+            if marker:
+                properties["marker_url"] = "%s/%s" % (marker_url,
+                                                      marker["image"])
+                properties["marker_height"] = str(marker["height"])
+                properties["marker_width"] = str(marker["width"])
+
+        attributes = locations.get("attributes")
+        if attributes and tablename in attributes:
+            attrs = attributes[tablename].get(record_id)
+            if attrs:
+                for key, value in attrs.items():
+                    properties[key] = s3_unicode(value).strip()
+
+        return '{"type":"Feature","geometry":%s,"properties":%s}' % \
+               (geometry, json.dumps(properties, separators=(",", ":")))
+
+# End =========================================================================
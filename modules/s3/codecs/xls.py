@@ -30,14 +30,12 @@
 
 __all__ = ["S3XLS"]
 
-try:
-    from cStringIO import StringIO    # Faster, where available
-except:
-    from StringIO import StringIO
+import tempfile
 
 from gluon import *
 from gluon.contenttype import contenttype
 from gluon.storage import Storage
+from gluon.streamer import DEFAULT_CHUNK_SIZE
 
 from ..s3codec import S3Codec
 from ..s3utils import s3_unicode, s3_strip_markup
@@ -55,6 +53,15 @@ class S3XLS(S3Codec):
     SUB_HEADER_COLOUR = 0x18
     ROW_ALTERNATING_COLOURS = [0x2A, 0x2B]
 
+    # Number of rows to extract at a time
+    CHUNK_SIZE = 1000
+
+    # Time (in seconds) to keep the bookmarks for paging through the rows
+    CHUNK_EXPIRE = 600
+
+    # Maximum number of rows per sheet (XLS limit)
+    MAX_ROWS = 65536
+
     # -------------------------------------------------------------------------
     def __init__(self):
         """
@@ -75,10 +82,13 @@ class S3XLS(S3Codec):
 
             @param resource: the resource
             @param list_fields: fields to include in list views
+
+            @return: tuple (title, types, lfields, heading, rows), where
+                     rows is an iterator extracting the rows in chunks
         """
 
         title = self.crud_string(resource.tablename, "title_list")
-        
+
         vars = Storage(current.request.vars)
         vars["iColumns"] = len(list_fields)
         filter, orderby, left = resource.datatable_filter(list_fields, vars)
@@ -86,19 +96,36 @@ class S3XLS(S3Codec):
 
         if orderby is None:
             orderby = resource.get_config("orderby", None)
-
-        result = resource.select(list_fields,
-                                 left=left,
-                                 limit=None,
-                                 count=True,
-                                 getids=True,
-                                 orderby=orderby,
-                                 represent=True,
-                                 show_links=False)
-
+        # Chunks must not overlap, so order by primary key (too)
+        pkey = resource.table._id
+        if orderby is None:
+            orderby = pkey
+        elif isinstance(orderby, str):
+            orderby = "%s, %s" % (orderby, pkey)
+        elif isinstance(orderby, (list, tuple)):
+            orderby = list(orderby) + [pkey]
+        else:
+            orderby = [orderby, pkey]
+
+        # Page by keyset (seeking to the sort keys of the last row of
+        # the previous chunk) rather than by offset, where the sort keys
+        # are indexed (see S3Resource.select)
+        chunk_size = self.CHUNK_SIZE
+        chunk_expire = self.CHUNK_EXPIRE
+        def extract(start):
+            return resource.select(list_fields,
+                                   left=left,
+                                   start=start,
+                                   limit=chunk_size,
+                                   orderby=orderby,
+                                   count=True,
+                                   represent=True,
+                                   show_links=False,
+                                   count_cache=chunk_expire)
+
+        result = extract(0)
         rfields = result["rfields"]
-        rows = result["rows"]
-        
+
         types = []
         lfields = []
         heading = {}
@@ -111,7 +138,17 @@ class S3XLS(S3Codec):
                 else:
                     types.append(rfield.ftype)
 
-        return (title, types, lfields, heading, rows)
+        def iterate(rows):
+            start = 0
+            while rows:
+                for row in rows:
+                    yield row
+                if len(rows) < chunk_size:
+                    break
+                start += chunk_size
+                rows = extract(start)["rows"]
+
+        return (title, types, lfields, heading, iterate(result["rows"]))
 
     # -------------------------------------------------------------------------
     def encode(self, data_source, **attr):
@@ -169,7 +206,7 @@ class S3XLS(S3Codec):
         # Get the attributes
         title = attr.get("title")
         list_fields = attr.get("list_fields")
-        if not list_fields:
+        if not list_fields and not isinstance(data_source, (list, tuple)):
             list_fields = data_source.list_fields()
         group = attr.get("dt_group")
         use_colour = attr.get("use_colour", False)
@@ -179,17 +216,19 @@ class S3XLS(S3Codec):
             headers = data_source[0]
             types = data_source[1]
             rows = data_source[2:]
+            lfields = range(len(headers))
         else:
             (title, types, lfields, headers, rows) = self.extractResource(data_source,
                                                                           list_fields)
         report_groupby = lfields[group] if group else None
-        if len(rows) > 0 and len(headers) != len(rows[0]):
+        if isinstance(rows, (list, tuple)) and \
+           len(rows) > 0 and len(headers) != len(rows[0]):
             from ..s3utils import s3_debug
             msg = """modules/s3/codecs/xls: There is an error in the list_items, a field doesn't exist"
 requesting url %s
 Headers = %d, Data Items = %d
 Headers     %s
-List Fields %s""" % (request.url, len(headers), len(items[0]), headers, list_fields)
+List Fields %s""" % (request.url, len(headers), len(rows[0]), headers, list_fields)
             s3_debug(msg)
         groupby_label = headers[report_groupby] if report_groupby else None
 
@@ -210,7 +249,17 @@ List Fields %s""" % (request.url, len(headers), len(items[0]), headers, list_fie
         # sheet_name cannot be over 31 chars
         if len(sheet_name) > 31:
             sheet_name = sheet_name[:31]
-        sheet1 = book.add_sheet(sheet_name)
+        sheets = []
+        def add_sheet():
+            """ Add a (continuation) sheet """
+            name = sheet_name
+            if sheets:
+                suffix = " (%s)" % (len(sheets) + 1)
+                name = "%s%s" % (sheet_name[:31 - len(suffix)], suffix)
+            sheet = book.add_sheet(name)
+            sheets.append(sheet)
+            return sheet
+        sheet1 = add_sheet()
 
         # Styles
         styleLargeHeader = xlwt.XFStyle()
@@ -250,34 +299,43 @@ List Fields %s""" % (request.url, len(headers), len(items[0]), headers, list_fie
             styleEven.pattern.pattern_fore_colour = S3XLS.ROW_ALTERNATING_COLOURS[1]
 
         # Header row
-        colCnt = 0
-        #headerRow = sheet1.row(2)
-        headerRow = sheet1.row(0)
         fieldWidths = []
-        id = False
-        for selector in lfields:
-            if selector == report_groupby:
-                continue
-            label = headers[selector]
-            if label == "Id":
-                # Indicate to adjust colCnt when writing out
-                id = True
-                fieldWidths.append(0)
+        def write_header(sheet):
+            """ Write the header row into a sheet """
+            colCnt = 0
+            #headerRow = sheet.row(2)
+            headerRow = sheet.row(0)
+            id = False
+            for selector in lfields:
+                if selector == report_groupby:
+                    continue
+                label = headers[selector]
+                if label == "Id":
+                    # Indicate to adjust colCnt when writing out
+                    id = True
+                    if len(fieldWidths) <= colCnt:
+                        fieldWidths.append(0)
+                    colCnt += 1
+                    continue
+                if label == "Sort":
+                    continue
+                if id:
+                    # Adjust for the skipped column
+                    writeCol = colCnt - 1
+                else:
+                    writeCol = colCnt
+                headerRow.write(writeCol, str(label), styleHeader)
+                if len(fieldWidths) <= colCnt:
+                    width = max(len(label) * COL_WIDTH_MULTIPLIER, 2000)
+                    #width = len(label) * COL_WIDTH_MULTIPLIER
+                    fieldWidths.append(width)
+                sheet.col(writeCol).width = fieldWidths[colCnt]
                 colCnt += 1
-                continue
-            if label == "Sort":
-                continue
-            if id:
-                # Adjust for the skipped column
-                writeCol = colCnt - 1
-            else:
-                writeCol = colCnt
-            headerRow.write(writeCol, str(label), styleHeader)
-            width = max(len(label) * COL_WIDTH_MULTIPLIER, 2000)
-            #width = len(label) * COL_WIDTH_MULTIPLIER
-            fieldWidths.append(width)
-            sheet1.col(writeCol).width = width
-            colCnt += 1
+            sheet.panes_frozen = True
+            #sheet.horz_split_pos = 3
+            sheet.horz_split_pos = 1
+            return colCnt, id
+        colCnt, id = write_header(sheet1)
         # Title row
         # - has been removed to allow columns to be easily sorted post-export.
         # - add deployment_setting if an Org wishes a Title Row
@@ -298,8 +356,16 @@ List Fields %s""" % (request.url, len(headers), len(items[0]), headers, list_fie
         #rowCnt = 2
         rowCnt = 0
 
+        max_rows = self.MAX_ROWS
         subheading = None
         for row in rows:
+            if rowCnt >= max_rows - 2:
+                # Sheet full => continue on a new sheet
+                sheet1 = add_sheet()
+                write_header(sheet1)
+                rowCnt = 0
+                subheading = None
+
             # Item details
             rowCnt += 1
             currentRow = sheet1.row(rowCnt)
@@ -395,12 +461,12 @@ List Fields %s""" % (request.url, len(headers), len(items[0]), headers, list_fie
                     fieldWidths[colCnt] = width
                     sheet1.col(writeCol).width = width
                 colCnt += 1
-        sheet1.panes_frozen = True
-        #sheet1.horz_split_pos = 3
-        sheet1.horz_split_pos = 1
 
-        output = StringIO()
+        # Save the workbook into a temporary file and stream it from there
+        output = tempfile.TemporaryFile()
         book.save(output)
+        size = output.tell()
+        output.seek(0)
 
         # Response headers
         filename = "%s_%s.xls" % (request.env.server_name, str(title))
@@ -408,9 +474,10 @@ List Fields %s""" % (request.url, len(headers), len(items[0]), headers, list_fie
         response = current.response
         response.headers["Content-Type"] = contenttype(".xls")
         response.headers["Content-disposition"] = disposition
+        response.headers["Content-Length"] = size
 
-        output.seek(0)
-        return output.read()
+        return response.stream(output, chunk_size=DEFAULT_CHUNK_SIZE,
+                               request=request)
 
     # -------------------------------------------------------------------------
     @staticmethod
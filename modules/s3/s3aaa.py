@@ -31,6 +31,7 @@
 
 __all__ = ["AuthS3",
            "S3Permission",
+           "S3Realm",
            "S3Audit",
            "S3RoleManager",
            "S3OrgRoleManager",
@@ -38,7 +39,9 @@ __all__ = ["AuthS3",
            ]
 
 import datetime
+import os
 #import re
+import threading
 from uuid import uuid4
 
 try:
@@ -67,7 +70,7 @@ from s3error import S3PermissionError
 from s3fields import S3Represent, s3_uid, s3_timestamp, s3_deletion_status, s3_comments
 from s3rest import S3Method
 from s3track import S3Tracker
-from s3utils import s3_mark_required
+from s3utils import s3_debug, s3_mark_required
 
 DEFAULT = lambda: None
 #table_field = re.compile("[\w_]+\.[\w_]+")
@@ -216,6 +219,15 @@ Thank you
         # S3Permission
         self.permission = S3Permission(self)
 
+        # Restore compact realms from the session
+        user = self.user
+        if user and user.get("realm_version") is not None and user.realms:
+            version = user.realm_version
+            realms = user.realms
+            for group_id, realm in realms.items():
+                if realm is not None and not isinstance(realm, S3Realm):
+                    realms[group_id] = S3Realm(realm, version)
+
         # Set to True to override any authorization
         self.override = False
 
@@ -2714,6 +2726,9 @@ S3OptionsFilter({
             # Permissions of a group apply only for records owned by any of
             # the entities which belong to the realm of the group membership
 
+            # Hierarchy version of compact realms (see S3Realm)
+            self.user["realm_version"] = None
+
             if not self.permission.entity_realm:
                 # Group memberships have no realms (policy 5 and below)
                 self.user["realms"] = Storage([(row.group_id, None) for row in rows])
@@ -2756,16 +2771,9 @@ S3OptionsFilter({
                         realms[group_id].append(pe_id)
 
                 if self.permission.entity_hierarchy:
-                    # Realms include subsidiaries of the realm entities
-
-                    # Get all entities in realms
-                    all_entities = []
-                    append = all_entities.append
-                    for realm in realms.values():
-                        if realm is not None:
-                            for entity in realm:
-                                if entity not in all_entities:
-                                    append(entity)
+                    # Realms include subsidiaries of the realm entities,
+                    # which are looked up only when needed (see S3Realm)
+                    version = S3Realm.hierarchy_version()
 
                     # Lookup all delegations to any OU ancestor of the user
                     if self.permission.delegations and self.user.pe_id:
@@ -2788,43 +2796,38 @@ S3OptionsFilter({
                                                 dtable.group_id,
                                                 atable.pe_id,
                                                 cacheable=True)
+                    else:
+                        rows = []
+
+                    if rows:
+                        # Get all entities in realms
+                        all_entities = []
+                        append = all_entities.append
+                        for realm in realms.values():
+                            if realm is not None:
+                                for entity in realm:
+                                    if entity not in all_entities:
+                                        append(entity)
 
                         extensions = []
                         partners = []
                         for row in rows:
                             extensions.append(row[rn].pe_id)
                             partners.append(row[an].pe_id)
-                    else:
-                        rows = []
-                        extensions = []
-                        partners = []
 
-                    # Lookup the subsidiaries of all realms and extensions
-                    entities = all_entities + extensions + partners
-                    descendants = s3db.pr_descendants(entities)
+                        # Lookup the subsidiaries of all realms and extensions
+                        entities = all_entities + extensions + partners
+                        descendants = s3db.pr_descendants(entities)
 
-                    pmap = {}
-                    for p in partners:
-                        if p in all_entities:
-                            pmap[p] = [p]
-                        elif p in descendants:
-                            d = descendants[p]
-                            pmap[p] = [e for e in all_entities if e in d] or [p]
+                        pmap = {}
+                        for p in partners:
+                            if p in all_entities:
+                                pmap[p] = [p]
+                            elif p in descendants:
+                                d = descendants[p]
+                                pmap[p] = [e for e in all_entities if e in d] or [p]
 
-                    # Add the subsidiaries to the realms
-                    for group_id in realms:
-                        realm = realms[group_id]
-                        if realm is None:
-                            continue
-                        append = realm.append
-                        for entity in list(realm):
-                            if entity in descendants:
-                                for subsidiary in descendants[entity]:
-                                    if subsidiary not in realm:
-                                        append(subsidiary)
-
-                    # Process the delegations
-                    if self.permission.delegations:
+                        # Process the delegations
                         for row in rows:
 
                             # owner == delegates group_id to ==> partner
@@ -2854,6 +2857,13 @@ S3OptionsFilter({
                                 realm = groups[p]
                                 realm.extend(r)
 
+                    # Compact realms
+                    for group_id in realms:
+                        realm = realms[group_id]
+                        if realm is not None:
+                            realms[group_id] = S3Realm(realm, version)
+                    self.user["realm_version"] = version
+
                 self.user["realms"] = realms
                 self.user["delegations"] = delegations
 
@@ -2949,6 +2959,7 @@ S3OptionsFilter({
             ptable = self.permission.table
             pquery = (ptable.group_id == role.id)
             db(pquery).update(deleted=True)
+            self.permission.clear_acl_cache()
             # Remove the role
             db(gquery).update(role=None, deleted=True)
 
@@ -3021,6 +3032,9 @@ S3OptionsFilter({
                     membership["pe_id"] = for_pe
                 membership_id = mtable.insert(**membership)
 
+        # Invalidate cached ACLs
+        self.permission.clear_acl_cache()
+
         # Update roles for current user if required
         if self.user and str(user_id) == str(self.user.id):
             self.s3_set_roles()
@@ -3095,6 +3109,9 @@ S3OptionsFilter({
                             user_id=None,
                             group_id=None)
 
+        # Invalidate cached ACLs
+        self.permission.clear_acl_cache()
+
         # Update roles for current user if required
         if self.user and str(user_id) == str(self.user.id):
             self.s3_set_roles()
@@ -3952,6 +3969,75 @@ S3OptionsFilter({
         else:
             return None
 
+    # -------------------------------------------------------------------------
+    def s3_update_record_owners(self, table, record_ids, update=False, **fields):
+        """
+            Update ownership fields in multiple records to the same values
+            with one query (grouped variant of s3_update_record_owner)
+
+            @param table: the table
+            @param record_ids: the record IDs
+            @param update: True to update realm_entity in all realm-components
+            @param fields: dict of {ownership_field:value}
+        """
+
+        OUSR = "owned_by_user"
+        OGRP = "owned_by_group"
+        REALM = "realm_entity"
+
+        ownership_fields = (OUSR, OGRP, REALM)
+
+        data = Storage()
+        for key in fields:
+            if key in ownership_fields:
+                data[key] = fields[key]
+        if not data or not record_ids:
+            return
+
+        s3db = current.s3db
+        db = current.db
+
+        # Update records
+        q = (table._id.belongs(record_ids))
+        success = db(q).update(**data)
+
+        # Update realm-components
+        if success and update and REALM in data:
+            rc = s3db.get_config(table, "realm_components", [])
+            resource = s3db.resource(table, components=rc)
+            realm = {REALM:data[REALM]}
+            for component in resource.components.values():
+                ctable = component.table
+                if REALM not in ctable.fields:
+                    continue
+                query = component.get_join() & q
+                rows = db(query).select(ctable._id)
+                ids = list(set([row[ctable._id] for row in rows]))
+                if ids:
+                    db(ctable._id.belongs(ids)).update(**realm)
+
+        # Update super-entities
+        super_entities = s3db.get_config(table, "super_entity")
+        if not super_entities:
+            return
+        if not isinstance(super_entities, (list, tuple)):
+            super_entities = [super_entities]
+        super_key = s3db.super_key
+        for se in super_entities:
+            supertable = s3db.table(se)
+            if not supertable:
+                continue
+            updates = dict((f, data[f]) for f in data
+                           if f in supertable.fields)
+            skey = super_key(supertable)
+            if not updates or skey not in table.fields:
+                continue
+            rows = db(q).select(table[skey])
+            keys = [row[skey] for row in rows if row[skey]]
+            if keys:
+                db(supertable[skey].belongs(keys)).update(**updates)
+        return
+
     # -------------------------------------------------------------------------
     def s3_set_record_owner(self,
                             table,
@@ -3986,6 +4072,39 @@ S3OptionsFilter({
                    no separate call to set_realm_entity required.
         """
 
+        if not hasattr(table, "_tablename"):
+            table = current.s3db.table(table)
+        row, data = self.s3_get_record_owner(table, record,
+                                             force_update=force_update,
+                                             **fields)
+        if row is not None:
+            self.s3_update_record_owner(table, row,
+                                        update=force_update, **data)
+        return
+
+    # -------------------------------------------------------------------------
+    def s3_get_record_owner(self,
+                            table,
+                            record,
+                            force_update=False,
+                            **fields):
+        """
+            Auto-detect the values of owned_by_user, owned_by_group and
+            realm_entity for a record, without updating it (helper method
+            for s3_set_record_owner)
+
+            @param table: the Table (or table name)
+            @param record: the record (or record ID)
+            @param force_update: True to detect all fields regardless of
+                                 the current value in the record, False
+                                 to only detect if current value is None
+            @param fields: override auto-detected values, see
+                           s3_set_record_owner
+
+            @return: tuple (row, data), with row being None if the record
+                     or the table has no ownership fields
+        """
+
         s3db = current.s3db
 
         # Ownership fields
@@ -4010,13 +4129,13 @@ S3OptionsFilter({
             tablename = table
             table = s3db.table(tablename)
         if not table:
-            return
+            return None, None
 
         # Get the record ID
         pkey = table._id.name
         if isinstance(record, (Row, dict)):
             if pkey not in record:
-                return
+                return None, None
             else:
                 record_id = record[pkey]
         else:
@@ -4026,7 +4145,7 @@ S3OptionsFilter({
         # Find the available fields
         fields_in_table = [f for f in ownership_fields if f in table.fields]
         if not fields_in_table:
-            return
+            return None, None
         fields_in_table += [f for f in entity_fields if f in table.fields]
 
         # Get all available fields for the record
@@ -4039,7 +4158,7 @@ S3OptionsFilter({
         else:
             row = record
         if not row:
-            return
+            return None, None
 
         # Prepare the udpate
         data = Storage()
@@ -4100,8 +4219,7 @@ S3OptionsFilter({
                                                      entity=entity)
                 data[REALM] = realm_entity
 
-        self.s3_update_record_owner(table, row, update=force_update, **data)
-        return
+        return row, data
 
     # -------------------------------------------------------------------------
     def set_realm_entity(self, table, records, entity=0, force_update=False):
@@ -4511,6 +4629,13 @@ class S3Permission(object):
         "reject": APPROVE,
     })
 
+    # Process-wide cache for ACL lookups, flushed whenever the
+    # version stamp of the permissions table changes
+    ACL_CACHE = {}
+    ACL_CACHE_LOCK = threading.Lock()
+    ACL_CACHE_SIZE = 10000
+    ACL_CACHE_VERSION = None
+
     # Lambda expressions for ACL handling
     required_acl = lambda self, methods: \
                           reduce(lambda a, b: a | b,
@@ -4601,6 +4726,9 @@ class S3Permission(object):
         self.page_acls = Storage()
         self.table_acls = Storage()
 
+        # Version stamp of the ACLs (looked up once per request)
+        self._acl_version = None
+
         # Pages which never require permission:
         # Make sure that any data access via these pages uses
         # accessible_query explicitly!
@@ -4688,6 +4816,7 @@ class S3Permission(object):
             del s3["permissions"]
         if "restricted_tables" in s3:
             del s3["restricted_tables"]
+        self.clear_acl_cache()
 
         if c is None and f is None and t is None:
             return None
@@ -4987,9 +5116,11 @@ class S3Permission(object):
                     if realm is None or not use_realm:
                         any_entity.append(group_id)
                         continue
-                    realm = [e for e in realm if e not in no_realm]
+                    if no_realm:
+                        realm = [e for e in realm if e not in no_realm]
                     if realm:
-                        q = (table[OGRP] == group_id) & (table[OENT].belongs(realm))
+                        q = (table[OGRP] == group_id) & \
+                            self.entity_query(table[OENT], realm)
                         if g is None:
                             g = q
                         else:
@@ -5028,11 +5159,65 @@ class S3Permission(object):
             return None
         elif OENT in table.fields:
             public = (table[OENT] == None)
+            return self.entity_query(table[OENT], entities) | public
+        return None
+
+    # -------------------------------------------------------------------------
+    def entity_query(self, field, entities):
+        """
+            Returns a query to select the records where field (e.g. the
+            realm entity) is one of the entities. Complete subtrees of the
+            user's realms (see S3Realm) are selected with a subquery against
+            the OU closure rather than by listing all their entities.
+
+            @param field: the Field
+            @param entities: list of entities (pe_ids)
+            @return: a web2py Query instance
+        """
+
+        roots = set()
+        version = None
+        user = self.auth.user
+        if isinstance(entities, S3Realm):
+            roots.update(entities.roots)
+            version = entities.version
+        elif self.entity_hierarchy and user and user.realms:
+            for realm in user.realms.values():
+                if isinstance(realm, S3Realm):
+                    roots.update(realm.roots)
+            version = user.get("realm_version")
+
+        tops = []
+        if roots and len(entities) > 1:
+            # Find the roots with all their descendants in entities
+            index = set(entities)
+            subtrees = S3Realm.subtrees(roots, version)
+            covered = set()
+            for root in sorted(roots):
+                if root in covered or root not in index:
+                    continue
+                subtree = subtrees[root]
+                if subtree and index.issuperset(subtree):
+                    tops.append(root)
+                    covered.add(root)
+                    covered.update(subtree)
+            if tops:
+                entities = [e for e in entities if e not in covered]
+
+        query = None
+        if tops:
+            ctable = current.s3db.pr_ou_closure
+            subquery = current.db((ctable.ancestor.belongs(tops)) &
+                                  (ctable.instance_type != "pr_person")) \
+                                  ._select(ctable.descendant)
+            query = (field.belongs(tops)) | (field.belongs(subquery))
+        if entities:
             if len(entities) == 1:
-                return (table[OENT] == entities[0]) | public
+                q = (field == entities[0])
             else:
-                return (table[OENT].belongs(entities)) | public
-        return None
+                q = (field.belongs(list(entities)))
+            query = q if query is None else query | q
+        return query
 
     # -------------------------------------------------------------------------
     def permitted_realms(self, tablename, method="read"):
@@ -5725,15 +5910,20 @@ class S3Permission(object):
         # Retrieve the ACLs
         if q:
             query &= q
-            rows = db(query).select(table.group_id,
-                                    table.controller,
-                                    table.function,
-                                    table.tablename,
-                                    table.unrestricted,
-                                    table.entity,
-                                    table.uacl,
-                                    table.oacl,
-                                    cacheable=True)
+            lookup = lambda: tuple(db(query).select(table.group_id,
+                                                    table.controller,
+                                                    table.function,
+                                                    table.tablename,
+                                                    table.unrestricted,
+                                                    table.entity,
+                                                    table.uacl,
+                                                    table.oacl,
+                                                    cacheable=True))
+            key = ("acls",
+                   tuple(sorted(roles)),
+                   page_restricted,
+                   c, f, str(t) if t is not None else None)
+            rows = self.cached(key, lookup)
         else:
             rows = []
 
@@ -5961,12 +6151,84 @@ class S3Permission(object):
             query = (table.deleted != True) & \
                     (table.controller == None) & \
                     (table.function == None)
-            rows = current.db(query).select(table.tablename,
-                                            groupby=table.tablename)
-            s3.restricted_tables = [row.tablename for row in rows]
+            def lookup():
+                rows = current.db(query).select(table.tablename,
+                                                groupby=table.tablename)
+                return set(row.tablename for row in rows)
+            s3.restricted_tables = self.cached("restricted_tables", lookup)
 
         return str(t) in s3.restricted_tables
 
+    # -------------------------------------------------------------------------
+    def acl_version(self):
+        """
+            Get the version stamp of the ACLs, looked up once per request
+            (cheap aggregate query). Any write to the permissions table
+            changes the stamp, and thus invalidates the ACL cache in all
+            processes.
+
+            @return: tuple (number of ACL records, latest modification)
+        """
+
+        version = self._acl_version
+        if version is None:
+            table = self.table
+            if not table:
+                return None
+            count = table.id.count()
+            latest = table.modified_on.max()
+            row = current.db(table.id > 0).select(count, latest).first()
+            if row:
+                version = (row[count], row[latest])
+            self._acl_version = version
+        return version
+
+    # -------------------------------------------------------------------------
+    def cached(self, key, lookup):
+        """
+            Look up a value from the process-wide ACL cache
+
+            @param key: the cache key
+            @param lookup: function to retrieve the value if it is not
+                           in the cache (or the cache is outdated)
+        """
+
+        version = self.acl_version()
+        if version is None:
+            return lookup()
+
+        cls = S3Permission
+        cache = cls.ACL_CACHE
+        with cls.ACL_CACHE_LOCK:
+            if cls.ACL_CACHE_VERSION != version:
+                cache.clear()
+                cls.ACL_CACHE_VERSION = version
+            elif key in cache:
+                return cache[key]
+
+        value = lookup()
+
+        with cls.ACL_CACHE_LOCK:
+            if cls.ACL_CACHE_VERSION == version:
+                if len(cache) >= cls.ACL_CACHE_SIZE:
+                    cache.clear()
+                cache[key] = value
+        return value
+
+    # -------------------------------------------------------------------------
+    def clear_acl_cache(self):
+        """
+            Clear the process-wide ACL cache and reset the version stamp,
+            to be called after updating ACLs or role assignments
+        """
+
+        cls = S3Permission
+        with cls.ACL_CACHE_LOCK:
+            cls.ACL_CACHE.clear()
+            cls.ACL_CACHE_VERSION = None
+        self._acl_version = None
+        return
+
     # -------------------------------------------------------------------------
     def hidden_modules(self):
         """ List of modules to hide from the main menu """
@@ -6113,9 +6375,170 @@ class S3Permission(object):
                     del permissions[key]
         return
 
+# =============================================================================
+class S3Realm(object):
+    """
+        The realm of a role with entity hierarchy (policies 7 and 8): the
+        realm entities ("roots") of the role memberships, expanded to all
+        their OU descendants only when needed (e.g. to check whether an
+        entity belongs to the realm). Realms are stored in the session as
+        plain lists of their roots, and queried against the OU closure
+        (see S3Permission.entity_query) rather than by listing all entities.
+    """
+
+    # Process-wide cache of the OU descendants of realm entities,
+    # {(root, hierarchy version): [descendants]}
+    DESCENDANTS = {}
+    DESCENDANTS_LOCK = threading.Lock()
+    DESCENDANTS_SIZE = 10000
+
+    def __init__(self, roots, version=None):
+        """
+            Constructor
+
+            @param roots: the realm entities (list of pe_ids)
+            @param version: the hierarchy version (see hierarchy_version)
+        """
+
+        self.roots = list(roots)
+        self.version = version
+
+        self._entities = None
+        self._index = None
+
+    # -------------------------------------------------------------------------
+    def __reduce__(self):
+        """ Pickle as plain list of the roots (keeps the session compact) """
+
+        return (list, (self.roots,))
+
+    # -------------------------------------------------------------------------
+    @property
+    def entities(self):
+        """ All entities in this realm (roots first, then descendants) """
+
+        if self._entities is None:
+            roots = self.roots
+            subtrees = self.subtrees(roots, self.version)
+            entities = list(roots)
+            index = set(entities)
+            append = entities.append
+            for root in roots:
+                for entity in subtrees[root]:
+                    if entity not in index:
+                        index.add(entity)
+                        append(entity)
+            self._entities = entities
+            self._index = index
+        return self._entities
+
+    # -------------------------------------------------------------------------
+    def __contains__(self, entity):
+
+        if self._index is None:
+            self.entities
+        return entity in self._index
+
+    def __iter__(self):
+        return iter(self.entities)
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __getitem__(self, index):
+        return self.entities[index]
+
+    def __eq__(self, other):
+        if isinstance(other, S3Realm):
+            other = other.entities
+        return self.entities == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __nonzero__(self):
+        return len(self.roots) > 0
+
+    def __repr__(self):
+        return "<S3Realm %s>" % self.roots
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def hierarchy_version():
+        """
+            Get a version stamp for the current state of the OU hierarchy,
+            to tell the descendants of realm entities looked up for earlier
+            states apart
+        """
+
+        ctable = current.s3db.pr_ou_closure
+        count = ctable.id.count()
+        maxid = ctable.id.max()
+        row = current.db(ctable.id > 0).select(count, maxid).first()
+        if row:
+            return (row[count], row[maxid])
+        return (0, None)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def subtrees(cls, roots, version=None):
+        """
+            Get the OU descendants of realm entities, with one closure
+            lookup for all entities which are not cached yet
+
+            @param roots: the realm entities (list of pe_ids)
+            @param version: the hierarchy version
+
+            @return: dict {root: [descendants]}
+        """
+
+        # Writes to the closure in this process supersede the version
+        version = (version, current.s3db.table_version("pr_ou_closure"))
+
+        cache = cls.DESCENDANTS
+        subtrees = {}
+        missing = []
+        for root in roots:
+            key = (root, version)
+            if key in cache:
+                subtrees[root] = cache[key]
+            else:
+                missing.append(root)
+
+        if missing:
+            descendants = current.s3db.pr_descendants(missing)
+            with cls.DESCENDANTS_LOCK:
+                if len(cache) + len(missing) > cls.DESCENDANTS_SIZE:
+                    cache.clear()
+                for root in missing:
+                    subtree = descendants.get(root, [])
+                    cache[(root, version)] = subtrees[root] = subtree
+        return subtrees
+
 # =============================================================================
 class S3Audit(object):
-    """ S3 Audit Trail Writer Class """
+    """
+        S3 Audit Trail Writer Class
+
+        Audit entries can be buffered per request (security.audit_buffer)
+        and written in bulk when the request commits, and optionally be
+        appended to an SQLite spool file (security.audit_spool) instead of
+        the database, from where they are transferred into the audit table
+        by the s3_audit_flush task. Entries are only ever spooled when the
+        request commits, so that they are not retained for transactions
+        which are rolled back.
+    """
+
+    # Process-wide statistics
+    STATS = {"buffered": 0,   # number of buffered entries
+             "written": 0,    # number of entries written into the table
+             "batches": 0,    # number of bulk inserts
+             "spooled": 0,    # number of entries appended to the spool
+             "overflow": 0,   # number of entries written directly due
+                              # to a full spool (back-pressure)
+             "max_batch": 0,  # largest batch written/spooled
+             }
+    STATS_LOCK = threading.Lock()
 
     def __init__(self,
                  tablename="s3_audit",
@@ -6163,6 +6586,20 @@ class S3Audit(object):
         else:
             self.user_id = None
 
+        # Buffer and spool
+        self.buffer = []
+        self.buffer_size = settings.get_security_audit_buffer()
+        self.spool = self.spool_path()
+
+        # Write the buffered entries when the request commits
+        self.custom_commit = None
+        self.hooked = False
+        response = current.response
+        if (self.buffer_size or self.spool) and response is not None:
+            self.custom_commit = response.custom_commit
+            response.custom_commit = self.commit
+            self.hooked = True
+
     # -------------------------------------------------------------------------
     def __call__(self, method, prefix, name,
                  form=None,
@@ -6227,9 +6664,10 @@ class S3Audit(object):
             audit_write = audit_write(method, tablename, form, record,
                                       representation)
 
+        entry = None
         if method in ("list", "read"):
             if audit_read:
-                table.insert(timestmp = now,
+                entry = dict(timestmp = now,
                              user_id = self.user_id,
                              method = method,
                              tablename = tablename,
@@ -6247,7 +6685,7 @@ class S3Audit(object):
                                  for var in vars if vars[var]]
                 else:
                     new_value = []
-                table.insert(timestmp = now,
+                entry = dict(timestmp = now,
                              user_id = self.user_id,
                              method = method,
                              tablename = tablename,
@@ -6273,7 +6711,7 @@ class S3Audit(object):
                 else:
                     new_value = []
                     old_value = []
-                table.insert(timestmp = now,
+                entry = dict(timestmp = now,
                              user_id = self.user_id,
                              method = method,
                              tablename = tablename,
@@ -6292,7 +6730,7 @@ class S3Audit(object):
                 if row:
                     old_value = ["%s:%s" % (field, row[field])
                                  for field in row]
-                table.insert(timestmp = now,
+                entry = dict(timestmp = now,
                              user_id = self.user_id,
                              method = method,
                              tablename = tablename,
@@ -6301,8 +6739,266 @@ class S3Audit(object):
                              old_value = old_value,
                              )
 
+        if entry is not None:
+            self.write(entry)
+
         return True
 
+    # -------------------------------------------------------------------------
+    def write(self, entry):
+        """
+            Write an audit entry, or buffer it until the request commits
+
+            @param entry: the audit entry (dict)
+        """
+
+        if not self.hooked:
+            self.flush([entry])
+            return
+
+        buffer = self.buffer
+        buffer.append(entry)
+        self.count("buffered")
+        buffer_size = self.buffer_size
+        if buffer_size and len(buffer) >= buffer_size:
+            # Buffer full => write into the table now, within the
+            # transaction (the spool is only written at commit)
+            self.flush()
+
+    # -------------------------------------------------------------------------
+    def commit(self, adapter):
+        """
+            Custom commit for the request (response.custom_commit): writes
+            all buffered entries, then commits the transaction
+
+            @param adapter: the DB adapter
+        """
+
+        self.flush(spool=True)
+        custom_commit = self.custom_commit
+        if custom_commit:
+            custom_commit(adapter)
+        else:
+            adapter.commit()
+
+    # -------------------------------------------------------------------------
+    def flush(self, entries=None, spool=False):
+        """
+            Write audit entries into the audit table, or into the spool
+
+            @param entries: list of entries (dicts), defaults to the
+                            buffered entries
+            @param spool: append the entries to the spool if configured
+                          (only when the request commits)
+        """
+
+        if entries is None:
+            entries = self.buffer
+            self.buffer = []
+        if not entries:
+            return
+
+        if spool and self.spool and self.spool_entries(self.spool, entries):
+            return
+
+        self.insert(self.table, entries)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def insert(cls, table, entries, chunk_size=500):
+        """
+            Insert audit entries into the audit table, with one multi-row
+            INSERT per chunk of entries
+
+            @param table: the audit table
+            @param entries: the entries (list of dicts)
+            @param chunk_size: the maximum number of rows per INSERT
+        """
+
+        if len(entries) == 1:
+            table.insert(**entries[0])
+        else:
+            fields = [f for f in table.fields if f != "id"]
+            executesql = current.db.executesql
+            for i in xrange(0, len(entries), chunk_size):
+                head = None
+                values = []
+                for entry in entries[i:i + chunk_size]:
+                    row = dict((f, entry.get(f)) for f in fields)
+                    head, tail = table._insert(**row).split(" VALUES ", 1)
+                    values.append(tail.rstrip().rstrip(";"))
+                executesql("%s VALUES %s;" % (head, ",".join(values)))
+        cls.count("written", len(entries))
+        cls.count("batches")
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def count(cls, key, value=1):
+        """
+            Update the statistics
+
+            @param key: the statistics key
+            @param value: the number to add
+        """
+
+        stats = cls.STATS
+        with cls.STATS_LOCK:
+            stats[key] += value
+            if value > stats["max_batch"] and key in ("written", "spooled"):
+                stats["max_batch"] = value
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def stats(cls):
+        """
+            Get the audit statistics of this process
+
+            @return: dict with the statistics
+        """
+
+        with cls.STATS_LOCK:
+            return dict(cls.STATS)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def spool_path():
+        """
+            Get the path of the audit spool file
+
+            @return: the absolute path, or None if no spool is configured
+        """
+
+        spool = current.deployment_settings.get_security_audit_spool()
+        if not spool:
+            return None
+        if not os.path.isabs(spool):
+            spool = os.path.join(current.request.folder, spool)
+        return spool
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def spool_connect(path):
+        """
+            Connect to the audit spool, creating it as necessary
+
+            @param path: the path of the spool file
+        """
+
+        import sqlite3
+        spool = sqlite3.connect(path, timeout=30)
+        spool.execute("CREATE TABLE IF NOT EXISTS s3_audit_spool "
+                      "(id INTEGER PRIMARY KEY AUTOINCREMENT, entry TEXT)")
+        return spool
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def spool_entries(cls, path, entries):
+        """
+            Append audit entries to the spool
+
+            @param path: the path of the spool file
+            @param entries: the entries (list of dicts)
+
+            @return: True if the entries have been spooled, False if the
+                     spool is full (back-pressure) or not accessible
+        """
+
+        limit = current.deployment_settings.get_security_audit_spool_size()
+        try:
+            spool = cls.spool_connect(path)
+        except Exception, e:
+            s3_debug("S3Audit: cannot open spool %s" % path, e)
+            return False
+        try:
+            with spool:
+                if limit:
+                    # Entries are removed from the start, so the ID range
+                    # is the spool size (without counting all rows)
+                    first, last = spool.execute("SELECT MIN(id), MAX(id) "
+                                                "FROM s3_audit_spool") \
+                                       .fetchone()
+                    size = last - first + 1 if first is not None else 0
+                    if size + len(entries) > limit:
+                        cls.count("overflow", len(entries))
+                        return False
+                dumps = json.dumps
+                spool.executemany("INSERT INTO s3_audit_spool (entry) VALUES (?)",
+                                  [(dumps(entry, default=cls.encode),)
+                                   for entry in entries])
+        finally:
+            spool.close()
+        cls.count("spooled", len(entries))
+        return True
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def flush_spool(cls, limit=1000):
+        """
+            Transfer the spooled audit entries into the audit table,
+            in batches - to be run as scheduled task (s3_audit_flush)
+
+            @param limit: the maximum number of entries per batch
+
+            @return: the number of transferred entries
+        """
+
+        table = current.audit.table
+        path = cls.spool_path()
+        if not table or not path or not os.path.exists(path):
+            return 0
+
+        db = current.db
+        spool = cls.spool_connect(path)
+        total = 0
+        try:
+            while True:
+                rows = spool.execute("SELECT id, entry FROM s3_audit_spool "
+                                     "ORDER BY id LIMIT ?", (limit,)).fetchall()
+                if not rows:
+                    break
+                entries = [cls.decode(json.loads(row[1])) for row in rows]
+                cls.insert(table, entries)
+                db.commit()
+                # Remove the entries only once they are committed
+                with spool:
+                    spool.execute("DELETE FROM s3_audit_spool WHERE id <= ?",
+                                  (rows[-1][0],))
+                total += len(entries)
+        finally:
+            spool.close()
+        return total
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def encode(value):
+        """ JSON encoder for the timestamp of spooled entries """
+
+        if isinstance(value, datetime.datetime):
+            return value.strftime("%Y-%m-%d %H:%M:%S")
+        return str(value)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def decode(entry):
+        """
+            Restore a spooled entry
+
+            @param entry: the entry as loaded from JSON
+        """
+
+        output = {}
+        for key, value in entry.items():
+            key = str(key)
+            if key == "timestmp" and value:
+                value = datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+            elif isinstance(value, list):
+                value = [v.encode("utf-8") if isinstance(v, unicode) else v
+                         for v in value]
+            elif isinstance(value, unicode):
+                value = value.encode("utf-8")
+            output[key] = value
+        return output
+
     # -------------------------------------------------------------------------
     def represent(self, records):
         """
@@ -7928,13 +8624,16 @@ class S3EntityRoleManager(S3Method):
 
         # Get the realm from the current realms
         if ADMIN in realms:
-            return realms[ADMIN]
+            realm = realms[ADMIN]
         elif ORG_ADMIN in realms:
-            return realms[ORG_ADMIN]
+            realm = realms[ORG_ADMIN]
         else:
             # raise an error here - user is not permitted
             # to access the role matrix
             auth.permission.fail()
+        if isinstance(realm, S3Realm):
+            realm = realm.entities
+        return realm
 
     # -------------------------------------------------------------------------
     def get_modules(self):
@@ -69,6 +69,7 @@ class S3Codec(object):
     def get_codec(format):
 
         # Import the codec classes
+        from codecs import S3GeoJSON
         from codecs import S3SHP
         from codecs import S3SVG
         from codecs import S3XLS
@@ -76,6 +77,7 @@ class S3Codec(object):
 
         # Register the codec classes
         CODECS = Storage(
+            geojson = S3GeoJSON,
             pdf = S3RL_PDF,
             shp = S3SHP,
             svg = S3SVG,
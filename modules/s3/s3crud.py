@@ -1281,13 +1281,16 @@ class S3CRUD(S3Method):
 
             # Get a data table
             if totalrows != 0:
+                settings = current.deployment_settings
+                count_cache = settings.get_ui_datatables_count_cache()
                 dt, displayrows, ids = resource.datatable(fields=list_fields,
                                                           start=start,
                                                           limit=limit,
                                                           left=left,
                                                           orderby=orderby,
                                                           distinct=distinct,
-                                                          getids=False)
+                                                          getids=False,
+                                                          count_cache=count_cache)
             else:
                 dt, displayrows = None, 0
             if totalrows is None:
@@ -32,6 +32,7 @@
 """
 
 import datetime
+import re
 import sys
 import time
 
@@ -1156,12 +1157,26 @@ class S3PivotTable(object):
                #"std": "Standard Deviation"
                }
 
-    def __init__(self, resource, rows, cols, layers, strict=True):
+    #: Aggregation methods which can be computed by the database
+    DB_METHODS = ("count", "min", "max", "sum", "avg")
+
+    def __init__(self,
+                 resource,
+                 rows,
+                 cols,
+                 layers,
+                 strict=True,
+                 aggregate=None):
         """
             Constructor - extracts all unique records, generates a
             pivot table from them with the given dimensions and
             computes the aggregated values for each cell.
 
+            If all dimensions and facts are single-valued database
+            fields, and all methods are supported by the database,
+            the aggregates can alternatively be computed with grouped
+            queries (aggregate=True) rather than extracting all records.
+
             @param resource: the S3Resource
             @param rows: field selector for the rows dimension
             @param cols: field selector for the columns dimension
@@ -1169,6 +1184,8 @@ class S3PivotTable(object):
                            for the value aggregation(s)
             @param strict: filter out dimension values which don't match
                            the resource filter
+            @param aggregate: compute the aggregates in the database,
+                              None to use the deployment setting
         """
 
         # Initialize ----------------------------------------------------------
@@ -1197,6 +1214,8 @@ class S3PivotTable(object):
 
         self.empty = False
         """ Empty-flag (True if no records could be found) """
+        self.numrecords = None
+        """ The number of records in the pivot table (database aggregation) """
         self.numrows = None
         """ The number of rows in the pivot table """
         self.numcols = None
@@ -1251,95 +1270,105 @@ class S3PivotTable(object):
             _start = datetime.datetime.now()
             _debug("S3PivotTable %s starting" % tablename)
 
-        # Retrieve the records ------------------------------------------------
+        # Aggregate in the database if possible -------------------------------
         #
-        data = resource.select(self.rfields.keys(), limit=None)
-        drows = data["rows"]
-        if drows:
+        if aggregate is None:
+            settings = current.deployment_settings
+            aggregate = settings.get_ui_report_db_aggregation()
+        if aggregate and self._db_supported():
+            self._db_pivot()
+            if not self.numrecords:
+                self.empty = True
+        else:
+            # Retrieve the records --------------------------------------------
+            #
+            data = resource.select(self.rfields.keys(), limit=None)
+            drows = data["rows"]
+            if drows:
 
-            key = str(resource.table._id)
-            records = Storage([(i[key], i) for i in drows])
+                key = str(resource.table._id)
+                records = Storage([(i[key], i) for i in drows])
                 
-            # Generate the data frame -----------------------------------------
-            #
-            gfields = self.gfields
-            pkey_colname = gfields[self.pkey]
-            rows_colname = gfields[rows]
-            cols_colname = gfields[cols]
-
-            if strict:
-                rfields = self.rfields
-                axes = (rfield
-                        for rfield in (rfields[rows], rfields[cols])
-                        if rfield != None)
-                axisfilter = resource.axisfilter(axes)
-            else:
-                axisfilter = None
+                # Generate the data frame -------------------------------------
+                #
+                gfields = self.gfields
+                pkey_colname = gfields[self.pkey]
+                rows_colname = gfields[rows]
+                cols_colname = gfields[cols]
+
+                if strict:
+                    rfields = self.rfields
+                    axes = (rfield
+                            for rfield in (rfields[rows], rfields[cols])
+                            if rfield != None)
+                    axisfilter = resource.axisfilter(axes)
+                else:
+                    axisfilter = None
                 
-            dataframe = []
-            insert = dataframe.append
-            expand = self._expand
-
-            for _id in records:
-                row = records[_id]
-                item = {key: _id}
-                if rows_colname:
-                    item[rows_colname] = row[rows_colname]
-                if cols_colname:
-                    item[cols_colname] = row[cols_colname]
-                dataframe.extend(expand(item, axisfilter=axisfilter))
+                dataframe = []
+                insert = dataframe.append
+                expand = self._expand
+
+                for _id in records:
+                    row = records[_id]
+                    item = {key: _id}
+                    if rows_colname:
+                        item[rows_colname] = row[rows_colname]
+                    if cols_colname:
+                        item[cols_colname] = row[cols_colname]
+                    dataframe.extend(expand(item, axisfilter=axisfilter))
                 
-            self.records = records
+                self.records = records
 
-            #if DEBUG:
-                #duration = datetime.datetime.now() - _start
-                #duration = '{:.2f}'.format(duration.total_seconds())
-                #_debug("Dataframe complete after %s seconds" % duration)
+                #if DEBUG:
+                    #duration = datetime.datetime.now() - _start
+                    #duration = '{:.2f}'.format(duration.total_seconds())
+                    #_debug("Dataframe complete after %s seconds" % duration)
                 
-            # Group the records -----------------------------------------------
-            #
-            matrix, rnames, cnames = self._pivot(dataframe,
-                                                 pkey_colname,
-                                                 rows_colname,
-                                                 cols_colname)
-
-            #if DEBUG:
-                #duration = datetime.datetime.now() - _start
-                #duration = '{:.2f}'.format(duration.total_seconds())
-                #_debug("Pivoting complete after %s seconds" % duration)
+                # Group the records -------------------------------------------
+                #
+                matrix, rnames, cnames = self._pivot(dataframe,
+                                                     pkey_colname,
+                                                     rows_colname,
+                                                     cols_colname)
+
+                #if DEBUG:
+                    #duration = datetime.datetime.now() - _start
+                    #duration = '{:.2f}'.format(duration.total_seconds())
+                    #_debug("Pivoting complete after %s seconds" % duration)
                 
-            # Initialize columns and rows -------------------------------------
-            #
-            if cols:
-                self.col = [Storage({"value": v}) for v in cnames]
-                self.numcols = len(self.col)
-            else:
-                self.col = [Storage({"value": None})]
-                self.numcols = 1
+                # Initialize columns and rows ---------------------------------
+                #
+                if cols:
+                    self.col = [Storage({"value": v}) for v in cnames]
+                    self.numcols = len(self.col)
+                else:
+                    self.col = [Storage({"value": None})]
+                    self.numcols = 1
 
-            if rows:
-                self.row = [Storage({"value": v}) for v in rnames]
-                self.numrows = len(self.row)
-            else:
-                self.row = [Storage({"value": None})]
-                self.numrows = 1
+                if rows:
+                    self.row = [Storage({"value": v}) for v in rnames]
+                    self.numrows = len(self.row)
+                else:
+                    self.row = [Storage({"value": None})]
+                    self.numrows = 1
 
-            # Add the layers --------------------------------------------------
-            #
-            add_layer = self._add_layer
-            layers = list(self.layers)
-            for f, m in self.layers:
-                add_layer(matrix, f, m)
+                # Add the layers ----------------------------------------------
+                #
+                add_layer = self._add_layer
+                layers = list(self.layers)
+                for f, m in self.layers:
+                    add_layer(matrix, f, m)
 
-            #if DEBUG:
-                #duration = datetime.datetime.now() - _start
-                #duration = '{:.2f}'.format(duration.total_seconds())
-                #_debug("Layers complete after %s seconds" % duration)
+                #if DEBUG:
+                    #duration = datetime.datetime.now() - _start
+                    #duration = '{:.2f}'.format(duration.total_seconds())
+                    #_debug("Layers complete after %s seconds" % duration)
 
-        else:
-            # No items to report on -------------------------------------------
-            #
-            self.empty = True
+            else:
+                # No items to report on ---------------------------------------
+                #
+                self.empty = True
 
         if DEBUG:
             duration = datetime.datetime.now() - _start
@@ -1354,7 +1383,7 @@ class S3PivotTable(object):
 
         items = self.records
         if items is None:
-            return 0
+            return self.numrecords or 0
         else:
             return len(self.records)
 
@@ -1561,15 +1590,8 @@ class S3PivotTable(object):
 
                         rfield = rfields[f]
                         field = rfield.field
-                        colname = rfield.colname
                         has_fk = field is not None and s3_has_foreign_key(field)
-                        for id in cell.records:
-
-                            record = self.records[id]
-                            try:
-                                fvalue = record[colname]
-                            except AttributeError:
-                                fvalue = None
+                        for fvalue in self._cell_values(cell, rfield):
 
                             if fvalue is not None:
                                 if has_fk:
@@ -1798,6 +1820,8 @@ class S3PivotTable(object):
             cothers = ctail[0] or []
 
             # Group and sort the cells
+            rfield = rfields[field]
+            cell_values = self._cell_values
             icell = self.cell
             cells = {}
             for i in xrange(self.numrows):
@@ -1809,6 +1833,10 @@ class S3PivotTable(object):
                     cidx = (j, OTHER) if cothers and j in cothers else (j,)
 
                     cell_records = cell["records"]
+                    if method == "count":
+                        fvalues = cell_values(cell, rfield)
+                    else:
+                        fvalues = []
                     items = cell[layer]
                     value = items if is_numeric \
                                   else len(cell_records)
@@ -1827,12 +1855,12 @@ class S3PivotTable(object):
                                 else:
                                     ocell["value"] = value
                                     ocell["items"] = items
-                                ocell["records"] = cell_records
+                                ocell["fvalues"] = list(fvalues)
                             else:
                                 ocell = orow[ci]
                                 ocell["value"].append(value)
                                 ocell["items"].append(items)
-                                ocell["records"].extend(cell_records)
+                                ocell["fvalues"].extend(fvalues)
 
             # Aggregate the grouped values
             ctotals = True
@@ -1840,7 +1868,6 @@ class S3PivotTable(object):
             rappend = orows.append
             cappend = ocols.append
             
-            rfield = rfields[field]
             f = rfield.field
             has_fk = f is not None and s3_has_foreign_key(f)
             if has_fk:
@@ -1867,7 +1894,6 @@ class S3PivotTable(object):
                     cell = cells[rindex][cindex]
                     items = cell["items"]
                     value = cell["value"]
-                    cell_records = cell["records"]
                     if type(value) is list:
                         value = self._aggregate(value, hmethod)
                     if method == "list":
@@ -1880,12 +1906,7 @@ class S3PivotTable(object):
                     # Build a lookup table for field values if counting
                     if method == "count":
                         keys = []
-                        for record_id in cell_records:
-                            record = self.records[record_id]
-                            try:
-                                fvalue = record[rfield.colname]
-                            except AttributeError:
-                                continue
+                        for fvalue in cell["fvalues"]:
                             if fvalue is None:
                                 continue
                             if type(fvalue) is not list:
@@ -2161,6 +2182,257 @@ class S3PivotTable(object):
 
     # -------------------------------------------------------------------------
     # Internal methods
+    # -------------------------------------------------------------------------
+    def _db_supported(self):
+        """
+            Check whether the pivot table can be computed with grouped
+            database queries, i.e. all dimensions and facts are real
+            and single-valued fields (no virtual fields, no list:types,
+            no multiple components), all methods are supported by the
+            database (sum/avg/min/max for numeric fields only) and
+            there is no virtual filter
+
+            @return: True|False
+        """
+
+        resource = self.resource
+        if resource.get_filter() is not None:
+            return False
+
+        NUMERIC = ("integer", "double")
+
+        rfields = self.rfields
+        selectors = [s for s in (self.rows, self.cols) if s]
+        for f, m in self.layers:
+            if m not in self.DB_METHODS:
+                return False
+            if m in ("sum", "avg", "min", "max"):
+                # Totals of non-numeric layers are computed from the
+                # records, which are not extracted in DB mode
+                rfield = rfields.get(f)
+                if rfield is None:
+                    return False
+                ftype = rfield.ftype
+                if ftype not in NUMERIC and ftype[:7] != "decimal":
+                    return False
+            selectors.append(f)
+
+        alias = resource.alias
+        for selector in selectors:
+            rfield = rfields.get(selector)
+            if rfield is None or rfield.field is None or rfield.virtual:
+                return False
+            if rfield.ftype[:5] == "list:":
+                return False
+            # Only the master table and foreign keys (no components
+            # or context expressions, which could multiply the rows)
+            tokens = re.split("(\.|\$)", rfield.selector)
+            if "(" in rfield.selector:
+                return False
+            for i in xrange(1, len(tokens), 2):
+                if tokens[i] == "." and tokens[i-1] not in ("~", alias):
+                    return False
+        return True
+
+    # -------------------------------------------------------------------------
+    def _db_pivot(self):
+        """
+            Compute the pivot table with grouped database queries (one
+            query per cells/rows/columns/totals), so that the effort
+            scales with the number of cells rather than with the number
+            of records; sets the same instance variables as the pivot
+            from extracted records except that the "records" lists
+            remain empty (cells of "count" layers keep the distinct
+            fact values for drill-down instead, except for the
+            primary key)
+        """
+
+        from s3resource import S3LeftJoins
+
+        db = current.db
+        resource = self.resource
+        table = resource.table
+        pkey = table._id
+        rfields = self.rfields
+        layers = self.layers
+        aggregate = self._aggregate
+
+        # The base query
+        query = resource.get_query()
+        filter_joins = resource.rfilter.get_left_joins()
+        if filter_joins:
+            # Left joins for the filter could produce multiple rows per
+            # record => sub-select the record IDs
+            query = pkey.belongs(db(query)._select(pkey,
+                                                   left=filter_joins,
+                                                   distinct=True))
+
+        # Dimensions
+        rfield = rfields[self.rows] if self.rows else None
+        cfield = rfields[self.cols] if self.cols else None
+        dimensions = [d for d in (rfield, cfield) if d is not None]
+
+        # Aggregate expressions per layer
+        expressions = {}
+        facts = []
+        for layer in layers:
+            f, m = layer
+            field = rfields[f].field
+            if m == "count":
+                expression = field.count(distinct=True)
+                if str(field) != str(pkey):
+                    facts.append(rfields[f])
+            else:
+                expression = getattr(field, m)()
+            expressions[layer] = expression
+        numrecords = pkey.count()
+
+        # Left joins for dimensions and facts
+        left_joins = S3LeftJoins(resource.tablename)
+        for d in dimensions + [rfields[f] for f, m in layers]:
+            if d.left:
+                for tn in d.left:
+                    left_joins.add(d.left[tn])
+        left = left_joins.as_list(aqueries={})
+
+        def select(dims):
+            """ Grouped select, returns a dict {key: Storage} """
+
+            fields = [d.field for d in dims]
+            groupby = reduce(lambda x, y: x|y, fields) if fields else None
+            rows = db(query).select(numrecords,
+                                    left=left,
+                                    groupby=groupby,
+                                    *(fields + expressions.values()))
+            results = {}
+            for row in rows:
+                key = tuple(row[d.colname] for d in dims)
+                result = results[key] = Storage(records=[],
+                                                numrecords=row[numrecords])
+                for layer, expression in expressions.items():
+                    value = row[expression]
+                    method = layer[1]
+                    if value is None:
+                        value = aggregate([], method)
+                    elif method == "avg":
+                        value = float(value)
+                    result[layer] = value
+            return results
+
+        # Grand totals
+        totals = select([]).get(())
+        if not totals or not totals.numrecords:
+            self.numrecords = 0
+            return
+        self.numrecords = totals.numrecords
+        for layer in layers:
+            self.totals[layer] = totals[layer]
+
+        # Cells
+        cells = select(dimensions)
+        rindex = {}
+        cindex = {}
+        for key in cells:
+            rvalue = key[0] if rfield else None
+            cvalue = key[-1] if cfield else None
+            if rvalue not in rindex:
+                rindex[rvalue] = len(rindex)
+            if cvalue not in cindex:
+                cindex[cvalue] = len(cindex)
+
+        self.row = [None] * len(rindex)
+        for value, i in rindex.items():
+            self.row[i] = Storage(value=value)
+        self.numrows = len(self.row)
+        self.col = [None] * len(cindex)
+        for value, i in cindex.items():
+            self.col[i] = Storage(value=value)
+        self.numcols = len(self.col)
+
+        empty = dict((layer, aggregate([], layer[1])) for layer in layers)
+        matrix = self.cell = [[Storage(empty, records=[])
+                               for j in xrange(self.numcols)]
+                              for i in xrange(self.numrows)]
+        for key, cell in cells.items():
+            r = rindex[key[0] if rfield else None]
+            c = cindex[key[-1] if cfield else None]
+            matrix[r][c] = cell
+
+        # Row and column totals
+        for dim, index, headers in ((rfield, rindex, self.row),
+                                    (cfield, cindex, self.col)):
+            if dim is None:
+                results = {(None,): totals}
+            else:
+                results = select([dim])
+            for key, result in results.items():
+                header = headers[index[key[0]]]
+                header.records = []
+                for layer in layers:
+                    header[layer] = result[layer]
+
+        # Totals of count layers are the sums of the cells (as in _add_layer,
+        # i.e. values in multiple cells are counted once per cell)
+        for layer in layers:
+            if layer[1] != "count":
+                continue
+            total = 0
+            for i, row in enumerate(self.row):
+                row[layer] = sum(cell[layer] for cell in matrix[i])
+                total += row[layer]
+            for j, col in enumerate(self.col):
+                col[layer] = sum(row[j][layer] for row in matrix)
+            self.totals[layer] = total
+
+        # Distinct fact values for drill-down of count layers
+        for rfact in facts:
+            fields = [d.field for d in dimensions] + [rfact.field]
+            rows = db(query).select(left=left,
+                                    groupby=reduce(lambda x, y: x|y, fields),
+                                    *fields)
+            colname = rfact.colname
+            for row in rows:
+                value = row[colname]
+                if value is None:
+                    continue
+                r = rindex[row[rfield.colname] if rfield else None]
+                c = cindex[row[cfield.colname] if cfield else None]
+                cell = matrix[r][c]
+                if "facts" not in cell:
+                    cell.facts = {}
+                if colname not in cell.facts:
+                    cell.facts[colname] = [value]
+                else:
+                    cell.facts[colname].append(value)
+        return
+
+    # -------------------------------------------------------------------------
+    def _cell_values(self, cell, rfield):
+        """
+            Get the values of a fact field in a cell (for drill-down)
+
+            @param cell: the cell
+            @param rfield: the fact field (S3ResourceField)
+            @return: list of values (can contain lists for list:types)
+        """
+
+        colname = rfield.colname
+
+        facts = cell.get("facts")
+        if facts is not None:
+            return facts.get(colname, [])
+
+        values = []
+        append = values.append
+        records = self.records
+        for record_id in cell.records:
+            record = records[record_id]
+            try:
+                append(record[colname])
+            except AttributeError:
+                continue
+        return values
+
     # -------------------------------------------------------------------------
     def _pivot(self, items, pkey_colname, rows_colname, cols_colname):
         """
@@ -113,6 +113,12 @@ class S3Exporter(object):
 
         return rows.json()
 
+    # -------------------------------------------------------------------------
+    def geojson(self, *args, **kwargs):
+
+        codec = S3Codec.get_codec("geojson").encode
+        return codec(*args, **kwargs)
+
     # -------------------------------------------------------------------------
     def pdf(self, *args, **kwargs):
 
@@ -31,9 +31,18 @@
 
 import datetime
 import sys
+import threading
+import time
 from itertools import chain
 from uuid import uuid4
 
+try:
+    # Python 2.7
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    from gluon.contrib.simplejson.ordered_dict import OrderedDict
+
 from gluon import *
 # Here are dependencies listed for reference:
 #from gluon import current
@@ -220,7 +229,8 @@ class S3Represent(object):
                  hierarchy=False,
                  default=None,
                  none=None,
-                 field_sep=" "
+                 field_sep=" ",
+                 cache=None,
                  ):
         """
             Constructor
@@ -244,6 +254,10 @@ class S3Represent(object):
             @param default: default representation for unknown options
             @param none: representation for empty fields (None or empty list)
             @param field_sep: separator to use to join fields
+            @param cache: share representations across requests (using
+                          S3RepresentCache, if enabled in deployment settings),
+                          None to enable automatically for the default lookup
+                          with string templates
         """
 
         self.tablename = lookup
@@ -260,8 +274,11 @@ class S3Represent(object):
         self.default = default
         self.none = none
         self.field_sep = field_sep
+        self.cache = cache
         self.setup = False
         self.theset = None
+        self.rcache = None
+        self.rkey = None
         self.queries = 0
         self.lazy = []
         self.lazy_show_link = False
@@ -576,6 +593,27 @@ class S3Represent(object):
         else:
             self.htemplate = "%s > %s"
 
+        # Shared representation cache (not for options or hierarchies,
+        # and by default only for the default lookup and string labels)
+        if self.table is not None and \
+           self.options is None and not self.hierarchy:
+            cache = self.cache
+            if cache is None:
+                cache = not self.custom_lookup and not self.clabels
+            if cache:
+                self.rcache = S3RepresentCache.instance()
+                if self.clabels:
+                    labels = "%s.%s" % (getattr(labels, "__module__", None),
+                                        getattr(labels, "__name__", None))
+                cls = self.__class__
+                self.rkey = ("%s.%s" % (cls.__module__, cls.__name__),
+                             self.key,
+                             tuple(self.fields) if self.fields else None,
+                             labels,
+                             self.translate,
+                             self.field_sep,
+                             )
+
         self.setup = True
         return
 
@@ -636,6 +674,17 @@ class S3Represent(object):
         # Use the given rows to lookup the values
         pop = lookup.pop
         represent_row = self.represent_row
+
+        # Lookup the shared cache
+        rcache = self.rcache
+        if rcache is not None and not rows:
+            tablename = table._tablename
+            cached = rcache.get(tablename, self.rkey, lookup.keys())
+            for k, v in cached.items():
+                pop(k, None)
+                items[k] = theset[k] = v
+            if not lookup:
+                return items
         if rows and not self.custom_lookup:
             for row in rows:
                 k = row[key]
@@ -671,6 +720,11 @@ class S3Represent(object):
                     k = row[key]
                     lookup.pop(k, None)
                     items[k] = theset[k] = represent_row(row)
+                if rcache is not None and rows:
+                    rcache.put(table._tablename,
+                               self.rkey,
+                               dict((row[key], items[row[key]])
+                                    for row in rows))
 
         if lookup:
             for k in lookup:
@@ -714,6 +768,217 @@ class S3Represent(object):
         theset[value] = result
         return result
 
+# =============================================================================
+class S3RepresentCache(object):
+    """
+        Process-wide cache for representations of foreign keys, shared
+        between all S3Represent instances with the same configuration
+        (and thus across requests), bounded in size (least-recently-used
+        entries get removed first) and age of the entries.
+
+        Entries are keyed by lookup table, key value, renderer and
+        language, and can be invalidated per lookup table or record
+        when records get updated or deleted.
+    """
+
+    _instance = None
+
+    def __init__(self, size=10000, ttl=300):
+        """
+            Constructor
+
+            @param size: the maximum number of entries
+            @param ttl: the maximum age of entries (in seconds)
+        """
+
+        self.size = size
+        self.ttl = ttl
+
+        self.lock = threading.RLock()
+        self.items = OrderedDict()
+        self.index = {}
+
+        self.hits = {}
+        self.misses = {}
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def instance(cls):
+        """
+            Get the cache instance for this process (as configured
+            in deployment settings)
+
+            @return: the S3RepresentCache, or None if disabled
+        """
+
+        if cls._instance is None:
+            settings = current.deployment_settings
+            size = settings.get_base_represent_cache_size()
+            if not size:
+                return None
+            ttl = settings.get_base_represent_cache_ttl()
+            cls._instance = cls(size=size, ttl=ttl)
+        return cls._instance
+
+    # -------------------------------------------------------------------------
+    def get(self, tablename, renderer, values):
+        """
+            Get cached representations
+
+            @param tablename: the lookup table name
+            @param renderer: the renderer key
+            @param values: the key values to lookup
+
+            @return: dict {value: representation} for all values found
+        """
+
+        language = current.T.accepted_language
+        expired = time.time() - self.ttl
+
+        found = {}
+        with self.lock:
+            items = self.items
+            for value in values:
+                key = (tablename, value, renderer, language)
+                item = items.pop(key, None)
+                if item is None:
+                    continue
+                if item[1] < expired:
+                    self._unindex(key)
+                    continue
+                # Re-insert as most recently used
+                items[key] = item
+                found[value] = item[0]
+
+            hits = len(found)
+            self.hits[tablename] = self.hits.get(tablename, 0) + hits
+            self.misses[tablename] = self.misses.get(tablename, 0) + \
+                                     len(values) - hits
+        return found
+
+    # -------------------------------------------------------------------------
+    def put(self, tablename, renderer, representations):
+        """
+            Add representations to the cache
+
+            @param tablename: the lookup table name
+            @param renderer: the renderer key
+            @param representations: dict {value: representation}
+        """
+
+        language = current.T.accepted_language
+        now = time.time()
+
+        with self.lock:
+            items = self.items
+            index = self.index
+            for value, text in representations.items():
+                if isinstance(text, lazyT):
+                    text = s3_unicode(text)
+                elif not isinstance(text, basestring):
+                    # Can't share HTML helpers
+                    continue
+                key = (tablename, value, renderer, language)
+                items.pop(key, None)
+                items[key] = (text, now)
+                record = (tablename, value)
+                if record not in index:
+                    index[record] = set([key])
+                else:
+                    index[record].add(key)
+
+            # Remove the least recently used entries
+            size = self.size
+            while len(items) > size:
+                key = items.popitem(last=False)[0]
+                self._unindex(key)
+        return
+
+    # -------------------------------------------------------------------------
+    def invalidate(self, tablename, values=None):
+        """
+            Remove entries from the cache
+
+            @param tablename: the lookup table name
+            @param values: the key values (record IDs), None for all
+                           entries of the lookup table
+        """
+
+        with self.lock:
+            items = self.items
+            index = self.index
+            if values is None:
+                records = [r for r in index if r[0] == tablename]
+            else:
+                if type(values) is not list:
+                    values = [values]
+                records = [(tablename, v) for v in values]
+            for record in records:
+                keys = index.pop(record, None)
+                if keys:
+                    for key in keys:
+                        items.pop(key, None)
+        return
+
+    # -------------------------------------------------------------------------
+    def stats(self):
+        """
+            Get the cache statistics
+
+            @return: dict {tablename: (hits, misses)}
+        """
+
+        with self.lock:
+            hits = self.hits
+            misses = self.misses
+            return dict((tn, (hits.get(tn, 0), misses.get(tn, 0)))
+                        for tn in set(hits.keys() + misses.keys()))
+
+    # -------------------------------------------------------------------------
+    def clear(self):
+        """ Remove all entries and reset the statistics """
+
+        with self.lock:
+            self.items.clear()
+            self.index.clear()
+            self.hits.clear()
+            self.misses.clear()
+        return
+
+    # -------------------------------------------------------------------------
+    def _unindex(self, key):
+        """
+            Remove a cache key from the record index
+
+            @param key: the cache key
+        """
+
+        record = key[:2]
+        keys = self.index.get(record)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.index[record]
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def clear_record(cls, tablename, record_id=None):
+        """
+            Invalidate the representations of a record (or of all records
+            in a table) in the cache of this process, to be called when
+            records get updated or deleted
+
+            @param tablename: the table name
+            @param record_id: the record ID (or list of record IDs),
+                              None for all records
+        """
+
+        instance = cls._instance
+        if instance is not None:
+            instance.invalidate(tablename, record_id)
+        return
+
 # =============================================================================
 class S3RepresentLazy(object):
     """
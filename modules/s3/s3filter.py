@@ -30,6 +30,7 @@
 """
 
 import datetime
+import hashlib
 import re
 
 try:
@@ -53,7 +54,7 @@ from gluon.storage import Storage
 from gluon.tools import callback
 
 from s3rest import S3Method
-from s3resource import S3FieldSelector, S3ResourceField, S3URLQuery
+from s3resource import S3FieldSelector, S3LeftJoins, S3ResourceField, S3URLQuery
 from s3utils import s3_get_foreign_key, s3_unicode, S3TypeConverter
 from s3validators import *
 from s3widgets import S3DateWidget, S3DateTimeWidget, S3GroupedOptionsWidget, S3MultiSelectWidget, S3OrganisationHierarchyWidget, S3RadioOptionsWidget, s3_grouped_checkboxes_widget, S3SelectChosenWidget
@@ -172,6 +173,9 @@ class S3FilterWidget(object):
                                  (L{S3OptionsFilter} with "groupedopts" widget)
             @keyword none: label for explicit None-option in many-to-many
                            fields (L{S3OptionsFilter})
+            @keyword counts: show the number of matching records with
+                             each option (L{S3OptionsFilter},
+                             L{S3LocationFilter})
             @keyword fieldtype: explicit field type "date" or "datetime" to
                                 use for context or virtual fields
                                 (L{S3DateFilter})
@@ -884,10 +888,36 @@ class S3LocationFilter(S3FilterWidget):
             return default
         
         # Find the options
-        rows = resource.select(fields=fields,
-                               limit=None,
-                               virtual=False,
-                               as_rows=True)
+        counts = None
+        facets = S3Facets(resource, fields)()
+        if facets is not None:
+            # Distinct locations and counts from grouped query
+            names = [l for l in levels]
+            if translate:
+                names.append("path")
+            if joined:
+                if "$" in selector:
+                    colname = "%s.%s" % (rfield.field.tablename,
+                                         selector.split("$", 1)[1])
+                else:
+                    colname = "%s.%s" % (resource.tablename, selector)
+            rows = []
+            counts = []
+            for values, count in facets:
+                location = Storage(zip(names, values[1:]))
+                if joined:
+                    row = Storage(gis_location=location)
+                    row[colname] = values[0]
+                else:
+                    location.id = values[0]
+                    row = location
+                rows.append(row)
+                counts.append(count)
+        else:
+            rows = resource.select(fields=fields,
+                                   limit=None,
+                                   virtual=False,
+                                   as_rows=True)
         # No options?
         if not rows:
             return default
@@ -946,8 +976,10 @@ class S3LocationFilter(S3FilterWidget):
                 name_l10n[row["gis_location.name"]] = row["gis_location_name.name_l10n"]
 
         # Populate the Options and the Hierarchy
-        for row in rows:
+        level_counts = dict((level, {}) for level in levels)
+        for index, row in enumerate(rows):
             _row = getattr(row, "gis_location") if joined else row
+            count = counts[index] if counts else 0
             if inject_hierarchy:
                 parent = None
                 grandparent = None
@@ -964,6 +996,8 @@ class S3LocationFilter(S3FilterWidget):
                             o[v] = name_l10n.get(v, v)
                         else:
                             o.append(v)
+                    c = level_counts[level]
+                    c[v] = c.get(v, 0) + count
                 if inject_hierarchy:
                     if i == 0:
                         h = hierarchy[_level]
@@ -1016,6 +1050,22 @@ class S3LocationFilter(S3FilterWidget):
             for level in levels:
                 levels[level]["options"].sort()
 
+        if counts:
+            for level in levels:
+                levels[level]["counts"] = level_counts[level]
+            if opts.get("counts"):
+                # Show the number of matching records with the options
+                for level in levels:
+                    options = levels[level]["options"]
+                    c = level_counts[level]
+                    if translate:
+                        items = options.items()
+                    else:
+                        items = [(v, v) for v in options]
+                    levels[level]["options"] = OrderedDict(
+                        (v, "%s (%s)" % (s3_unicode(label), c.get(v, 0)))
+                        for v, label in items)
+
         if inject_hierarchy:
             # Inject the Location Hierarchy
             hierarchy = "S3.location_filter_hierarchy=%s" % json.dumps(hierarchy)
@@ -1264,6 +1314,7 @@ class S3OptionsFilter(S3FilterWidget):
 
         # Find the options
         opt_keys = []
+        counts = None
 
         multiple = ftype[:5] == "list:"
         if opts.options is not None:
@@ -1281,29 +1332,38 @@ class S3OptionsFilter(S3FilterWidget):
                 opt_keys = (True, False)
 
             elif field or rfield.virtual:
-                groupby = field if field and not multiple else None
-                virtual = field is None
-                rows = resource.select([selector],
-                                       limit=None,
-                                       orderby=field,
-                                       groupby=groupby,
-                                       virtual=virtual,
-                                       as_rows=True)
-                opt_keys = []
-                if rows:
-                    if multiple:
-                        kextend = opt_keys.extend
-                        for row in rows:
-                            vals = row[colname]
-                            if vals:
-                                kextend([v for v in vals
-                                           if v not in opt_keys])
-                    else:
+                facets = S3Facets(resource, selector)() if field else None
+                if facets is not None:
+                    # Distinct values and counts from grouped query
+                    counts = {}
+                    for values, count in facets:
+                        counts[values[0]] = count
+                    opt_keys = counts.keys()
+                else:
+                    groupby = field if field and not multiple else None
+                    virtual = field is None
+                    rows = resource.select([selector],
+                                           limit=None,
+                                           orderby=field,
+                                           groupby=groupby,
+                                           virtual=virtual,
+                                           as_rows=True)
+                    opt_keys = []
+                    if rows:
+                        seen = set()
                         kappend = opt_keys.append
                         for row in rows:
-                            v = row[colname]
-                            if v not in opt_keys:
-                                kappend(v)
+                            vals = row[colname]
+                            if not multiple:
+                                vals = [vals]
+                            elif not vals:
+                                continue
+                            for v in vals:
+                                if v not in seen:
+                                    seen.add(v)
+                                    kappend(v)
+        # Pass to widget
+        self.counts = counts
 
         # No options?
         if len(opt_keys) < 1 or len(opt_keys) == 1 and not opt_keys[0]:
@@ -1386,6 +1446,11 @@ class S3OptionsFilter(S3FilterWidget):
 
         none = opts["none"]
 
+        if counts and opts.get("counts"):
+            # Show the number of matching records with the options
+            opt_list = [(k, "%s (%s)" % (s3_unicode(v), counts.get(k, 0)))
+                        for k, v in opt_list]
+
         try:
             opt_list.sort(key=lambda item: item[1])
         except:
@@ -1505,6 +1570,192 @@ $('#%(widget_id)s').hierarchicalopts({
 
         return widget
 
+# =============================================================================
+class S3Facets(object):
+    """
+        Facet engine for filter widgets: finds the distinct values of
+        fields in a filtered resource, and the number of matching records
+        for each of them, with a grouped query
+
+        The results can be cached per resource query and fields, and the
+        cache is invalidated by writes to any of the tables involved
+        within the same process (see settings.search.filter_options_cache).
+    """
+
+    def __init__(self, resource, selectors):
+        """
+            Constructor
+
+            @param resource: the S3Resource
+            @param selectors: the field selector(s)
+        """
+
+        self.resource = resource
+        if not isinstance(selectors, (list, tuple)):
+            selectors = [selectors]
+        self.selectors = selectors
+
+    # -------------------------------------------------------------------------
+    def __call__(self):
+        """
+            Get the facets
+
+            @return: list of tuples (values, count), where values is a tuple
+                     of the field values in the order of the selectors (for
+                     list types: the single list items); or None if the
+                     facets can not be determined with a grouped query
+                     (virtual fields, or filters on virtual fields)
+        """
+
+        resource = self.resource
+        if resource.rfilter is None:
+            resource.build_query()
+        if resource.get_filter() is not None:
+            # Filter needs to be applied in Python
+            return None
+
+        db = current.db
+        table = resource.table
+        tablename = resource.tablename
+
+        rfields, joins, left, distinct = resource.resolve_selectors(
+                                                    self.selectors,
+                                                    extra_fields=False)
+        if len(rfields) != len(self.selectors):
+            return None
+        fields = []
+        multiple = False
+        for rfield in rfields:
+            if rfield.field is None:
+                # Virtual field
+                return None
+            if rfield.ftype[:5] == "list:":
+                if len(rfields) > 1:
+                    return None
+                multiple = True
+            fields.append(rfield.field)
+
+        # Resource query with joins and permissions for joined tables
+        query = resource.get_query()
+        accessible_query = current.auth.s3_accessible_query
+        for tname, join in joins.items():
+            query &= join
+            if tname != tablename:
+                aquery = accessible_query("read", db[tname])
+                if aquery is not None:
+                    query &= aquery
+
+        left_joins = S3LeftJoins(tablename)
+        left_joins.add(resource.rfilter.get_left_joins())
+        left_joins.extend(left)
+        left = left_joins.as_list(aqueries={})
+
+        count = table._id.count(distinct=True)
+        if multiple:
+            sql = db(query)._select(table._id, fields[0],
+                                    left=left,
+                                    distinct=True)
+        else:
+            sql = db(query)._select(count,
+                                    left=left,
+                                    groupby=fields,
+                                    *fields)
+
+        lookup = lambda: self._lookup(table, query, rfields, count, left,
+                                      multiple)
+
+        expire = current.deployment_settings.get_search_filter_options_cache()
+        if not expire:
+            return lookup()
+
+        # Cache key from the query and the write counters of all tables
+        tablenames = set(db._adapter.tables(query))
+        tablenames |= set(str(j.first) for j in left)
+        table_version = current.s3db.table_version
+        versions = [(tn, table_version(tn)) for tn in sorted(tablenames)]
+        key = "s3_facets_%s" % hashlib.md5("%s%s" % (sql, versions)).hexdigest()
+
+        return current.cache.ram(key, lookup, time_expire=expire)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _lookup(table, query, rfields, count, left, multiple):
+        """
+            Run the facet query
+
+            @param table: the resource table
+            @param query: the query
+            @param rfields: the S3ResourceFields
+            @param count: the count expression
+            @param left: the left joins
+            @param multiple: the field is a list type
+
+            @return: list of tuples (values, count)
+        """
+
+        db = current.db
+
+        if not multiple:
+            fields = [rfield.field for rfield in rfields]
+            colnames = [rfield.colname for rfield in rfields]
+            rows = db(query).select(count,
+                                    left=left,
+                                    groupby=fields,
+                                    *fields)
+            return [(tuple(row[colname] for colname in colnames), row[count])
+                    for row in rows]
+
+        rfield = rfields[0]
+        field = rfield.field
+        ftype = rfield.ftype
+        pkey = table._id
+
+        types = db._adapter.types
+        if db._dbname == "postgres" and \
+           types.get(ftype.split(" ", 1)[0], "")[:4].upper() == "TEXT":
+            # Unnest the list values in the database: values are stored
+            # as |item|item|, with bars in items escaped as ||, hence
+            # match items as sequences of non-bars or escaped bars
+            inner = db(query)._select(pkey, field,
+                                      left=left,
+                                      distinct=True).rstrip(";")
+            sql = "SELECT v, COUNT(DISTINCT i) FROM " \
+                  "(SELECT i, replace((regexp_matches(" \
+                  "substr(c, 2, length(c) - 2), '(?:[^|]|[|][|])+', 'g'))[1], " \
+                  "'||', '|') AS v " \
+                  "FROM (%s) AS facet_rows(i, c)) AS facet_values " \
+                  "WHERE trim(v) <> '' GROUP BY v;" % inner
+            if ftype in ("list:string", "list:text"):
+                convert = lambda v: v
+            else:
+                convert = long
+            facets = []
+            for value, number in db.executesql(sql):
+                try:
+                    value = convert(value)
+                except ValueError:
+                    continue
+                facets.append(((value,), number))
+            return facets
+
+        # Unnest the list values in Python
+        rows = db(query).select(pkey, field, left=left, distinct=True)
+        colname = rfield.colname
+        pname = str(pkey)
+        seen = set()
+        counts = {}
+        for row in rows:
+            values = row[colname]
+            if not values:
+                continue
+            record_id = row[pname]
+            for value in values:
+                item = (value, record_id)
+                if item not in seen:
+                    seen.add(item)
+                    counts[value] = counts.get(value, 0) + 1
+        return [((value,), number) for value, number in counts.items()]
+
 # =============================================================================
 class S3FilterForm(object):
     """ Helper class to construct and render a filter form for a resource """
@@ -51,8 +51,10 @@ from gluon.sqlhtml import StringWidget
 from gluon.tools import callback
 from gluon.validators import Validator
 
+from s3hierarchy import S3Hierarchy
 from s3resource import S3FieldSelector
 from s3utils import s3_mark_required, s3_unicode
+from s3validators import IS_ONE_OF_EMPTY
 
 # =============================================================================
 class S3SQLForm(object):
@@ -584,6 +586,10 @@ class S3SQLDefaultForm(S3SQLForm):
             s3db = current.s3db
             s3db.update_super(table, vars)
 
+            # Update the stored hierarchy
+            S3Hierarchy.postprocess_create_node(tablename, vars,
+                                                original=form.record)
+
             # Update component link
             if link and link.postprocess is None:
                 resource = link.resource
@@ -1139,6 +1145,10 @@ class S3SQLCustomForm(S3SQLForm):
         # Update super entity links
         s3db.update_super(table, form.vars)
 
+        # Update the stored hierarchy
+        S3Hierarchy.postprocess_create_node(tablename, form.vars,
+                                            original=form.record)
+
         # Update component link
         if link and link.postprocess is None:
             resource = link.resource
@@ -2066,6 +2076,26 @@ class S3SQLInlineComponent(S3SQLSubForm):
             auth = current.auth
             manager = current.manager
 
+            # Validate the foreign keys of all changed items at once
+            columns = {}
+            for item in data:
+                if not "_changed" in item:
+                    continue
+                for f, d in item.iteritems():
+                    if f[0] != "_" and d and isinstance(d, dict) and \
+                       "value" in d:
+                        if f in columns:
+                            columns[f].append(d["value"])
+                        else:
+                            columns[f] = [d["value"]]
+            prevalidated = []
+            for f, values in columns.items():
+                if f not in table.fields:
+                    continue
+                for validator in IS_ONE_OF_EMPTY.validators(table[f]):
+                    validator.prevalidate(values)
+                    prevalidated.append(validator)
+
             # Process each item
             permit = component.permit
             audit = current.audit
@@ -2155,6 +2185,8 @@ class S3SQLInlineComponent(S3SQLSubForm):
                         master = db(query).select(mastertable[pkey],
                                                   limitby=(0, 1)).first()
                         if not master:
+                            for validator in prevalidated:
+                                validator.prevalidated.clear()
                             return
                     else:
                         master = Storage({pkey: master_id})
@@ -2188,6 +2220,9 @@ class S3SQLInlineComponent(S3SQLSubForm):
                         # onaccept
                         onaccept(table, Storage(vars=values), method="create")
 
+            for validator in prevalidated:
+                validator.prevalidated.clear()
+
             # Success
             return True
         else:
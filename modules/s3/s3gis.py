@@ -4024,25 +4024,7 @@ class GIS(object):
 
         if not feature:
             # Do the whole database
-            # Do in chunks to save memory and also do in correct order
-            fields = [table.id, table.name, table.gis_feature_type,
-                      table.L0, table.L1, table.L2, table.L3, table.L4,
-                      table.lat, table.lon, table.wkt, table.inherited,
-                      # Handle Countries which start with Bounds set, yet are Points
-                      table.lat_min, table.lon_min, table.lat_max, table.lon_max,
-                      table.path, table.parent]
-            update_location_tree = GIS.update_location_tree
-            for level in ["L0", "L1", "L2", "L3", "L4", "L5", None]:
-                features = db(table.level == level).select(*fields)
-                for feature in features:
-                    feature["level"] = level
-                    wkt = feature["wkt"]
-                    if wkt and not wkt.startswith("POI"):
-                        # Polygons aren't inherited
-                        feature["inherited"] = False
-                    update_location_tree(feature)
-                    # Also do the Bounds/Centroid/WKT
-                    bounds_centroid_wkt(feature)
+            GIS.rebuild_location_tree()
             return
 
         # Single Feature
@@ -5133,6 +5115,259 @@ class GIS(object):
                                       L5=L5_name)
         return _path
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def rebuild_location_tree(workers=None, chunk_size=500):
+        """
+            Rebuild Materialized path, Lx locations, Lat/Lon & Bounds for
+            all GIS Locations in bulk
+
+            Locations are processed level by level, so the tree data for a
+            whole level can be calculated in memory from the results for
+            the parent level, without any per-feature look-ups. Only
+            changed records are written back, in batches.
+
+            @param workers: number of processes to parse the geometries
+                            with (defaults to deployment setting)
+            @param chunk_size: number of records to process at a time
+        """
+
+        db = current.db
+        try:
+            table = db.gis_location
+        except:
+            table = current.s3db.gis_location
+
+        spatial = current.deployment_settings.get_gis_spatialdb()
+        if workers is None:
+            workers = current.deployment_settings.get_gis_location_tree_workers()
+
+        try:
+            import shapely
+        except ImportError:
+            s3_debug("Shapely not installed, so can't calculate Centroids & Bounds of Polygons")
+            SHAPELY = False
+        else:
+            SHAPELY = True
+
+        pool = None
+        if SHAPELY and workers > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(workers)
+
+        bulk_update = GIS._bulk_update
+        hierarchy_levels = ("L0", "L1", "L2", "L3", "L4", "L5")
+
+        fields = [table.id, table.name, table.level, table.parent,
+                  table.path, table.inherited, table.gis_feature_type,
+                  table.lat, table.lon, table.wkt,
+                  table.lat_min, table.lon_min, table.lat_max, table.lon_max,
+                  ] + [table[level] for level in hierarchy_levels]
+
+        # Tree data of all processed parent locations:
+        # {id: (level, name, path, [L0, ..., L5], lat, lon)}
+        tree = {}
+
+        # Specific locations can be parents of other specific locations,
+        # so remember which of them are needed
+        query = (table.level == None) & \
+                (table.parent != None) & \
+                (table.deleted != True)
+        rows = db(query).select(table.parent, distinct=True)
+        specific_parents = set(row.parent for row in rows)
+
+        def process(features, geometries):
+            """
+                Calculate the tree data for features whose parents have
+                already been processed
+
+                @return: list of features which have been skipped because
+                         their parent has not been processed (yet)
+            """
+
+            updates = {}
+            deferred = []
+            for feature in features:
+                feature_id = feature.id
+                level = feature.level
+                parent = feature.parent if level != "L0" else None
+
+                # Path & Lx
+                if parent:
+                    if parent not in tree:
+                        deferred.append(feature)
+                        continue
+                    p_level, p_name, p_path, names, p_lat, p_lon = tree[parent]
+                    if level and (not p_level or p_level >= level):
+                        s3_debug("Parent of %s Location ID %s has invalid level: %s is %s" % \
+                                    (level, feature_id, parent, p_level))
+                        continue
+                    path = "%s/%s" % (p_path, feature_id)
+                    names = list(names)
+                    if p_level:
+                        names[int(p_level[1:])] = p_name
+                else:
+                    path = str(feature_id)
+                    names = [None] * 6
+                    p_lat = p_lon = None
+                if level:
+                    names[int(level[1:])] = feature.name
+                values = dict(path = path)
+                for i, name in enumerate(names):
+                    values[hierarchy_levels[i]] = name
+
+                # Lat/Lon & Bounds
+                wkt = feature.wkt
+                lat = feature.lat
+                lon = feature.lon
+                if wkt and not wkt.startswith("POI"):
+                    # Polygons aren't inherited
+                    values["inherited"] = False
+                    geometry = geometries.get(feature_id)
+                    if geometry:
+                        values.update(geometry)
+                else:
+                    if feature.inherited or lat is None or lon is None:
+                        values["inherited"] = True
+                        lat = p_lat
+                        lon = p_lon
+                    else:
+                        values["inherited"] = False
+                    values["lat"] = lat
+                    values["lon"] = lon
+                    if lat is not None and lon is not None:
+                        values["gis_feature_type"] = 1
+                        values["wkt"] = "POINT(%s %s)" % (lon, lat)
+                        # Recompute the Bounds, unless the Point has got
+                        # wider Bounds (such as a country), as in wkt_centroid
+                        if feature.lon_min is None or \
+                           feature.lon_min == feature.lon_max:
+                            values.update(lon_min = lon,
+                                          lon_max = lon,
+                                          lat_min = lat,
+                                          lat_max = lat)
+
+                if level or feature_id in specific_parents:
+                    tree[feature_id] = (level,
+                                        feature.name,
+                                        path,
+                                        names,
+                                        values.get("lat", lat),
+                                        values.get("lon", lon),
+                                        )
+
+                # Only write back what has changed
+                changed = dict((k, v) for k, v in values.items()
+                               if feature[k] != v)
+                if changed:
+                    updates[feature_id] = changed
+
+            bulk_update(table, updates)
+            return deferred
+
+        def parse(features):
+            """
+                Calculate Centroids & Bounds for all non-Point features
+
+                @return: dict {id: {fieldname: value}}
+            """
+
+            if not SHAPELY:
+                return {}
+            wkts = [(feature.id, feature.wkt) for feature in features
+                    if feature.wkt and not feature.wkt.startswith("POI")]
+            if not wkts:
+                return {}
+            if pool is not None:
+                results = pool.map(_location_geometry, wkts)
+            else:
+                results = map(_location_geometry, wkts)
+            return dict(result for result in results if result)
+
+        try:
+            for level in list(hierarchy_levels) + [None]:
+                last_id = 0
+                deferred = []
+                while True:
+                    query = (table.level == level) & \
+                            (table.deleted != True) & \
+                            (table.id > last_id)
+                    features = db(query).select(limitby=(0, chunk_size),
+                                                orderby=table.id,
+                                                *fields)
+                    if not features:
+                        break
+                    last_id = features.last().id
+
+                    deferred.extend(process(features, parse(features)))
+
+                # Specific locations with specific parents: repeat until
+                # no more progress
+                while deferred:
+                    features = deferred
+                    deferred = process(features, parse(features))
+                    if len(deferred) == len(features):
+                        for feature in deferred:
+                            s3_debug("Parent of Location ID %s not found: %s" % \
+                                        (feature.id, feature.parent))
+                        break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if spatial:
+            # Populate the spatial field from the WKT, all in one go
+            sql = "UPDATE %s SET the_geom=ST_GeomFromText(wkt, 4326) " \
+                  "WHERE wkt IS NOT NULL AND deleted=%s;" % \
+                  (table._tablename, db._adapter.represent(False, "boolean"))
+            db.executesql(sql)
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _bulk_update(table, updates, chunk_size=200):
+        """
+            Update many records with different values at once, using one
+            UPDATE with CASE expressions per chunk of records
+
+            @param table: the Table
+            @param updates: dict {record_id: {fieldname: value}}
+            @param chunk_size: number of records per statement
+        """
+
+        if not updates:
+            return
+
+        db = current.db
+        represent = db._adapter.represent
+
+        record_ids = updates.keys()
+        for i in xrange(0, len(record_ids), chunk_size):
+            chunk = record_ids[i:i + chunk_size]
+            cases = {}
+            for record_id in chunk:
+                for fieldname, value in updates[record_id].items():
+                    field = table[fieldname]
+                    case = cases.get(fieldname)
+                    if case is None:
+                        case = cases[fieldname] = []
+                    case.append("WHEN %s THEN %s" % \
+                                (record_id, represent(value, field.type)))
+            if not cases:
+                continue
+            assignments = []
+            for fieldname, case in cases.items():
+                name = getattr(table[fieldname], "sqlsafe_name", fieldname)
+                assignments.append("%s=CASE id %s ELSE %s END" % \
+                                   (name, " ".join(case), name))
+            sql = "UPDATE %s SET %s WHERE id IN (%s);" % \
+                  (getattr(table, "sqlsafe", table._tablename),
+                   ", ".join(assignments),
+                   ",".join(str(record_id) for record_id in chunk))
+            db.executesql(sql)
+        return
+
     # -------------------------------------------------------------------------
     @staticmethod
     def wkt_centroid(form):
@@ -5662,6 +5897,47 @@ class GIS(object):
                    plugins = plugins,
                    )
 
+# =============================================================================
+def _location_geometry(item):
+    """
+        Parse the WKT of a Location, calculating Centroid & Bounds
+        - module-level function so that it can be run in a process pool
+
+        @param item: tuple (record_id, wkt)
+
+        @return: tuple (record_id, dict of field values), or None if the
+                 WKT could not be parsed
+    """
+
+    from shapely.wkt import loads as wkt_loads
+
+    record_id, wkt = item
+    values = {}
+    try:
+        shape = wkt_loads(wkt)
+    except:
+        try:
+            # Perhaps this is really a LINESTRING (e.g. OSM import of an unclosed Way)
+            linestring = "LINESTRING%s" % wkt[8:-1]
+            shape = wkt_loads(linestring)
+            values["wkt"] = linestring
+        except:
+            return None
+    try:
+        centroid = shape.centroid
+        bounds = shape.bounds
+    except:
+        return None
+    values.update(gis_feature_type = GEOM_TYPES[shape.type.lower()],
+                  lon = centroid.x,
+                  lat = centroid.y,
+                  lon_min = bounds[0],
+                  lat_min = bounds[1],
+                  lon_max = bounds[2],
+                  lat_max = bounds[3],
+                  )
+    return (record_id, values)
+
 # =============================================================================
 class MAP(DIV):
     """
@@ -31,6 +31,8 @@
     @status: experimental
 """
 
+import threading
+
 try:
     import json # try stdlib (Python 2.6)
 except ImportError:
@@ -48,6 +50,11 @@ DEFAULT = lambda: None
 class S3Hierarchy(object):
     """ Class representing an object hierarchy """
 
+    # Process-wide cache of the hierarchies, {tablename: (version, roots, nodes)}
+    # - shared between requests, so never modified in-place (copy-on-write)
+    CACHE = {}
+    CACHE_LOCK = threading.Lock()
+
     # -------------------------------------------------------------------------
     def __init__(self, tablename=None, hierarchy=None, represent=None):
         """
@@ -64,17 +71,15 @@ class S3Hierarchy(object):
             current.s3db.configure(tablename, hierarchy=hierarchy)
         self.represent = represent
 
-        self.__roots = None
-        self.__nodes = None
-        self.__flags = None
-        
+        self.__hierarchy = None
+
     # -------------------------------------------------------------------------
     @property
     def roots(self):
         """ Set of root node IDs """
 
         nodes = self.nodes
-        return self.__roots
+        return self.__hierarchy["roots"]
 
     # -------------------------------------------------------------------------
     @property
@@ -88,20 +93,20 @@ class S3Hierarchy(object):
                 }}
         """
 
-        if self.__nodes is None:
+        if self.__hierarchy is None:
             self.__connect()
         if self.__status("dirty"):
             self.read()
-        return self.__nodes
+        return self.__hierarchy["nodes"]
 
     # -------------------------------------------------------------------------
     @property
     def flags(self):
         """ Dict of status flags """
 
-        if self.__flags is None:
-            nodes = self.nodes
-        return self.__flags
+        if self.__hierarchy is None:
+            self.__connect()
+        return self.__hierarchy["flags"]
 
     # -------------------------------------------------------------------------
     @property
@@ -124,25 +129,27 @@ class S3Hierarchy(object):
         if tablename :
             hierarchies = current.model.hierarchies
             if tablename in hierarchies:
-                hierarchy = hierarchies[tablename]
-                self.__roots = hierarchy["roots"]
-                self.__nodes = hierarchy["nodes"]
-                self.__flags = hierarchy["flags"]
+                self.__hierarchy = hierarchies[tablename]
             else:
-                self.__roots = set()
-                self.__nodes = dict()
-                self.__flags = dict()
+                self.__hierarchy = hierarchies[tablename] = self.__new()
                 self.load()
-                hierarchy = {"roots": self.__roots,
-                             "nodes": self.__nodes,
-                             "flags": self.__flags}
-                hierarchies[tablename] = hierarchy
         else:
-            self.__roots = set()
-            self.__nodes = dict()
-            self.__flags = dict()
+            self.__hierarchy = self.__new()
         return
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __new():
+        """ Create a new (empty) request-local hierarchy """
+
+        # Labels are request-specific (language), so they are kept
+        # separately from the nodes which are shared between requests
+        return {"roots": set(),
+                "nodes": dict(),
+                "flags": dict(),
+                "labels": dict(),
+                }
+
     # -------------------------------------------------------------------------
     def __status(self, flag=None, default=None, **attr):
         """
@@ -168,7 +175,12 @@ class S3Hierarchy(object):
 
     # -------------------------------------------------------------------------
     def load(self):
-        """ Try loading the hierarchy from s3_hierarchy """
+        """
+            Try loading the hierarchy from the process cache, bringing
+            it up to date with the changes in s3_hierarchy_node since
+            it has been cached, or - if not cached yet - from the
+            s3_hierarchy_node table
+        """
 
         if not self.config:
             return
@@ -179,36 +191,139 @@ class S3Hierarchy(object):
             self.__status(dirty=True)
             return
 
-        htable = current.s3db.s3_hierarchy
+        db = current.db
+        s3db = current.s3db
+        htable = s3db.s3_hierarchy
         query = (htable.tablename == tablename)
-        row = current.db(query).select(htable.dirty,
-                                        htable.hierarchy,
-                                        limitby=(0, 1)).first()
-        if row and not row.dirty:
-            data = row.hierarchy
-            nodes = self.__nodes
-            nodes.clear()
-            for node_id, item in data["nodes"].items():
-                nodes[long(node_id)] = {"p": item["p"],
-                                        "c": item["c"],
-                                        "s": set(item["s"]) \
-                                             if item["s"] else set()}
-            roots = self.__roots
-            roots.clear()
-            roots.update(set(data["roots"]))
-            self.__status(dirty=False,
-                                 dbupdate=None,
-                                 dbstatus=True)
-            return
-        else:
+        row = db(query).select(htable.dirty,
+                               htable.version,
+                               limitby=(0, 1)).first()
+        if not row or row.dirty or not row.version:
+            # Not stored yet, or needs to be rebuilt
             self.__status(dirty=True,
                           dbupdate=None,
                           dbstatus=False if row else None)
+            return
+
+        version = row.version or 0
+
+        cache = self.CACHE
+        lock = self.CACHE_LOCK
+        with lock:
+            cached = cache.get(tablename)
+
+        ntable = s3db.s3_hierarchy_node
+        query = (ntable.tablename == tablename)
+        fields = [ntable.node_id,
+                  ntable.parent_id,
+                  ntable.category,
+                  ntable.removed,
+                  ntable.version,
+                  ]
+        if cached is None or cached[0] > version:
+            # Load all nodes
+            rows = db(query & (ntable.removed != True)).select(*fields)
+            roots, nodes = self._apply(set(), {}, rows)
+        elif cached[0] < version:
+            # Apply the changes since the cached version
+            query &= (ntable.version > cached[0])
+            rows = db(query).select(orderby=ntable.version, *fields)
+            roots, nodes = self._apply(cached[1], cached[2], rows)
+        else:
+            rows = None
+            roots, nodes = cached[1], cached[2]
+
+        if rows:
+            # Node versions can be ahead of the hierarchy version
+            version = max(version, max(row.version for row in rows))
+            with lock:
+                cached = cache.get(tablename)
+                if cached is None or cached[0] < version:
+                    cache[tablename] = (version, roots, nodes)
+
+        hierarchy = self.__hierarchy
+        hierarchy["roots"] = roots
+        hierarchy["nodes"] = nodes
+        self.__status(dirty=False,
+                      dbupdate=None,
+                      dbstatus=True)
         return
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _apply(roots, nodes, rows):
+        """
+            Apply changes to a hierarchy (copy-on-write, i.e. the
+            original roots and nodes remain unchanged)
+
+            @param roots: the set of root node IDs
+            @param nodes: the nodes dict
+            @param rows: iterable of node changes, each with the
+                         attributes node_id, parent_id, category and
+                         removed, in the order they were made
+
+            @return: tuple (roots, nodes) with the updated hierarchy
+        """
+
+        roots = set(roots)
+        nodes = dict(nodes)
+        copied = set()
+
+        def node(node_id):
+            """ Get a private copy of a node, create it if necessary """
+
+            if node_id in copied:
+                return nodes[node_id]
+            item = nodes.get(node_id)
+            if item is None:
+                item = {"p": None, "c": None, "s": set()}
+                roots.add(node_id)
+            else:
+                item = {"p": item["p"], "c": item["c"], "s": set(item["s"])}
+            nodes[node_id] = item
+            copied.add(node_id)
+            return item
+
+        for row in rows:
+            node_id = row.node_id
+            if node_id in nodes:
+                item = node(node_id)
+                # Detach from the current parent
+                parent_id = item["p"]
+                if parent_id:
+                    if parent_id in nodes:
+                        node(parent_id)["s"].discard(node_id)
+                else:
+                    roots.discard(node_id)
+            elif row.removed:
+                continue
+            else:
+                item = node(node_id)
+                roots.discard(node_id)
+
+            if row.removed:
+                # Orphaned children become root nodes
+                for child_id in item["s"]:
+                    if child_id in nodes:
+                        node(child_id)["p"] = None
+                        roots.add(child_id)
+                del nodes[node_id]
+                copied.discard(node_id)
+                continue
+
+            parent_id = row.parent_id
+            item["p"] = parent_id
+            item["c"] = row.category
+            if parent_id:
+                node(parent_id)["s"].add(node_id)
+            else:
+                roots.add(node_id)
+
+        return roots, nodes
+
     # -------------------------------------------------------------------------
     def save(self):
-        """ Save this hierarchy in s3_hierarchy """
+        """ Save this hierarchy in s3_hierarchy and s3_hierarchy_node """
 
         if not self.config:
             return
@@ -217,29 +332,32 @@ class S3Hierarchy(object):
         nodes = self.nodes
         if not self.__status("dbupdate"):
             return
-            
-        # Serialize the nodes
-        nodes_dict = dict()
-        for node_id, node in nodes.items():
-            nodes_dict[node_id] = {"p": node["p"],
-                                   "c": node["c"],
-                                   "s": list(node["s"]) \
-                                        if node["s"] else []}
-
-        # Generate record
-        data = {"tablename": tablename,
-                "dirty": False,
-                "hierarchy": {"roots": list(self.__roots),
-                              "nodes": nodes_dict
-                             }
-                }
+
+        db = current.db
+        s3db = current.s3db
 
         # Get current entry
-        htable = current.s3db.s3_hierarchy
+        htable = s3db.s3_hierarchy
         query = (htable.tablename == tablename)
-        row = current.db(query).select(htable.id,
-                                       limitby=(0, 1)).first()
+        row = db(query).select(htable.id,
+                               htable.version,
+                               limitby=(0, 1)).first()
+        version = (row.version or 0) + 1 if row else 1
+
+        # Replace all nodes
+        ntable = s3db.s3_hierarchy_node
+        db(ntable.tablename == tablename).delete()
+        ntable.bulk_insert([{"tablename": tablename,
+                             "node_id": node_id,
+                             "parent_id": node["p"],
+                             "category": node["c"],
+                             "version": version,
+                             } for node_id, node in nodes.items()])
 
+        data = {"tablename": tablename,
+                "dirty": False,
+                "version": version,
+                }
         if row:
             # Update record
             row.update_record(**data)
@@ -247,10 +365,20 @@ class S3Hierarchy(object):
             # Create new record
             htable.insert(**data)
 
+        # Update the process cache (with a copy, as this request may
+        # still modify its own hierarchy)
+        roots = set(self.roots)
+        nodes = dict((node_id, {"p": node["p"],
+                                "c": node["c"],
+                                "s": set(node["s"]),
+                                }) for node_id, node in nodes.items())
+        with self.CACHE_LOCK:
+            self.CACHE[tablename] = (version, roots, nodes)
+
         # Update status
         self.__status(dirty=False, dbupdate=None, dbstatus=True)
         return
-        
+
     # -------------------------------------------------------------------------
     @classmethod
     def dirty(cls, tablename):
@@ -268,16 +396,14 @@ class S3Hierarchy(object):
         config = s3db.get_config(tablename, "hierarchy")
         if not config:
             return
-        
+
         hierarchies = current.model.hierarchies
         if tablename in hierarchies:
             hierarchy = hierarchies[tablename]
             flags = hierarchy["flags"]
         else:
-            flags = {}
-            hierarchies[tablename] = {"roots": set(),
-                                      "nodes": dict(),
-                                      "flags": flags}
+            hierarchy = hierarchies[tablename] = cls.__new()
+            flags = hierarchy["flags"]
         flags["dirty"] = True
 
         dbstatus = flags.get("dbstatus", True)
@@ -295,27 +421,192 @@ class S3Hierarchy(object):
         return
 
     # -------------------------------------------------------------------------
-    def read(self):
-        """ Rebuild this hierarchy from the target table """
+    @classmethod
+    def postprocess_create_node(cls, tablename, record, original=None):
+        """
+            Add a node to the stored hierarchy or move it, to be called
+            after a record in the target table has been created or
+            updated (onaccept)
 
-        tablename = self.tablename
-        if not tablename:
-            return
+            @param tablename: the tablename
+            @param record: the record (Row or form.vars), must contain
+                           the record ID
+            @param original: the record as it was before the update
+                             (Row or dict), to skip the update of the
+                             stored hierarchy if neither parent nor
+                             category have changed
+        """
 
         s3db = current.s3db
-        table = s3db[tablename]
-        
+
         config = s3db.get_config(tablename, "hierarchy")
         if not config:
             return
-            
+
+        table = s3db[tablename]
+        pkey = table._id.name
+        node_id = record.get(pkey)
+        if not node_id:
+            return
+
+        parent, category = cls._fields(table, config)
+        if original and str(original.get(pkey)) == str(node_id):
+            changed = False
+            for fn in (parent, category):
+                if fn and fn in record and \
+                   (fn not in original or \
+                    cls._value(record[fn]) != cls._value(original[fn])):
+                    changed = True
+                    break
+            if not changed:
+                # Node unchanged, nothing to store
+                return
+
+        if parent not in record or category and category not in record:
+            # Reload the record
+            fields = [table[parent]]
+            if category:
+                fields.append(table[category])
+            record = current.db(table._id == node_id).select(limitby=(0, 1),
+                                                             *fields).first()
+            if not record:
+                return
+
+        parent_id = record[parent]
+        category = record[category] if category else None
+        cls._store(tablename, long(node_id),
+                   parent_id = long(parent_id) if parent_id else None,
+                   category = category,
+                   )
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def postprocess_delete_node(cls, tablename, node_id):
+        """
+            Remove a node from the stored hierarchy, to be called after a
+            record in the target table has been deleted (ondelete)
+
+            @param tablename: the tablename
+            @param node_id: the record ID
+        """
+
+        if not node_id or \
+           not current.s3db.get_config(tablename, "hierarchy"):
+            return
+        cls._store(tablename, long(node_id), removed=True)
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _store(cls, tablename, node_id, parent_id=None, category=None, removed=False):
+        """
+            Store a change of a node in s3_hierarchy_node, so that other
+            processes can apply it to their cached hierarchy
+
+            @param tablename: the tablename
+            @param node_id: the node ID
+            @param parent_id: the parent node ID
+            @param category: the category
+            @param removed: whether the node has been removed
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        # Get the hierarchy status and the current node in one query
+        htable = s3db.s3_hierarchy
+        ntable = s3db.s3_hierarchy_node
+        left = ntable.on((ntable.tablename == htable.tablename) & \
+                         (ntable.node_id == node_id))
+        query = (htable.tablename == tablename)
+        row = db(query).select(htable.id,
+                               htable.dirty,
+                               htable.version,
+                               ntable.id,
+                               ntable.parent_id,
+                               ntable.category,
+                               ntable.removed,
+                               left=left,
+                               limitby=(0, 1)).first()
+        if not row:
+            return
+        node = row[ntable._tablename]
+        row = row[htable._tablename]
+        if row.dirty or not row.version:
+            # Will be rebuilt from the target table anyway
+            return
+
+        if node.id:
+            if removed and node.removed or \
+               not removed and not node.removed and \
+               node.parent_id == parent_id and node.category == category:
+                # No change
+                return
+        elif removed:
+            return
+
+        # New version
+        db(htable.id == row.id).update(version=htable.version + 1)
+        version = db(htable.id == row.id).select(htable.version,
+                                                 limitby=(0, 1)
+                                                 ).first().version
+
+        data = {"parent_id": parent_id,
+                "category": category,
+                "removed": removed,
+                "version": version,
+                }
+        if node.id:
+            db(ntable.id == node.id).update(**data)
+        else:
+            ntable.insert(tablename=tablename, node_id=node_id, **data)
+        if removed:
+            # Orphaned children become root nodes
+            query = (ntable.tablename == tablename) & \
+                    (ntable.parent_id == node_id) & \
+                    (ntable.removed != True)
+            db(query).update(parent_id=None, version=version)
+
+        # Reload the hierarchy for this request when next accessed
+        hierarchies = current.model.hierarchies
+        if tablename in hierarchies:
+            del hierarchies[tablename]
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _value(value):
+        """
+            Normalize a parent or category value for comparison (form
+            vars can contain strings where the Row contains integers)
+
+            @param value: the value
+        """
+
+        if value is None or value == "":
+            return None
+        return str(value)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _fields(table, config):
+        """
+            Find the parent and category fields for a hierarchy
+
+            @param table: the target table
+            @param config: the hierarchy configuration of the table
+
+            @return: tuple (parent fieldname, category fieldname or None)
+        """
+
         if isinstance(config, tuple):
             parent, category = config[:2]
         else:
             parent, category = config, None
         if parent is None:
+            tablename = table._tablename
             pkey = table._id.name
-            parent_field = None
             for field in table:
                 ftype = str(field.type)
                 if ftype[:9] == "reference":
@@ -323,14 +614,29 @@ class S3Hierarchy(object):
                     if key[0] == tablename and \
                        (len(key) == 1 or key[1] == pkey):
                         parent = field.name
-                        parent_field = field
                         break
-        else:
-            parent_field = table[parent]
-        if not parent_field:
+        if parent is None or parent not in table.fields:
             raise AttributeError
-            
-        fields = [table._id, parent_field]
+        return parent, category
+
+    # -------------------------------------------------------------------------
+    def read(self):
+        """ Rebuild this hierarchy from the target table """
+
+        tablename = self.tablename
+        if not tablename:
+            return
+
+        s3db = current.s3db
+        table = s3db[tablename]
+
+        config = s3db.get_config(tablename, "hierarchy")
+        if not config:
+            return
+
+        parent, category = self._fields(table, config)
+
+        fields = [table._id, table[parent]]
         if category is not None:
             fields.append(table[category])
 
@@ -340,9 +646,11 @@ class S3Hierarchy(object):
             query = (table.id > 0)
         rows = current.db(query).select(*fields)
 
-        self.__nodes.clear()
-        self.__roots.clear()
-        
+        # Build new sets (the current ones may be shared with other requests)
+        hierarchy = self.__hierarchy
+        hierarchy["nodes"] = {}
+        hierarchy["roots"] = set()
+
         add = self.add
         for row in rows:
             n = row[table._id.name]
@@ -367,8 +675,9 @@ class S3Hierarchy(object):
             @param category: the category
         """
 
-        nodes = self.__nodes
-        roots = self.__roots
+        hierarchy = self.__hierarchy
+        nodes = hierarchy["nodes"]
+        roots = hierarchy["roots"]
 
         if node_id in nodes:
             node = nodes[node_id]
@@ -626,7 +935,8 @@ class S3Hierarchy(object):
     def _represent(self, node_ids=None, renderer=None):
         """
             Represent nodes as labels, the labels are stored in the
-            nodes as attribute "l".
+            request-local labels dict of the hierarchy (not in the nodes,
+            as those are shared between requests)
 
             @param node_ids: the node IDs (None for all nodes)
             @param renderer: the representation method (falls back
@@ -635,17 +945,14 @@ class S3Hierarchy(object):
         """
 
         nodes = self.nodes
-        LABEL = "l"
+        labels = self.__hierarchy["labels"]
 
         if node_ids is None:
             node_ids = nodes.keys()
 
         pending = set()
         for node_id in node_ids:
-            node = nodes.get(node_id)
-            if not node:
-                continue
-            if LABEL not in node:
+            if node_id in nodes and node_id not in labels:
                 pending.add(node_id)
 
         if renderer is None:
@@ -659,17 +966,17 @@ class S3Hierarchy(object):
             else:
                 renderer = s3_unicode
         if hasattr(renderer, "bulk"):
-            labels = renderer.bulk(list(pending), list_type = False)
-            for node_id, label in labels.items():
+            represented = renderer.bulk(list(pending), list_type = False)
+            for node_id, label in represented.items():
                 if node_id in nodes:
-                    nodes[node_id][LABEL] = label
+                    labels[node_id] = label
         else:
             for node_id in pending:
                 try:
                     label = renderer(node_id)
                 except:
                     label = s3_unicode(node_id)
-                nodes[node_id][LABEL] = label
+                labels[node_id] = label
         return
 
     # -------------------------------------------------------------------------
@@ -681,17 +988,12 @@ class S3Hierarchy(object):
             @param represent: the node ID representation method
         """
 
-        LABEL = "l"
-
         nodes = self.nodes
-        node = nodes.get(node_id)
-        if node:
-            if LABEL in node:
-                return node[LABEL]
-            else:
+        if node_id in nodes:
+            labels = self.__hierarchy["labels"]
+            if node_id not in labels:
                 self._represent(node_ids=[node_id], renderer=represent)
-            if LABEL in node:
-                return node[LABEL]
+            return labels.get(node_id)
         return None
 
     # -------------------------------------------------------------------------
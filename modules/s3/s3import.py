@@ -36,6 +36,7 @@ __all__ = ["S3Importer",
 
 import cPickle
 import os
+import re
 import sys
 import tempfile
 import urllib2          # Needed for error handling on fetch
@@ -68,7 +69,10 @@ from gluon.tools import callback, fetch
 
 from s3rest import S3Method
 from s3resource import S3Resource
+from s3fields import s3_all_meta_field_names
+from s3hierarchy import S3Hierarchy
 from s3utils import s3_debug, s3_mark_required, s3_has_foreign_key, s3_get_foreign_key, s3_unicode
+from s3validators import IS_ONE_OF_EMPTY
 from s3xml import S3XML
 
 DEBUG = False
@@ -1826,8 +1830,8 @@ class S3ImportItem(object):
         self.tablename = table._tablename
 
         if original is None:
-            original = S3Resource.original(table, element,
-                                           mandatory=self._mandatory_fields())
+            original = self.job.original(table, element,
+                                         mandatory=self._mandatory_fields())
         postprocess = s3db.get_config(self.tablename, "xml_post_parse")
         data = xml.record(table, element,
                           files=files,
@@ -1893,8 +1897,8 @@ class S3ImportItem(object):
         if self.original is not None:
             original = self.original
         elif self.data:
-            original = S3Resource.original(table, self.data,
-                                           mandatory=mandatory)
+            original = self.job.original(table, self.data,
+                                         mandatory=mandatory)
         else:
             original = None
 
@@ -2351,6 +2355,7 @@ class S3ImportItem(object):
                     return ignore_errors
                 else:
                     self.committed = True
+                    self.job.forget_duplicates(tablename, self.id, data)
             else:
                 # Nothing to update
                 self.committed = True
@@ -2386,6 +2391,7 @@ class S3ImportItem(object):
                 if success:
                     self.id = success
                     self.committed = True
+                    self.job.forget_duplicates(tablename, self.id, data)
 
             else:
                 # Nothing to create
@@ -2489,15 +2495,26 @@ class S3ImportItem(object):
                           representation="xml")
             # Update super entity links
             s3db.update_super(table, form.vars)
+            # Update the stored hierarchy
+            S3Hierarchy.postprocess_create_node(tablename, form.vars,
+                                                original=self.original)
+            job = self.job
+            job.forget(tablename, self.uid)
             if method == CREATE:
                 # Set record owner
-                current.auth.s3_set_record_owner(table, self.id)
+                if job.bulk:
+                    job.defer(tablename, method, self.id)
+                else:
+                    current.auth.s3_set_record_owner(table, self.id)
             elif method == UPDATE:
                 # Update realm
                 update_realm = s3db.get_config(table, "update_realm")
                 if update_realm:
-                    current.auth.set_realm_entity(table, self.id,
-                                                  force_update=True)
+                    if job.bulk:
+                        job.defer(tablename, method, self.id)
+                    else:
+                        current.auth.set_realm_entity(table, self.id,
+                                                      force_update=True)
             # Onaccept
             key = "%s_onaccept" % method
             onaccept = current.deployment_settings.get_import_callback(tablename, key)
@@ -2851,6 +2868,23 @@ class S3ImportJob():
         self.items = Storage()
         self.references = []
 
+        # Originals pre-fetched by UID, {tablename: {uid: row or None}}
+        self.originals = Storage()
+
+        # Duplicate candidates for deduplication hooks,
+        # {lookup key: {value: [rows]}}, and {tablename: {record_id:
+        # set of (lookup key, value)}} to forget them when committing
+        self.duplicates = {}
+        self.duplicate_index = {}
+
+        # Foreign key validators with batch validation results
+        self.prevalidated = []
+
+        # Bulk commit: defer owner/realm updates to set-based passes
+        self.bulk = current.deployment_settings.get_import_bulk_commit()
+        self.deferred = Storage()
+        self.deferred_keys = []
+
         self.job_table = None
         self.item_table = None
 
@@ -3265,6 +3299,309 @@ class S3ImportJob():
 
         return reference_list
 
+    # -------------------------------------------------------------------------
+    def prefetch(self, tree=None, chunk_size=500):
+        """
+            Look up the originals of all elements in the tree by their UIDs,
+            with one query per table (rather than one query per element)
+
+            @param tree: the element tree (defaults to the job tree)
+            @param chunk_size: maximum number of UIDs per query
+
+            @note: only tables where the UID is the only unique field are
+                   pre-fetched, others require S3Resource.original to match
+                   by their unique keys first
+        """
+
+        if tree is None:
+            tree = self.tree
+        if tree is None:
+            return
+        if isinstance(tree, etree._ElementTree):
+            root = tree.getroot()
+        else:
+            root = tree
+
+        db = current.db
+        s3db = current.s3db
+        xml = current.xml
+        import_uid = xml.import_uid
+        UID = xml.UID
+        NAME = xml.ATTRIBUTE.name
+
+        # Collect the UIDs per table
+        uids = {}
+        expr = ".//%s[@%s and @%s]" % (xml.TAG.resource, NAME, UID)
+        for element in root.xpath(expr):
+            uid = import_uid(element.get(UID))
+            if uid:
+                tablename = element.get(NAME)
+                if tablename in uids:
+                    uids[tablename].add(uid)
+                else:
+                    uids[tablename] = set([uid])
+
+        originals = self.originals
+        for tablename, table_uids in uids.items():
+            if tablename in originals:
+                continue
+            table = s3db.table(tablename)
+            if table is None or UID not in table.fields:
+                continue
+            pkey = table._id.name
+            unique = [fn for fn in table.fields
+                      if table[fn].unique and fn not in (UID, pkey)]
+            if unique:
+                continue
+            # Unmatched UIDs map to None (=no original)
+            lookup = dict((uid, None) for uid in table_uids)
+            table_uids = list(table_uids)
+            for i in xrange(0, len(table_uids), chunk_size):
+                query = table[UID].belongs(table_uids[i:i + chunk_size])
+                rows = db(query).select(table.ALL)
+                for row in rows:
+                    lookup[row[UID]] = row
+            originals[tablename] = lookup
+        return
+
+    # -------------------------------------------------------------------------
+    def find_duplicates(self,
+                        table,
+                        fieldname,
+                        value,
+                        fields=None,
+                        left=None,
+                        orderby=None,
+                        chunk_size=500):
+        """
+            Find the records where a field matches a value (ignoring case),
+            for deduplication hooks: the records for all values of this
+            field in the job tree are looked up at the first call, with
+            one query per chunk of values (rather than one query per item)
+
+            @param table: the table
+            @param fieldname: the name of the field to match
+            @param value: the value to match
+            @param fields: the fields to select (defaults to all fields of
+                           the table)
+            @param left: left joins
+            @param orderby: orderby-expression for the matching records
+            @param chunk_size: maximum number of values per query
+
+            @return: list of the matching rows
+
+            @note: committing an item forgets the matches for its values
+                   (see forget_duplicates), so that subsequent lookups of
+                   these values find the committed record
+        """
+
+        if not value:
+            return []
+        value = s3_unicode(value).lower()
+
+        tablename = table._tablename
+        if fields is None:
+            fields = [table.ALL]
+        key = (tablename, fieldname, str(fields), str(left), str(orderby))
+
+        duplicates = self.duplicates
+        if key in duplicates:
+            matches = duplicates[key]
+            if value in matches:
+                return matches[value]
+            values = set([value])
+        else:
+            matches = duplicates[key] = {}
+            values = self._values(tablename, fieldname)
+            values.add(value)
+
+        index = self.duplicate_index.setdefault(tablename, {})
+        field = table[fieldname]
+        pkey = str(table._id)
+        db = current.db
+
+        values = list(values)
+        for v in values:
+            matches[v] = []
+        for i in xrange(0, len(values), chunk_size):
+            chunk = [v.encode("utf-8") for v in values[i:i + chunk_size]]
+            rows = db(field.lower().belongs(chunk)).select(left=left,
+                                                           orderby=orderby,
+                                                           *fields)
+            for row in rows:
+                v = s3_unicode(row[field]).lower()
+                if v in matches:
+                    matches[v].append(row)
+                    record_id = row[pkey]
+                    if record_id in index:
+                        index[record_id].add((key, v))
+                    else:
+                        index[record_id] = set([(key, v)])
+        return matches[value]
+
+    # -------------------------------------------------------------------------
+    def forget_duplicates(self, tablename, record_id, data):
+        """
+            Forget the matches of find_duplicates for the values of a
+            committed record, and for the values it had before
+
+            @param tablename: the table name
+            @param record_id: the record ID
+            @param data: the committed data
+        """
+
+        index = self.duplicate_index.get(tablename)
+        if index is None:
+            # No lookups for this table
+            return
+
+        forget = index.pop(record_id, set())
+        duplicates = self.duplicates
+        for key in duplicates:
+            if key[0] == tablename:
+                value = data.get(key[1])
+                if value:
+                    forget.add((key, s3_unicode(value).lower()))
+        for key, value in forget:
+            duplicates[key].pop(value, None)
+        return
+
+    # -------------------------------------------------------------------------
+    def _values(self, tablename, fieldname):
+        """
+            Get all values of a field in the job tree
+
+            @param tablename: the table name
+            @param fieldname: the field name
+
+            @return: set of the values (lower case)
+        """
+
+        values = set()
+
+        tree = self.tree
+        if tree is None:
+            return values
+        if isinstance(tree, etree._ElementTree):
+            root = tree.getroot()
+        else:
+            root = tree
+
+        xml = current.xml
+        xml_decode = xml.xml_decode
+        ATTRIBUTE = xml.ATTRIBUTE
+        VALUE = ATTRIBUTE.value
+
+        expr = ".//%s[@%s='%s']/%s[@%s='%s']" % (xml.TAG.resource,
+                                                 ATTRIBUTE.name,
+                                                 tablename,
+                                                 xml.TAG.data,
+                                                 ATTRIBUTE.field,
+                                                 fieldname)
+        for element in root.xpath(expr):
+            value = element.get(VALUE, None)
+            if value is None:
+                value = xml_decode(element.text)
+            if value:
+                values.add(s3_unicode(value).lower())
+        return values
+
+    # -------------------------------------------------------------------------
+    def prevalidate(self, tree=None, chunk_size=500):
+        """
+            Validate all foreign keys in the tree which have an IS_ONE_OF
+            validator, with one query per column (rather than one query
+            per value)
+
+            @param tree: the element tree (defaults to the job tree)
+            @param chunk_size: maximum number of keys per query
+        """
+
+        if tree is None:
+            tree = self.tree
+        if tree is None:
+            return
+        if isinstance(tree, etree._ElementTree):
+            root = tree.getroot()
+        else:
+            root = tree
+
+        s3db = current.s3db
+        xml = current.xml
+        xml_decode = xml.xml_decode
+        NAME = xml.ATTRIBUTE.name
+        FIELD = xml.ATTRIBUTE.field
+        VALUE = xml.ATTRIBUTE.value
+        DATA = xml.TAG.data
+
+        # Collect the values per column
+        columns = {}
+        expr = ".//%s[@%s]" % (xml.TAG.resource, NAME)
+        for element in root.xpath(expr):
+            tablename = element.get(NAME)
+            for child in element.iterchildren(tag=DATA):
+                fieldname = child.get(FIELD)
+                value = child.get(VALUE, None)
+                if value is None:
+                    value = xml_decode(child.text)
+                if not value:
+                    continue
+                try:
+                    value = json.loads(value)
+                except:
+                    pass
+                column = (tablename, fieldname)
+                if column in columns:
+                    columns[column].append(value)
+                else:
+                    columns[column] = [value]
+
+        validators = IS_ONE_OF_EMPTY.validators
+        prevalidated = self.prevalidated
+        for (tablename, fieldname), values in columns.items():
+            table = s3db.table(tablename)
+            if table is None or fieldname not in table.fields:
+                continue
+            for validator in validators(table[fieldname]):
+                validator.prevalidate(values, chunk_size=chunk_size)
+                prevalidated.append(validator)
+        return
+
+    # -------------------------------------------------------------------------
+    def original(self, table, record, mandatory=None):
+        """
+            Find the original DB record for an element or data dict, using
+            the pre-fetched originals if available, or S3Resource.original
+            otherwise
+
+            @param table: the table
+            @param record: the record as dict or S3XML Element
+            @param mandatory: the mandatory fields of the table
+        """
+
+        lookup = self.originals.get(table._tablename)
+        if lookup is not None:
+            xml = current.xml
+            uid = xml.import_uid(record.get(xml.UID, None))
+            if uid and uid in lookup:
+                return lookup[uid]
+        return S3Resource.original(table, record, mandatory=mandatory)
+
+    # -------------------------------------------------------------------------
+    def forget(self, tablename, uid):
+        """
+            Remove a pre-fetched original which has been changed by the
+            import (so that subsequent look-ups go to the database)
+
+            @param tablename: the table name
+            @param uid: the record UID
+        """
+
+        lookup = self.originals.get(tablename)
+        if lookup is not None and uid:
+            lookup.pop(current.xml.import_uid(uid), None)
+        return
+
     # -------------------------------------------------------------------------
     def load_item(self, row):
         """
@@ -3318,6 +3655,12 @@ class S3ImportJob():
         ATTRIBUTE = current.xml.ATTRIBUTE
         METHOD = S3ImportItem.METHOD
 
+        # All items have been validated => drop the batch validation
+        # results, the committed records may change them
+        for validator in self.prevalidated:
+            validator.prevalidated.clear()
+        self.prevalidated = []
+
         # Resolve references
         import_list = []
         for item_id in self.items:
@@ -3374,7 +3717,10 @@ class S3ImportJob():
                         
         if failed:
             return False
-            
+
+        # Set-based owner/realm updates
+        self.commit_deferred()
+
         self.count = count
         self.mtime = mtime
         self.created = created
@@ -3382,6 +3728,88 @@ class S3ImportJob():
         self.deleted = deleted
         return True
 
+    # -------------------------------------------------------------------------
+    def defer(self, tablename, method, record_id):
+        """
+            Register a committed record for the set-based owner/realm
+            update at the end of the job (bulk commit mode)
+
+            @param tablename: the table name
+            @param method: the import method (create or update)
+            @param record_id: the record ID
+        """
+
+        key = (tablename, method)
+        deferred = self.deferred
+        if key not in deferred:
+            deferred[key] = []
+            self.deferred_keys.append(key)
+        deferred[key].append(record_id)
+        return
+
+    # -------------------------------------------------------------------------
+    def commit_deferred(self, chunk_size=500):
+        """
+            Set the owners of all created records, and update the realms
+            of all updated records (if configured for the table): the
+            ownership values are detected per record, but the records are
+            then updated with one query per table, chunk and distinct set
+            of values rather than one (or more) per record
+
+            @param chunk_size: maximum number of records per query
+
+            @note: tables are processed in the order of their first commit,
+                   so that realms of referenced records are set before
+                   those of the records referencing them
+        """
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+
+        CREATE = S3ImportItem.METHOD.CREATE
+        deferred = self.deferred
+
+        get_record_owner = auth.s3_get_record_owner
+        get_realm_entity = auth.get_realm_entity
+        update_record_owners = auth.s3_update_record_owners
+
+        for key in self.deferred_keys:
+            tablename, method = key
+            table = s3db.table(tablename)
+            record_ids = deferred[key]
+            if table is None or not record_ids:
+                continue
+            if method != CREATE and "realm_entity" not in table.fields:
+                continue
+            pkey = table._id
+            for i in xrange(0, len(record_ids), chunk_size):
+                query = pkey.belongs(record_ids[i:i + chunk_size])
+                rows = db(query).select(table.ALL)
+
+                # Group the records by their ownership values
+                groups = {}
+                for row in rows:
+                    if method == CREATE:
+                        row, data = get_record_owner(table, row)
+                        if not row:
+                            continue
+                    else:
+                        data = {"realm_entity": get_realm_entity(table, row)}
+                    if data:
+                        values = tuple(sorted(data.items()))
+                        groups.setdefault(values, []).append(row[pkey.name])
+
+                # Update each group with one query
+                for values, ids in groups.items():
+                    update_record_owners(table, ids,
+                                         update=method != CREATE,
+                                         **dict(values))
+
+        self.deferred = Storage()
+        self.deferred_keys = []
+        return
+
     # -------------------------------------------------------------------------
     def __define_tables(self):
         """
@@ -3573,6 +4001,10 @@ class S3BulkImporter(object):
         http://eden.sahanafoundation.org/wiki/DeveloperGuidelines/PrePopulate
     """
 
+    # Patterns to find resources generated by (and includes of) stylesheets
+    RESOURCE_NAME = re.compile(r'<resource\s+name="([a-z0-9]+_[a-z0-9_]+)"')
+    STYLESHEET_HREF = re.compile(r'<xsl:(?:include|import)\s+href="([^"]+)"')
+
     def __init__(self):
         """ Constructor """
 
@@ -3595,6 +4027,7 @@ class S3BulkImporter(object):
             }
         self.errorList = []
         self.resultList = []
+        self.timings = []
 
     # -------------------------------------------------------------------------
     def load_descriptor(self, path):
@@ -3603,7 +4036,10 @@ class S3BulkImporter(object):
             into the task property.
             The descriptor file is the file called tasks.cfg in path.
             The file consists of a comma separated list of:
-            application, resource name, csv filename, xsl filename.
+            application, resource name, csv filename, xsl filename,
+            and optionally extra data and a chunk size (number of rows
+            to import per transaction, only for CSV files without any
+            references between their rows).
         """
 
         source = open(os.path.join(path, "tasks.cfg"), "r")
@@ -3626,7 +4062,7 @@ class S3BulkImporter(object):
         """
 
         argCnt = len(details)
-        if argCnt == 4 or argCnt == 5:
+        if 4 <= argCnt <= 6:
              # remove any spaces and enclosing double quote
             app = details[0].strip('" ')
             res = details[1].strip('" ')
@@ -3665,9 +4101,16 @@ class S3BulkImporter(object):
                         "Failed to find a transform file %s, Giving up." % xslFileName)
                         return
             vars = None
-            if argCnt == 5:
+            if argCnt >= 5:
                 vars = details[4]
-            self.tasks.append([1, app, res, csv, xsl, vars])
+            chunk_size = None
+            if argCnt == 6:
+                try:
+                    chunk_size = int(details[5].strip('" '))
+                except ValueError:
+                    self.errorList.append(
+                    "WARNING: invalid chunk size %s ignored" % details[5])
+            self.tasks.append([1, app, res, csv, xsl, vars, chunk_size])
         else:
             self.errorList.append(
             "prepopulate error: job not of length 4. %s job ignored" % task)
@@ -3772,32 +4215,40 @@ class S3BulkImporter(object):
                     extra_data = extradata
                 except:
                     self.errorList.append("WARNING:5th parameter invalid, parameter %s ignored" % task[5])
+            # Split large CSV files into chunks?
+            chunk_size = task[6] if len(task) > 6 else None
+            if chunk_size and chunk_size > 0:
+                sources = self.csv_chunks(csv, chunk_size)
+            else:
+                sources = [csv]
+
             auth = current.auth
             auth.rollback = True
-            try:
-                # @todo: add extra_data and file attachments
-                result = resource.import_xml(csv,
-                                             format="csv",
-                                             stylesheet=task[4],
-                                             extra_data=extra_data)
-            except SyntaxError, e:
-                self.errorList.append("WARNING: import error - %s (file: %s, stylesheet: %s)" %
-                                     (e, filename, task[4]))
-                auth.rollback = False
-                return
+            for source in sources:
+                try:
+                    # @todo: add extra_data and file attachments
+                    result = resource.import_xml(source,
+                                                 format="csv",
+                                                 stylesheet=task[4],
+                                                 extra_data=extra_data)
+                except SyntaxError, e:
+                    self.errorList.append("WARNING: import error - %s (file: %s, stylesheet: %s)" %
+                                         (e, filename, task[4]))
+                    auth.rollback = False
+                    return
+
+                if not resource.error:
+                    current.db.commit()
+                else:
+                    # Must roll back if there was an error!
+                    error = resource.error
+                    self.errorList.append("%s - %s: %s" % (
+                                          task[3], resource.tablename, error))
+                    errors = current.xml.collect_errors(resource)
+                    if errors:
+                        self.errorList.extend(errors)
+                    current.db.rollback()
 
-            if not resource.error:
-                current.db.commit()
-            else:
-                # Must roll back if there was an error!
-                error = resource.error
-                self.errorList.append("%s - %s: %s" % (
-                                      task[3], resource.tablename, error))
-                errors = current.xml.collect_errors(resource)
-                if errors:
-                    self.errorList.extend(errors)
-                current.db.rollback()
-                
             auth.rollback = False
 
             # Restore the view
@@ -3805,6 +4256,7 @@ class S3BulkImporter(object):
             end = datetime.now()
             duration = end - start
             csvName = task[3][task[3].rfind("/") + 1:]
+            self.timings.append((csvName, duration))
             try:
                 # Python 2.7
                 duration = '{:.2f}'.format(duration.total_seconds() / 60)
@@ -3816,6 +4268,41 @@ class S3BulkImporter(object):
             if response.s3.debug:
                 s3_debug(msg)
 
+    # -------------------------------------------------------------------------
+    def csv_chunks(self, source, chunk_size):
+        """
+            Split a CSV source into chunks of rows (each with the header row)
+
+            @param source: the CSV source (file-like object)
+            @param chunk_size: the maximum number of rows per chunk
+
+            @return: generator of file-like objects
+        """
+
+        csv = self.csv
+        reader = csv.reader(source)
+        try:
+            header = reader.next()
+        except StopIteration:
+            return
+
+        def chunk(rows):
+            output = StringIO()
+            writer = csv.writer(output)
+            writer.writerow(header)
+            writer.writerows(rows)
+            output.seek(0)
+            return output
+
+        rows = []
+        for row in reader:
+            rows.append(row)
+            if len(rows) >= chunk_size:
+                yield chunk(rows)
+                rows = []
+        if rows:
+            yield chunk(rows)
+
     # -------------------------------------------------------------------------
     def execute_special_task(self, task):
         """
@@ -3842,6 +4329,7 @@ class S3BulkImporter(object):
                 self.errorList.append(error)
             end = datetime.now()
             duration = end - start
+            self.timings.append((fun, duration))
             try:
                 # Python 2.7
                 duration = '{:.2f}'.format(duration.total_seconds()/60)
@@ -4078,7 +4566,6 @@ class S3BulkImporter(object):
         # Create the working directory
         TEMP = os.path.join(cwd, "temp")
         if not os.path.exists(TEMP): # use web2py/temp/remote_csv as a cache
-            import tempfile
             TEMP = tempfile.gettempdir()
         tempPath = os.path.join(TEMP, "remote_csv")
         if not os.path.exists(tempPath):
@@ -4145,10 +4632,256 @@ class S3BulkImporter(object):
         """
 
         self.load_descriptor(path)
-        for task in self.tasks:
+
+        # Run independent import tasks concurrently?
+        workers = current.deployment_settings.get_base_prepopulate_workers()
+        if workers > 1 and hasattr(os, "fork") and \
+           current.db._dbname != "sqlite":
+            self.perform_tasks_parallel(self.tasks, workers)
+        else:
+            for task in self.tasks:
+                if task[0] == 1:
+                    self.execute_import_task(task)
+                elif task[0] == 2:
+                    self.execute_special_task(task)
+
+    # -------------------------------------------------------------------------
+    def perform_tasks_parallel(self, tasks, workers):
+        """
+            Execute the import tasks in worker processes, running tasks
+            concurrently as long as they do not depend on each other
+
+            @param tasks: the list of tasks
+            @param workers: the maximum number of concurrent worker processes
+
+            @note: special tasks are executed in this process, and only
+                   when all previous tasks have been completed
+        """
+
+        import multiprocessing
+        from Queue import Empty
+
+        db = current.db
+
+        depends = self.dependencies(tasks)
+        pending = range(len(tasks))
+        running = {}
+        done = set()
+
+        queue = multiprocessing.Queue()
+        while pending or running:
+
+            # Start all tasks which are ready
+            for index in list(pending):
+                if len(running) >= workers:
+                    break
+                if not depends[index] <= done:
+                    continue
+                pending.remove(index)
+                task = tasks[index]
+                if task[0] == 2:
+                    # Nothing else can run at this point
+                    self.execute_special_task(task)
+                    db.commit()
+                    done.add(index)
+                    continue
+                elif task[0] != 1:
+                    done.add(index)
+                    continue
+                # Workers must see all previous changes
+                db.commit()
+                process = multiprocessing.Process(target=self.execute_forked,
+                                                  args=(index, task, queue))
+                process.start()
+                running[index] = process
+
+            if not running:
+                continue
+
+            # Wait for the next task to complete
+            try:
+                index, errors, results, timings = queue.get(True, 1)
+            except Empty:
+                for index, process in running.items():
+                    exitcode = process.exitcode
+                    if exitcode is not None and exitcode != 0:
+                        # Worker has died without reporting back
+                        del running[index]
+                        done.add(index)
+                        self.errorList.append(
+                            "prepopulate error: worker for %s failed (exit code %s)" %
+                            (tasks[index][3], exitcode))
+                continue
+            process = running.pop(index, None)
+            if process is not None:
+                process.join()
+            done.add(index)
+            self.errorList.extend(errors)
+            self.resultList.extend(results)
+            self.timings.extend(timings)
+
+        return
+
+    # -------------------------------------------------------------------------
+    def execute_forked(self, index, task, queue):
+        """
+            Execute an import task in a worker process (forked), and report
+            the results back to the parent process
+
+            @param index: the index of the task
+            @param task: the task
+            @param queue: the multiprocessing.Queue to report to
+        """
+
+        self.errorList = []
+        self.resultList = []
+        self.timings = []
+
+        db = current.db
+        adapter = db._adapter
+        try:
+            # Open a separate connection for this process, but keep the
+            # inherited one referenced: closing it (or having it garbage-
+            # collected) would terminate the DB session of the parent
+            self._inherited = (adapter.connection, adapter.cursor)
+            adapter.connection = None
+            adapter.pool_size = 0
+            adapter.reconnect()
+            self.execute_import_task(task)
+        except:
+            db.rollback()
+            self.errorList.append("prepopulate error: %s (file: %s)" %
+                                  (sys.exc_info()[1], task[3]))
+        try:
+            adapter.connection.close()
+        except:
+            pass
+        queue.put((index, self.errorList, self.resultList, self.timings))
+
+    # -------------------------------------------------------------------------
+    def dependencies(self, tasks):
+        """
+            Find out which of the previous tasks each task depends on
+
+            @param tasks: the list of tasks
+            @return: list of sets of task indices
+
+            @note: import tasks depend on all previous import tasks which
+                   write to the same tables, or to tables referenced by the
+                   other task (or vice versa); special tasks depend on all
+                   previous tasks, and all subsequent tasks depend on them
+        """
+
+        tables = []
+        depends = []
+        barrier = set()
+        for index, task in enumerate(tasks):
             if task[0] == 1:
-                self.execute_import_task(task)
-            elif task[0] == 2:
-                self.execute_special_task(task)
+                written, supers, referenced = self.task_tables(task)
+                required = set(barrier)
+                for i, other in enumerate(tables):
+                    if other is None or i in required:
+                        continue
+                    w, s, r = other
+                    if written & w or \
+                       written & r or w & referenced or \
+                       supers & r or s & referenced:
+                        required.add(i)
+                tables.append((written, supers, referenced))
+            else:
+                required = set(range(index))
+                barrier = set([index])
+                tables.append(None)
+            depends.append(required)
+        return depends
+
+    # -------------------------------------------------------------------------
+    def task_tables(self, task):
+        """
+            Find the tables an import task writes to, their super-entities,
+            and the tables they reference
+
+            @param task: the import task
+            @return: tuple of sets of table names (written, supers, referenced)
+        """
+
+        s3db = current.s3db
+
+        tablename = "%s_%s" % (task[1], task[2])
+        if tablename in self.alternateTables:
+            details = self.alternateTables[tablename]
+            tablename = details.get("tablename", tablename)
+
+        names = set([tablename]) | self.stylesheet_tables(task[4])
+
+        meta = set(s3_all_meta_field_names())
+        written = set()
+        supers = set()
+        referenced = set()
+        for name in names:
+            table = s3db.table(name)
+            if table is None:
+                continue
+            written.add(name)
+            super_entity = s3db.get_config(name, "super_entity")
+            if super_entity:
+                if isinstance(super_entity, (list, tuple)):
+                    supers |= set(super_entity)
+                else:
+                    supers.add(super_entity)
+            for fn in table.fields:
+                if fn in meta:
+                    continue
+                ktablename = s3_get_foreign_key(table[fn])[0]
+                if ktablename:
+                    referenced.add(ktablename)
+        return written, supers, referenced
+
+    # -------------------------------------------------------------------------
+    def stylesheet_tables(self, path, seen=None):
+        """
+            Find the names of all resources which can be generated by a
+            stylesheet (including stylesheets it includes or imports)
+
+            @param path: the stylesheet path
+            @param seen: set of already inspected stylesheets (internal)
+            @return: set of table names
+        """
+
+        if seen is None:
+            seen = set()
+        path = os.path.abspath(path)
+        if path in seen:
+            return set()
+        seen.add(path)
+
+        try:
+            stylesheet = open(path, "r").read()
+        except IOError:
+            return set()
+
+        names = set(self.RESOURCE_NAME.findall(stylesheet))
+        folder = os.path.dirname(path)
+        for href in self.STYLESHEET_HREF.findall(stylesheet):
+            names |= self.stylesheet_tables(os.path.join(folder, href),
+                                            seen=seen)
+        return names
+
+    # -------------------------------------------------------------------------
+    def timing_report(self, limit=10):
+        """
+            Report of the slowest tasks
+
+            @param limit: the maximum number of tasks to report
+            @return: list of lines
+        """
+
+        timings = sorted(self.timings, key=lambda t: t[1], reverse=True)
+        report = []
+        for name, duration in timings[:limit]:
+            seconds = duration.days * 86400 + duration.seconds + \
+                      duration.microseconds / 1000000.0
+            report.append("%8.1fs %s" % (seconds, name))
+        return report
 
 # END =========================================================================
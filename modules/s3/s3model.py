@@ -29,6 +29,8 @@
 
 __all__ = ["S3Model", "S3ModelExtensions"]
 
+import threading
+
 from gluon import *
 from gluon.dal import Table
 # Here are dependencies listed for reference:
@@ -37,6 +39,7 @@ from gluon.dal import Table
 #from gluon.validators import IS_EMPTY_OR
 from gluon.storage import Storage
 
+from s3fields import S3RepresentCache
 from s3navigation import S3ScriptItem
 from s3resource import S3Resource
 from s3validators import IS_ONE_OF
@@ -64,6 +67,14 @@ class S3Model(object):
     LOAD = "s3_model_load"
     DELETED = "deleted"
 
+    # Process-wide index of the model modules {prefix: Storage}
+    INDEX = {}
+    INDEX_LOCK = threading.Lock()
+
+    # Process-wide write counters {tablename: version}
+    TABLE_VERSIONS = {}
+    TABLE_VERSIONS_LOCK = threading.Lock()
+
     def __init__(self, module=None):
         """ Constructor """
 
@@ -209,30 +220,16 @@ class S3Model(object):
             return ogetattr(db, tablename)
         else:
             prefix, name = tablename.split("_", 1)
-            if hasattr(models, prefix):
-                module = models.__dict__[prefix]
-                loaded = False
-                generic = []
-                for n in module.__all__:
-                    model = module.__dict__[n]
-                    if hasattr(model, "_s3model"):
-                        if loaded:
-                            continue
-                        if hasattr(model, "names"):
-                            if tablename in model.names:
-                                model(prefix)
-                                loaded = True
-                            else:
-                                continue
-                        else:
-                            generic.append(n)
-                    else:
-                        if n == tablename:
-                            s3db.classes[tablename] = (prefix, n)
-                            found = model
-                            loaded = True
-                if not loaded:
-                    [module.__dict__[n](prefix) for n in generic]
+            index = cls.index(prefix)
+            if index is not None:
+                module = index.module
+                if tablename in index.names:
+                    module.__dict__[index.names[tablename]](prefix)
+                elif tablename in index.objects:
+                    s3db.classes[tablename] = (prefix, tablename)
+                    found = module.__dict__[tablename]
+                else:
+                    [module.__dict__[n](prefix) for n in index.generic]
         if found:
             return found
         if not db_only and tablename in s3:
@@ -262,28 +259,16 @@ class S3Model(object):
             return s3[name]
         elif "_" in name:
             prefix = name.split("_", 1)[0]
-            models = current.models
-            if hasattr(models, prefix):
-                module = models.__dict__[prefix]
-                loaded = False
-                generic = []
-                for n in module.__all__:
-                    model = module.__dict__[n]
-                    if type(model).__name__ == "type":
-                        if loaded:
-                            continue
-                        if hasattr(model, "names"):
-                            if name in model.names:
-                                model(prefix)
-                                loaded = True
-                                generic = []
-                            else:
-                                continue
-                        else:
-                            generic.append(n)
-                    elif n.startswith("%s_" % prefix):
-                        s3[n] = model
-                [module.__dict__[n](prefix) for n in generic]
+            index = cls.index(prefix)
+            if index is not None:
+                module = index.module
+                for n in index.objects:
+                    if n.startswith("%s_" % prefix):
+                        s3[n] = module.__dict__[n]
+                if name in index.names:
+                    module.__dict__[index.names[name]](prefix)
+                elif name not in s3:
+                    [module.__dict__[n](prefix) for n in index.generic]
         if name in s3:
             return s3[name]
         elif isinstance(default, Exception):
@@ -301,18 +286,70 @@ class S3Model(object):
         s3 = current.response.s3
         if s3 is None:
             s3 = current.response.s3 = Storage()
+        index = cls.index(name)
+        if index is not None:
+            module = index.module
+            for n in index.models:
+                module.__dict__[n](name)
+            for n in index.objects:
+                if n.startswith("%s_" % name):
+                    s3[n] = module.__dict__[n]
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def index(cls, prefix):
+        """
+            Get the index entry for a model module, to find the model
+            for a name without scanning the module. The index is
+            process-wide, entries are built once per module (and again
+            only if the module has been reloaded).
+
+            @param prefix: the module prefix
+
+            @return: Storage with the following items, or None if there
+                     is no model module for this prefix:
+                        - module: the module
+                        - models: names of all model classes in the module
+                        - names: dict {name: model class name} of all names
+                                 declared by the model classes
+                        - generic: names of the model classes without names
+                                   declaration (=which have to be loaded if
+                                   a name can not be found otherwise)
+                        - objects: names of all other objects in the module
+        """
+
         models = current.models
+        if models is None:
+            return None
+        module = models.__dict__.get(prefix)
+        if module is None or type(module).__name__ != "module":
+            return None
 
-        if models is not None and hasattr(models, name):
-            module = models.__dict__[name]
-            for n in module.__all__:
+        index = cls.INDEX.get(prefix)
+        if index is None or index.module is not module:
+            index = Storage(module = module,
+                            models = [],
+                            names = {},
+                            generic = [],
+                            objects = set(),
+                            )
+            for n in getattr(module, "__all__", []):
                 model = module.__dict__[n]
-                if type(model).__name__ == "type" and \
-                   issubclass(model, S3Model):
-                    model(name)
-                elif n.startswith("%s_" % name):
-                    s3[n] = model
-        return
+                if hasattr(model, "_s3model"):
+                    index.models.append(n)
+                    if hasattr(model, "names"):
+                        for name in model.names:
+                            # First model declaring a name wins
+                            if name not in index.names:
+                                index.names[name] = n
+                    else:
+                        index.generic.append(n)
+                else:
+                    index.objects.add(n)
+            with cls.INDEX_LOCK:
+                cls.INDEX[prefix] = index
+        return index
 
     # -------------------------------------------------------------------------
     @classmethod
@@ -351,8 +388,40 @@ class S3Model(object):
             table = ogetattr(db, tablename)
         else:
             table = db.define_table(tablename, *fields, **args)
+            if hasattr(table, "_after_insert"):
+                # Count writes to this table
+                written = lambda *args: cls.table_written(tablename)
+                table._after_insert.append(written)
+                table._after_update.append(written)
+                table._after_delete.append(written)
         return table
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def table_written(cls, tablename):
+        """
+            Increase the write counter of a table (called after each
+            insert, update or delete in the table)
+
+            @param tablename: the tablename
+        """
+
+        with cls.TABLE_VERSIONS_LOCK:
+            versions = cls.TABLE_VERSIONS
+            versions[tablename] = versions.get(tablename, 0) + 1
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def table_version(cls, tablename):
+        """
+            Get the write counter of a table, to invalidate data cached
+            in this process whenever the table is written to
+
+            @param tablename: the tablename
+        """
+
+        return cls.TABLE_VERSIONS.get(tablename, 0)
+
     # -------------------------------------------------------------------------
     # Resource configuration
     # -------------------------------------------------------------------------
@@ -976,14 +1045,18 @@ class S3Model(object):
 
         get_config = cls.get_config
 
-        # Get all super-entities of this table
+        # Get the record
+        id = record.get("id", None)
+
+        # Representations of this record may have changed
         tablename = table._tablename
+        S3RepresentCache.clear_record(tablename, id)
+
+        # Get all super-entities of this table
         supertables = get_config(tablename, "super_entity")
         if not supertables:
             return False
 
-        # Get the record
-        id = record.get("id", None)
         if not id:
             return False
 
@@ -1045,6 +1118,7 @@ class S3Model(object):
             if row:
                 # Update the super-entity record
                 db(s._id == skey).update(**data)
+                S3RepresentCache.clear_record(tn, skey)
                 super_keys[key] = skey
                 data[key] = skey
                 form = Storage(vars=data)
@@ -1082,7 +1156,12 @@ class S3Model(object):
         """
 
         get_config = cls.get_config
-        supertable = get_config(table._tablename, "super_entity")
+
+        # Forget the representations of this record
+        tablename = table._tablename
+        S3RepresentCache.clear_record(tablename, record.get(table._id.name))
+
+        supertable = get_config(tablename, "super_entity")
         if not supertable:
             return True
         if not isinstance(supertable, (list, tuple)):
@@ -40,11 +40,24 @@ __all__ = ["S3Msg",
            ]
 
 import base64
+import copy
 import datetime
+import email.utils
+import httplib
 import os
+import Queue
+import smtplib
+import socket
 import string
+import sys
+import threading
+import time
 import urllib
 import urllib2
+import urlparse
+
+from email.header import Header
+from email.mime.text import MIMEText
 
 try:
     from cStringIO import StringIO    # Faster, where available
@@ -88,6 +101,9 @@ TWITTER_HAS_PREV_PREFIX = u'\u2026 '
 class S3Msg(object):
     """ Messaging framework """
 
+    # Maximum number of outbox entries to send per batch
+    OUTBOX_BATCH_SIZE = 500
+
     def __init__(self,
                  modem=None):
 
@@ -434,6 +450,7 @@ class S3Msg(object):
         db = current.db
         s3db = current.s3db
 
+        outgoing_sms_handler = None
         if contact_method == "SMS":
             table = s3db.msg_sms_outbound_gateway
             settings = db(table.id > 0).select(table.outgoing_sms_handler,
@@ -444,56 +461,6 @@ class S3Msg(object):
                 raise ValueError("No SMS handler defined!")
             outgoing_sms_handler = settings.outgoing_sms_handler
 
-        def dispatch_to_pe_id(pe_id,
-                              subject,
-                              message,
-                              outbox_id,
-                              message_id,
-                              contact_method=contact_method):
-            """
-                Helper method to send messages by pe_id
-
-                @param pe_id: the pe_id
-                @param subject: the message subject
-                @param message: the message body
-                @param outbox_id: the outbox record ID
-                @param message_id: the message_id
-                @param contact_method: the contact method
-            """
-
-            # Get the recipient's contact info
-            table = s3db.pr_contact
-            query = (table.pe_id == pe_id) & \
-                    (table.contact_method == contact_method) & \
-                    (table.deleted == False)
-            contact_info = db(query).select(table.value,
-                                            orderby=table.priority,
-                                            limitby=(0, 1)).first()
-            # Send the message
-            if contact_info:
-                address = contact_info.value
-                if contact_method == "EMAIL":
-                    return self.send_email(address,
-                                           subject,
-                                           message)
-                elif contact_method == "SMS":
-                    if outgoing_sms_handler == "WEB_API":
-                        return self.send_sms_via_api(address, message)
-                    elif outgoing_sms_handler == "SMTP":
-                        return self.send_sms_via_smtp(address, message)
-                    elif outgoing_sms_handler == "MODEM":
-                        return self.send_sms_via_modem(address, message)
-                    elif outgoing_sms_handler == "TROPO":
-                        # NB This does not mean the message is sent
-                        return self.send_text_via_tropo(outbox_id,
-                                                        message_id,
-                                                        address,
-                                                        message)
-                elif contact_method == "TWITTER":
-                    return self.send_tweet(message, address)
-
-            return False
-
         outbox = s3db.msg_outbox
 
         petable = s3db.pr_pentity
@@ -553,6 +520,10 @@ class S3Msg(object):
                            (ptable.deleted != True))
                  ]
 
+        lookups = {"pr_group": (gtable, gleft),
+                   "org_organisation": (otable, oleft),
+                   }
+
         atable = s3db.table("deploy_alert", None)
         if atable:
             ltable = db.deploy_alert_recipient
@@ -563,15 +534,14 @@ class S3Msg(object):
                      ptable.on((ptable.id == htable.person_id) &
                                (ptable.deleted != True))
                      ]
+            lookups["deploy_alert"] = (atable, aleft)
 
-        # chainrun: used to fire process_outbox again,
-        # when messages are sent to groups or organisations
-        chainrun = False
-
+        # Sort the messages by recipient type
+        messages = []
+        multiple = {}
+        invalid = []
         for row in rows:
 
-            status = True
-
             if contact_method == "EMAIL":
                 subject = row["msg_email.subject"] or ""
                 message = row["msg_email.body"] or ""
@@ -591,85 +561,297 @@ class S3Msg(object):
                 continue
 
             row = row["msg_outbox"]
-            pe_id = row.pe_id
-            message_id = row.message_id
-
-            if entity_type == "pr_group":
-                # Re-queue the message for each member in the group
-                gquery = (gtable.pe_id == pe_id)
-                recipients = db(gquery).select(ptable.pe_id, left=gleft)
-                pe_ids = set(r.pe_id for r in recipients)
-                pe_ids.discard(None)
-                if pe_ids:
-                    for pe_id in pe_ids:
-                        outbox.insert(message_id=message_id,
-                                      pe_id=pe_id,
-                                      pr_message_method=contact_method,
-                                      system_generated=True)
-                    chainrun = True
-                status = True
-
-            elif entity_type == "deploy_alert":
-                # Re-queue the message for each HR in the group
-                aquery = (atable.pe_id == pe_id)
-                recipients = db(aquery).select(ptable.pe_id, left=aleft)
-                pe_ids = set(r.pe_id for r in recipients)
-                pe_ids.discard(None)
-                if pe_ids:
-                    for pe_id in pe_ids:
-                        outbox.insert(message_id=message_id,
-                                      pe_id=pe_id,
-                                      pr_message_method=contact_method,
-                                      system_generated=True)
-                    chainrun = True
-                status = True
-
-            elif entity_type == "org_organisation":
-                # Re-queue the message for each HR in the organisation
-                oquery = (otable.pe_id == pe_id)
-                recipients = db(oquery).select(ptable.pe_id, left=oleft)
-                pe_ids = set(r.pe_id for r in recipients)
-                pe_ids.discard(None)
-                if pe_ids:
-                    for pe_id in pe_ids:
-                        outbox.insert(message_id=message_id,
-                                      pe_id=pe_id,
-                                      pr_message_method=contact_method,
-                                      system_generated=True)
-                    chainrun = True
-                status = True
-
+            if entity_type in lookups:
+                if entity_type in multiple:
+                    multiple[entity_type].append(row)
+                else:
+                    multiple[entity_type] = [row]
             elif entity_type == "pr_person":
-                # Send the message to this person
-                try:
-                    status = dispatch_to_pe_id(pe_id,
-                                               subject,
-                                               message,
-                                               row.id,
-                                               message_id)
-                except:
-                    status = False
+                messages.append((row, subject, message))
             else:
                 # Unsupported entity type
-                row.update_record(status = 4) # Invalid
-                db.commit()
-                continue
+                invalid.append(row.id)
 
-            if status:
-                row.update_record(status = 2) # Sent
-                db.commit()
-            else:
-                if row.retries > 0:
-                    row.update_record(retries = row.retries - 1)
-                    db.commit()
+        if invalid:
+            db(outbox.id.belongs(invalid)).update(status = 4) # Invalid
+            db.commit()
+
+        # chainrun: used to fire process_outbox again,
+        # when messages are sent to groups or organisations
+        chainrun = False
+
+        # Re-queue the messages for each member of groups, alerts
+        # and organisations, looking up all members at once
+        for entity_type, entity_rows in multiple.items():
+            etable, eleft = lookups[entity_type]
+            pe_ids = set(row.pe_id for row in entity_rows)
+            members = db(etable.pe_id.belongs(pe_ids)).select(etable.pe_id,
+                                                              ptable.pe_id,
+                                                              left=eleft)
+            recipients = {}
+            for member in members:
+                pe_id = member[ptable.pe_id]
+                if pe_id is None:
+                    continue
+                entity_id = member[etable.pe_id]
+                if entity_id in recipients:
+                    recipients[entity_id].add(pe_id)
+                else:
+                    recipients[entity_id] = set([pe_id])
+            for row in entity_rows:
+                message_id = row.message_id
+                for pe_id in recipients.get(row.pe_id, ()):
+                    outbox.insert(message_id=message_id,
+                                  pe_id=pe_id,
+                                  pr_message_method=contact_method,
+                                  system_generated=True)
+                    chainrun = True
+            query = outbox.id.belongs([row.id for row in entity_rows])
+            db(query).update(status = 2) # Sent
+            db.commit()
+
+        # Send the messages to persons, in batches
+        ctable = s3db.pr_contact
+        batch_size = self.OUTBOX_BATCH_SIZE
+        for i in xrange(0, len(messages), batch_size):
+            batch = messages[i:i + batch_size]
+
+            # Look up the contact addresses of all recipients at once
+            pe_ids = set(row.pe_id for row, subject, message in batch)
+            query = (ctable.pe_id.belongs(pe_ids)) & \
+                    (ctable.contact_method == contact_method) & \
+                    (ctable.deleted == False)
+            contacts = db(query).select(ctable.pe_id,
+                                        ctable.value,
+                                        orderby=ctable.priority)
+            addresses = {}
+            for contact in contacts:
+                if contact.pe_id not in addresses:
+                    addresses[contact.pe_id] = contact.value
+
+            jobs = []
+            for row, subject, message in batch:
+                address = addresses.get(row.pe_id)
+                if address:
+                    jobs.append((row, address, subject, message))
+            status = self.dispatch(contact_method,
+                                   jobs,
+                                   sms_handler=outgoing_sms_handler)
+
+            # Update the outbox status
+            sent = []
+            retry = []
+            failed = []
+            for row, subject, message in batch:
+                if status.get(row.id):
+                    sent.append(row.id)
+                elif row.retries > 0:
+                    retry.append(row.id)
                 elif row.retries is not None:
-                    row.update_record(status = 5) # Failed
+                    failed.append(row.id)
+            if sent:
+                db(outbox.id.belongs(sent)).update(status = 2) # Sent
+            if retry:
+                db(outbox.id.belongs(retry)).update(retries = outbox.retries - 1)
+            if failed:
+                db(outbox.id.belongs(failed)).update(status = 5) # Failed
+            db.commit()
 
         if chainrun:
             self.process_outbox(contact_method)
 
         return
 
+    # -------------------------------------------------------------------------
+    def dispatch(self, contact_method, jobs, sms_handler=None):
+        """
+            Send outbox messages to their recipients, concurrently and
+            over persistent connections (one per worker thread, reused
+            for all messages the worker sends) if the gateway allows
+
+            @param contact_method: the contact method
+            @param jobs: list of tuples (outbox row, address, subject, message)
+            @param sms_handler: the outgoing SMS handler (for SMS)
+
+            @return: dict {outbox_id: True|False}
+
+            @note: custom implementations of send_email (etc.) in
+                   instances or subclasses are honoured, but called one
+                   message at a time
+        """
+
+        status = {}
+        if not jobs:
+            return status
+
+        # Find a pooled sender for the gateway
+        sender = None
+        gateway = None
+        if contact_method == "EMAIL":
+            if not self.overridden("send_email"):
+                sender = self.smtp_sender()
+                gateway = "EMAIL"
+        elif contact_method == "SMS":
+            if sms_handler == "WEB_API":
+                if not self.overridden("send_sms_via_api"):
+                    sender = self.webapi_sender()
+                    gateway = sms_handler
+            elif sms_handler == "SMTP":
+                if not self.overridden("send_sms_via_smtp") and \
+                   not self.overridden("send_email"):
+                    sender = self.smtp_sender(sms=True)
+                    gateway = sms_handler
+
+        if sender is None:
+            # Send one by one
+            for row, address, subject, message in jobs:
+                try:
+                    status[row.id] = self.send_to_address(contact_method,
+                                                          address,
+                                                          subject,
+                                                          message,
+                                                          row.id,
+                                                          row.message_id,
+                                                          sms_handler)
+                except:
+                    status[row.id] = False
+            return status
+
+        factory, convert = sender
+        jobs = [(row.id, convert(address), subject, message)
+                for row, address, subject, message in jobs]
+
+        # Apply the daily limit for emails
+        if gateway in ("EMAIL", "SMTP"):
+            jobs = jobs[:self.mail_quota(len(jobs))]
+
+        settings = current.deployment_settings
+        dispatcher = S3MsgDispatcher(factory,
+                                     workers=settings.get_msg_outbox_workers(),
+                                     rate=settings.get_msg_send_rate(gateway))
+        return dispatcher.dispatch(jobs)
+
+    # -------------------------------------------------------------------------
+    def overridden(self, name):
+        """
+            Check whether a send method has been overridden (in the instance
+            or a subclass), and hence must be used instead of pooled senders
+
+            @param name: the method name
+        """
+
+        method = getattr(self, name)
+        return getattr(method, "im_func", None) is not \
+               getattr(S3Msg, name).im_func
+
+    # -------------------------------------------------------------------------
+    def send_to_address(self,
+                        contact_method,
+                        address,
+                        subject,
+                        message,
+                        outbox_id,
+                        message_id,
+                        sms_handler=None):
+        """
+            Send a single message to an address
+
+            @param contact_method: the contact method
+            @param address: the address (as in pr_contact.value)
+            @param subject: the message subject
+            @param message: the message body
+            @param outbox_id: the outbox record ID
+            @param message_id: the message_id
+            @param sms_handler: the outgoing SMS handler (for SMS)
+        """
+
+        if contact_method == "EMAIL":
+            return self.send_email(address,
+                                   subject,
+                                   message)
+        elif contact_method == "SMS":
+            if sms_handler == "WEB_API":
+                return self.send_sms_via_api(address, message)
+            elif sms_handler == "SMTP":
+                return self.send_sms_via_smtp(address, message)
+            elif sms_handler == "MODEM":
+                return self.send_sms_via_modem(address, message)
+            elif sms_handler == "TROPO":
+                # NB This does not mean the message is sent
+                return self.send_text_via_tropo(outbox_id,
+                                                message_id,
+                                                address,
+                                                message)
+        elif contact_method == "TWITTER":
+            return self.send_tweet(message, address)
+
+        return False
+
+    # -------------------------------------------------------------------------
+    def smtp_sender(self, sms=False):
+        """
+            Get a factory for persistent SMTP connections with the
+            settings of current.mail
+
+            @param sms: for the SMS-via-SMTP gateway
+
+            @return: tuple (factory, address converter), or None if
+                     email sending is disabled
+        """
+
+        settings = current.deployment_settings
+        if not settings.get_mail_sender():
+            return None
+
+        mail = current.mail
+        if not mail.settings.server or mail.settings.server == "gae":
+            return None
+
+        if sms:
+            table = current.s3db.msg_sms_smtp_channel
+            query = (table.enabled == True)
+            channel = current.db(query).select(table.address,
+                                               limitby=(0, 1)).first()
+            if not channel:
+                return None
+            sanitise_phone = self.sanitise_phone
+            domain = channel.address
+            convert = lambda mobile: "%s@%s" % (sanitise_phone(mobile), domain)
+        else:
+            convert = lambda address: address
+
+        factory = lambda: S3SMTPSender(mail)
+        return factory, convert
+
+    # -------------------------------------------------------------------------
+    def webapi_sender(self):
+        """
+            Get a factory for persistent HTTP connections to the SMS
+            Web API gateway
+
+            @return: tuple (factory, address converter), or None if
+                     there is no enabled Web API channel
+        """
+
+        table = current.s3db.msg_sms_webapi_channel
+        query = (table.enabled == True)
+        sms_api = current.db(query).select(limitby=(0, 1)).first()
+        if not sms_api:
+            return None
+
+        parameters = {}
+        for parameter in sms_api.parameters.split("&"):
+            parameter = parameter.split("=")
+            parameters[parameter[0]] = parameter[1]
+
+        factory = lambda: S3HTTPSender(sms_api.url,
+                                       parameters,
+                                       sms_api.message_variable,
+                                       sms_api.to_variable,
+                                       username=sms_api.username,
+                                       password=sms_api.password)
+        return factory, self.sanitise_phone
+
     # -------------------------------------------------------------------------
     # Send Email
     # -------------------------------------------------------------------------
@@ -697,18 +879,9 @@ class S3Msg(object):
             s3_debug("Email sending disabled until the Sender address has been set in models/000_config.py")
             return False
 
-        limit = settings.get_mail_limit()
-        if limit:
-            # Check whether we've reached our daily limit
-            day = datetime.timedelta(hours=24)
-            cutoff = current.request.utcnow - day
-            table = current.s3db.msg_channel_limit
-            # @ToDo: Include Channel Info
-            check = current.db(table.created_on > cutoff).count()
-            if check >= limit:
-                return False
-            # Log the sending
-            table.insert()
+        if not self.mail_quota():
+            # Daily limit reached
+            return False
 
         result = current.mail.send(to,
                                    subject=subject,
@@ -728,6 +901,32 @@ class S3Msg(object):
 
         return result
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def mail_quota(count=1):
+        """
+            Check the daily limit for emails and log the sending attempts
+
+            @param count: the number of emails to send
+
+            @return: the number of emails that can be sent
+        """
+
+        limit = current.deployment_settings.get_mail_limit()
+        if not limit:
+            return count
+
+        day = datetime.timedelta(hours=24)
+        cutoff = current.request.utcnow - day
+        table = current.s3db.msg_channel_limit
+        # @ToDo: Include Channel Info
+        check = current.db(table.created_on > cutoff).count()
+        count = max(min(count, limit - check), 0)
+        # Log the sending (attempts count against the limit)
+        for i in xrange(count):
+            table.insert()
+        return count
+
     # -------------------------------------------------------------------------
     def send_email_by_pe_id(self,
                             pe_id,
@@ -893,12 +1092,7 @@ class S3Msg(object):
         except urllib2.HTTPError, e:
             return False
         else:
-            # @ToDo: parse result
-            # if service == MobileCommons:
-            # Good = <response success="true"></response>
-            # Bad = <response success="false"><errror id="id" message="message"></response>
-            # http://www.mobilecommons.com/mobile-commons-api/rest/#errors
-            return True
+            return S3HTTPSender.parse(result.getcode(), output)
 
     # -------------------------------------------------------------------------
     def send_sms_via_smtp(self, mobile, text=""):
@@ -1805,7 +1999,6 @@ class S3Msg(object):
         """ Process results of twitter search with KeyGraph."""
 
         import subprocess
-        import os
         import tempfile
 
         db = current.db
@@ -1873,6 +2066,327 @@ class S3Msg(object):
         else:
             return hashdef["defs"]["def"]["text"]
 
+# =============================================================================
+class S3MsgDispatcher(object):
+    """
+        Helper to send messages concurrently through a bounded pool of
+        worker threads, each using its own persistent gateway connection
+
+        @note: the worker threads have no access to current (and hence
+               the database), so all data must be resolved beforehand
+    """
+
+    def __init__(self, factory, workers=1, rate=None):
+        """
+            Constructor
+
+            @param factory: function to create a sender (one per worker)
+            @param workers: the maximum number of worker threads
+            @param rate: the maximum number of messages per second
+                         across all workers (None for unlimited)
+        """
+
+        self.factory = factory
+        self.workers = max(workers or 1, 1)
+
+        if rate:
+            self.interval = 1.0 / rate
+        else:
+            self.interval = None
+        self.next_send = 0
+        self.lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    def dispatch(self, jobs):
+        """
+            Send the messages
+
+            @param jobs: list of tuples (key, address, subject, message)
+
+            @return: dict {key: True|False}
+        """
+
+        status = {}
+        queue = Queue.Queue()
+        for job in jobs:
+            queue.put(job)
+
+        def worker():
+            sender = self.factory()
+            try:
+                while True:
+                    try:
+                        key, address, subject, message = queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    self.throttle()
+                    try:
+                        status[key] = sender.send(address, subject, message)
+                    except:
+                        status[key] = False
+            finally:
+                sender.close()
+
+        workers = min(self.workers, len(jobs))
+        if workers <= 1:
+            worker()
+        else:
+            threads = [threading.Thread(target=worker)
+                       for i in xrange(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        return status
+
+    # -------------------------------------------------------------------------
+    def throttle(self):
+        """ Wait for the next send slot if the rate is limited """
+
+        interval = self.interval
+        if not interval:
+            return
+
+        lock = self.lock
+        lock.acquire()
+        try:
+            now = time.time()
+            wait = self.next_send - now
+            self.next_send = max(now, self.next_send) + interval
+        finally:
+            lock.release()
+        if wait > 0:
+            time.sleep(wait)
+
+# =============================================================================
+class S3SMTPSender(object):
+    """
+        Sends emails with the settings of web2py Mail (current.mail) over
+        a persistent SMTP connection, which is opened with the first
+        message and reused until close()
+
+        @note: for servers other than SMTP (e.g. "logging") or with
+               signed/encrypted mails, web2py Mail is used to send each
+               message instead
+    """
+
+    def __init__(self, mail):
+        """
+            Constructor
+
+            @param mail: the web2py Mail instance (current.mail)
+        """
+
+        settings = mail.settings
+        self.settings = settings
+
+        if settings.server == "logging" or \
+           getattr(settings, "cipher_type", None):
+            # Mail keeps the result of the last send in the instance
+            self.mail = copy.copy(mail)
+        else:
+            self.mail = None
+
+        self.connection = None
+
+    # -------------------------------------------------------------------------
+    def connect(self):
+        """ Open the SMTP connection """
+
+        settings = self.settings
+        hostname = getattr(settings, "hostname", None)
+
+        smtp_args = settings.server.split(":")
+        if getattr(settings, "ssl", False):
+            connection = smtplib.SMTP_SSL(*smtp_args)
+        else:
+            connection = smtplib.SMTP(*smtp_args)
+            if settings.tls:
+                connection.ehlo(hostname)
+                connection.starttls()
+                connection.ehlo(hostname)
+        if settings.login:
+            connection.login(*settings.login.split(":", 1))
+        self.connection = connection
+
+    # -------------------------------------------------------------------------
+    def send(self, to, subject, message):
+        """
+            Send an email
+
+            @param to: the recipient address
+            @param subject: the subject
+            @param message: the message body (text or HTML)
+        """
+
+        if self.mail is not None:
+            return self.mail.send(to,
+                                  subject=subject,
+                                  message=message,
+                                  encoding="utf-8")
+
+        if isinstance(subject, unicode):
+            subject = subject.encode("utf-8")
+        if isinstance(message, unicode):
+            message = message.encode("utf-8")
+
+        # Same detection of HTML messages as in Mail
+        text = message.strip()
+        if text.startswith("<html") and text.endswith("</html>"):
+            subtype = "html"
+        else:
+            subtype = "plain"
+
+        sender = self.settings.sender
+        payload = MIMEText(message, subtype, "utf-8")
+        payload["Subject"] = Header(subject, "utf-8")
+        payload["From"] = sender
+        payload["To"] = to
+        payload["Date"] = email.utils.formatdate()
+        payload = payload.as_string()
+
+        for attempt in (0, 1):
+            if self.connection is None:
+                self.connect()
+            try:
+                self.connection.sendmail(sender, [to], payload)
+            except smtplib.SMTPServerDisconnected:
+                # Connection closed by the server => reconnect and try again
+                self.connection = None
+                continue
+            except smtplib.SMTPRecipientsRefused:
+                return False
+            except:
+                # Connection state unknown => start over with the next
+                self.close()
+                raise
+            return True
+        return False
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        """ Close the SMTP connection """
+
+        connection = self.connection
+        if connection is not None:
+            self.connection = None
+            try:
+                connection.quit()
+            except:
+                pass
+
+# =============================================================================
+class S3HTTPSender(object):
+    """ Sends SMS over a persistent HTTP connection to a Web API """
+
+    def __init__(self,
+                 url,
+                 parameters,
+                 message_variable,
+                 to_variable,
+                 username=None,
+                 password=None):
+        """
+            Constructor
+
+            @param url: the URL of the Web API
+            @param parameters: dict of fixed POST parameters
+            @param message_variable: the name of the message parameter
+            @param to_variable: the name of the recipient parameter
+            @param username: the username (for basic authentication)
+            @param password: the password (for basic authentication)
+        """
+
+        url = urlparse.urlsplit(url)
+        self.https = url.scheme == "https"
+        self.host = url.netloc
+        path = url.path or "/"
+        if url.query:
+            path = "%s?%s" % (path, url.query)
+        self.path = path
+
+        self.parameters = parameters
+        self.message_variable = message_variable
+        self.to_variable = to_variable
+
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        if username and password:
+            credentials = base64.encodestring("%s:%s" % (username, password))
+            headers["Authorization"] = "Basic %s" % \
+                                       credentials.replace("\n", "")
+        self.headers = headers
+
+        self.connection = None
+
+    # -------------------------------------------------------------------------
+    def send(self, to, subject, message):
+        """
+            Send an SMS
+
+            @param to: the recipient phone number (sanitised)
+            @param subject: the subject (ignored)
+            @param message: the message text
+        """
+
+        if isinstance(message, unicode):
+            message = message.encode("utf-8")
+        data = dict(self.parameters)
+        data[self.message_variable] = message
+        data[self.to_variable] = str(to)
+        body = urllib.urlencode(data)
+
+        for attempt in (0, 1):
+            if self.connection is None:
+                if self.https:
+                    self.connection = httplib.HTTPSConnection(self.host)
+                else:
+                    self.connection = httplib.HTTPConnection(self.host)
+            try:
+                self.connection.request("POST", self.path, body, self.headers)
+                response = self.connection.getresponse()
+                output = response.read()
+            except (httplib.HTTPException, socket.error):
+                # Connection closed by the server => reconnect and try again
+                self.close()
+                continue
+            return self.parse(response.status, output)
+        return False
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def parse(status, output):
+        """
+            Parse the response of the Web API
+
+            @param status: the HTTP status code
+            @param output: the response body
+
+            @return: True if the message has been accepted, otherwise False
+        """
+
+        if not 200 <= status < 300:
+            return False
+        # MobileCommons:
+        # Good = <response success="true"></response>
+        # Bad = <response success="false"><errror id="id" message="message"></response>
+        # http://www.mobilecommons.com/mobile-commons-api/rest/#errors
+        if output and 'success="false"' in output:
+            return False
+        return True
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        """ Close the HTTP connection """
+
+        connection = self.connection
+        if connection is not None:
+            self.connection = None
+            try:
+                connection.close()
+            except:
+                pass
+
 # =============================================================================
 class S3Compose(S3CRUD):
     """ RESTful method for messaging """
@@ -29,6 +29,7 @@
 
 import datetime
 import os
+import string
 import sys
 import urlparse
 import urllib2
@@ -82,10 +83,23 @@ class S3Notifications(object):
         subscriptions = cls._subscriptions(now)
         if subscriptions:
             async = current.s3task.async
-            for row in subscriptions:
-                # Create asynchronous notification task.
-                row.update_record(locked=True)
-                async("notify_notify", args=[row.id])
+            engine = current.deployment_settings.get_msg_notify_engine()
+            if engine == "grouped":
+                # Create one asynchronous notification task per resource
+                rtable = current.s3db.pr_subscription_resource
+                resources = {}
+                for row in subscriptions:
+                    resource_ids = resources.setdefault(row.resource, [])
+                    resource_ids.append(row.id)
+                for resource_ids in resources.values():
+                    current.db(rtable.id.belongs(resource_ids)) \
+                           .update(locked=True)
+                    async("notify_notify_grouped", args=[resource_ids])
+            else:
+                for row in subscriptions:
+                    # Create asynchronous notification task.
+                    row.update_record(locked=True)
+                    async("notify_notify", args=[row.id])
             message = "%s notifications scheduled." % len(subscriptions)
             current.db.commit()
         else:
@@ -244,6 +258,314 @@ class S3Notifications(object):
         # Done
         return message
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def notify_grouped(cls, resource_ids):
+        """
+            Asynchronous task to notify subscribers about updates without
+            requests against the subscribed controllers: subscriptions to
+            the same resource with the same filters and permissions are
+            grouped, so that the data are extracted only once per group,
+            and subscribers receiving the same updates share the rendered
+            messages, which are handed over to the outbox in bulk.
+
+            Subscriptions to pages which are not a plain resource (e.g.
+            components of a particular record), and subscriptions of
+            subscribers without user account are still notified by
+            requests against the subscribed controllers (see notify()).
+
+            @param resource_ids: the pr_subscription_resource record IDs
+        """
+
+        _debug("S3Notifications.notify_grouped(resource_ids=%s)" % resource_ids)
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+
+        stable = s3db.pr_subscription
+        rtable = db.pr_subscription_resource
+        ftable = s3db.pr_filter
+        utable = s3db.pr_person_user
+
+        # Extract the subscription data
+        join = stable.on(rtable.subscription_id == stable.id)
+        left = [ftable.on(ftable.id == stable.filter_id),
+                utable.on(utable.pe_id == stable.pe_id),
+                ]
+        rows = db(rtable.id.belongs(resource_ids)).select(stable.pe_id,
+                                                          stable.frequency,
+                                                          stable.notify_on,
+                                                          stable.method,
+                                                          stable.email_format,
+                                                          rtable.id,
+                                                          rtable.resource,
+                                                          rtable.url,
+                                                          rtable.last_check_time,
+                                                          ftable.query,
+                                                          utable.user_id,
+                                                          join=join,
+                                                          left=left)
+
+        # Time stamp for the next check (records modified during the
+        # notification will be notified again rather than not at all)
+        now = datetime.datetime.utcnow()
+
+        settings = current.deployment_settings
+        public_url = "%s/%s" % (settings.get_base_public_url(),
+                                current.request.application)
+        default_format = settings.get_msg_notify_email_format()
+
+        # Group the subscriptions by resource, filters and time stamp field
+        groups = {}
+        fallback = []
+        done = {}
+        for row in rows:
+
+            s = getattr(row, "pr_subscription")
+            r = getattr(row, "pr_subscription_resource")
+            f = getattr(row, "pr_filter")
+
+            if r.id in done or r.id in fallback:
+                continue
+
+            # URL of the subscribed page
+            purl = urlparse.urlparse(r.url)
+            if len(purl.path.strip("/").split("/")) > 2:
+                # Not a plain resource => notify by request
+                fallback.append(r.id)
+                continue
+            if not row.pr_person_user.user_id:
+                # Subscriber without user account => notify by request,
+                # which applies the authorization rules of send()
+                fallback.append(r.id)
+                continue
+
+            done[r.id] = s.frequency
+            notify_on = s.notify_on
+            methods = s.method
+            if not notify_on or not methods:
+                # No notifications configured for this subscription
+                continue
+
+            # Filters
+            get_vars = dict((k, v[0] if len(v) == 1 else v)
+                            for k, v in urlparse.parse_qs(purl.query).items())
+            if f.query:
+                from s3filter import S3FilterString
+                resource = s3db.resource(r.resource)
+                fstring = S3FilterString(resource, f.query)
+                for k, v in fstring.get_vars.iteritems():
+                    if v is not None:
+                        if k in get_vars:
+                            value = get_vars[k]
+                            if type(value) is list:
+                                value.append(v)
+                            else:
+                                get_vars[k] = [value, v]
+                        else:
+                            get_vars[k] = v
+                filter_query = s3_unicode(fstring.represent())
+            else:
+                filter_query = None
+
+            selector = "modified_on" if "upd" in notify_on else "created_on"
+            key = (r.resource, selector, json.dumps(sorted(get_vars.items())))
+            subscriptions = groups.setdefault(key, [])
+            subscriptions.append(Storage(resource_id = r.id,
+                                         pe_id = s.pe_id,
+                                         user_id = row.pr_person_user.user_id,
+                                         notify_on = tuple(notify_on),
+                                         methods = tuple(methods),
+                                         email_format = s.email_format or \
+                                                        default_format,
+                                         last_check_time = r.last_check_time,
+                                         page_url = "%s/%s" % (public_url,
+                                                               r.url.lstrip("/")),
+                                         filter_query = filter_query,
+                                         get_vars = get_vars,
+                                         ))
+
+        failed = set()
+        messages = 0
+        try:
+            for key, subscriptions in groups.items():
+                tablename, selector = key[:2]
+                try:
+                    messages += cls._notify_group(tablename,
+                                                  selector,
+                                                  subscriptions,
+                                                  failed)
+                except:
+                    exc_info = sys.exc_info()[:2]
+                    _debug("%s: %s" % (exc_info[0].__name__, exc_info[1]))
+                    failed |= set(s.resource_id for s in subscriptions)
+        finally:
+            auth.s3_impersonate(None)
+
+        # Update time stamps and unlock
+        intervals = s3db.pr_subscription_check_intervals
+        frequencies = {}
+        for resource_id, frequency in done.items():
+            if resource_id not in failed:
+                frequencies.setdefault(frequency, []).append(resource_id)
+        for frequency, ids in frequencies.items():
+            interval = datetime.timedelta(minutes=intervals.get(frequency, 0))
+            db(rtable.id.belongs(ids)).update(locked=False,
+                                              last_check_time=now,
+                                              next_check_time=now + interval)
+        if failed:
+            db(rtable.id.belongs(failed)).update(locked=False)
+        db.commit()
+
+        # Subscriptions which can not be handled here
+        for resource_id in fallback:
+            cls.notify(resource_id)
+
+        message = "%s notification messages sent, %s failed." % \
+                  (messages, len(failed))
+        _debug(message)
+        return message
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _notify_group(cls, tablename, selector, subscriptions, failed):
+        """
+            Helper method for notify_grouped to notify a group of
+            subscriptions to the same resource with the same filters
+
+            @param tablename: the tablename of the resource
+            @param selector: the time stamp field ("created_on" for
+                             new records only, otherwise "modified_on")
+            @param subscriptions: the subscriptions (list of Storages)
+            @param failed: set to add the IDs of failed subscriptions to
+
+            @return: the number of sent messages
+        """
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+        as_utc = current.xml.as_utc
+
+        get_vars = subscriptions[0].get_vars
+
+        # Split the group by the effective query (i.e. permissions)
+        views = {}
+        for subscription in subscriptions:
+            auth.s3_impersonate(subscription.user_id)
+            # Same rule as in send(): the subscriber must be logged in
+            if not auth.s3_logged_in() or \
+               auth.user.pe_id != subscription.pe_id:
+                _debug("Subscriber %s not authorized" % subscription.pe_id)
+                failed.add(subscription.resource_id)
+                continue
+            resource = s3db.resource(tablename, vars=get_vars)
+            view = str(resource.get_query())
+            views.setdefault(view, []).append(subscription)
+
+        sent = 0
+        for subscriptions in views.values():
+
+            # Extract the data as the first subscriber (all subscribers
+            # in this view have the same permissions for this resource)
+            auth.s3_impersonate(subscriptions[0].user_id)
+
+            times = set(s.last_check_time for s in subscriptions)
+            since = None if None in times else min(times)
+
+            resource = s3db.resource(tablename, vars=get_vars)
+            if since is not None:
+                from s3resource import S3FieldSelector as FS
+                resource.add_filter(FS(selector) >= since)
+
+            fields = resource.list_fields(key="notify_fields")
+            if "created_on" not in fields:
+                fields.append("created_on")
+            data = resource.select(fields,
+                                   represent=True,
+                                   raw_data=True)
+            rows = data["rows"]
+            if not rows:
+                continue
+
+            # Time stamps of the records
+            stamps = None
+            if len(times) > 1:
+                pkey = str(resource._id)
+                ids = [row["_row"][pkey] for row in rows]
+                table = resource.table
+                query = (table._id.belongs(ids))
+                stamps = dict((record[table._id.name], as_utc(record[selector]))
+                              for record in db(query).select(table._id,
+                                                             table[selector]))
+
+            # Group the subscribers by the updates they receive
+            recipients = {}
+            for subscription in subscriptions:
+                last_check_time = subscription.last_check_time
+                if stamps is not None and last_check_time is not None:
+                    threshold = as_utc(last_check_time)
+                    subset = tuple(i for i, row in enumerate(rows)
+                                   if stamps.get(row["_row"][pkey]) >= threshold)
+                    if not subset:
+                        continue
+                else:
+                    subset = None
+                key = (subset,
+                       last_check_time,
+                       subscription.notify_on,
+                       subscription.methods,
+                       subscription.email_format,
+                       subscription.page_url,
+                       subscription.filter_query,
+                       )
+                recipients.setdefault(key, []).append(subscription)
+
+            # Render the messages once per group of recipients, and hand
+            # them over to the outbox with all recipients at once
+            for key, recipients in recipients.items():
+
+                subset, last_check_time, notify_on, methods, email_format, \
+                page_url, filter_query = key
+
+                if subset is None:
+                    data_subset = data
+                else:
+                    data_subset = dict(data)
+                    data_subset["rows"] = [rows[i] for i in subset]
+
+                if last_check_time is not None:
+                    last_check_time = as_utc(last_check_time)
+                meta_data = cls._meta_data(resource,
+                                           page_url,
+                                           notify_on,
+                                           last_check_time,
+                                           filter_query,
+                                           len(data_subset["rows"]))
+
+                subject, messages, errors = cls._compose(resource,
+                                                         data_subset,
+                                                         meta_data,
+                                                         methods,
+                                                         email_format)
+
+                pe_ids = [s.pe_id for s in recipients]
+                success = False
+                for method, message in messages:
+                    ok, error = cls._send(pe_ids, subject, message, method)
+                    if ok:
+                        success = True
+                        sent += 1
+                    elif error:
+                        errors.append(error)
+                if errors:
+                    _debug(", ".join(errors))
+                if not success:
+                    failed |= set(s.resource_id for s in recipients)
+
+        return sent
+
     # -------------------------------------------------------------------------
     @classmethod
     def send(cls, r, resource):
@@ -305,35 +627,102 @@ class S3Notifications(object):
         #_debug("%s rows:" % numrows)
 
         # Prepare meta-data
-        get_config = resource.get_config
+        email_format = subscription["email_format"]
+        if not email_format:
+            email_format = current.deployment_settings \
+                                  .get_msg_notify_email_format()
+
+        last_check_time = current.xml.decode_iso_datetime(
+                                subscription["last_check_time"])
+
+        meta_data = cls._meta_data(resource,
+                                   subscription["page_url"],
+                                   notify_on,
+                                   last_check_time,
+                                   subscription.get("filter_query"),
+                                   numrows)
+
+        # Render the message(s)
+        subject, messages, errors = cls._compose(resource,
+                                                 data,
+                                                 meta_data,
+                                                 methods,
+                                                 email_format)
+
+        # Send the message(s)
+        success = False
+        for method, message in messages:
+            sent, error = cls._send(pe_id, subject, message, method)
+            if sent:
+                # Successful if at least one notification went out
+                success = True
+            elif error:
+                errors.append(error)
+
+        # Done
+        if errors:
+            message = ", ".join(errors)
+        else:
+            message = "Success"
+        return json_message(success=success,
+                            statuscode=200 if success else 403,
+                            message=message)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _meta_data(cls,
+                   resource,
+                   page_url,
+                   notify_on,
+                   last_check_time,
+                   filter_query,
+                   numrows):
+        """
+            Helper method to prepare the meta-data for the message template
+
+            @param resource: the S3Resource
+            @param page_url: the URL of the subscribed page
+            @param notify_on: the events to notify about
+            @param last_check_time: the time of the last check (datetime)
+            @param filter_query: the representation of the filter
+            @param numrows: the number of records
+        """
+
         settings = current.deployment_settings
 
-        page_url = subscription["page_url"]
-        
         crud_strings = current.response.s3.crud_strings.get(resource.tablename)
         if crud_strings:
             resource_name = crud_strings.title_list
         else:
             resource_name = string.capwords(resource.name, "_")
 
-        last_check_time = current.xml.decode_iso_datetime(
-                                subscription["last_check_time"])
+        return {"systemname": settings.get_system_name(),
+                "systemname_short": settings.get_system_name_short(),
+                "resource": resource_name,
+                "page_url": page_url,
+                "notify_on": notify_on,
+                "last_check_time": last_check_time,
+                "filter_query": filter_query,
+                "total_rows": numrows,
+                }
 
-        email_format = subscription["email_format"]
-        if not email_format:
-            email_format = settings.get_msg_notify_email_format()
+    # -------------------------------------------------------------------------
+    @classmethod
+    def _compose(cls, resource, data, meta_data, methods, email_format):
+        """
+            Helper method to render the notification messages
 
-        filter_query = subscription.get("filter_query")
+            @param resource: the S3Resource
+            @param data: the data returned from S3Resource.select
+            @param meta_data: the meta data for the notification
+            @param methods: the notification methods
+            @param email_format: the email format ("text" or "html")
+
+            @return: tuple (subject, [(method, message)], [errors])
+        """
 
-        meta_data = {"systemname": settings.get_system_name(),
-                     "systemname_short": settings.get_system_name_short(),
-                     "resource": resource_name,
-                     "page_url": page_url,
-                     "notify_on": notify_on,
-                     "last_check_time": last_check_time,
-                     "filter_query": filter_query,
-                     "total_rows": numrows,
-                    }
+        get_config = resource.get_config
+        settings = current.deployment_settings
 
         # Render contents for the message template(s)
         renderer = get_config("notify_renderer")
@@ -349,12 +738,12 @@ class S3Notifications(object):
         if email_format != "html" or "EMAIL" not in methods or len(methods) > 1:
             contents["text"] = renderer(resource, data, meta_data, "text")
             contents["default"] = contents["text"]
-        
+
         # Subject line
         subject = get_config("notify_subject")
         if not subject:
             subject = settings.get_msg_notify_subject()
-            
+
         from string import Template
         subject = Template(subject).safe_substitute(S="%(systemname)s",
                                                     s="%(systemname_short)s",
@@ -373,19 +762,14 @@ class S3Notifications(object):
                         pass
             return None
 
-        # Render and send the message(s)
+        # Render the message(s)
         theme = settings.get_template()
-        prefix = resource.get_config("notify_template", "notify")
-        
-        send = current.msg.send_by_pe_id
+        prefix = get_config("notify_template", "notify")
 
-        success = False
+        messages = []
         errors = []
-
         for method in methods:
 
-            error = None
-            
             # Get the message template
             template = None
             filenames = ["%s_%s.html" % (prefix, method.lower())]
@@ -398,14 +782,14 @@ class S3Notifications(object):
                 path = join("views", "msg")
                 template = get_template(path, filenames)
             if template is None:
-                template = StringIO(T("New updates are available."))
+                template = StringIO(current.T("New updates are available."))
 
             # Select contents format
             if method == "EMAIL" and email_format == "html":
                 output = contents["html"]
             else:
                 output = contents["text"]
-                
+
             # Render the message
             try:
                 message = current.response.render(template, output)
@@ -414,40 +798,43 @@ class S3Notifications(object):
                 error = ("%s: %s" % (exc_info[0].__name__, exc_info[1]))
                 errors.append(error)
                 continue
+            messages.append((method, message))
 
-            # Send the message
-            #_debug("Sending message per %s" % method)
-            #_debug(message)
-            try:
-                sent = send(pe_id,
-                            subject=s3_truncate(subject, 78),
-                            message=message,
-                            pr_message_method=method,
-                            system_generated=True)
-            except:
-                exc_info = sys.exc_info()[:2]
-                error = ("%s: %s" % (exc_info[0].__name__, exc_info[1]))
-                sent = False
-                
-            if sent:
-                # Successful if at least one notification went out
-                success = True
-            else:
-                if not error:
-                    error = current.session.error
-                    if isinstance(error, list):
-                        error = "/".join(error)
-                if error:
-                    errors.append(error)
+        return s3_truncate(subject, 78), messages, errors
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _send(pe_id, subject, message, method):
+        """
+            Helper method to hand a notification message over to the outbox
+
+            @param pe_id: the pe_id of the recipient (or a list of pe_ids)
+            @param subject: the subject line
+            @param message: the message
+            @param method: the notification method
+
+            @return: tuple (sent, error)
+        """
+
+        #_debug("Sending message per %s" % method)
+        #_debug(message)
+        error = None
+        try:
+            sent = current.msg.send_by_pe_id(pe_id,
+                                             subject=subject,
+                                             message=message,
+                                             pr_message_method=method,
+                                             system_generated=True)
+        except:
+            exc_info = sys.exc_info()[:2]
+            error = ("%s: %s" % (exc_info[0].__name__, exc_info[1]))
+            sent = False
+        if not sent and not error:
+            error = current.session.error
+            if isinstance(error, list):
+                error = "/".join(error)
+        return sent, error
 
-        # Done
-        if errors:
-            message = ", ".join(errors)
-        else:
-            message = "Success"
-        return json_message(success=success,
-                            statuscode=200 if success else 403,
-                            message=message)
 
     # -------------------------------------------------------------------------
     @classmethod
@@ -524,7 +911,7 @@ class S3Notifications(object):
                     ((rtable.next_check_time == None) | \
                      (rtable.next_check_time <= now)) & \
                     query
-            return db(query).select(rtable.id, join=join)
+            return db(query).select(rtable.id, rtable.resource, join=join)
         else:
             return None
 
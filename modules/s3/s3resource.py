@@ -38,6 +38,7 @@
 
 import collections
 import datetime
+import hashlib
 import re
 import sys
 import time
@@ -76,6 +77,7 @@ from gluon.tools import callback
 
 from s3data import S3DataTable, S3DataList, S3PivotTable
 from s3fields import S3Represent, S3RepresentLazy, s3_all_meta_field_names
+from s3hierarchy import S3Hierarchy
 from s3utils import s3_has_foreign_key, s3_flatlist, s3_get_foreign_key, s3_unicode, S3MarkupStripper, S3TypeConverter
 from s3validators import IS_ONE_OF
 from s3xml import S3XMLFormat
@@ -113,6 +115,9 @@ class S3Resource(object):
         S3 framework rules.
     """
 
+    # Maximum number of bookmarks for keyset pagination per query
+    MAX_BOOKMARKS = 1000
+
     def __init__(self, tablename,
                  id=None,
                  prefix=None,
@@ -320,6 +325,7 @@ class S3Resource(object):
         # Export meta data
         self.muntil = None      # latest mtime of the exported records
         self.results = None     # number of exported records
+        self.cursor = None      # cursor for the next chunk of the export
 
         # Standard methods ----------------------------------------------------
 
@@ -538,7 +544,8 @@ class S3Resource(object):
                as_rows=False,
                represent=False,
                show_links=True,
-               raw_data=False):
+               raw_data=False,
+               count_cache=None):
         """
             Extract data from this resource
 
@@ -555,6 +562,9 @@ class S3Resource(object):
             @param as_rows: return the rows (don't extract)
             @param represent: render field value representations
             @param raw_data: include raw data in the result
+            @param count_cache: time (in seconds) to cache the total number
+                                of matching records and the bookmarks for
+                                keyset pagination, None to not cache
         """
 
         # Init
@@ -624,7 +634,7 @@ class S3Resource(object):
                                    dfield.virtual)
 
         # Resolve ORDERBY
-        orderby_aggregate = orderby_fields = None
+        orderby_aggregate = orderby_fields = orderby_keys = None
         
         if orderby:
 
@@ -638,6 +648,9 @@ class S3Resource(object):
             orderby = []
             orderby_fields = []
 
+            # Sort keys [(Field, descending)] for keyset pagination
+            orderby_keys = []
+
             # For GROUPBY id (which we need here for left joins), we need
             # all ORDERBY-fields to appear in an aggregation function, or
             # otherwise the ORDERBY can be ambiguous.
@@ -688,10 +701,13 @@ class S3Resource(object):
                     expression = f if direction == "asc" else ~f
                     orderby.append(expression)
                     direction = direction.strip().lower()[:3]
+                    if orderby_keys is not None:
+                        orderby_keys.append((f, direction == "des"))
                     if fname != pkey:
                         expression = f.min() if direction == "asc" else ~(f.max())
                 else:
                     orderby.append(expression)
+                    orderby_keys = None
                 orderby_aggregate.append(expression)
 
         # Initialize master query
@@ -713,50 +729,80 @@ class S3Resource(object):
         filter_joins = left_joins.as_list(tablenames=ftables,
                                           aqueries=aqueries)
 
-        if getids or count or left_joins:
+        # Keyset pagination
+        bookmarks = None
+        if count_cache and limitby and \
+           not groupby and not vfltr and not getids:
+            keys = self._keyset(orderby_keys)
+            if keys:
+                if len(keys) > len(orderby_keys):
+                    # Break ties by record ID
+                    orderby.append(table._id)
+                    orderby_aggregate.append(table._id)
+                bookmarks = self._bookmarks(filter_query,
+                                            filter_joins,
+                                            orderby,
+                                            count_cache)
+                page_start, page_end = limitby
+
+        if getids or count or left_joins or bookmarks:
             if not groupby and not vfltr and \
                (count or limitby or vtables != ftables):
 
-                if getids or left_joins:
-                    field = table._id
-                    fdistinct = False
-                    fgroupby = field
-                else:
-                    field = table._id.count()
-                    fdistinct = True
-                    fgroupby = None
-
-                # We don't need virtual fields here, so deactivate
-                # even if virtual is True
-                if virtual:
-                    vf = table.virtualfields
-                    osetattr(table, "virtualfields", [])
-
-                # Retrieve the ordered record IDs (or number of rows)
-                rows = db(filter_query).select(field,
-                                               left=filter_joins,
-                                               distinct=fdistinct,
-                                               orderby=orderby_aggregate,
-                                               groupby=fgroupby,
-                                               cacheable=True)
-                                               
-                # Restore the virtual fields
-                if virtual:
-                    osetattr(table, "virtualfields", vf)
+                if count and not getids and (limitby or not left_joins):
+                    # Total number of matching records
+                    totalrows = self._cached_count(filter_query,
+                                                   filter_joins,
+                                                   expire=count_cache)
+
+                if bookmarks and (totalrows is not None or not left_joins):
+                    # Seek to the first record of the page rather than
+                    # skipping all records before it
+                    bookmark = bookmarks.get(page_start)
+                    if bookmark is not None:
+                        kquery = self._keyset_query(keys, bookmark)
+                        filter_query &= kquery
+                        master_query &= kquery
+                        limitby = (0, page_end - page_start)
 
                 if getids or left_joins:
-                    ids = [row[pkey] for row in rows]
-                    totalrows = len(ids)
-                    if limitby:
-                        page = ids[limitby[0]:limitby[1]]
+
+                    # We don't need virtual fields here, so deactivate
+                    # even if virtual is True
+                    if virtual:
+                        vf = table.virtualfields
+                        osetattr(table, "virtualfields", [])
+
+                    # Retrieve the ordered record IDs (of the page, if
+                    # the total number of rows is already known)
+                    if totalrows is None:
+                        idlimit = None
                     else:
+                        idlimit = limitby
+                    rows = db(filter_query).select(table._id,
+                                                   left=filter_joins,
+                                                   orderby=orderby_aggregate,
+                                                   groupby=table._id,
+                                                   limitby=idlimit,
+                                                   cacheable=True)
+
+                    # Restore the virtual fields
+                    if virtual:
+                        osetattr(table, "virtualfields", vf)
+
+                    ids = [row[pkey] for row in rows]
+                    if idlimit:
                         page = ids
+                    else:
+                        totalrows = len(ids)
+                        if limitby:
+                            page = ids[limitby[0]:limitby[1]]
+                        else:
+                            page = ids
                     # Use simplified master query
                     master_query = table._id.belongs(page)
                     orderby = None
                     limitby = None
-                else:
-                    totalrows = rows.first()[field]
 
         # Master Query:
         
@@ -929,6 +975,10 @@ class S3Resource(object):
                 page = ids = [row[key] for row in rows]
             else:
                 page = ids
+
+        # Bookmark the start of the next page
+        if bookmarks is not None and len(page) == page_end - page_start:
+            self._bookmark(bookmarks, page_end, keys, page[-1])
                 
         # Secondary Queries:
 
@@ -1122,7 +1172,162 @@ class S3Resource(object):
 
         output["rows"] = [results[record_id] for record_id in page]
         return output
-        
+
+    # -------------------------------------------------------------------------
+    def _cached_count(self, query, left=None, expire=None):
+        """
+            Helper method for select to count the records matching a query,
+            optionally caching the result for a short time so that paging
+            through a data table doesn't repeat the count for every page
+
+            @param query: the query
+            @param left: the left joins
+            @param expire: time (in seconds) to cache the result, None
+                           to not cache
+        """
+
+        db = current.db
+        table = self.table
+
+        if left:
+            cnt = table._id.count(distinct=True)
+        else:
+            cnt = table._id.count()
+        lookup = lambda: db(query).select(cnt,
+                                          left=left,
+                                          cacheable=True).first()[cnt]
+
+        if not expire:
+            return lookup()
+
+        sql = db(query)._select(cnt, left=left)
+        key = "s3_count_%s" % self._fingerprint(sql, query, left)
+        return current.cache.ram(key, lookup, time_expire=expire)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _fingerprint(sql, query, left=None):
+        """
+            Helper method to generate a cache key for the result of a
+            query, which changes whenever any of the involved tables is
+            written to within this process
+
+            @param sql: the SQL of the query
+            @param query: the query
+            @param left: the left joins
+        """
+
+        tablenames = set(current.db._adapter.tables(query))
+        if left:
+            tablenames |= set(str(j.first) for j in left)
+        table_version = current.s3db.table_version
+        versions = [(tn, table_version(tn)) for tn in sorted(tablenames)]
+        return hashlib.md5("%s%s" % (sql, versions)).hexdigest()
+
+    # -------------------------------------------------------------------------
+    def _keyset(self, orderby_keys):
+        """
+            Helper method for select to check whether the records can be
+            paged by seeking to the sort key values of the last record of
+            the previous page (keyset pagination) rather than by skipping
+            all records before the page, which requires that all sort keys
+            are indexed, non-null fields of the master table
+
+            @param orderby_keys: the sort keys [(Field, descending)]
+
+            @return: the sort keys including the record ID as tie-breaker,
+                     or None if keyset pagination is not possible
+        """
+
+        if not orderby_keys:
+            return None
+
+        table = self.table
+        pkey = str(table._id)
+        indexed = self.get_config("indexed_fields", [])
+
+        keys = []
+        for field, descending in orderby_keys:
+            if str(field) == pkey:
+                keys.append((field, descending))
+                break
+            if field._tablename != table._tablename or not field.notnull or \
+               not field.unique and field.name not in indexed:
+                return None
+            keys.append((field, descending))
+        else:
+            keys.append((table._id, False))
+        return keys
+
+    # -------------------------------------------------------------------------
+    def _bookmarks(self, query, left, orderby, expire):
+        """
+            Helper method for select to look up the bookmarks for keyset
+            pagination of a query, which expire with the cached count
+
+            @param query: the query
+            @param left: the left joins
+            @param orderby: the orderby expressions
+            @param expire: time (in seconds) to cache the bookmarks
+
+            @return: dict {start: sort key values of the last record
+                     before start}
+        """
+
+        sql = current.db(query)._select(self.table._id,
+                                        left=left,
+                                        orderby=orderby)
+        key = "s3_bookmarks_%s" % self._fingerprint(sql, query, left)
+        return current.cache.ram(key, dict, time_expire=expire)
+
+    # -------------------------------------------------------------------------
+    def _bookmark(self, bookmarks, start, keys, record_id):
+        """
+            Helper method for select to bookmark the start of a page
+
+            @param bookmarks: the bookmarks dict
+            @param start: the index of the first record of the page
+            @param keys: the sort keys [(Field, descending)]
+            @param record_id: the ID of the last record of the previous page
+        """
+
+        if start in bookmarks:
+            return
+        fields = [field for field, descending in keys]
+        row = current.db(self.table._id == record_id).select(limitby=(0, 1),
+                                                             *fields).first()
+        if row:
+            if len(bookmarks) >= self.MAX_BOOKMARKS:
+                bookmarks.clear()
+            bookmarks[start] = [row[field.name] for field in fields]
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _keyset_query(keys, values):
+        """
+            Helper method for select to construct a query for the records
+            following a bookmark in the order of the sort keys
+
+            @param keys: the sort keys [(Field, descending)]
+            @param values: the sort key values of the bookmarked record
+        """
+
+        query = None
+        for idx, (field, descending) in enumerate(keys):
+            value = values[idx]
+            q = field < value if descending else field > value
+            for f, v in zip(keys[:idx], values[:idx]):
+                q = (f[0] == v) & q
+            query = q if query is None else query | q
+
+        # Leading range condition for the index on the first key
+        field, descending = keys[0]
+        value = values[0]
+        if len(keys) > 1:
+            first = field <= value if descending else field >= value
+            query = first & query
+        return query
+
     # -------------------------------------------------------------------------
     @staticmethod
     def __extract(rows,
@@ -1442,6 +1647,8 @@ class S3Resource(object):
                           record=row[pkey], representation=format)
                     # Delete super-entity
                     delete_super(table, row)
+                    # Update the stored hierarchy
+                    S3Hierarchy.postprocess_delete_node(tablename, row[pkey])
                     # On-delete hook
                     if ondelete:
                         callback(ondelete, row)
@@ -1473,6 +1680,8 @@ class S3Resource(object):
                           record=row[pkey], representation=format)
                     # Delete super-entity
                     delete_super(table, row)
+                    # Update the stored hierarchy
+                    S3Hierarchy.postprocess_delete_node(tablename, row[pkey])
                     # On-delete hook
                     if ondelete:
                         callback(ondelete, row)
@@ -1722,7 +1931,8 @@ class S3Resource(object):
                   left=None,
                   orderby=None,
                   distinct=False,
-                  getids=False):
+                  getids=False,
+                  count_cache=None):
         """
             Generate a data table of this resource
 
@@ -1734,6 +1944,8 @@ class S3Resource(object):
             @param distinct: distinct-flag for DB query
             @param getids: return the record IDs of all records matching the
                            query (used in search to create a filter)
+            @param count_cache: time (in seconds) to cache the total number
+                                of matching records, see select()
 
             @return: tuple (S3DataTable, numrows, ids), where numrows represents
                      the total number of rows in the table that match the query;
@@ -1760,7 +1972,8 @@ class S3Resource(object):
                            distinct=distinct,
                            count=True,
                            getids=getids,
-                           represent=True)
+                           represent=True,
+                           count_cache=count_cache)
 
         # Generate the data table
         if data["rows"]:
@@ -1837,7 +2050,7 @@ class S3Resource(object):
         return dl, numrows, data["ids"]
 
     # -------------------------------------------------------------------------
-    def pivottable(self, rows, cols, layers, strict=True):
+    def pivottable(self, rows, cols, layers, strict=True, aggregate=None):
         """
             Generate a pivot table of this resource.
 
@@ -1847,13 +2060,17 @@ class S3Resource(object):
                            the aggregation layers
             @param strict: filter out dimension values which don't match
                            the resource filter
+            @param aggregate: compute the aggregates in the database
+                              (None to use the deployment setting)
 
             @return: an S3PivotTable instance
 
             Supported methods: see S3PivotTable
         """
 
-        return S3PivotTable(self, rows, cols, layers, strict=strict)
+        return S3PivotTable(self, rows, cols, layers,
+                            strict=strict,
+                            aggregate=aggregate)
 
     # -------------------------------------------------------------------------
     def json(self,
@@ -2272,6 +2489,7 @@ class S3Resource(object):
                    maxbounds=False,
                    filters=None,
                    pretty_print=False,
+                   cursor=None,
                    **args):
         """
             Export this resource as S3XML
@@ -2293,6 +2511,8 @@ class S3Resource(object):
             @param filters: additional URL filters (Sync), as dict
                             {tablename: {url_var: string}}
             @param pretty_print: insert newlines/indentation in the output
+            @param cursor: export the records after this cursor (Sync),
+                           see export_tree
             @param args: dict of arguments to pass to the XSLT stylesheet
         """
 
@@ -2319,7 +2539,8 @@ class S3Resource(object):
                                 references=references,
                                 filters=filters,
                                 maxbounds=maxbounds,
-                                xmlformat=xmlformat)
+                                xmlformat=xmlformat,
+                                cursor=cursor)
         #if DEBUG:
             #end = datetime.datetime.now()
             #duration = end - _start
@@ -2379,7 +2600,8 @@ class S3Resource(object):
                     rcomponents=None,
                     filters=None,
                     maxbounds=False,
-                    xmlformat=None):
+                    xmlformat=None,
+                    cursor=None):
         """
             Export the resource as element tree
 
@@ -2399,6 +2621,12 @@ class S3Resource(object):
                             {tablename: {url_var: string}}
             @param maxbounds: include lat/lon boundaries in the top
                               level element (off by default)
+            @param cursor: tuple (modified_on, uuid) of the last record
+                           of the previous chunk, or an empty tuple for
+                           the first chunk - exports the records ordered
+                           by modified_on and uuid (chunked Sync), and
+                           sets self.cursor to the cursor for the next
+                           chunk (None if this is the last chunk)
         """
 
         xml = current.xml
@@ -2425,6 +2653,16 @@ class S3Resource(object):
             queries = S3URLQuery.parse(self, filters[tablename])
             [self.add_filter(q) for a in queries for q in queries[a]]
 
+        # Chunk cursor
+        self.cursor = None
+        chunked = cursor is not None and \
+                  "modified_on" in table.fields and "uuid" in table.fields
+        if chunked and cursor:
+            mtime, uuid = cursor
+            query = (table.modified_on > mtime) | \
+                    ((table.modified_on == mtime) & (table.uuid > uuid))
+            self.add_filter(query)
+
         # Total number of results
         results = self.count()
 
@@ -2433,7 +2671,9 @@ class S3Resource(object):
         self.results = 0
 
         # Load slice
-        if msince is not None and "modified_on" in table.fields:
+        if chunked:
+            orderby = "%s ASC, %s ASC" % (table["modified_on"], table["uuid"])
+        elif msince is not None and "modified_on" in table.fields:
             orderby = "%s ASC" % table["modified_on"]
         else:
             orderby = None
@@ -2450,6 +2690,9 @@ class S3Resource(object):
                   orderby=orderby,
                   virtual=False,
                   cacheable=True)
+        if chunked and limit and len(self._rows) == limit:
+            last = self._rows[-1]
+            self.cursor = (last.modified_on, last.uuid)
 
         format = current.auth.permission.format
         if format == "geojson":
@@ -3269,6 +3512,10 @@ class S3Resource(object):
                                      conflict_policy=conflict_policy,
                                      last_sync=last_sync,
                                      onconflict=onconflict)
+            # Look up the originals and foreign keys for all elements
+            # in one go
+            import_job.prefetch()
+            import_job.prevalidate()
             add_item = import_job.add_item
             for element in elements:
                 success = add_item(element=element,
@@ -63,6 +63,8 @@ from gluon.dal import Row
 from gluon.storage import Storage
 from gluon.tools import callback
 
+from s3export import S3Exporter
+from s3hierarchy import S3Hierarchy
 from s3resource import S3Resource
 from s3utils import S3MarkupStripper, s3_unicode
 
@@ -404,6 +406,7 @@ class S3RequestManager(object):
                    s3db.get_config(tablename, "onaccept"))
         if "vars" not in record:
             record = Storage(vars=record, errors=Storage())
+        S3Hierarchy.postprocess_create_node(tablename, record.vars)
         if onaccept:
             callback(onaccept, record, tablename=tablename)
         return
@@ -1282,6 +1285,18 @@ class S3Request(object):
         headers["Content-Type"] = manager.content_type.get(representation,
                                                            default)
 
+        # Encode Feature Layers directly as GeoJSON (bypassing the XSLT)
+        if representation == "geojson" and \
+           current.deployment_settings.get_gis_geojson_direct() and \
+           not r.component and msince is None and \
+           not any(k in _vars for k in ("transform", "xsltmode", "fields",
+                                        "references", "maxbounds")):
+            output = S3Exporter().geojson(r.resource,
+                                          start=start,
+                                          limit=limit)
+            if output is not None:
+                return output
+
         # Export the resource
         output = r.resource.export_xml(start=start,
                                        limit=limit,
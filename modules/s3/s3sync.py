@@ -30,8 +30,15 @@
 import sys
 import urllib, urllib2
 import datetime
+import gzip
 import time
 import traceback
+import zlib
+
+try:
+    from cStringIO import StringIO    # Faster, where available
+except:
+    from StringIO import StringIO
 
 try:
     from lxml import etree
@@ -67,6 +74,9 @@ else:
 class S3Sync(S3Method):
     """ Synchronization Handler """
 
+    # Maximum number of records per chunk of a chunked pull
+    MAX_CHUNK_SIZE = 2000
+
     # -------------------------------------------------------------------------
     def __init__(self):
         """ Constructor """
@@ -367,17 +377,46 @@ class S3Sync(S3Method):
         if not filters:
             filters = None
 
+        # Chunked export: cursor of the previous chunk (empty for the first)
+        cursor = _vars.get("cursor", None)
+        if cursor is not None:
+            cursor = self.decode_cursor(cursor)
+            try:
+                limit = int(_vars.get("chunk_size", None))
+            except (ValueError, TypeError):
+                limit = self.MAX_CHUNK_SIZE
+            limit = max(1, min(limit, self.MAX_CHUNK_SIZE))
+            start = None
+
         # Export the resource
-        output = resource.export_xml(start=start,
-                                     limit=limit,
-                                     filters=filters,
-                                     msince=msince)
+        tree = resource.export_xml(start=start,
+                                   limit=limit,
+                                   filters=filters,
+                                   msince=msince,
+                                   cursor=cursor,
+                                   as_tree=True)
         count = resource.results
 
+        xml = current.xml
+        if tree is None:
+            output = None
+        else:
+            if cursor is not None and resource.cursor:
+                # Tell the peer where to continue
+                tree.getroot().set("cursor",
+                                   self.encode_cursor(resource.cursor))
+            output = xml.tostring(tree, pretty_print=False)
+
         # Set content type header
         headers = current.response.headers
         headers["Content-Type"] = "text/xml"
 
+        # Compress the payload if the peer accepts that
+        accept_encoding = r.env.http_accept_encoding or ""
+        if output and "gzip" in accept_encoding:
+            output = self.compress(output)
+            headers["Content-Encoding"] = "gzip"
+
         # Log the operation
         log = self.log
         log.write(repository_id=repository_id,
@@ -470,6 +509,10 @@ class S3Sync(S3Method):
 
         # Get the source
         source = r.read_body()
+        if r.env.http_content_encoding == "gzip":
+            source = [gzip.GzipFile(fileobj=item, mode="rb")
+                      if not isinstance(item, tuple) else item
+                      for item in source]
 
         # Import resource
         resource = r.resource
@@ -632,6 +675,57 @@ class S3Sync(S3Method):
             filters[tablename] = parse_url(filters[tablename])
         return filters
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def encode_cursor(cursor):
+        """
+            Encode a chunk cursor for transmission or storage
+
+            @param cursor: the cursor, tuple (modified_on, uuid)
+            @return: the cursor as string, or None for no cursor
+        """
+
+        if not cursor:
+            return None
+        mtime, uuid = cursor
+        return "%s,%s" % (mtime.strftime(current.xml.ISOFORMAT), uuid)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+            Decode a chunk cursor
+
+            @param cursor: the cursor as string
+            @return: the cursor, tuple (modified_on, uuid), or an empty
+                     tuple to start from the first record
+        """
+
+        if not cursor or "," not in cursor:
+            return ()
+        mtime, uuid = cursor.split(",", 1)
+        try:
+            (y, m, d, hh, mm, ss, t0, t1, t2) = \
+                time.strptime(mtime, current.xml.ISOFORMAT)
+        except ValueError:
+            return ()
+        return (datetime.datetime(y, m, d, hh, mm, ss), uuid)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def compress(data):
+        """
+            Compress a payload with gzip
+
+            @param data: the payload (string)
+        """
+
+        output = StringIO()
+        f = gzip.GzipFile(fileobj=output, mode="wb")
+        f.write(data)
+        f.close()
+        return output.getvalue()
+
 # =============================================================================
 class S3SyncLog(S3Method):
     """ Synchronization Logger """
@@ -773,6 +867,9 @@ class S3SyncRepository(object):
         push(task)              - push data for a task
     """
 
+    # Number of records to transfer per chunk
+    CHUNK_SIZE = 500
+
     # -------------------------------------------------------------------------
     @staticmethod
     def factory(repository):
@@ -814,6 +911,9 @@ class S3SyncRepository(object):
         self.site_key = repository.site_key
         self.proxy = repository.proxy
 
+        # Whether the peer accepts compressed payloads
+        self.compress = False
+
     # -------------------------------------------------------------------------
     def get_config(self):
         """ Read the sync settings, avoid repeated DB lookups """
@@ -934,7 +1034,9 @@ class S3SyncRepository(object):
     # -------------------------------------------------------------------------
     def pull(self, task, onconflict=None):
         """
-            Outgoing pull
+            Outgoing pull, in chunks of CHUNK_SIZE records, each chunk is
+            committed and its cursor stored in the task, so that an
+            interrupted pull can be resumed
 
             @param task: the task (sync_task Row)
         """
@@ -963,138 +1065,115 @@ class S3SyncRepository(object):
             for k, v in filters[tablename].items():
                 urlfilter = "[%s]%s=%s" % (prefix, k, v)
                 url += "&%s" % urlfilter
-                
-        _debug("...pull from URL %s" % url)
 
-        # Figure out the protocol from the URL
-        url_split = url.split("://", 1)
-        if len(url_split) == 2:
-            protocol, path = url_split
-        else:
-            protocol, path = "http", None
+        # Get import strategy and update policy
+        strategy = task.strategy
+        update_policy = task.update_policy
+        conflict_policy = task.conflict_policy
 
-        # Create the request
-        req = urllib2.Request(url=url)
-        handlers = []
+        # Resume an interrupted pull
+        cursor = task.pull_cursor or ""
 
-        # Proxy handling
-        proxy = self.proxy or config.proxy or None
-        if proxy:
-            _debug("using proxy=%s" % proxy)
-            proxy_handler = urllib2.ProxyHandler({protocol: proxy})
-            handlers.append(proxy_handler)
+        log = self.log
+        result = log.SUCCESS
+        remote = False
+        output = None
+        message = ""
+        mtime = None
+        count = 0
 
-        # Authentication handling
-        username = self.username
-        password = self.password
-        if username and password:
-            # Send auth data unsolicitedly (the only way with Eden instances):
-            import base64
-            base64string = base64.encodestring('%s:%s' %
-                                               (username, password))[:-1]
-            req.add_header("Authorization", "Basic %s" % base64string)
-            # Just in case the peer does not accept that, add a 401 handler:
-            passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-            passwd_manager.add_password(realm=None,
-                                        uri=url,
-                                        user=username,
-                                        passwd=password)
-            auth_handler = urllib2.HTTPBasicAuthHandler(passwd_manager)
-            handlers.append(auth_handler)
+        while True:
 
-        # Install all handlers
-        if handlers:
-            opener = urllib2.build_opener(*handlers)
-            urllib2.install_opener(opener)
+            chunk_url = "%s&cursor=%s&chunk_size=%s" % \
+                        (url, urllib.quote(cursor), self.CHUNK_SIZE)
+            _debug("...pull from URL %s" % chunk_url)
 
-        # Execute the request
-        remote = False
-        output = None
-        response = None
-        log = self.log
-        try:
-            f = urllib2.urlopen(req)
-        except urllib2.HTTPError, e:
-            result = log.ERROR
-            remote = True # Peer error
-            code = e.code
-            message = e.read()
+            # Execute the request
             try:
-                # Sahana-Eden would send a JSON message,
-                # try to extract the actual error message:
-                message_json = json.loads(message)
-                message = message_json.get("message", message)
+                f = self._open(chunk_url)
+            except urllib2.HTTPError, e:
+                result = log.ERROR
+                remote = True # Peer error
+                code = e.code
+                message = e.read()
+                try:
+                    # Sahana-Eden would send a JSON message,
+                    # try to extract the actual error message:
+                    message_json = json.loads(message)
+                    message = message_json.get("message", message)
+                except:
+                    pass
+                # Prefix as peer error and strip XML markup from the message
+                # @todo: better method to do this?
+                message = "<message>%s</message>" % message
+                try:
+                    markup = etree.XML(message)
+                    message = markup.xpath(".//text()")
+                    if message:
+                        message = " ".join(message)
+                    else:
+                        message = ""
+                except etree.XMLSyntaxError:
+                    pass
+                output = xml.json_message(False, code, message, tree=None)
+                break
             except:
-                pass
-            # Prefix as peer error and strip XML markup from the message
-            # @todo: better method to do this?
-            message = "<message>%s</message>" % message
-            try:
-                markup = etree.XML(message)
-                message = markup.xpath(".//text()")
-                if message:
-                    message = " ".join(message)
-                else:
-                    message = ""
-            except etree.XMLSyntaxError:
-                pass
-            output = xml.json_message(False, code, message, tree=None)
-        except:
-            result = log.FATAL
-            code = 400
-            message = sys.exc_info()[1]
-            output = xml.json_message(False, code, message)
-        else:
-            result = log.SUCCESS
-            response = f
-
-        # Process the response
-        mtime = None
-        if response:
+                result = log.FATAL
+                code = 400
+                message = sys.exc_info()[1]
+                output = xml.json_message(False, code, message)
+                break
 
-            # Get import strategy and update policy
-            strategy = task.strategy
-            update_policy = task.update_policy
-            conflict_policy = task.conflict_policy
+            # Parse the response while reading it
+            tree = xml.parse(self._read(f))
+            if tree is None:
+                result = log.ERROR
+                remote = True
+                message = "invalid data received from peer: %s" % xml.error
+                output = xml.json_message(False, 400, message)
+                break
 
-            success = True
-            message = ""
+            # Peers without chunking support send everything at once
+            next_cursor = tree.getroot().get("cursor", None)
 
             # Import the data
             resource = current.s3db.resource(resource_name)
-            onconflict = lambda item: onconflict(item, self, resource)
-            count = 0
+            if onconflict:
+                resolve = lambda item, resource=resource: \
+                                 onconflict(item, self, resource)
+            else:
+                resolve = None
+            success = True
             try:
                 success = resource.import_xml(
-                                response,
+                                tree,
                                 ignore_errors=True,
                                 strategy=strategy,
                                 update_policy=update_policy,
                                 conflict_policy=conflict_policy,
                                 last_sync=last_pull,
-                                onconflict=onconflict)
-                count = resource.import_count
+                                onconflict=resolve)
+                count += resource.import_count
             except IOError, e:
                 result = log.FATAL
                 message = "%s" % e
                 output = xml.json_message(False, 400, message)
+                break
             except Exception, e:
                 # If we end up here, an uncaught error during import
                 # has occured which indicates a code defect! We log it
-                # and continue here, however - in order to maintain a
-                # valid sync status, so that developers can restart
-                # the process more easily after fixing the defect.
+                # and stop here - the pull resumes with this chunk once
+                # the defect has been fixed.
                 result = log.FATAL
                 message = "Uncaught Exception During Import: %s" % \
                           traceback.format_exc()
                 output = xml.json_message(False, 500, sys.exc_info()[1])
-                
-            mtime = resource.mtime
+                break
 
             # Log all validation errors
             if resource.error_tree is not None:
                 result = log.WARNING
-                message = "%s" % resource.error
+                message = "%s%s" % (message, resource.error)
                 for element in resource.error_tree.findall("resource"):
                     for field in element.findall("data[@error]"):
                         error_msg = field.get("error", None)
@@ -1114,17 +1193,24 @@ class S3SyncRepository(object):
                     error = current.manager.error
                     message = "%s" % error
                 output = xml.json_message(False, 400, message)
-                mtime = None
+                break
 
-            # ...or report success
-            elif not message:
-                message = "data imported successfully (%s records)" % count
+            chunk_mtime = resource.mtime
+            if chunk_mtime and (mtime is None or chunk_mtime > mtime):
+                mtime = chunk_mtime
 
-        elif result == log.SUCCESS:
-            # No data received from peer
-            result = log.ERROR
-            remote = True
-            message = "no data received from peer"
+            # Checkpoint
+            task.update_record(pull_cursor=next_cursor)
+            current.db.commit()
+
+            if not next_cursor:
+                break
+            cursor = next_cursor
+
+        if output is not None:
+            mtime = None
+        elif not message:
+            message = "data imported successfully (%s records)" % count
 
         # Log the operation
         log.write(repository_id=self.id,
@@ -1142,7 +1228,9 @@ class S3SyncRepository(object):
     # -------------------------------------------------------------------------
     def push(self, task):
         """
-            Outgoing push
+            Outgoing push, in chunks of CHUNK_SIZE records, the cursor of
+            each transmitted chunk is stored in the task, so that an
+            interrupted push can be resumed
 
             @param task: the sync_task Row
         """
@@ -1172,98 +1260,82 @@ class S3SyncRepository(object):
             last_push = None
         _debug("...push to URL %s" % url)
 
-        # Define the resource
-        resource = current.s3db.resource(resource_name,
-                                         include_deleted=True)
-
         # Apply sync filters for this task
         filters = current.sync.get_filters(task.id)
-        
-        # Export the resource as S3XML
-        data = resource.export_xml(filters=filters,
-                                   msince=last_push)
-        count = resource.results or 0
-        mtime = resource.muntil
 
-        # Transmit the data via HTTP
+        # Resume an interrupted push
+        cursor = current.sync.decode_cursor(task.push_cursor)
+
+        REF = xml.ATTRIBUTE.ref
+
         remote = False
         output = None
         log = self.log
-        if data and count:
-
-            # Find the protocol
-            url_split = url.split("://", 1)
-            if len(url_split) == 2:
-                protocol, path = url_split
-            else:
-                protocol, path = "http", None
-
-            # Generate the request
-            import urllib2
-            req = urllib2.Request(url=url, data=data)
-            req.add_header('Content-Type', "text/xml")
-            handlers = []
-
-            # Proxy handling
-            proxy = self.proxy or config.proxy or None
-            if proxy:
-                _debug("using proxy=%s" % proxy)
-                proxy_handler = urllib2.ProxyHandler({protocol: proxy})
-                handlers.append(proxy_handler)
-
-            # Authentication
-            username = self.username
-            password = self.password
-            if username and password:
-                # send auth credentials unsolicitedly
-                import base64
-                base64string = base64.encodestring('%s:%s' %
-                                                   (username, password))[:-1]
-                req.add_header("Authorization", "Basic %s" % base64string)
-                # Just in case the peer does not accept that
-                # => add a 401 handler:
-                passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-                passwd_manager.add_password(realm=None,
-                                            uri=url,
-                                            user=username,
-                                            passwd=password)
-                auth_handler = urllib2.HTTPBasicAuthHandler(passwd_manager)
-                handlers.append(auth_handler)
-
-            # Install all handlers
-            if handlers:
-                opener = urllib2.build_opener(*handlers)
-                urllib2.install_opener(opener)
-
-            # Execute the request
-            try:
-                f = urllib2.urlopen(req)
-            except urllib2.HTTPError, e:
-                result = log.FATAL
-                remote = True # Peer error
-                code = e.code
-                message = e.read()
+        mtime = None
+        count = 0
+
+        while True:
+
+            # Export the next chunk of the resource as S3XML
+            resource = current.s3db.resource(resource_name,
+                                             include_deleted=True)
+            tree = resource.export_xml(filters=filters,
+                                       msince=last_push,
+                                       limit=self.CHUNK_SIZE,
+                                       cursor=cursor,
+                                       as_tree=True)
+            next_cursor = resource.cursor
+            chunk_mtime = resource.muntil
+
+            # Transmit the data via HTTP
+            if tree is not None and chunk_mtime:
+                data = xml.tostring(tree, pretty_print=False)
                 try:
-                    # Sahana-Eden sends a JSON message,
-                    # try to extract the actual error message:
-                    message_json = json.loads(message)
-                    message = message_json.get("message", message)
+                    f = self._open(url, data=data)
+                except urllib2.HTTPError, e:
+                    result = log.FATAL
+                    remote = True # Peer error
+                    code = e.code
+                    message = e.read()
+                    try:
+                        # Sahana-Eden sends a JSON message,
+                        # try to extract the actual error message:
+                        message_json = json.loads(message)
+                        message = message_json.get("message", message)
+                    except:
+                        pass
+                    output = xml.json_message(False, code, message)
+                    break
                 except:
-                    pass
-                output = xml.json_message(False, code, message)
-            except:
-                result = log.FATAL
-                code = 400
-                message = sys.exc_info()[1]
-                output = xml.json_message(False, code, message)
-            else:
+                    result = log.FATAL
+                    code = 400
+                    message = sys.exc_info()[1]
+                    output = xml.json_message(False, code, message)
+                    break
+
+                count += len([element
+                              for element in tree.getroot().findall("resource")
+                              if element.get(REF) != "True"])
+                if mtime is None or chunk_mtime > mtime:
+                    mtime = chunk_mtime
+
+            # Checkpoint
+            task.update_record(
+                    push_cursor=current.sync.encode_cursor(next_cursor))
+            current.db.commit()
+
+            if not next_cursor:
+                break
+            cursor = next_cursor
+
+        if output is None:
+            if count:
                 result = log.SUCCESS
                 message = "data sent successfully (%s records)" % count
-
-        else:
-            # No data to send
-            result = log.WARNING
-            message = "No data to send"
+            else:
+                # No data to send
+                result = log.WARNING
+                message = "No data to send"
 
         # Log the operation
         log.write(repository_id=self.id,
@@ -1279,6 +1351,88 @@ class S3SyncRepository(object):
             mtime = None
         return (output, mtime)
 
+    # -------------------------------------------------------------------------
+    def _open(self, url, data=None):
+        """
+            Send a request to the peer
+
+            @param url: the URL
+            @param data: S3XML to send (POST), compressed if the peer
+                         is known to accept compressed payloads
+
+            @return: the response (file-like object)
+            @raise urllib2.HTTPError: for errors reported by the peer
+        """
+
+        config = self.get_config()
+
+        # Figure out the protocol from the URL
+        url_split = url.split("://", 1)
+        if len(url_split) == 2:
+            protocol, path = url_split
+        else:
+            protocol, path = "http", None
+
+        # Create the request
+        if data is not None:
+            if self.compress:
+                data = current.sync.compress(data)
+            req = urllib2.Request(url=url, data=data)
+            req.add_header("Content-Type", "text/xml")
+            if self.compress:
+                req.add_header("Content-Encoding", "gzip")
+        else:
+            req = urllib2.Request(url=url)
+        req.add_header("Accept-Encoding", "gzip")
+        handlers = []
+
+        # Proxy handling
+        proxy = self.proxy or config.proxy or None
+        if proxy:
+            _debug("using proxy=%s" % proxy)
+            proxy_handler = urllib2.ProxyHandler({protocol: proxy})
+            handlers.append(proxy_handler)
+
+        # Authentication handling
+        username = self.username
+        password = self.password
+        if username and password:
+            # Send auth data unsolicitedly (the only way with Eden instances):
+            import base64
+            base64string = base64.encodestring('%s:%s' %
+                                               (username, password))[:-1]
+            req.add_header("Authorization", "Basic %s" % base64string)
+            # Just in case the peer does not accept that, add a 401 handler:
+            passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
+            passwd_manager.add_password(realm=None,
+                                        uri=url,
+                                        user=username,
+                                        passwd=password)
+            auth_handler = urllib2.HTTPBasicAuthHandler(passwd_manager)
+            handlers.append(auth_handler)
+
+        # Install all handlers
+        if handlers:
+            opener = urllib2.build_opener(*handlers)
+            urllib2.install_opener(opener)
+
+        return urllib2.urlopen(req)
+
+    # -------------------------------------------------------------------------
+    def _read(self, response):
+        """
+            Get a file-like object to read the (decompressed) body of
+            a response from
+
+            @param response: the response
+        """
+
+        if response.info().get("Content-Encoding") == "gzip":
+            # The peer supports compression => compress pushes too
+            self.compress = True
+            return S3SyncDecompressor(response)
+        return response
+
 # =============================================================================
 class S3SyncCiviCRM(S3SyncRepository):
     """
@@ -1561,4 +1715,42 @@ class S3SyncCiviCRM(S3SyncRepository):
 
         return response, message
 
+# =============================================================================
+class S3SyncDecompressor(object):
+    """ File-like object to decompress a gzip-encoded stream while reading """
+
+    def __init__(self, stream, block_size=65536):
+        """
+            Constructor
+
+            @param stream: the gzip-encoded stream (file-like object)
+            @param block_size: number of bytes to read at a time
+        """
+
+        self.stream = stream
+        self.block_size = block_size
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ""
+
+    # -------------------------------------------------------------------------
+    def read(self, size=-1):
+        """
+            Read decompressed data
+
+            @param size: maximum number of bytes to read, -1 to read all
+        """
+
+        buffer = self.buffer
+        while size < 0 or len(buffer) < size:
+            data = self.stream.read(self.block_size)
+            if not data:
+                buffer += self.decompressor.flush()
+                break
+            buffer += self.decompressor.decompress(data)
+        if size < 0:
+            self.buffer = ""
+            return buffer
+        self.buffer = buffer[size:]
+        return buffer[:size]
+
 # End =========================================================================
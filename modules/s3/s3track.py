@@ -32,7 +32,9 @@ from gluon import current
 from gluon.dal import Table, Rows, Row
 from datetime import datetime, timedelta
 
-__all__ = ["S3Tracker"]
+__all__ = ["S3Trackable",
+           "S3Tracker",
+           ]
 
 UID = "uuid"                # field name for UIDs
 
@@ -249,58 +251,31 @@ class S3Trackable(object):
             @param exclude: interlocks to break at (avoids circular check-ins)
 
             @return: a location record, or a list of location records (if multiple)
+
+            @note: the locations of all instances are resolved set-based, i.e.
+                   the number of queries does not depend on the number of
+                   instances, but only on the depth of their interlocks
         """
 
-        db = current.db
-        s3db = current.s3db
+        records = self.records
 
-        ptable = s3db[PRESENCE]
-        ltable = s3db[LOCATION]
+        base_ids = self.__base_location_ids(records)
+        trackables = {}
+        for index, r in enumerate(records):
+            track_id = r[TRACK_ID] if TRACK_ID in r else None
+            trackables[index] = (track_id, base_ids[index])
 
-        if timestmp is None:
-            timestmp = datetime.utcnow()
+        found = self.__locate(trackables,
+                              timestmp = timestmp,
+                              exclude = exclude,
+                              _fields = _fields,
+                              _filter = _filter,
+                              )
 
         locations = []
-        for r in self.records:
-            location = None
-            if TRACK_ID in r:
-                query = ((ptable.deleted == False) & \
-                         (ptable[TRACK_ID] == r[TRACK_ID]) & \
-                         (ptable.timestmp <= timestmp))
-                presence = db(query).select(orderby=~ptable.timestmp,
-                                            limitby=(0, 1)).first()
-                if presence:
-                    if presence.interlock:
-                        exclude = [r[TRACK_ID]] + exclude
-                        tablename, record_id = presence.interlock.split(",", 1)
-                        trackable = S3Trackable(tablename=tablename, record_id=record_id)
-                        record = trackable.records.first()
-                        if TRACK_ID not in record or \
-                           record[TRACK_ID] not in exclude:
-                            location = trackable.get_location(timestmp=timestmp,
-                                                              exclude=exclude,
-                                                              _fields=_fields,
-                                                              as_rows=True).first()
-                    elif presence.location_id:
-                        query = (ltable.id == presence.location_id)
-                        if _filter is not None:
-                            query = query & _filter
-                        if _fields is None:
-                            location = db(query).select(ltable.ALL,
-                                                        limitby=(0, 1)).first()
-                        else:
-                            location = db(query).select(limitby=(0, 1),
-                                                        *_fields).first()
-
-            if not location:
-                if len(self.records) > 1:
-                    trackable = S3Trackable(record=r, rtable=self.rtable)
-                else:
-                    trackable = self
-                location = trackable.get_base_location(_fields=_fields)
-
-            if location:
-                locations.append(location)
+        for index in xrange(len(records)):
+            if index in found:
+                locations.append(found[index])
             else:
                 # Ensure we return an entry so that indexes match
                 locations.append(Row({"lat": None, "lon": None}))
@@ -313,6 +288,382 @@ class S3Trackable(object):
         else:
             return locations
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def latest_presence(cls, track_ids, timestmp=None):
+        """
+            Get the latest presence records of trackables (set-based)
+
+            @param track_ids: iterable of track IDs
+            @param timestmp: last datetime for presence (defaults to current time)
+
+            @return: dict {track_id: Row} with the latest presence record
+                     (timestmp, location_id, interlock) of each trackable
+
+            @note: with settings.gis.latest_presence, the current presence
+                   is read from the sit_presence_latest table
+        """
+
+        track_ids = set(t for t in track_ids if t)
+        presence = {}
+        if not track_ids:
+            return presence
+
+        if timestmp is None:
+            timestmp = datetime.utcnow()
+            if current.deployment_settings.get_gis_latest_presence():
+                table = current.s3db.sit_presence_latest
+                query = (table[TRACK_ID].belongs(track_ids))
+                rows = current.db(query).select(table[TRACK_ID],
+                                                table.timestmp,
+                                                table.location_id,
+                                                table.interlock,
+                                                )
+                for row in rows:
+                    # Presences in the future must be looked up in the log
+                    if row.timestmp and row.timestmp <= timestmp:
+                        presence[row[TRACK_ID]] = row
+                track_ids -= set(presence)
+                if not track_ids:
+                    return presence
+
+        presence.update(cls.__latest(track_ids, timestmp))
+        return presence
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __latest(track_ids, timestmp=None, chunk_size=500):
+        """
+            Look up the latest presence records of trackables in the
+            presence log, one grouped query per chunk of trackables
+
+            @param track_ids: set of track IDs
+            @param timestmp: last datetime for presence (None for no limit)
+            @param chunk_size: number of trackables per query
+
+            @return: dict {track_id: Row}
+        """
+
+        db = current.db
+        ptable = current.s3db[PRESENCE]
+
+        presence = {}
+        track_ids = list(track_ids)
+        latest = ptable.timestmp.max()
+
+        for i in xrange(0, len(track_ids), chunk_size):
+            chunk = track_ids[i:i + chunk_size]
+            query = (ptable.deleted == False) & \
+                    (ptable[TRACK_ID].belongs(chunk))
+            if timestmp is not None:
+                query &= (ptable.timestmp <= timestmp)
+            rows = db(query).select(ptable[TRACK_ID],
+                                    latest,
+                                    groupby=ptable[TRACK_ID],
+                                    )
+            times = dict((row[ptable[TRACK_ID]], row[latest])
+                         for row in rows if row[latest])
+            if not times:
+                continue
+
+            query = (ptable.deleted == False) & \
+                    (ptable[TRACK_ID].belongs(times.keys())) & \
+                    (ptable.timestmp.belongs(set(times.values())))
+            rows = db(query).select(ptable.id,
+                                    ptable[TRACK_ID],
+                                    ptable.timestmp,
+                                    ptable.location_id,
+                                    ptable.interlock,
+                                    orderby=ptable.id,
+                                    )
+            for row in rows:
+                track_id = row[TRACK_ID]
+                if row.timestmp == times[track_id]:
+                    # Last entry wins if there are several at the same time
+                    presence[track_id] = row
+
+        return presence
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def update_latest_presence(cls, track_ids):
+        """
+            Update the latest presence projection (sit_presence_latest)
+            of trackables from their presence logs
+
+            @param track_ids: iterable of track IDs
+        """
+
+        if not current.deployment_settings.get_gis_latest_presence():
+            return
+
+        track_ids = set(t for t in track_ids if t)
+        if not track_ids:
+            return
+
+        db = current.db
+        table = current.s3db.sit_presence_latest
+
+        presence = cls.__latest(track_ids)
+
+        db(table[TRACK_ID].belongs(track_ids)).delete()
+        for track_id, row in presence.items():
+            data = {TRACK_ID: track_id,
+                    "timestmp": row.timestmp,
+                    "location_id": row.location_id,
+                    "interlock": row.interlock,
+                    }
+            table.insert(**data)
+
+    # -------------------------------------------------------------------------
+    def __locate(self,
+                 trackables,
+                 timestmp=None,
+                 exclude=None,
+                 _fields=None,
+                 _filter=None):
+        """
+            Find the current locations of trackables, following their
+            presence logs and interlocks level-wise
+
+            @param trackables: dict {key: (track_id, base_location_id)}
+            @param timestmp: last datetime for presence (defaults to current time)
+            @param exclude: track IDs to break interlocks at
+            @param _fields: fields to retrieve from the location records (None for ALL)
+            @param _filter: filter for the locations (applies to the
+                            presence locations of the trackables themselves)
+
+            @return: dict {key: location Row}, trackables without any
+                     location are omitted
+        """
+
+        # Location IDs in order of precedence
+        candidates = {}
+
+        paths = {}
+        chains = {}
+        active = {}
+        for key, (track_id, base_id) in trackables.items():
+            if track_id:
+                active[key] = track_id
+                paths[key] = set([track_id])
+                if exclude:
+                    paths[key].update(exclude)
+                chains[key] = []
+                candidates[key] = [None]
+
+        presence = {}
+        depth = 0
+        while active:
+            missing = set(active.values()) - set(presence)
+            if missing:
+                latest = self.latest_presence(missing, timestmp=timestmp)
+                for track_id in missing:
+                    presence[track_id] = latest.get(track_id)
+
+            interlocks = {}
+            for key, track_id in active.items():
+                row = presence[track_id]
+                if not row:
+                    continue
+                if row.interlock:
+                    interlocks[key] = row.interlock
+                elif row.location_id:
+                    if depth == 0:
+                        candidates[key][0] = row.location_id
+                    else:
+                        chains[key].append(row.location_id)
+
+            # Look up all interlocked instances of this level at once
+            entities = self.__interlocked(set(interlocks.values()))
+
+            active = {}
+            for key, interlock in interlocks.items():
+                entity = entities.get(interlock)
+                if not entity:
+                    continue
+                track_id, base_id = entity
+                if track_id in paths[key]:
+                    # Circular check-in
+                    continue
+                # Base location of the interlocked instance as fallback
+                chains[key].append(base_id)
+                if track_id:
+                    paths[key].add(track_id)
+                    active[key] = track_id
+            depth += 1
+
+        for key, chain in chains.items():
+            # Innermost presence location first, then base locations
+            # from the innermost to the outermost interlocked instance
+            chain.reverse()
+            candidates[key].extend(chain)
+
+        # Presence locations of the trackables themselves
+        top = self.__locations([c[0] for c in candidates.values()],
+                               _fields = _fields,
+                               _filter = _filter,
+                               )
+
+        # Interlocked and base locations
+        location_ids = set(base_id for track_id, base_id in trackables.values())
+        for c in candidates.values():
+            location_ids.update(c[1:])
+        locations = self.__locations(location_ids, _fields=_fields)
+
+        result = {}
+        for key, (track_id, base_id) in trackables.items():
+            location = None
+            if key in candidates:
+                c = candidates[key]
+                location = top.get(c[0])
+                if location is None:
+                    for location_id in c[1:]:
+                        location = locations.get(location_id)
+                        if location is not None:
+                            break
+            if location is None:
+                location = locations.get(base_id)
+            if location is not None:
+                result[key] = location
+
+        return result
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __interlocked(interlocks):
+        """
+            Look up the instances referenced by presence interlocks,
+            one query per instance table
+
+            @param interlocks: set of interlocks ("tablename,record_id")
+
+            @return: dict {interlock: (track_id, location_id)}
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        record_ids = {}
+        for interlock in interlocks:
+            try:
+                tablename, record_id = interlock.split(",", 1)
+                record_id = long(record_id)
+            except ValueError:
+                continue
+            record_ids.setdefault(tablename, {})[record_id] = interlock
+
+        entities = {}
+        for tablename, items in record_ids.items():
+            table = s3db.table(tablename)
+            if table is None:
+                continue
+            if "instance_type" in table.fields:
+                # Super-entity => resolve the instance records
+                for record_id, interlock in items.items():
+                    record = S3Trackable(table=table,
+                                         record_id=record_id).records.first()
+                    if record:
+                        entities[interlock] = (
+                            record[TRACK_ID] if TRACK_ID in record else None,
+                            record[LOCATION_ID] if LOCATION_ID in record else None,
+                        )
+                continue
+            fields = [table._id]
+            for fn in (TRACK_ID, LOCATION_ID):
+                if fn in table.fields:
+                    fields.append(table[fn])
+            query = (table._id.belongs(items.keys()))
+            rows = db(query).select(*fields)
+            pkey = table._id.name
+            for row in rows:
+                entities[items[row[pkey]]] = (
+                    row[TRACK_ID] if TRACK_ID in row else None,
+                    row[LOCATION_ID] if LOCATION_ID in row else None,
+                )
+
+        return entities
+
+    # -------------------------------------------------------------------------
+    def __base_location_ids(self, records):
+        """
+            Get the base location IDs of records, one query per
+            instance type for records which only have a track ID
+
+            @param records: the records
+
+            @return: list of location IDs, in the same order as records
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        location_ids = [None] * len(records)
+
+        lookup = {}
+        for index, r in enumerate(records):
+            if LOCATION_ID in r:
+                location_ids[index] = r[LOCATION_ID]
+            elif TRACK_ID in r and r[TRACK_ID]:
+                lookup.setdefault(r[TRACK_ID], []).append(index)
+        if not lookup:
+            return location_ids
+
+        ttable = self.table
+        rows = db(ttable[TRACK_ID].belongs(lookup.keys())).select(
+                                                    ttable[TRACK_ID],
+                                                    ttable.instance_type,
+                                                    )
+        instance_types = {}
+        for row in rows:
+            instance_types.setdefault(row.instance_type, []) \
+                          .append(row[TRACK_ID])
+
+        for instance_type, track_ids in instance_types.items():
+            table = s3db.table(instance_type)
+            if table is None or LOCATION_ID not in table.fields:
+                continue
+            query = (table[TRACK_ID].belongs(track_ids))
+            rows = db(query).select(table[TRACK_ID], table[LOCATION_ID])
+            for row in rows:
+                for index in lookup[row[TRACK_ID]]:
+                    location_ids[index] = row[LOCATION_ID]
+
+        return location_ids
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __locations(location_ids, _fields=None, _filter=None):
+        """
+            Look up location records
+
+            @param location_ids: iterable of location IDs
+            @param _fields: fields to retrieve from the location records (None for ALL)
+            @param _filter: filter for the locations
+
+            @return: dict {location_id: Row}
+        """
+
+        location_ids = set(l for l in location_ids if l)
+        if not location_ids:
+            return {}
+
+        ltable = current.s3db[LOCATION]
+
+        query = (ltable.id.belongs(location_ids))
+        if _filter is not None:
+            query &= _filter
+        if not _fields:
+            fields = [ltable.ALL]
+        else:
+            fields = list(_fields)
+            if not [f for f in fields if str(f) == str(ltable.id)]:
+                # Needed to map the records
+                fields.insert(0, ltable.id)
+        rows = current.db(query).select(*fields)
+
+        return dict((row.id, row) for row in rows)
+
     # -------------------------------------------------------------------------
     def set_location(self, location, timestmp=None):
         """
@@ -344,6 +695,7 @@ class S3Trackable(object):
         else:
             data = dict(location_id=location, timestmp=timestmp)
 
+        track_ids = []
         for r in self.records:
             if TRACK_ID not in r:
                 # No track ID => set base location
@@ -355,7 +707,8 @@ class S3Trackable(object):
             elif r[TRACK_ID]:
                 data.update({TRACK_ID:r[TRACK_ID]})
                 ptable.insert(**data)
-                self.__update_timestamp(r[TRACK_ID], timestmp)
+                track_ids.append(r[TRACK_ID])
+        self.__update_timestamp(track_ids, timestmp)
 
     # -------------------------------------------------------------------------
     def check_in(self, table, record, timestmp=None):
@@ -405,20 +758,20 @@ class S3Trackable(object):
             data = dict(location_id=None,
                         timestmp=timestmp,
                         interlock=interlock)
-            q = ((ptable.deleted == False) & (ptable.timestmp <= timestmp))
-            for r in self.records:
-                if TRACK_ID not in r:
-                    # Cannot check-in a non-trackable
-                    continue
-                query = q & (ptable[TRACK_ID] == r[TRACK_ID])
-                presence = db(query).select(orderby=~ptable.timestmp,
-                                            limitby=(0, 1)).first()
-                if presence and presence.interlock == interlock:
+            # Cannot check-in a non-trackable
+            track_ids = [r[TRACK_ID] for r in self.records
+                         if TRACK_ID in r and r[TRACK_ID]]
+            presence = self.latest_presence(track_ids, timestmp=timestmp)
+            checked_in = []
+            for track_id in track_ids:
+                row = presence.get(track_id)
+                if row and row.interlock == interlock:
                     # already checked-in to the same instance
                     continue
-                data.update({TRACK_ID:r[TRACK_ID]})
+                data.update({TRACK_ID:track_id})
                 ptable.insert(**data)
-                self.__update_timestamp(r[TRACK_ID], timestmp)
+                checked_in.append(track_id)
+            self.__update_timestamp(checked_in, timestmp)
 
     # -------------------------------------------------------------------------
     def check_out(self, table=None, record=None, timestmp=None):
@@ -460,33 +813,48 @@ class S3Trackable(object):
             else:
                 return
 
-        q = ((ptable.deleted == False) & (ptable.timestmp <= timestmp))
-
-        for r in self.records:
-            if TRACK_ID not in r:
-                # Cannot check-out a non-trackable
-                continue
-            query = q & (ptable[TRACK_ID] == r[TRACK_ID])
-            presence = db(query).select(orderby=~ptable.timestmp,
-                                        limitby=(0, 1)).first()
-            if presence and presence.interlock:
-                if interlock and presence.interlock != interlock:
+        # Cannot check-out a non-trackable
+        track_ids = [r[TRACK_ID] for r in self.records
+                     if TRACK_ID in r and r[TRACK_ID]]
+        presence = self.latest_presence(track_ids, timestmp=timestmp)
+
+        checkouts = {}
+        for track_id in track_ids:
+            row = presence.get(track_id)
+            if row and row.interlock:
+                if interlock and row.interlock != interlock:
                     continue
                 elif not interlock and table and \
-                     not presence.interlock.startswith("%s" % table):
+                     not row.interlock.startswith("%s" % table):
                     continue
-                tablename, record_id = presence.interlock.split(",", 1)
-                trackable = S3Trackable(tablename=tablename, record_id=record_id)
-                location = trackable.get_location(timestmp=timestmp,
-                                                  as_rows=True).first()
-                if timestmp - presence.timestmp < timedelta(seconds=1):
-                    timestmp = timestmp + timedelta(seconds=1)
-                data = dict(location_id=location,
-                            timestmp=timestmp,
-                            interlock=None)
-                data.update({TRACK_ID:r[TRACK_ID]})
-                ptable.insert(**data)
-                self.__update_timestamp(r[TRACK_ID], timestmp)
+                checkouts[track_id] = row
+        if not checkouts:
+            return
+
+        # Current locations of the instances to check-out from
+        entities = self.__interlocked(set(row.interlock
+                                          for row in checkouts.values()))
+        ltable = s3db[LOCATION]
+        locations = self.__locate(entities,
+                                  timestmp=timestmp,
+                                  _fields=[ltable.id],
+                                  )
+
+        checked_out = {}
+        for track_id, row in checkouts.items():
+            location = locations.get(row.interlock)
+            check_out = timestmp
+            if check_out - row.timestmp < timedelta(seconds=1):
+                check_out = check_out + timedelta(seconds=1)
+            data = dict(location_id=location.id if location else None,
+                        timestmp=check_out,
+                        interlock=None)
+            data.update({TRACK_ID:track_id})
+            ptable.insert(**data)
+            checked_out.setdefault(check_out, []).append(track_id)
+
+        for check_out, track_ids in checked_out.items():
+            self.__update_timestamp(track_ids, check_out)
 
     # -------------------------------------------------------------------------
     def remove_location(self, location=None):
@@ -512,40 +880,13 @@ class S3Trackable(object):
             @return: the base location(s) of the current instance
         """
 
-        db = current.db
-        s3db = current.s3db
-
-        ltable = s3db[LOCATION]
-        rtable = self.rtable
+        base_ids = self.__base_location_ids(self.records)
+        found = self.__locations(base_ids, _fields=_fields, _filter=_filter)
 
         locations = []
-        for r in self.records:
-            location = None
-            query = None
-            if LOCATION_ID in r:
-                query = (ltable.id == r[LOCATION_ID])
-                if rtable:
-                    query = query & (rtable[LOCATION_ID] == ltable.id)
-                    if TRACK_ID in r:
-                        query = query & (rtable[TRACK_ID] == r[TRACK_ID])
-            elif TRACK_ID in r:
-                q = (self.table[TRACK_ID] == r[TRACK_ID])
-                trackable = db(q).select(limitby=(0, 1)).first()
-                table = s3db[trackable.instance_type]
-                if LOCATION_ID in table.fields:
-                    query = ((table[TRACK_ID] == r[TRACK_ID]) &
-                             (table[LOCATION_ID] == ltable.id))
-            if query:
-                if _filter is not None:
-                    query = query & _filter
-                if not _fields:
-                    location = db(query).select(ltable.ALL,
-                                                limitby=(0, 1)).first()
-                else:
-                    location = db(query).select(limitby=(0, 1),
-                                                *_fields).first()
-            if location:
-                locations.append(location)
+        for location_id in base_ids:
+            if location_id in found:
+                locations.append(found[location_id])
             else:
                 # Ensure we return an entry so that indexes match
                 locations.append(Row({"lat": None, "lon": None}))
@@ -624,20 +965,22 @@ class S3Trackable(object):
                 r[LOCATION_ID] = location
 
     # -------------------------------------------------------------------------
-    def __update_timestamp(self, track_id, timestamp):
+    def __update_timestamp(self, track_ids, timestamp):
         """
-            Update the timestamp of a trackable
+            Update the timestamps (and the latest presence) of trackables
 
-            @param track_id: the trackable ID (super-entity key)
+            @param track_ids: the trackable IDs (super-entity keys)
             @param timestamp: the timestamp
         """
 
         if timestamp is None:
             timestamp = datetime.utcnow()
-        if track_id:
-            trackable = self.table[track_id]
-        if trackable:
-            trackable.update_record(track_timestmp=timestamp)
+        track_ids = [t for t in track_ids if t]
+        if track_ids:
+            table = self.table
+            query = (table[TRACK_ID].belongs(track_ids))
+            current.db(query).update(track_timestmp=timestamp)
+            self.update_latest_presence(track_ids)
 
 # =============================================================================
 class S3Tracker(object):
@@ -570,6 +570,9 @@ class IS_ONE_OF_EMPTY(Validator):
         self.updateable = updateable
         self.instance_types = instance_types
 
+        # Results of batch validation {key: valid}
+        self.prevalidated = {}
+
     # -------------------------------------------------------------------------
     def set_self_id(self, id):
         if self._and:
@@ -830,50 +833,16 @@ class IS_ONE_OF_EMPTY(Validator):
         try:
             dbset = self.dbset
             table = dbset._db[self.ktable]
-            deleted_q = ("deleted" in table) and (table["deleted"] == False) or False
-            filter_opts_q = False
-            filterby = self.filterby
-            if filterby and filterby in table:
-                filter_opts = self.filter_opts
-                if filter_opts:
-                    if None in filter_opts:
-                        # Needs special handling (doesn't show up in 'belongs')
-                        filter_opts_q = (table[filterby] == None)
-                        filter_opts = [f for f in filter_opts if f is not None]
-                        if filter_opts:
-                            filter_opts_q |= (table[filterby].belongs(filter_opts))
-                    else:
-                        filter_opts_q = (table[filterby].belongs(filter_opts))
 
             if self.multiple:
-                if isinstance(value, list):
-                    values = [str(v) for v in value]
-                elif isinstance(value, basestring) and \
-                     value[0] == "|" and value[-1] == "|":
-                    values = value[1:-1].split("|")
-                elif value:
-                    values = [value]
-                else:
-                    values = []
-
+                values = self._keys(value)
                 if self.theset:
                     if not [x for x in values if not x in self.theset]:
                         return (values, None)
                     else:
                         return (value, self.error_message)
                 else:
-                    field = table[self.kfield]
-                    query = None
-                    for v in values:
-                        q = (field == v)
-                        query = query is not None and query | q or q
-                    if filter_opts_q != False:
-                        query = query is not None and \
-                                (filter_opts_q & (query)) or filter_opts_q
-                    if deleted_q != False:
-                        query = query is not None and \
-                                (deleted_q & (query)) or deleted_q
-                    if dbset(query).count() < 1:
+                    if values and not self._lookup(table, values):
                         return (value, self.error_message)
                     return (values, None)
             elif self.theset:
@@ -883,18 +852,7 @@ class IS_ONE_OF_EMPTY(Validator):
                     else:
                         return (value, None)
             else:
-                values = [value]
-                query = None
-                for v in values:
-                    q = (table[self.kfield] == v)
-                    query = query is not None and query | q or q
-                if filter_opts_q != False:
-                    query = query is not None and \
-                            (filter_opts_q & (query)) or filter_opts_q
-                if deleted_q != False:
-                    query = query is not None and \
-                            (deleted_q & (query)) or deleted_q
-                if dbset(query).count():
+                if self._lookup(table, [str(value)]):
                     if self._and:
                         return self._and(value)
                     else:
@@ -904,6 +862,179 @@ class IS_ONE_OF_EMPTY(Validator):
 
         return (value, self.error_message)
 
+    # -------------------------------------------------------------------------
+    def validate_batch(self, values):
+        """
+            Validate a column of values at once, e.g. a foreign key column
+            of an import
+
+            @param values: list of values
+
+            @return: list of tuples (value, error) like __call__, in the
+                     same order as values
+        """
+
+        self.prevalidate(values)
+        return [self(value) for value in values]
+
+    # -------------------------------------------------------------------------
+    def prevalidate(self, values, chunk_size=500):
+        """
+            Look up the keys in a column of values with one query per
+            chunk of keys (rather than one query per value), and remember
+            the results for the validation of the individual values
+
+            @param values: list of values
+            @param chunk_size: maximum number of keys per query
+
+            @note: the results are kept until prevalidated is cleared,
+                   so callers should clear it once they have validated
+                   the individual values
+        """
+
+        if self.theset:
+            # No lookups required
+            return
+
+        prevalidated = self.prevalidated
+        try:
+            keys = set()
+            if self.multiple:
+                for value in values:
+                    if value:
+                        keys.update(self._keys(value))
+            else:
+                keys.update(str(value) for value in values
+                                       if value not in (None, ""))
+            keys = [key for key in keys if key not in prevalidated]
+
+            table = self.dbset._db[self.ktable]
+            for i in xrange(0, len(keys), chunk_size):
+                chunk = keys[i:i + chunk_size]
+                found = self._lookup(table, chunk)
+                for key in chunk:
+                    prevalidated[key] = key in found
+        except:
+            # Fall back to validation of the individual values
+            pass
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def validators(field):
+        """
+            Get the IS_ONE_OF validators of a field (including those
+            wrapped in IS_EMPTY_OR), e.g. for batch validation
+
+            @param field: the Field
+
+            @return: list of validators
+        """
+
+        requires = field.requires
+        if isinstance(requires, (list, tuple)):
+            requires = list(requires)
+        else:
+            requires = [requires]
+        validators = []
+        for validator in requires:
+            other = getattr(validator, "other", None)
+            if other is not None:
+                if isinstance(other, (list, tuple)):
+                    requires.extend(other)
+                else:
+                    validator = other
+            if isinstance(validator, IS_ONE_OF_EMPTY):
+                validators.append(validator)
+        return validators
+
+    # -------------------------------------------------------------------------
+    def _keys(self, value):
+        """
+            Get the keys from a value for multiple=True
+
+            @param value: the value
+        """
+
+        if isinstance(value, list):
+            values = [str(v) for v in value]
+        elif isinstance(value, basestring) and \
+             value[0] == "|" and value[-1] == "|":
+            values = value[1:-1].split("|")
+        elif value:
+            values = [value]
+        else:
+            values = []
+        return values
+
+    # -------------------------------------------------------------------------
+    def _lookup(self, table, keys):
+        """
+            Find out which of the keys refer to valid records in the
+            referenced table (considering filterby, deleted flag and
+            realms), using the results of batch validation if available
+
+            @param table: the referenced table
+            @param keys: the keys (list of strings)
+
+            @return: set of the valid keys
+        """
+
+        prevalidated = self.prevalidated
+        valid = set(key for key in keys if prevalidated.get(key))
+        keys = [key for key in keys if key not in prevalidated]
+        if not keys:
+            return valid
+
+        kfield = self.kfield
+        field = table[kfield]
+
+        # Convert the keys for the query
+        values = {}
+        if field.type in ("id", "integer") or \
+           field.type[:9] == "reference":
+            for key in keys:
+                try:
+                    values[key] = str(long(key))
+                except ValueError:
+                    continue
+        else:
+            values = dict((key, key) for key in keys)
+        if not values:
+            return valid
+
+        query = field.belongs(set(values.values()))
+
+        if "deleted" in table:
+            query &= (table["deleted"] != True)
+
+        filterby = self.filterby
+        if filterby and filterby in table:
+            filter_opts = self.filter_opts
+            if filter_opts:
+                if None in filter_opts:
+                    # Needs special handling (doesn't show up in 'belongs')
+                    filter_opts_q = (table[filterby] == None)
+                    filter_opts = [f for f in filter_opts if f is not None]
+                    if filter_opts:
+                        filter_opts_q |= (table[filterby].belongs(filter_opts))
+                else:
+                    filter_opts_q = (table[filterby].belongs(filter_opts))
+                query &= filter_opts_q
+
+        # Realms filter?
+        if self.realms:
+            auth = current.auth
+            if auth.is_logged_in() and \
+               auth.get_system_roles().ADMIN in auth.user.realms:
+                # Admin doesn't filter
+                pass
+            else:
+                query &= auth.permission.realm_query(table, self.realms)
+
+        rows = self.dbset(query).select(field, distinct=True)
+        found = set(str(row[kfield]) for row in rows)
+        valid.update(key for key, value in values.items() if value in found)
+        return valid
 
 # =============================================================================
 class IS_ONE_OF(IS_ONE_OF_EMPTY):
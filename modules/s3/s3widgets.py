@@ -75,6 +75,7 @@ __all__ = ["S3ACLWidget",
            ]
 
 import datetime
+import hashlib
 import os
 
 try:
@@ -4363,80 +4364,47 @@ class S3LocationSelectorWidget2(FormWidget):
             # (client-side JS will open when-needed)
             hidden = hide_lx
 
+        # Only the countries are rendered into the page, lower levels
+        # are loaded on demand from gis/ldata (see ldata)
+        top = dict(id = default_L0,
+                   b = default_L0_bounds)
+        location_dict = dict(d=top)
         if not default_L0:
-            query = (gtable.level == "L0")
+            query = (gtable.level == "L0") & \
+                    (gtable.deleted == False)
             if len(countries):
                 ttable = s3db.gis_location_tag
                 query &= ((ttable.tag == "ISO2") & \
                           (ttable.value.belongs(countries)) & \
                           (ttable.location_id == gtable.id))
-        elif "L1" in levels:
-            query = (gtable.level == "L1") & \
-                    (gtable.parent == default_L0)
-        elif default_L1 and "L2" in levels:
-            query = (gtable.level == "L2") & \
-                    (gtable.parent == default_L1)
-        elif default_L2 and "L3" in levels:
-            query = (gtable.level == "L3") & \
-                    (gtable.parent == default_L2)
-        elif default_L3 and "L4" in levels:
-            query = (gtable.level == "L4") & \
-                    (gtable.parent == default_L3)
-        elif default_L4 and "L5" in levels:
-            query = (gtable.level == "L5") & \
-                    (gtable.parent == default_L4)
-        query &= (gtable.deleted == False)
-        fields = [gtable.id,
-                  gtable.name,
-                  gtable.level,
-                  gtable.parent,
-                  gtable.inherited,
-                  gtable.lat_min,
-                  gtable.lon_min,
-                  gtable.lat_max,
-                  gtable.lon_max,
-                  ]
-        if translate:
-            ntable = s3db.gis_location_name
-            fields.append(ntable.name_l10n)
-            left = ntable.on((ntable.deleted == False) & \
-                             (ntable.language == language) & \
-                             (ntable.location_id == gtable.id))
-        else:
-            left = None
-        locations = db(query).select(*fields,
-                                     left=left)
-        top = dict(id = default_L0,
-                   b = default_L0_bounds)
-        location_dict = dict(d=top)
-        if translate:
+            fields = [gtable.id,
+                      gtable.name,
+                      gtable.inherited,
+                      gtable.lat_min,
+                      gtable.lon_min,
+                      gtable.lat_max,
+                      gtable.lon_max,
+                      ]
+            if translate:
+                ntable = s3db.gis_location_name
+                fields.append(ntable.name_l10n)
+                left = ntable.on((ntable.deleted == False) & \
+                                 (ntable.language == language) & \
+                                 (ntable.location_id == gtable.id))
+            else:
+                left = None
+            locations = db(query).select(*fields,
+                                         left=left)
             for location in locations:
-                l = location["gis_location"]
-                name = location["gis_location_name.name_l10n"] or l.name
+                if translate:
+                    l = location["gis_location"]
+                    name = location["gis_location_name.name_l10n"] or l.name
+                else:
+                    l = location
+                    name = l.name
                 data = dict(n=name,
-                            l=int(l.level[1]),
+                            l=0,
                             )
-                if l.parent:
-                    data["f"] = int(l.parent)
-                if not l.inherited:
-                    data["b"] = [l.lon_min,
-                                 l.lat_min,
-                                 l.lon_max,
-                                 l.lat_max,
-                                 ]
-                location_dict[int(l.id)] = data
-        else:
-            for l in locations:
-                level = l.level
-                if level:
-                    level = int(level[1])
-                else:
-                    s3_debug("Location Hierarchy not setup properly")
-                    continue
-                data = dict(n=l.name,
-                            l=level)
-                if l.parent:
-                    data["f"] = int(l.parent)
                 if not l.inherited:
                     data["b"] = [l.lon_min,
                                  l.lat_min,
@@ -4467,6 +4435,10 @@ class S3LocationSelectorWidget2(FormWidget):
             global_append(script)
             script = '''h=%s''' % json.dumps(hdict)
             global_append(script)
+            # Version of the hierarchy data, so that they can be cached
+            version = self.data_version(language if translate else None)
+            script = '''lv="%s"''' % version
+            global_append(script)
 
         # If we need to show the map since we have an existing lat/lon/wkt
         # then we need to launch the client-side JS as a callback to the MapJS loader
@@ -4603,6 +4575,46 @@ i18n.location_not_found="%s"''' % (T("Address Mapped"),
                        requires=field.requires
                        )
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def data_version(language=None):
+        """
+            Get a version stamp for the location hierarchy data served by
+            gis/ldata, which changes whenever locations (or their names)
+            are modified, so that these data can be cached by browsers and
+            proxies
+
+            @param language: the language of location names, None if they
+                             are not translated
+        """
+
+        db = current.db
+        s3db = current.s3db
+
+        tablenames = ["gis_location"]
+        if language:
+            tablenames.append("gis_location_name")
+
+        def lookup():
+            stamps = []
+            for tablename in tablenames:
+                table = s3db[tablename]
+                modified_on = table.modified_on.max()
+                count = table.id.count()
+                row = db(table.id > 0).select(modified_on, count).first()
+                stamps.append("%s:%s" % (row[modified_on], row[count]))
+            return hashlib.md5("|".join(stamps)).hexdigest()[:12]
+
+        # Writes within this process invalidate the cached version
+        # immediately, writes by other processes after one minute
+        key = "gis_ldata_version_%s" % \
+              "_".join("%s" % s3db.table_version(tablename)
+                       for tablename in tablenames)
+        version = current.cache.ram(key, lookup, time_expire=60)
+        if language:
+            version = "%s-%s" % (language, version)
+        return version
+
 # =============================================================================
 class S3MultiSelectWidget(MultipleOptionsWidget):
     """
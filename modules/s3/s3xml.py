@@ -38,6 +38,7 @@ import datetime
 import os
 import re
 import sys
+import threading
 import urllib2
 
 try:
@@ -73,6 +74,10 @@ class S3XML(S3Codec):
 
     CACHE_TTL = 20 # time-to-live of RAM cache for field representations
 
+    # Process-wide cache of compiled XSLT stylesheets {path: (mtime, XSLT)}
+    XSLT_CACHE = {}
+    XSLT_CACHE_LOCK = threading.Lock()
+
     UID = "uuid"
     MCI = "mci"
     DELETED = "deleted"
@@ -252,17 +257,10 @@ class S3XML(S3Codec):
             _args = dict([(k, "'%s'" % args[k]) for k in args])
         else:
             _args = None
-            
-        if isinstance(stylesheet_path, (etree._ElementTree, etree._Element)):
-            # Pre-parsed stylesheet
-            stylesheet = stylesheet_path
-        else:
-            stylesheet = self.parse(stylesheet_path)
 
-        if stylesheet is not None:
+        transformer = self.transformer(stylesheet_path)
+        if transformer is not None:
             try:
-                ac = etree.XSLTAccessControl(read_file=True, read_network=True)
-                transformer = etree.XSLT(stylesheet, access_control=ac)
                 if _args:
                     result = transformer(tree, **_args)
                 else:
@@ -273,9 +271,65 @@ class S3XML(S3Codec):
                 self.error = e
                 return None
         else:
+            # Error parsing or compiling the XSL stylesheet
+            return None
+
+    # -------------------------------------------------------------------------
+    def transformer(self, stylesheet):
+        """
+            Get a compiled XSLT transformer for a stylesheet; transformers
+            for stylesheet files are cached process-wide and re-compiled
+            only when the file has been modified (note that changes in
+            included/imported stylesheets are not detected)
+
+            @param stylesheet: the stylesheet pathname, or a pre-parsed
+                               stylesheet (ElementTree or Element), or a
+                               file-like object
+            @return: the XSLT transformer, or None on error
+
+            @note: lxml allows to use the same XSLT instance in concurrent
+                   threads, so the cache is only locked while accessing it
+        """
+
+        self.error = None
+
+        path = mtime = None
+        if isinstance(stylesheet, (etree._ElementTree, etree._Element)):
+            # Pre-parsed stylesheet
+            tree = stylesheet
+        else:
+            if isinstance(stylesheet, basestring) and \
+               os.path.isfile(stylesheet):
+                path = os.path.abspath(stylesheet)
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    path = None
+                else:
+                    cache = self.XSLT_CACHE
+                    with self.XSLT_CACHE_LOCK:
+                        cached = cache.get(path)
+                    if cached and cached[0] == mtime:
+                        return cached[1]
+            tree = self.parse(stylesheet)
+
+        if tree is None:
             # Error parsing the XSL stylesheet
             return None
 
+        try:
+            ac = etree.XSLTAccessControl(read_file=True, read_network=True)
+            transformer = etree.XSLT(tree, access_control=ac)
+        except:
+            e = sys.exc_info()[1]
+            self.error = e
+            return None
+
+        if path is not None:
+            with self.XSLT_CACHE_LOCK:
+                self.XSLT_CACHE[path] = (mtime, transformer)
+        return transformer
+
     # -------------------------------------------------------------------------
     def envelope(self, tree, stylesheet_path, **args):
         """
@@ -2447,6 +2501,11 @@ class S3XML(S3Codec):
 class S3XMLFormat(object):
     """ Helper class to store a pre-parsed stylesheet """
 
+    # Process-wide cache of parsed and inspected stylesheet files
+    # {path: (mtime, tree, select, skip)}
+    CACHE = {}
+    CACHE_LOCK = threading.Lock()
+
     def __init__(self, stylesheet):
         """
             Constructor
@@ -2454,11 +2513,29 @@ class S3XMLFormat(object):
             @param stylesheet: the stylesheet (pathname or stream)
         """
 
-        self.tree = current.xml.parse(stylesheet)
-        
+        self.path = None
+        self.mtime = None
+
         self.select = None
         self.skip = None
 
+        if isinstance(stylesheet, basestring) and os.path.isfile(stylesheet):
+            path = os.path.abspath(stylesheet)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                pass
+            else:
+                self.path = path
+                self.mtime = mtime
+                with self.CACHE_LOCK:
+                    cached = self.CACHE.get(path)
+                if cached and cached[0] == mtime:
+                    self.tree, self.select, self.skip = cached[1:]
+                    return
+
+        self.tree = current.xml.parse(stylesheet)
+
     # -------------------------------------------------------------------------
     def get_fields(self, tablename):
         """
@@ -2549,6 +2626,12 @@ class S3XMLFormat(object):
                 
         self.select = select
         self.skip = skip
+
+        # Cache the inspection results
+        path = self.path
+        if path is not None:
+            with self.CACHE_LOCK:
+                self.CACHE[path] = (self.mtime, tree, select, skip)
         return
 
     # -------------------------------------------------------------------------
@@ -2560,6 +2643,7 @@ class S3XMLFormat(object):
             @param args: parameters for the stylesheet
         """
 
-        return current.xml.transform(tree, self.tree, **args)
+        stylesheet = self.path if self.path is not None else self.tree
+        return current.xml.transform(tree, stylesheet, **args)
 
 # End =========================================================================
@@ -74,6 +74,8 @@ class S3Config(Storage):
         self.req = Storage()
         self.supply = Storage()
         self.hms = Storage()
+        # "import" is a keyword => settings["import"]
+        self["import"] = Storage()
 
     # -------------------------------------------------------------------------
     # Template
@@ -395,6 +397,28 @@ class S3Config(Storage):
         return self.security.get("audit_read", False)
     def get_security_audit_write(self):
         return self.security.get("audit_write", False)
+    def get_security_audit_buffer(self):
+        """
+            Number of audit entries to buffer per request before writing
+            them in bulk (written at the latest when the request commits),
+            0 to write every entry immediately (or, with an audit spool,
+            to keep all entries until the request commits)
+        """
+        return self.security.get("audit_buffer", 0)
+    def get_security_audit_spool(self):
+        """
+            Path (absolute or relative to the application folder) of an
+            SQLite file to spool audit entries in rather than writing them
+            into the database when the request commits; spooled entries
+            are transferred into the audit table by the s3_audit_flush task
+        """
+        return self.security.get("audit_spool", None)
+    def get_security_audit_spool_size(self):
+        """
+            Maximum number of entries in the audit spool, entries beyond
+            this are written into the database directly
+        """
+        return self.security.get("audit_spool_size", 100000)
     def get_security_policy(self):
         " Default is Simple Security Policy "
         return self.security.get("policy", 1)
@@ -443,6 +467,26 @@ class S3Config(Storage):
         """ Whether to prepopulate the database &, if so, which set of data to use for this """
         return self.base.get("prepopulate", 1)
 
+    def get_base_prepopulate_workers(self):
+        """
+            Number of worker processes to run independent prepopulate
+            import tasks concurrently (not for SQLite, 1 to disable)
+        """
+        return self.base.get("prepopulate_workers", 1)
+
+    def get_base_chart_workers(self):
+        """
+            Number of worker processes to render charts in (0 to render
+            charts inside the request)
+        """
+        return self.base.get("chart_workers", 0)
+
+    def get_base_chart_cache_size(self):
+        """
+            Maximum size (in MB) of the cache of rendered charts
+        """
+        return self.base.get("chart_cache_size", 20)
+
     def get_base_guided_tour(self):
         """ Whether the guided tours are enabled """
         return self.base.get("guided_tour", False)
@@ -466,12 +510,40 @@ class S3Config(Storage):
         """
         return self.base.get("session_memcache", False)
 
+    def get_base_represent_cache_size(self):
+        """
+            Maximum number of foreign key representations to share
+            across requests in each server process (0 to disable)
+            - changes in other server processes only become visible when
+              the entries expire (see represent_cache_ttl), and neither do
+              rolled-back changes
+        """
+        return self.base.get("represent_cache_size", 0)
+
+    def get_base_represent_cache_ttl(self):
+        """
+            Maximum age (in seconds) of shared foreign key representations
+            (limits the time representations can be outdated after changes
+            in other server processes)
+        """
+        return self.base.get("represent_cache_ttl", 300)
+
     def get_base_solr_url(self):
         """
             URL to connect to solr server
         """    
         return self.base.get("solr_url", False)
 
+    def get_import_bulk_commit(self):
+        """
+            Whether import jobs shall set record owners and realms after
+            all items have been committed, with one update per table and
+            distinct set of owner values (rather than record-by-record
+            during commit), which speeds up large imports but means that
+            import onaccept callbacks will not see the owner fields set yet
+        """
+        return self["import"].get("bulk_commit", False)
+
     def get_import_callback(self, tablename, callback):
         """
             Lookup callback to use for imports in the following order:
@@ -677,6 +749,23 @@ class S3Config(Storage):
         """
         return self.gis.get("max_features", 1000)
 
+    def get_gis_geojson_direct(self):
+        """
+            Encode Feature Layers directly as GeoJSON rather than via
+            S3XML and the geojson/export.xsl stylesheet (faster, and
+            streams the output). Requests with fields, references or
+            maxbounds parameters still use the stylesheet. Not suitable
+            for templates which rely on a customised GeoJSON stylesheet.
+        """
+        return self.gis.get("geojson_direct", False)
+
+    def get_gis_latest_presence(self):
+        """
+            Whether to maintain a projection of the latest presence of
+            each trackable (speeds up mapping of tracked resources)
+        """
+        return self.gis.get("latest_presence", False)
+
     def get_gis_legend(self):
         """
             Should we display a Legend on the Map?
@@ -686,6 +775,14 @@ class S3Config(Storage):
         """
         return self.gis.get("legend", True)
 
+    def get_gis_location_tree_workers(self):
+        """
+            Number of processes to use for calculating Centroids & Bounds
+            when rebuilding the whole Location Tree (e.g. after importing
+            Admin Boundaries)
+        """
+        return self.gis.get("location_tree_workers", 1)
+
     def get_gis_menu(self):
         """
             Should we display a menu of GIS configurations?
@@ -991,6 +1088,16 @@ class S3Config(Storage):
         else:
             return attr
 
+    def get_ui_datatables_count_cache(self):
+        """
+            Time (in seconds) to cache the total number of matching records
+            (and the keyset pagination bookmarks) for the Ajax pages of
+            server-side paginated data tables, 0 to disable the cache.
+            Writes to the tables within the same process invalidate the
+            cache immediately, other processes see them after this time.
+        """
+        return self.ui.get("datatables_count_cache", 0)
+
     def get_ui_export_formats(self):
         """
             Which export formats should we display?
@@ -1122,6 +1229,14 @@ class S3Config(Storage):
         """
         return self.ui.get("report_auto_submit", 800)
 
+    def get_ui_report_db_aggregation(self):
+        """
+            Compute pivot table reports with grouped database queries
+            where possible (rather than extracting all records), at the
+            expense of the record-level drill-down for record counts
+        """
+        return self.ui.get("report_db_aggregation", False)
+
     # =========================================================================
     # Messaging
     # -------------------------------------------------------------------------
@@ -1203,6 +1318,19 @@ class S3Config(Storage):
         """
         return self.msg.get("notify_renderer", None)
 
+    def get_msg_notify_engine(self):
+        """
+            How to notify subscribers about updates:
+                "request" = render and send each notification by a request
+                            against the subscribed controller
+                "grouped" = render and send notifications within the
+                            scheduler task, extracting the data only once
+                            for all subscriptions with the same resource,
+                            filters and permissions (NB controller-specific
+                            configurations of the resource do not apply)
+        """
+        return self.msg.get("notify_engine", "request")
+
     # -------------------------------------------------------------------------
     # Outbox settings
     def get_msg_max_send_retries(self):
@@ -1212,6 +1340,24 @@ class S3Config(Storage):
             to retry forever.
         """
         return self.msg.get("max_send_retries", 9)
+
+    def get_msg_outbox_workers(self):
+        """
+            Maximum number of worker threads to send outbox messages
+            concurrently (per gateway)
+        """
+        return self.msg.get("outbox_workers", 1)
+
+    def get_msg_send_rate(self, gateway):
+        """
+            Maximum number of messages per second to send through a
+            gateway ("EMAIL", or the outgoing SMS handler "WEB_API"
+            or "SMTP"), None for unlimited
+        """
+        send_rate = self.msg.get("send_rate", None)
+        if isinstance(send_rate, dict):
+            return send_rate.get(gateway, None)
+        return send_rate
     
     # -------------------------------------------------------------------------
     def get_search_max_results(self):
@@ -1256,6 +1402,16 @@ class S3Config(Storage):
         """ Text for saved filter load-button """
         return self.search.get("filter_manager_load", None)
 
+    def get_search_filter_options_cache(self):
+        """
+            Time (in seconds) to cache the options (and counts) of filter
+            widgets, 0 to disable the cache. Writes to the tables within
+            the same process invalidate the cache immediately, other
+            processes see them (and rolled-back writes disappear) only
+            after this time.
+        """
+        return self.search.get("filter_options_cache", 0)
+
     # =========================================================================
     # Modules
 
@@ -32,14 +32,25 @@
 
 __all__ = ["S3Chart"]
 
+import hashlib
+import os
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 try:
     from cStringIO import StringIO    # Faster, where available
 except:
     from StringIO import StringIO
 
 from gluon import current
-from gluon.storage import Storage
 from gluon.html import IMG
+from gluon.languages import lazyT
+
+from s3.s3utils import s3_unicode
 
 # =============================================================================
 class S3Chart(object):
@@ -47,16 +58,33 @@ class S3Chart(object):
         Module for graphing
 
         Currently a simple wrapper to matplotlib
+
+        Charts drawn with the survey_* methods are recorded as a
+        specification, and only rendered (in a separate process, if
+        configured) if there is no cached image for the same
+        specification yet.
+        The cache is content-addressed (file names are hashes of the
+        specification) and size-bounded (least recently used images
+        are removed first).
     """
 
     # This folder needs to be writable by the web2py process
     CACHE_PATH = "/%s/static/cache/chart"  %  current.request.application
 
+    # Pool of rendering processes, shared by all requests of this process
+    POOL = None
+    POOL_LOCK = threading.Lock()
+
+    # Maximum time (in seconds) to wait for a rendering process
+    RENDER_TIMEOUT = 60
+
     # -------------------------------------------------------------------------
-    def __init__(self, path, width=9, height=6):
+    def __init__(self, path=None, width=9, height=6):
         """
-            Create the base Figure object
-            
+            Create the chart
+
+            @param path: name of the chart (not used for caching anymore,
+                         for backwards-compatibility only)
             @param: height x100px
             @param: width x100px
         """
@@ -67,34 +95,128 @@ class S3Chart(object):
             #matplotlib.use("Agg")
             #import matplotlib.pyplot as plt
             #from pylab import savefig
-            from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-            self.FigureCanvas = FigureCanvas
-            from matplotlib.figure import Figure
-            self.Figure = Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
             MATPLOTLIB = True
         except ImportError:
             import sys
             print >> sys.stderr, "WARNING: S3Chart unresolved dependency: matplotlib required for charting"
             MATPLOTLIB = False
 
+        self.matplotlib = MATPLOTLIB
         self.filename = path
         self.width = width
         self.height = height
         self.asInt = False
-        if MATPLOTLIB:
-            self.fig = Figure(figsize=(width, height))
-        else:
-            self.fig = None
+
+        # Recorded drawing operations: [(name, args)]
+        self.ops = []
+        self._fig = None
+
+    # -------------------------------------------------------------------------
+    @property
+    def fig(self):
+        """
+            The Figure object for drawing directly with matplotlib
+            (such charts are rendered inside the request)
+        """
+
+        if self._fig is None and self.matplotlib:
+            from matplotlib.figure import Figure
+            self._fig = Figure(figsize=(self.width, self.height))
+        return self._fig
+
+    # -------------------------------------------------------------------------
+    def spec(self):
+        """
+            The specification of this chart, as passed to the renderer
+        """
+
+        return {"width": self.width,
+                "height": self.height,
+                "asInt": self.asInt,
+                "ops": self.ops,
+                }
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def key(spec):
+        """
+            The cache key for a chart specification
+
+            @param spec: the chart specification
+        """
+
+        return hashlib.md5(pickle.dumps(spec, 2)).hexdigest()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def pool(cls):
+        """
+            Get the pool of rendering processes, created on first use
+
+            @return: the multiprocessing.Pool, or None to render inside
+                     the request
+        """
+
+        workers = current.deployment_settings.get_base_chart_workers()
+        if not workers:
+            return None
+        with cls.POOL_LOCK:
+            if cls.POOL is None:
+                try:
+                    import multiprocessing
+                    # Fork the workers only once (not to re-fork them
+                    # from the threaded server later)
+                    cls.POOL = multiprocessing.Pool(workers)
+                except Exception:
+                    import sys
+                    print >> sys.stderr, "WARNING: S3Chart: could not start rendering processes"
+                    cls.POOL = False
+        return cls.POOL or None
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def render(cls, spec):
+        """
+            Render a chart specification as PNG
+
+            @param spec: the chart specification
+        """
+
+        pool = cls.pool()
+        if pool is None:
+            return s3_chart_render(spec)
+
+        # Raises multiprocessing.TimeoutError rather than rendering here
+        # if the rendering process takes too long
+        result = pool.apply_async(s3_chart_render, (spec,))
+        return result.get(cls.RENDER_TIMEOUT)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def cache_folder():
+        """ The file system path of the chart cache """
+
+        request = current.request
+        return os.path.join(request.folder, "static", "cache", "chart")
 
     # -------------------------------------------------------------------------
     @staticmethod
     def getCachedPath(filename):
-        import os
-        path = "applications"
-        chartFile = "%s/%s.png" % (S3Chart.CACHE_PATH, filename)
-        fullPath = "%s%s" % (path, chartFile)
+        """
+            Return the URL of a cached chart, or None if not cached
+
+            @param filename: the file name (without extension)
+        """
+
+        fullPath = os.path.join(S3Chart.cache_folder(), "%s.png" % filename)
         if os.path.exists(fullPath):
-            return chartFile
+            try:
+                # Mark as recently used
+                os.utime(fullPath, None)
+            except OSError:
+                pass
+            return "%s/%s.png" % (S3Chart.CACHE_PATH, filename)
         else:
             return None
 
@@ -105,13 +227,15 @@ class S3Chart(object):
             Return the opened cached file, if the file can't be found then
             return None
         """
-        chartFile = S3Chart.getCachedPath(filename)
-        if chartFile:
+
+        if S3Chart.getCachedPath(filename):
+            fullPath = os.path.join(S3Chart.cache_folder(),
+                                    "%s.png" % filename)
             try:
-                f = open(chartFile)
-                return f.read()
-            except:
-                # for some reason been unable to get the cached version
+                with open(fullPath, "rb") as f:
+                    return f.read()
+            except IOError:
+                # Removed meanwhile
                 pass
         return None
 
@@ -122,15 +246,60 @@ class S3Chart(object):
             Save the file in the cache area, and return the path to this file
         """
 
-        path = "applications"
-        chartFile = "%s/%s.png" % (S3Chart.CACHE_PATH, filename)
-        fullPath = "%s%s" % (path, chartFile)
+        folder = S3Chart.cache_folder()
+        fullPath = os.path.join(folder, "%s.png" % filename)
+        tmpPath = "%s.%s.tmp" % (fullPath, os.getpid())
         try:
-            f = open(fullPath, "w+")
-            print >> f, image
-        except:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            with open(tmpPath, "wb") as f:
+                f.write(image)
+            # Atomic, so other processes never see partial files
+            os.rename(tmpPath, fullPath)
+        except (IOError, OSError):
             return None
-        return chartFile
+        S3Chart.limitCache(keep=fullPath)
+        return "%s/%s.png" % (S3Chart.CACHE_PATH, filename)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def limitCache(keep=None):
+        """
+            Remove the least recently used files from the cache until
+            it is within the configured size limit
+
+            @param keep: path of a file that must not be removed
+        """
+
+        limit = current.deployment_settings.get_base_chart_cache_size()
+        limit = limit * 1024 * 1024
+
+        folder = S3Chart.cache_folder()
+        files = []
+        total = 0
+        for filename in os.listdir(folder):
+            path = os.path.join(folder, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        if total <= limit:
+            return
+
+        files.sort()
+        for mtime, size, path in files:
+            if total <= limit:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # Removed by another process
+                pass
+            total -= size
 
     # -------------------------------------------------------------------------
     @staticmethod
@@ -140,42 +309,55 @@ class S3Chart(object):
             if the prefix is None then all files will be deleted
         """
 
-        import os
-        folder = "applications%s/" % S3Chart.CACHE_PATH
+        folder = S3Chart.cache_folder()
         if os.path.exists(folder):
             filelist = os.listdir(folder)
             for file in filelist:
                 if prefix == None or file.startswith(prefix):
-                    os.remove("%s%s" % (folder, file))
+                    try:
+                        os.remove(os.path.join(folder, file))
+                    except OSError:
+                        pass
 
     # -------------------------------------------------------------------------
     def draw(self, output="xml"):
         """
             Output the chart as a PNG embedded in an IMG tag
                 - used by the Delphi module
+
+            @param output: "xml" for an IMG tag, otherwise the PNG itself
         """
 
-        fig = self.fig
-        if not fig:
+        if not self.matplotlib:
             return "Matplotlib not installed"
 
-        # For interactive shell tests
-        #plt.show()
-        # For web response
-        #savefig(response.body)
-        chart = Storage()
-        chart.body = StringIO()
-        chart.headers = Storage()
-        chart.headers["Content-Type"] = "image/png"
-
-        canvas = self.FigureCanvas(fig)
-        canvas.print_figure(chart.body)
-        #return response.body.getvalue()
-        image = chart.body.getvalue()
-        # IE 8 and before has a 32K limit on URIs this can be quickly 
+        if self._fig is not None:
+            # Drawn directly => render here, address by image content
+            image = s3_chart_print(self._fig)
+            key = hashlib.md5(image).hexdigest()
+            cachePath = self.getCachedPath(key)
+        else:
+            spec = self.spec()
+            key = self.key(spec)
+            cachePath = self.getCachedPath(key)
+            if cachePath is not None and output == "xml":
+                # Served directly from the cache
+                return IMG(_src=cachePath)
+            image = self.getCachedFile(key) if cachePath else None
+            if image is None:
+                from multiprocessing import TimeoutError
+                try:
+                    image = self.render(spec)
+                except TimeoutError:
+                    return "Chart rendering timed out"
+                cachePath = None
+
+        # IE 8 and before has a 32K limit on URIs this can be quickly
         # gobbled up if the image is too large. So the image will
         # stored on the server and a URI used in the src
-        cachePath = self.storeCachedFile(self.filename, image)
+        if cachePath is None:
+            cachePath = self.storeCachedFile(key, image)
+
         if output == "xml":
             if cachePath != None:
                 image = IMG(_src = cachePath)
@@ -195,25 +377,11 @@ class S3Chart(object):
                 - used by the Survey module
         """
 
-        fig = self.fig
-        if not fig:
+        if not self.matplotlib:
             return "Matplotlib not installed"
-
-        from numpy import arange
-
-        # Draw a histogram
-        ax = fig.add_subplot(111)
-        ax.hist(data, bins=bins, range=(min, max))
-        left = arange(0, bins + 1)
-        if self.asInt:
-            label = left * int(max / bins)
-        else:
-            label = left * max / bins
-        ax.set_xticks(label)
-        ax.set_xticklabels(label, rotation=30)
-        ax.set_title(title)
-        ax.set_xlabel(xlabel)
-        ax.set_ylabel(ylabel)
+        self.ops.append(("survey_hist",
+                         s3_chart_args(title, list(data), bins, min, max,
+                                       xlabel, ylabel)))
 
     # -------------------------------------------------------------------------
     def survey_pie(self, title, data, label):
@@ -222,15 +390,10 @@ class S3Chart(object):
                 - used by the Survey module
         """
 
-        fig = self.fig
-        if not fig:
+        if not self.matplotlib:
             return "Matplotlib not installed"
-
-        # Draw a pie chart
-        ax = fig.add_subplot(111)
-        ax.pie(data, labels=label)
-        ax.legend()
-        ax.set_title(title)
+        self.ops.append(("survey_pie",
+                         s3_chart_args(title, list(data), list(label))))
 
     # -------------------------------------------------------------------------
     def survey_bar(self, title, data, labels, legendLabels):
@@ -239,85 +402,185 @@ class S3Chart(object):
                 - used by the Survey module
         """
 
-        barColourList = ["#F2D7A0", "#7B77A8", "#69889A", "#9D7B34"]
-        barColourListExt = [(242, 215, 160),
-                            (123, 118, 168),
-                            (105, 136, 154),
-                            (157, 123, 52)
-                           ]
-        fig = self.fig
-        if not fig:
+        if not self.matplotlib:
             return "Matplotlib not installed"
+        self.ops.append(("survey_bar",
+                         s3_chart_args(title, data, labels, legendLabels)))
 
-        from numpy import arange
+# =============================================================================
+def s3_chart_render(spec):
+    """
+        Render a chart specification as PNG, runs in the rendering
+        processes (must therefore be a module-level function)
 
-        # Draw a bar chart
-        if not isinstance(data[0],list):
-            dataList = [data]
-        else:
-            dataList = data
-        legendColCnt = 3
-        cnt = len(labels)
-        dcnt = len(dataList)
-        lcnt = 0
-        if legendLabels != None:
-            lcnt = (len(legendLabels) + legendColCnt - 1) / legendColCnt
-        width = 0.9 / dcnt
-        offset = 0
-        gap = 0.1 / dcnt
-        bcnt = 0
-        bars = []
-        height = max(0.2, 0.85 - (0.04 * lcnt))
-        rect = [0.08, 0.08, 0.9, height]
-        ax = fig.add_axes(rect)
-        for data in dataList:
-            left = arange(offset, cnt + offset)    # the x locations for the bars
-            if bcnt < 3:
-                colour = barColourList[bcnt]
-            else:
-                colour = []
-                colourpart = barColourListExt[bcnt%4]
-                divisor = 256.0 - (32 * bcnt/4)
-                if divisor < 0.0:
-                    divisor = divisor * -1
-                for part in colourpart:
-                    calc = part/divisor
-                    while calc > 1.0:
-                        calc -= 1
-                    colour.append(calc)
-            plot = ax.bar(left, data, width=width, color=colour)
-            bars.append(plot[0])
-            bcnt += 1
-            offset += width + gap
-        left = arange(cnt)
-        lblAdjust = (1.0 - gap) * 0.5
-        if cnt <= 3:
-            angle = 0
-        elif cnt <= 10:
-            angle = -10
-        elif cnt <= 20:
-            angle = -30
+        @param spec: the chart specification, see S3Chart.spec()
+    """
+
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(spec["width"], spec["height"]))
+    for name, args in spec["ops"]:
+        DRAW[name](fig, spec, *args)
+    return s3_chart_print(fig)
+
+# -----------------------------------------------------------------------------
+def s3_chart_print(fig):
+    """
+        Print a Figure as PNG
+
+        @param fig: the Figure
+    """
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
+    body = StringIO()
+    canvas = FigureCanvas(fig)
+    canvas.print_figure(body)
+    return body.getvalue()
+
+# -----------------------------------------------------------------------------
+def s3_chart_args(*args):
+    """
+        Convert drawing arguments into plain (picklable) types
+
+        @param args: the arguments
+    """
+
+    result = []
+    for arg in args:
+        if isinstance(arg, lazyT):
+            arg = s3_unicode(arg)
+        elif isinstance(arg, (list, tuple)):
+            arg = list(s3_chart_args(*arg))
+        result.append(arg)
+    return tuple(result)
+
+# =============================================================================
+def _survey_hist(fig, spec, title,
+                 data, bins, min, max, xlabel=None, ylabel=None):
+    """
+        Draw a Histogram
+            - used by the Survey module
+    """
+
+    from numpy import arange
+
+    # Draw a histogram
+    ax = fig.add_subplot(111)
+    ax.hist(data, bins=bins, range=(min, max))
+    left = arange(0, bins + 1)
+    if spec["asInt"]:
+        label = left * int(max / bins)
+    else:
+        label = left * max / bins
+    ax.set_xticks(label)
+    ax.set_xticklabels(label, rotation=30)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+
+# -----------------------------------------------------------------------------
+def _survey_pie(fig, spec, title, data, label):
+    """
+        Draw a Pie Chart
+            - used by the Survey module
+    """
+
+    # Draw a pie chart
+    ax = fig.add_subplot(111)
+    ax.pie(data, labels=label)
+    ax.legend()
+    ax.set_title(title)
+
+# -----------------------------------------------------------------------------
+def _survey_bar(fig, spec, title, data, labels, legendLabels):
+    """
+        Draw a Bar Chart
+            - used by the Survey module
+    """
+
+    barColourList = ["#F2D7A0", "#7B77A8", "#69889A", "#9D7B34"]
+    barColourListExt = [(242, 215, 160),
+                        (123, 118, 168),
+                        (105, 136, 154),
+                        (157, 123, 52)
+                       ]
+    from numpy import arange
+
+    # Draw a bar chart
+    if not isinstance(data[0],list):
+        dataList = [data]
+    else:
+        dataList = data
+    legendColCnt = 3
+    cnt = len(labels)
+    dcnt = len(dataList)
+    lcnt = 0
+    if legendLabels != None:
+        lcnt = (len(legendLabels) + legendColCnt - 1) / legendColCnt
+    width = 0.9 / dcnt
+    offset = 0
+    gap = 0.1 / dcnt
+    bcnt = 0
+    bars = []
+    height = max(0.2, 0.85 - (0.04 * lcnt))
+    rect = [0.08, 0.08, 0.9, height]
+    ax = fig.add_axes(rect)
+    for data in dataList:
+        left = arange(offset, cnt + offset)    # the x locations for the bars
+        if bcnt < 3:
+            colour = barColourList[bcnt]
         else:
-            angle = -45
-        ax.set_xticks(left + lblAdjust)
-        try: # This function is only available with version 1.1 of matplotlib
-            ax.set_xticklabels(labels, rotation=angle)
-            ax.tick_params(labelsize=self.width)
-        except AttributeError:
-            newlabels = []
-            for label in labels:
-                if len(label) > 12:
-                    label = label[0:10] + "..."
-                newlabels.append(label)
-            ax.set_xticklabels(newlabels)
-        ax.set_title(title)
-        if legendLabels != None:
-            fig.legend(bars,
-                       legendLabels,
-                       "upper left",
-                       mode="expand",
-                       ncol = legendColCnt,
-                       prop={"size":10},
-                      )
+            colour = []
+            colourpart = barColourListExt[bcnt%4]
+            divisor = 256.0 - (32 * bcnt/4)
+            if divisor < 0.0:
+                divisor = divisor * -1
+            for part in colourpart:
+                calc = part/divisor
+                while calc > 1.0:
+                    calc -= 1
+                colour.append(calc)
+        plot = ax.bar(left, data, width=width, color=colour)
+        bars.append(plot[0])
+        bcnt += 1
+        offset += width + gap
+    left = arange(cnt)
+    lblAdjust = (1.0 - gap) * 0.5
+    if cnt <= 3:
+        angle = 0
+    elif cnt <= 10:
+        angle = -10
+    elif cnt <= 20:
+        angle = -30
+    else:
+        angle = -45
+    ax.set_xticks(left + lblAdjust)
+    try: # This function is only available with version 1.1 of matplotlib
+        ax.set_xticklabels(labels, rotation=angle)
+        ax.tick_params(labelsize=spec["width"])
+    except AttributeError:
+        newlabels = []
+        for label in labels:
+            if len(label) > 12:
+                label = label[0:10] + "..."
+            newlabels.append(label)
+        ax.set_xticklabels(newlabels)
+    ax.set_title(title)
+    if legendLabels != None:
+        fig.legend(bars,
+                   legendLabels,
+                   "upper left",
+                   mode="expand",
+                   ncol = legendColCnt,
+                   prop={"size":10},
+                  )
+
+# -----------------------------------------------------------------------------
+# Drawing functions for the recorded operations
+DRAW = {"survey_hist": _survey_hist,
+        "survey_pie": _survey_pie,
+        "survey_bar": _survey_bar,
+        }
 
 # END =========================================================================
@@ -709,18 +709,22 @@ class S3LocationModel(S3Model):
             # Try the Name
             # @ToDo: Hook for possible duplicates vs definite?
             #query = (table.name.lower().like('%%%s%%' % name.lower()))
-            query = (table.name.lower() == name.lower()) & \
-                    (table.level == level)
-            if parent:
-                query &= (table.parent == parent)
-            if end_date:
-                query &= (table.end_date == end_date)
-            if start_date:
-                query &= (table.start_date == start_date)
-
-            _duplicate = current.db(query).select(table.id,
-                                                  orderby=~table.end_date,
-                                                  limitby=(0, 1)).first()
+            # - looked up for all items of the job at once
+            candidates = job.job.find_duplicates(table, "name", name,
+                                                 fields=[table.id,
+                                                         table.level,
+                                                         table.parent,
+                                                         table.start_date,
+                                                         table.end_date],
+                                                 orderby=~table.end_date)
+            _duplicate = None
+            for row in candidates:
+                if row.level == level and \
+                   (not parent or row.parent == parent) and \
+                   (not end_date or row.end_date == end_date) and \
+                   (not start_date or row.start_date == start_date):
+                    _duplicate = row
+                    break
             if _duplicate:
                 # @ToDo: Import Log
                 #s3_debug("Location Match")
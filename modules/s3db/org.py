@@ -696,11 +696,12 @@ class S3OrganisationModel(S3Model):
             table = item.table
             name = "name" in item.data and item.data.name
             if name:
-                query = (table.name.lower() == name.lower())
-                duplicate = current.db(query).select(table.id,
-                                                     table.name,
-                                                     limitby=(0, 1)).first()
-                if duplicate:
+                # Looked up for all items of the job at once
+                duplicates = item.job.find_duplicates(table, "name", name,
+                                                      fields=[table.id,
+                                                              table.name])
+                if duplicates:
+                    duplicate = duplicates[0]
                     item.id = duplicate.id
                     # Retain the correct spelling of the name
                     item.data.name = duplicate.name
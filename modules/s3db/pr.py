@@ -78,6 +78,8 @@ __all__ = ["S3PersonEntity",
            # Internal Path Tools
            "pr_rebuild_path",
            "pr_role_rebuild_path",
+           "pr_rebuild_closure",
+           "pr_update_closure",
            # Helpers for ImageLibrary
            "pr_image_modify",
            "pr_image_resize",
@@ -114,6 +116,7 @@ class S3PersonEntity(S3Model):
 
     names = ["pr_pentity",
              "pr_affiliation",
+             "pr_ou_closure",
              "pr_person_user",
              "pr_role",
              "pr_role_types",
@@ -315,7 +318,8 @@ class S3PersonEntity(S3Model):
 
         # Resource configuration
         configure(tablename,
-                  onvalidation=self.pr_role_onvalidation)
+                  onvalidation=self.pr_role_onvalidation,
+                  onaccept=self.pr_role_onaccept)
 
         # Reusable fields
         role_id = S3ReusableField("role_id", table,
@@ -365,6 +369,19 @@ class S3PersonEntity(S3Model):
                   onaccept=self.pr_affiliation_onaccept,
                   ondelete=self.pr_affiliation_ondelete)
 
+        # ---------------------------------------------------------------------
+        # OU Closure
+        # - all ancestor/descendant pairs in the OU hierarchy, maintained
+        #   by pr_update_closure (for faster descendant lookups)
+        #
+        tablename = "pr_ou_closure"
+        table = define_table(tablename,
+                             Field("ancestor", "integer"),
+                             Field("descendant", "integer"),
+                             # Instance type of the descendant
+                             Field("instance_type"),
+                             )
+
         # ---------------------------------------------------------------------
         # Pass names back to global scope (s3.*)
         #
@@ -568,6 +585,20 @@ class S3PersonEntity(S3Model):
                 current.s3db.pr_role_rebuild_path(role_id, clear=True)
         return
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def pr_role_onaccept(form):
+        """
+            Update the OU closure if the role type has changed
+
+            @param form: the CRUD form
+        """
+
+        role_id = form.vars.id
+        if role_id:
+            pr_role_update_closure(role_id)
+        return
+
     # -------------------------------------------------------------------------
     @staticmethod
     def pr_pentity_onaccept(form):
@@ -868,6 +899,8 @@ class S3PersonModel(S3Model):
                        crud_form = crud_form,
                        deduplicate = self.person_deduplicate,
                        extra = "last_name",
+                       # Indexed in static/scripts/tools/indexes.py
+                       indexed_fields = ["first_name"],
                        list_fields = ["id",
                                       "first_name",
                                       "middle_name",
@@ -1120,22 +1153,28 @@ class S3PersonModel(S3Model):
                      data.contact_method == "SMS":
                     sms = data.value
 
+        # Candidates are looked up for all items of the job at once
+        fields = [ptable._id,
+                  ptable.first_name,
+                  ptable.last_name,
+                  ptable.initials,
+                  ptable.date_of_birth,
+                  etable.value,
+                  stable.value,
+                  ]
+        find_duplicates = lambda fn, value: \
+                          item.job.find_duplicates(ptable, fn, value,
+                                                   fields=fields,
+                                                   left=left,
+                                                   orderby=ptable.created_on)
         if fname and lname:
-            query = (ptable.first_name.lower() == fname.lower()) & \
-                    (ptable.last_name.lower() == lname.lower())
+            first_name = s3_unicode(fname).lower()
+            candidates = [row for row in find_duplicates("last_name", lname)
+                          if s3_unicode(row[ptable.first_name] or "").lower() == first_name]
         elif initials:
-            query = (ptable.initials.lower() == initials.lower())
+            candidates = find_duplicates("initials", initials)
         else:
             return
-        candidates = db(query).select(ptable._id,
-                                      ptable.first_name,
-                                      ptable.last_name,
-                                      ptable.initials,
-                                      ptable.date_of_birth,
-                                      etable.value,
-                                      stable.value,
-                                      left=left,
-                                      orderby=["pr_person.created_on ASC"])
 
         duplicates = Storage()
 
@@ -5029,13 +5068,17 @@ def pr_define_role(pe_id,
     else:
         duplicate = None
     if duplicate:
-        if duplicate.role_type != role_type:
+        type_changed = duplicate.role_type != role_type
+        if type_changed:
             # Clear paths if this changes the role type
             if str(role_type) != str(OU):
                 data["path"] = None
             s3db.pr_role_rebuild_path(duplicate.id, clear=True)
         duplicate.update_record(**data)
         record_id = duplicate.id
+        if type_changed:
+            # Update the OU closure
+            pr_role_update_closure(record_id)
     else:
         record_id = rtable.insert(**data)
     return record_id
@@ -5410,94 +5453,46 @@ def pr_ancestors(entities):
     return ancestors
 
 # =============================================================================
-def pr_descendants(pe_ids, skip=None, root=True):
+def pr_descendants(pe_ids):
     """
         Find descendant entities of a person entity in the OU hierarchy
-        (performs a real search, not a path lookup), grouped by root PE
+        (performs a closure table lookup), grouped by root PE
 
         @param pe_ids: set/list of pe_ids
-        @param skip: list of person entity IDs to skip during
-                     descending (internal)
-        @param root: this is the top-node (internal)
 
         @return: a dict of lists of descendant PEs per root PE
     """
 
-    if skip is None:
-        skip = set()
-
-    # We still need to support Py 2.6
-    #pe_ids = {i for i in pe_ids if i not in skip}
-    pe_ids = set(i for i in pe_ids if i not in skip)
+    pe_ids = set(pe_ids)
     if not pe_ids:
         return {}
 
-    s3db = current.s3db
-    etable = s3db.pr_pentity
-    rtable = s3db.pr_role
-    atable = s3db.pr_affiliation
-
-    q = (rtable.pe_id.belongs(pe_ids)) \
-        if len(pe_ids) > 1 else (rtable.pe_id == list(pe_ids)[0])
-
-    query = (q & (rtable.role_type == OU) & (rtable.deleted != True)) & \
-            ((atable.role_id == rtable.id) & (atable.deleted != True)) & \
-            (etable.pe_id == atable.pe_id)
-
-    rows = current.db(query).select(rtable.pe_id,
-                                    atable.pe_id,
-                                    etable.instance_type)
-    r = rtable._tablename
-    e = etable._tablename
-    a = atable._tablename
+    ctable = current.s3db.pr_ou_closure
+    if len(pe_ids) > 1:
+        q = (ctable.ancestor.belongs(pe_ids))
+    else:
+        q = (ctable.ancestor == list(pe_ids)[0])
+    query = q & (ctable.instance_type != "pr_person")
 
-    nodes = set()
-    ogetattr = object.__getattribute__
+    rows = pr_closure_lookup(query, ctable.ancestor, ctable.descendant)
 
     result = dict()
-    
-    skip.update(pe_ids)
     for row in rows:
-
-        parent = ogetattr(ogetattr(row, r), "pe_id")
-        child = ogetattr(ogetattr(row, a), "pe_id")
-        instance_type = ogetattr(ogetattr(row, e), "instance_type")
-        if instance_type != "pr_person":
-            if parent not in result:
-                result[parent] = []
-            result[parent].append(child)
-        if child not in skip:
-            nodes.add(child)
-
-    if nodes:
-        descendants = pr_descendants(nodes, skip=skip, root=False)
-        for child, nodes in descendants.iteritems():
-            for parent, children in result.iteritems():
-                if child in children:
-                    for node in nodes:
-                        if node not in children:
-                            children.append(node)
-    if root:
-        for child, nodes in result.iteritems():
-            for parent, children in result.iteritems():
-                if child in children:
-                    for node in nodes:
-                        if node not in children and node != parent:
-                            children.append(node)
+        parent = row.ancestor
+        if parent not in result:
+            result[parent] = []
+        result[parent].append(row.descendant)
 
     return result
 
 # =============================================================================
-def pr_get_descendants(pe_ids, entity_types=None, skip=None, ids=True):
+def pr_get_descendants(pe_ids, entity_types=None):
     """
         Find descendant entities of a person entity in the OU hierarchy
-        (performs a real search, not a path lookup).
+        (performs a closure table lookup).
 
         @param pe_ids: person entity ID or list of IDs
         @param entity_types: optional filter to a specific entity_type
-        @param ids: whether to return a list of ids or nodes (internal)
-        @param skip: list of person entity IDs to skip during
-                     descending (internal)
 
         @return: a list of PE-IDs
     """
@@ -5508,61 +5503,23 @@ def pr_get_descendants(pe_ids, entity_types=None, skip=None, ids=True):
         pe_ids = set(pe_ids) \
                  if isinstance(pe_ids, (list, tuple)) else set([pe_ids])
 
-    db = current.db
-    s3db = current.s3db
-    etable = s3db.pr_pentity
-    rtable = db.pr_role
-    atable = db.pr_affiliation
-
-    if skip is None:
-        skip = set()
-    skip.update(pe_ids)
-
+    ctable = current.s3db.pr_ou_closure
     if len(pe_ids) > 1:
-        q = (rtable.pe_id.belongs(pe_ids))
+        query = (ctable.ancestor.belongs(pe_ids))
     else:
-        q = (rtable.pe_id == list(pe_ids)[0])
-
-    query = ((rtable.deleted != True) & q & (rtable.role_type == OU)) & \
-            ((atable.deleted != True) & (atable.role_id == rtable.id))
+        query = (ctable.ancestor == list(pe_ids)[0])
 
     if entity_types is not None:
-        query &= (etable.pe_id == atable.pe_id)
-        rows = db(query).select(etable.pe_id, etable.instance_type)
-        # We still need to support Py 2.6
-        #result = {(r.pe_id, r.instance_type) for r in rows}
-        result = set((r.pe_id, r.instance_type) for r in rows)
-        # We still need to support Py 2.6
-        #node_ids = {i for i, t in result if i not in skip}
-        node_ids = set(i for i, t in result if i not in skip)
-    else:
-        rows = db(query).select(atable.pe_id)
-        # We still need to support Py 2.6
-        #result = {r.pe_id for r in rows}
-        result = set(r.pe_id for r in rows)
-        # We still need to support Py 2.6
-        #node_ids = {i for i in result if i not in skip}
-        node_ids = set(i for i in result if i not in skip)
-    # Recurse
-    if node_ids:
-        descendants = pr_get_descendants(node_ids,
-                                         skip=skip,
-                                         entity_types=entity_types,
-                                         ids=False)
-        result.update(descendants)
-
-    if ids:
-        if entity_types is not None:
-            if type(entity_types) is not set:
-                if not isinstance(entity_types, (tuple, list)):
-                    entity_types = set([entity_types])
-                else:
-                    entity_types = set(entity_types)
-            return [n[0] for n in result if n[1] in entity_types]
+        if isinstance(entity_types, (tuple, list, set)):
+            query &= (ctable.instance_type.belongs(entity_types))
         else:
-            return list(result)
-    else:
-        return result
+            query &= (ctable.instance_type == entity_types)
+
+    rows = pr_closure_lookup(query, ctable.descendant)
+
+    # We still need to support Py 2.6
+    #return list({row.descendant for row in rows})
+    return list(set(row.descendant for row in rows))
 
 # =============================================================================
 # Internal Path Tools
@@ -5592,6 +5549,10 @@ def pr_rebuild_path(pe_id, clear=False):
     for role in roles:
         if role.path is None:
             pr_role_rebuild_path(role, clear=clear)
+
+    # Update the OU closure (only necessary for writes)
+    if clear:
+        pr_update_closure(pe_id)
     return
 
 # =============================================================================
@@ -5659,6 +5620,222 @@ def pr_role_rebuild_path(role_id, skip=[], clear=False):
 
     return path
 
+# =============================================================================
+def pr_closure_lookup(query, *fields):
+    """
+        Look up the OU closure table, (re-)building it if it has not
+        been populated yet (e.g. after an upgrade)
+
+        @param query: the query
+        @param fields: the fields to select
+
+        @return: the Rows
+    """
+
+    db = current.db
+    rows = db(query).select(distinct=True, *fields)
+    if not rows:
+        ctable = current.s3db.pr_ou_closure
+        if db(ctable.id > 0).isempty() and pr_rebuild_closure():
+            rows = db(query).select(distinct=True, *fields)
+    return rows
+
+# =============================================================================
+def pr_ou_ancestors(nodes, edges):
+    """
+        Find all ancestors of a node in an OU adjacency map
+
+        @param nodes: the parent nodes to start from
+        @param edges: the adjacency map {child: set of parents}
+
+        @return: a set of PE-IDs
+    """
+
+    ancestors = set()
+    stack = list(nodes)
+    pop = stack.pop
+    while stack:
+        node = pop()
+        if node in ancestors:
+            continue
+        ancestors.add(node)
+        if node in edges:
+            stack.extend(edges[node])
+    return ancestors
+
+# =============================================================================
+def pr_rebuild_closure():
+    """
+        Rebuild the OU closure table from scratch
+
+        @return: the number of ancestor/descendant pairs
+    """
+
+    db = current.db
+    s3db = current.s3db
+    rtable = s3db.pr_role
+    atable = s3db.pr_affiliation
+    etable = s3db.pr_pentity
+    ctable = s3db.pr_ou_closure
+
+    # Load all OU edges in one query
+    query = (rtable.deleted != True) & \
+            (rtable.role_type == OU) & \
+            (atable.role_id == rtable.id) & \
+            (atable.deleted != True) & \
+            (etable.pe_id == atable.pe_id)
+    rows = db(query).select(rtable.pe_id,
+                            atable.pe_id,
+                            etable.instance_type)
+    r = rtable._tablename
+    a = atable._tablename
+    e = etable._tablename
+
+    edges = {}
+    types = {}
+    for row in rows:
+        child = row[a].pe_id
+        if child not in edges:
+            edges[child] = set()
+        edges[child].add(row[r].pe_id)
+        types[child] = row[e].instance_type
+
+    data = []
+    append = data.append
+    for child, parents in edges.items():
+        instance_type = types[child]
+        for ancestor in pr_ou_ancestors(parents, edges):
+            if ancestor != child:
+                append({"ancestor": ancestor,
+                        "descendant": child,
+                        "instance_type": instance_type})
+
+    db(ctable.id > 0).delete()
+    if data:
+        ctable.bulk_insert(data)
+    return len(data)
+
+# =============================================================================
+def pr_update_closure(pe_ids):
+    """
+        Update the OU closure table after the ancestors of person
+        entities have changed (e.g. new or removed affiliations)
+
+        @param pe_ids: the person entity ID or list of IDs
+    """
+
+    if not pe_ids:
+        return
+    if not isinstance(pe_ids, (list, tuple, set)):
+        pe_ids = [pe_ids]
+
+    db = current.db
+    s3db = current.s3db
+    rtable = s3db.pr_role
+    atable = s3db.pr_affiliation
+    etable = s3db.pr_pentity
+    ctable = s3db.pr_ou_closure
+
+    if db(ctable.id > 0).isempty():
+        # Closure not populated yet => build it from scratch
+        pr_rebuild_closure()
+        return
+
+    # The ancestors of these entities and all their descendants are affected
+    nodes = set(pe_ids)
+    rows = db(ctable.ancestor.belongs(nodes)).select(ctable.descendant,
+                                                      distinct=True)
+    nodes.update(row.descendant for row in rows)
+
+    # Collect the upward OU edges, one query per hierarchy level
+    query = (rtable.deleted != True) & \
+            (rtable.role_type == OU) & \
+            (atable.role_id == rtable.id) & \
+            (atable.deleted != True)
+    r = rtable._tablename
+    a = atable._tablename
+    edges = {}
+    seen = set()
+    frontier = set(nodes)
+    while frontier:
+        seen |= frontier
+        rows = db(query & (atable.pe_id.belongs(frontier))).select(
+                                                        rtable.pe_id,
+                                                        atable.pe_id)
+        frontier = set()
+        for row in rows:
+            child = row[a].pe_id
+            parent = row[r].pe_id
+            if child not in edges:
+                edges[child] = set()
+            edges[child].add(parent)
+            if parent not in seen:
+                frontier.add(parent)
+
+    # Instance types of the affected entities
+    rows = db(etable.pe_id.belongs(nodes)).select(etable.pe_id,
+                                                   etable.instance_type)
+    types = dict((row.pe_id, row.instance_type) for row in rows)
+
+    data = []
+    append = data.append
+    for node in nodes:
+        if node not in edges:
+            continue
+        instance_type = types.get(node)
+        for ancestor in pr_ou_ancestors(edges[node], edges):
+            if ancestor != node:
+                append({"ancestor": ancestor,
+                        "descendant": node,
+                        "instance_type": instance_type})
+
+    db(ctable.descendant.belongs(nodes)).delete()
+    if data:
+        ctable.bulk_insert(data)
+    return
+
+# =============================================================================
+def pr_role_update_closure(role_id):
+    """
+        Update the OU closure table for the affiliates of a role if
+        its role type has changed
+
+        @param role_id: the role ID
+    """
+
+    db = current.db
+    s3db = current.s3db
+    rtable = s3db.pr_role
+    atable = s3db.pr_affiliation
+    ctable = s3db.pr_ou_closure
+
+    role = db(rtable.id == role_id).select(rtable.pe_id,
+                                           rtable.role_type,
+                                           rtable.deleted,
+                                           limitby=(0, 1)).first()
+    if not role:
+        return
+    query = (atable.role_id == role_id) & \
+            (atable.deleted != True)
+    rows = db(query).select(atable.pe_id)
+    affiliates = set(row.pe_id for row in rows)
+    if not affiliates:
+        return
+
+    # Which affiliates are currently descendants of the role entity?
+    query = (ctable.ancestor == role.pe_id) & \
+            (ctable.descendant.belongs(affiliates))
+    rows = db(query).select(ctable.descendant)
+    descendants = set(row.descendant for row in rows)
+
+    if role.role_type == OU and not role.deleted:
+        update = affiliates - descendants
+    else:
+        update = descendants
+    if update:
+        pr_update_closure(update)
+    return
+
 # =============================================================================
 def pr_image_represent(image_name,
                        format = None,
@@ -36,7 +36,9 @@ from ..s3 import *
 class S3HierarchyModel(S3Model):
     """ Model for stored object hierarchies, experimental """
 
-    names = ["s3_hierarchy"]
+    names = ["s3_hierarchy",
+             "s3_hierarchy_node",
+             ]
 
     def model(self):
 
@@ -51,8 +53,32 @@ class S3HierarchyModel(S3Model):
                                    length=64),
                              Field("dirty", "boolean",
                                    default=False),
+                             # Legacy, the nodes are now stored in
+                             # s3_hierarchy_node
                              Field("hierarchy", "json"),
+                             # Incremented with every change of the nodes
+                             Field("version", "integer",
+                                   default=0),
                              *s3_timestamp())
+
+        # -------------------------------------------------------------------------
+        # Stored Hierarchy Nodes
+        # - version is the hierarchy version of the last change of the node,
+        #   so that cached hierarchies can be updated with just the changes
+        #
+        tablename = "s3_hierarchy_node"
+        table = define_table(tablename,
+                             Field("tablename",
+                                   length=64),
+                             Field("node_id", "integer"),
+                             Field("parent_id", "integer"),
+                             Field("category", "json"),
+                             Field("version", "integer",
+                                   default=0),
+                             Field("removed", "boolean",
+                                   default=False),
+                             )
+
         # ---------------------------------------------------------------------
         # Return global names to s3.*
         #
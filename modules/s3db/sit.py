@@ -29,8 +29,17 @@
 
 __all__ = ["S3SituationModel"]
 
+try:
+    import json # try stdlib (Python 2.6)
+except ImportError:
+    try:
+        import simplejson as json # try external module
+    except:
+        import gluon.contrib.simplejson as json # fallback to pure-Python module
+
 from gluon import *
 from gluon.storage import Storage
+from gluon.dal import Row
 from ..s3 import *
 
 # =============================================================================
@@ -41,6 +50,7 @@ class S3SituationModel(S3Model):
     names = ["sit_situation",
              "sit_trackable",
              "sit_presence",
+             "sit_presence_latest",
              ]
 
     def model(self):
@@ -109,13 +119,64 @@ class S3SituationModel(S3Model):
                                         writable=False),
                                   *s3_meta_fields())
 
+        configure(tablename,
+                  onaccept=self.sit_presence_onaccept,
+                  ondelete=self.sit_presence_onaccept)
+
         # Shared component of all trackable types
         self.add_component(table,
                            sit_trackable=self.super_key(sit_trackable))
 
+        # ---------------------------------------------------------------------
+        # Latest Presence of trackables
+        #
+        # Projection of the presence log, maintained by S3Trackable if
+        # settings.gis.latest_presence is enabled
+        #
+        tablename = "sit_presence_latest"
+        table = self.define_table(tablename,
+                                  self.super_link("track_id", sit_trackable),
+                                  Field("timestmp", "datetime"),
+                                  location_id(),
+                                  Field("interlock"))
+
         # ---------------------------------------------------------------------
         # Pass names back to global scope (s3.*)
         #
         return Storage()
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def sit_presence_onaccept(form):
+        """
+            Update the latest presence of the trackable after
+            presence records have been edited or deleted
+
+            @param form: the FORM (onaccept), or the deleted Row (ondelete)
+        """
+
+        if isinstance(form, Row):
+            # ondelete: the Row only contains id and uuid
+            record_id = form.id
+            track_id = None
+        else:
+            record_id = form.vars.id
+            track_id = form.vars.track_id
+        if not track_id and record_id:
+            table = current.s3db.sit_presence
+            row = current.db(table.id == record_id).select(table.track_id,
+                                                           table.deleted_fk,
+                                                           limitby=(0, 1)
+                                                           ).first()
+            if row:
+                track_id = row.track_id
+                if not track_id and row.deleted_fk:
+                    # Deleted record: track_id has been parked
+                    try:
+                        track_id = json.loads(row.deleted_fk).get("track_id")
+                    except ValueError:
+                        pass
+        if track_id:
+            S3Trackable.update_latest_presence([track_id])
+
 # END =========================================================================
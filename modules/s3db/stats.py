@@ -38,6 +38,17 @@ __all__ = ["S3StatsModel",
 
 from datetime import date
 
+try:
+    # try stdlib (Python 2.6)
+    import json
+except ImportError:
+    try:
+        # try external module
+        import simplejson as json
+    except:
+        # fallback to pure-Python module
+        import gluon.contrib.simplejson as json
+
 from gluon import *
 from gluon.storage import Storage
 
@@ -487,8 +498,8 @@ class S3StatsDemographicModel(S3Model):
     def stats_demographic_rebuild_all_aggregates():
         """
             This will delete all the stats_demographic_aggregate records and
-            then rebuild them by triggering off a request for each
-            stats_demographic_data record.
+            then rebuild them from all approved stats_demographic_data
+            records in a background task.
 
             This function is normally only run during prepop or postpop so we
             don't need to worry about the aggregate data being unavailable for
@@ -517,23 +528,9 @@ class S3StatsDemographicModel(S3Model):
         # Delete the existing aggregates
         current.s3db.stats_demographic_aggregate.truncate()
 
-        # Read all the approved vulnerability_data records
-        dtable = db.stats_demographic
-        ddtable = db.stats_demographic_data
-        query = (ddtable.deleted != True) & \
-                (ddtable.approved_by != None) & \
-                (ddtable.parameter_id == dtable.parameter_id)
-        records = db(query).select(ddtable.data_id,
-                                   ddtable.parameter_id,
-                                   ddtable.date,
-                                   ddtable.location_id,
-                                   ddtable.value,
-                                   dtable.total_id,
-                                   )
-
         # Fire off a rebuild task
+        # - without records, the task reads the data set from the database
         current.s3task.async("stats_demographic_update_aggregates",
-                             vars=dict(records=records.json()),
                              timeout=21600 # 6 hours
                              )
 
@@ -573,497 +570,459 @@ class S3StatsDemographicModel(S3Model):
 
             Once this has run then a complete set of  aggregate records should
             exists for this parameter_id and location for every time period from
-            the first data item until the current time period.
-
-            Where appropriate add test cases to modules/unit_tests/s3db/stats.py
+            the first data item until the current time period, and the
+            location aggregates of all their ancestors have been rebuilt.
+
+            @param records: the stats_demographic_data records which have
+                            been changed, either as list (or JSON) of data_ids,
+                            or as Rows (or JSON of Rows) containing the
+                            data_id; None to rebuild the aggregates for all
+                            approved stats_demographic_data records
         """
 
-        if not records:
+        model = S3StatsDemographicModel
+
+        keys = model.stats_demographic_dirty_keys(records)
+        if not keys:
             return
 
-        import datetime
-        from dateutil.rrule import rrule, YEARLY
+        model.stats_demographic_time_aggregates(keys)
+        model.stats_demographic_location_aggregates(keys)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def stats_demographic_dirty_keys(records=None, chunk_size=500):
+        """
+            Find the (location, parameter) pairs for which the aggregates
+            need to be rebuilt, together with the earliest period which
+            has been affected by the change
+
+            @param records: the changed records (see update_aggregates)
+            @param chunk_size: maximum number of IDs per query
+
+            @return: dict {(location_id, parameter_id): start_date}
+        """
 
         db = current.db
         s3db = current.s3db
         dtable = s3db.stats_demographic_data
-        atable = db.stats_demographic_aggregate
-        gtable = db.gis_location
-
-        # Data Structures used for the OPTIMISATION
-        param_total_dict = {} # the total_id for each parameter
-        param_location_dict = {} # a list of locations for each parameter
-        location_dict = {} # a list of locations
-        loc_level_list = {} # a list of levels for each location
 
         aggregated_period = S3StatsDemographicModel.stats_demographic_aggregated_period
-        (last_period, year_end) = aggregated_period(None)
 
-        # Test to see which date format we have based on how we were called
-        if isinstance(records, basestring):
-            from_json = True
-            from dateutil.parser import parse
-            records = json.loads(records)
-        elif isinstance(records[0]["stats_demographic_data"]["date"],
-                        (datetime.date, datetime.datetime)):
-            from_json = False
+        first_date = dtable.date.min()
+        fields = [dtable.location_id, dtable.parameter_id, first_date]
+        groupby = [dtable.location_id, dtable.parameter_id]
+
+        if records is None:
+            # All approved records
+            query = (dtable.deleted != True) & \
+                    (dtable.approved_by != None) & \
+                    (dtable.location_id != None) & \
+                    (dtable.parameter_id != None)
+            queries = [query]
         else:
-            from_json = True
-            from dateutil.parser import parse
+            if isinstance(records, basestring):
+                records = json.loads(records)
+            data_ids = set()
+            for record in records:
+                if isinstance(record, (int, long)):
+                    data_ids.add(record)
+                    continue
+                # Legacy format: (JSON of) Rows of stats_demographic_data
+                if "stats_demographic_data" in record:
+                    record = record["stats_demographic_data"]
+                data_id = record["data_id"]
+                if data_id:
+                    data_ids.add(data_id)
+            if not data_ids:
+                return {}
+            data_ids = list(data_ids)
+            # Deleted records must be included here so that their
+            # aggregates get removed
+            queries = [(dtable.data_id.belongs(data_ids[i:i + chunk_size])) & \
+                       (dtable.location_id != None) & \
+                       (dtable.parameter_id != None)
+                       for i in xrange(0, len(data_ids), chunk_size)]
+
+        keys = {}
+        for query in queries:
+            rows = db(query).select(groupby=groupby, *fields)
+            for row in rows:
+                start_date = row[first_date]
+                if start_date is None:
+                    continue
+                key = (row[dtable.location_id], row[dtable.parameter_id])
+                start_date = aggregated_period(start_date)[0]
+                if key not in keys or start_date < keys[key]:
+                    keys[key] = start_date
+
+        # The percentages of all parameters which use a changed parameter
+        # as their total must be recalculated as well
+        parameter_ids = set(parameter_id for (location_id, parameter_id) in keys)
+        if parameter_ids:
+            table = s3db.stats_demographic
+            query = (table.total_id.belongs(parameter_ids)) & \
+                    (table.deleted != True)
+            rows = db(query).select(table.parameter_id, table.total_id)
+            dependants = {}
+            for row in rows:
+                dependants.setdefault(row.total_id, []).append(row.parameter_id)
+            if dependants:
+                for (location_id, parameter_id), start_date in keys.items():
+                    for dependant_id in dependants.get(parameter_id, ()):
+                        key = (location_id, dependant_id)
+                        if key not in keys or start_date < keys[key]:
+                            keys[key] = start_date
+
+        return keys
 
-        for record in records:
-            total_id = record["stats_demographic"]["total_id"]
-            record = record["stats_demographic_data"]
-            data_id = record["data_id"]
-            location_id = record["location_id"]
-            parameter_id = record["parameter_id"]
-            # Skip if either the location or the parameter is not valid
-            if not location_id or not parameter_id:
-                s3_debug("Skipping bad stats_demographic_data record with data_id %s " % data_id)
-                continue
-            if total_id and parameter_id not in param_total_dict:
-                param_total_dict[parameter_id] = total_id
-            if from_json:
-                date = parse(record["date"])
-            else:
-                date = record["date"]
-            (start_date, end_date) = aggregated_period(date)
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def stats_demographic_totals(parameter_ids):
+        """
+            Look up the total parameter for each of the given parameters
 
-            # Get all the approved stats_demographic_data records for this location and parameter
-            query = (dtable.location_id == location_id) & \
+            @param parameter_ids: iterable of parameter IDs
+
+            @return: dict {parameter_id: total_id}
+        """
+
+        table = current.s3db.stats_demographic
+        query = (table.parameter_id.belongs(set(parameter_ids))) & \
+                (table.total_id != None)
+        rows = current.db(query).select(table.parameter_id, table.total_id)
+        return dict((row.parameter_id, row.total_id) for row in rows)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def stats_demographic_time_aggregates(keys, chunk_size=500):
+        """
+            Rebuild the time (and copy) aggregates for the given
+            (location, parameter) pairs
+
+            All data for a chunk of locations are read in one query, the
+            time series for each pair are calculated in memory, and the old
+            aggregates are replaced in bulk. Location aggregates are kept,
+            and their value carried forward into subsequent copy periods.
+
+            @param keys: dict {(location_id, parameter_id): start_date}
+            @param chunk_size: maximum number of locations per query
+        """
+
+        from dateutil.rrule import rrule, YEARLY
+
+        db = current.db
+        dtable = current.s3db.stats_demographic_data
+        atable = db.stats_demographic_aggregate
+
+        aggregated_period = S3StatsDemographicModel.stats_demographic_aggregated_period
+        last_period = aggregated_period(None)[0]
+
+        parameter_ids = set(parameter_id for (location_id, parameter_id) in keys)
+        totals = S3StatsDemographicModel.stats_demographic_totals(parameter_ids)
+        all_parameter_ids = parameter_ids | set(totals.values())
+
+        location_ids = list(set(location_id for (location_id, parameter_id) in keys))
+        for i in xrange(0, len(location_ids), chunk_size):
+            chunk = location_ids[i:i + chunk_size]
+
+            # Get all the approved data for these locations, and keep the
+            # most recent value per location, parameter and period
+            query = (dtable.location_id.belongs(chunk)) & \
+                    (dtable.parameter_id.belongs(all_parameter_ids)) & \
                     (dtable.deleted != True) & \
                     (dtable.approved_by != None)
-            fields = [dtable.data_id,
-                      dtable.date,
-                      dtable.value,
-                      ]
-            if total_id:
-                # Also get the records for the Total to use to calculate the percentage
-                query &= (dtable.parameter_id.belongs([parameter_id, total_id]))
-                fields.append(dtable.parameter_id)
-            else:
-                percentage = None
-                query &= (dtable.parameter_id == parameter_id)
-            data_rows = db(query).select(*fields)
-
-            if total_id:
-                # Separate out the rows relating to the Totals
-                total_rows = data_rows.exclude(lambda row: row.parameter_id == total_id)
-                # Get each record and store them in a dict keyed on the start date
-                # of the aggregated period. If a record already exists for the
-                # reporting period then the most recent value will be stored.
-                earliest_period = current.request.utcnow.date()
-                end_date = year_end
-                totals = {}
-                for row in total_rows:
-                    row_date = row.date
-                    (start_date, end_date) = aggregated_period(row_date)
-                    if start_date in totals:
-                        if row_date <= totals[start_date]["date"]:
-                            # The indicator in the row is of the same time period as
-                            # another which is already stored in totals but it is earlier
-                            # so ignore this particular record
-                            continue
-                    elif start_date < earliest_period:
-                        earliest_period = start_date
-                    # Store the record from the db in the totals storage
-                    totals[start_date] = Storage(date = row_date,
-                                                 id = row.data_id,
-                                                 value = row.value)
-
-            # Get each record and store them in a dict keyed on the start date
-            # of the aggregated period. If a record already exists for the
-            # reporting period then the most recent value will be stored.
-            earliest_period = start_date
-            end_date = year_end
+            rows = db(query).select(dtable.location_id,
+                                    dtable.parameter_id,
+                                    dtable.date,
+                                    dtable.value,
+                                    )
             data = {}
-            data[start_date] = Storage(date = date,
-                                       id = data_id,
-                                       value = record["value"])
-            for row in data_rows:
-                if row.data_id == data_id:
-                    # This is the record we started with, so skip
-                    continue
+            for row in rows:
                 row_date = row.date
-                (start_date, end_date) = aggregated_period(row_date)
-                if start_date in data:
-                    if row_date <= data[start_date]["date"]:
-                        # The indicator in the row is of the same time period as
-                        # another which is already stored in data but it is earlier
-                        # so ignore this particular record
-                        continue
-                elif start_date < earliest_period:
-                    earliest_period = start_date
-                # Store the record from the db in the data storage
-                data[start_date] = Storage(date = row_date,
-                                           id = row.data_id,
-                                           value = row.value)
-
-            # Get all the aggregate records for this parameter and location
-            query = (atable.location_id == location_id) & \
-                    (atable.parameter_id == parameter_id)
-            aggr_rows = db(query).select(atable.id,
-                                         atable.agg_type,
-                                         atable.date,
-                                         atable.end_date,
-                                         atable.sum,
-                                         )
-
-            aggr = {}
-            for row in aggr_rows:
-                (start_date, end_date) = aggregated_period(row.date)
-                aggr[start_date] = Storage(id = row.id,
-                                           type = row.agg_type,
-                                           end_date = row.end_date,
-                                           sum = row.sum,
-                                           )
-
-            # Step through each period and check that aggr is correct
-            last_data_period = earliest_period
-            last_type_agg = False # Whether the type of previous non-copy record was aggr
-            last_data_value = None # The value of the previous aggr record
-            last_total = None # The value of the previous aggr record for the totals param
-            # Keep track of which periods the aggr record has been changed in
-            # the database
-            changed_periods = []
-            for dt in rrule(YEARLY, dtstart=earliest_period, until=last_period):
-                # Calculate the end of the dt period.
-                # - it will be None if this is the last period
-                dt = dt.date()
-                if dt != last_period:
-                    (start_date, end_date) = aggregated_period(dt)
+                if row_date is None:
+                    continue
+                series = data.setdefault((row.location_id, row.parameter_id), {})
+                start_date = aggregated_period(row_date)[0]
+                if start_date not in series or row_date > series[start_date][0]:
+                    series[start_date] = (row_date, row.value)
+
+            # Get the existing aggregates for these locations
+            query = (atable.location_id.belongs(chunk)) & \
+                    (atable.parameter_id.belongs(parameter_ids))
+            rows = db(query).select(atable.id,
+                                    atable.location_id,
+                                    atable.parameter_id,
+                                    atable.agg_type,
+                                    atable.date,
+                                    atable.sum,
+                                    )
+            obsolete = []
+            location_aggregates = {}
+            for row in rows:
+                key = (row.location_id, row.parameter_id)
+                if key not in keys:
+                    continue
+                if row.agg_type == 2:
+                    # Built from child locations, so must not be replaced
+                    series = location_aggregates.setdefault(key, {})
+                    series[row.date] = row.sum
                 else:
-                    start_date = dt
-                    end_date = None
-                if dt in aggr:
-                    # Check that the stored aggr data is correct
-                    agg_type = aggr[dt]["type"]
-                    if agg_type == 2:
-                        # This is built using other location aggregates
-                        # so it can be ignored because only time or copy aggregates
-                        # are being calculated in this function
-                        last_type_agg = True
-                        last_data_value = aggr[dt]["sum"]
+                    obsolete.append(row.id)
+
+            # Calculate the new aggregates
+            items = []
+            append = items.append
+            for location_id in chunk:
+                for parameter_id in parameter_ids:
+                    key = (location_id, parameter_id)
+                    if key not in keys:
                         continue
-                    # Query to use to update aggr records
-                    query = (atable.id == aggr[dt]["id"])
-                    if agg_type == 3:
-                        # This is a copy aggregate
-                        if dt in data:
-                            # There is data in the data dictionary for this period
-                            # so aggregate record needs to be changed
-                            value = data[dt]["value"]
-                            last_data_value = value
-                            if total_id:
-                                if dt in totals:
-                                    last_total = totals[dt]["value"]
-                                if last_total:
-                                    percentage = 100 * value / last_total
-                                    percentage = round(percentage, 3)
-                            db(query).update(agg_type = 1, # time
-                                             #reported_count = 1, # one record
-                                             #ward_count = 1, # one ward
-                                             end_date = end_date,
-                                             percentage = percentage,
-                                             sum = value,
-                                             #min = value,
-                                             #max = value,
-                                             #mean = value,
-                                             #median = value,
-                                             )
-                            changed_periods.append((start_date, end_date))
-                        elif last_type_agg:
-                            # No data in the data dictionary and the last type was aggr
+                    series = data.get(key)
+                    if not series:
+                        # No (more) data for this pair
+                        continue
+                    total_id = totals.get(parameter_id)
+                    total_series = data.get((location_id, total_id), {})
+                    keep = location_aggregates.get(key, {})
+
+                    value = None
+                    total = None
+                    for dt in rrule(YEARLY,
+                                    dtstart=min(series),
+                                    until=last_period):
+                        dt = dt.date()
+                        if dt in total_series:
+                            total = total_series[dt][1]
+                        if dt in keep:
+                            value = keep[dt]
                             continue
-                        # Check that the data currently stored is correct
-                        elif aggr[dt]["sum"] != last_data_value:
-                            value = last_data_value
-                            if total_id:
-                                if dt in totals:
-                                    last_total = totals[dt]["value"]
-                                if last_total:
-                                    percentage = 100 * value / last_total
-                                    percentage = round(percentage, 3)
-                            db(query).update(agg_type = 3, # copy
-                                             #reported_count = 1, # one record
-                                             #ward_count = 1, # one ward
-                                             end_date = end_date,
-                                             percentage = percentage,
-                                             sum = value,
-                                             #min = value,
-                                             #max = value,
-                                             #mean = value,
-                                             #median = value,
-                                             )
-                            changed_periods.append((start_date, end_date))
-                    elif agg_type == 1:
-                        # The value in the aggr should match the value in data
-                        if dt in data:
-                            value = data[dt]["value"]
-                            last_data_value = value
-                            if total_id and dt in totals:
-                                last_total = totals[dt]["value"]
-                            if aggr[dt]["sum"] != value:
-                                if total_id and last_total:
-                                    percentage = 100 * value / last_total
-                                    percentage = round(percentage, 3)
-                                db(query).update(agg_type = 1, # time
-                                                 #reported_count = 1, # one record
-                                                 #ward_count = 1, # one ward
-                                                 end_date = end_date,
-                                                 percentage = percentage,
-                                                 sum = value,
-                                                 #min = value,
-                                                 #max = value,
-                                                 #mean = value,
-                                                 #median = value,
-                                                 )
-                                changed_periods.append((start_date, end_date))
+                        if dt in series:
+                            value = series[dt][1]
+                            agg_type = 1 # time
+                        else:
+                            agg_type = 3 # copy
+                        if total and value is not None:
+                            percentage = round(100 * value / total, 3)
+                        else:
+                            percentage = None
+                        if dt != last_period:
+                            end_date = aggregated_period(dt)[1]
                         else:
-                            # The data is not there so it must have been deleted
-                            # Copy the value from the previous record
-                            value = last_data_value
-                            if total_id:
-                                if dt in totals:
-                                    last_total = totals[dt]["value"]
-                                if last_total:
-                                    percentage = 100 * value / last_total
-                                    percentage = round(percentage, 3)
-                            db(query).update(agg_type = 3, # copy
-                                             #reported_count = 1, # one record
-                                             #ward_count = 1, # one ward
-                                             end_date = end_date,
-                                             percentage = percentage,
-                                             sum = value,
-                                             #min = value,
-                                             #max = value,
-                                             #mean = value,
-                                             #median = value,
-                                             )
-                            changed_periods.append((start_date, end_date))
-                # No aggregate record for this time period exists
-                # So one needs to be inserted
+                            end_date = None
+                        append(dict(parameter_id = parameter_id,
+                                    location_id = location_id,
+                                    agg_type = agg_type,
+                                    date = dt,
+                                    end_date = end_date,
+                                    sum = value,
+                                    percentage = percentage,
+                                    ))
+
+            # Replace the old aggregates
+            for j in xrange(0, len(obsolete), chunk_size):
+                db(atable.id.belongs(obsolete[j:j + chunk_size])).delete()
+            if items:
+                atable.bulk_insert(items)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def stats_demographic_location_aggregates(keys, chunk_size=500):
+        """
+            Rebuild the location aggregates for all ancestors of the given
+            (location, parameter) pairs
+
+            The hierarchy is processed bottom-up, one depth of the location
+            tree at a time, so that each ancestor is calculated exactly once
+            from the (already updated) aggregates of its direct children,
+            using one grouped query per depth rather than one query per
+            ancestor, parameter and period.
+
+            @param keys: dict {(location_id, parameter_id): start_date}
+            @param chunk_size: maximum number of locations per query
+        """
+
+        db = current.db
+        gtable = db.gis_location
+        atable = db.stats_demographic_aggregate
+
+        aggregated_period = S3StatsDemographicModel.stats_demographic_aggregated_period
+        last_period = aggregated_period(None)[0]
+
+        # Find the ancestors of all changed locations
+        location_ids = list(set(location_id for (location_id, parameter_id) in keys))
+        paths = {}
+        get_parents = current.gis.get_parents
+        for i in xrange(0, len(location_ids), chunk_size):
+            chunk = location_ids[i:i + chunk_size]
+            rows = db(gtable.id.belongs(chunk)).select(gtable.id,
+                                                       gtable.path,
+                                                       gtable.parent,
+                                                       )
+            for row in rows:
+                if row.path:
+                    path = [int(l) for l in row.path.split("/")]
+                elif row.parent:
+                    # Path not yet built
+                    parents = get_parents(row.id, feature=row, ids_only=True)
+                    if not parents:
+                        continue
+                    path = list(reversed(parents)) + [row.id]
                 else:
-                    if dt in data:
-                        value = data[dt]["value"]
-                        agg_type = 1 # time
-                        last_data_value = value
-                    else:
-                        value = last_data_value
-                        agg_type = 3 # copy
-                    if total_id:
-                        if dt in totals:
-                            last_total = totals[dt]["value"]
-                        if last_total:
-                            percentage = 100 * value / last_total
-                            percentage = round(percentage, 3)
-                    atable.insert(parameter_id = parameter_id,
-                                  location_id = location_id,
-                                  agg_type = agg_type,
-                                  #reported_count = 1, # one record
-                                  #ward_count = 1, # one ward
-                                  date = start_date,
-                                  end_date = end_date,
-                                  percentage = percentage,
-                                  sum = value,
-                                  #min = value,
-                                  #max = value,
-                                  #mean = value,
-                                  #median = value,
-                                  )
-                    changed_periods.append((start_date, end_date))
-            # End of loop through each time period
-
-            if changed_periods == []:
+                    continue
+                paths[row.id] = path[:-1]
+
+        # Collect the dirty (ancestor, parameter) pairs per depth
+        depths = {}
+        for (location_id, parameter_id), start_date in keys.items():
+            ancestors = paths.get(location_id)
+            if not ancestors:
+                # L0 or orphan
                 continue
-            # The following structures are used in the OPTIMISATION step later
-            location = db(gtable.id == location_id).select(gtable.level,
-                                                           limitby=(0, 1)
-                                                           ).first()
-            loc_level_list[location_id] = location.level
-            if parameter_id not in param_location_dict:
-                param_location_dict[parameter_id] = {location_id : changed_periods}
-            elif location_id not in param_location_dict[parameter_id]:
-                param_location_dict[parameter_id][location_id] = changed_periods
-            else:
-                # Store the older of the changed periods (the end will always be None)
-                # Only need to check the start date of the first period
-                if changed_periods[0][0] < param_location_dict[parameter_id][location_id][0][0]:
-                    param_location_dict[parameter_id][location_id] = changed_periods
-            if location_id not in location_dict:
-                location_dict[location_id] = changed_periods
-            else:
-                # Store the older of the changed periods (the end will always be None)
-                # Only need to check the start date of the first period
-                if changed_periods[0][0] < location_dict[location_id][0][0]:
-                    location_dict[location_id] = changed_periods
-
-        # End of loop through each stats_demographic_data record
-
-        # OPTIMISATION
-        # The following code will get all the locations for which a parameter
-        # has been changed. This will remove duplicates which will occur when
-        # items are being imported for many communes in the same district.
-        # Take an import of 12 communes in the same district, without this the
-        # district will be updated 12 times, the province will be updated 12
-        # times and the country will be updated 12 times that is 33 unnecessary
-        # updates (for each time period) (i.e. 15 updates rather than 48)
-
-        # Get all the parents
-        parents = {}
-        get_parents = current.gis.get_parents
-        for loc_id in location_dict.keys():
-            _parents = get_parents(loc_id)
-            if parents:
-                parents[loc_id] = _parents
-        # Expand the list of locations for each parameter
-        parents_data = {}
-        for (param_id, loc_dict) in param_location_dict.items():
-            for (loc_id, periods) in loc_dict.items():
-                if loc_id in parents: # There won't be a parent if this is a L0
-                    for p_loc_row in parents[loc_id]:
-                        p_loc_id = p_loc_row.id
-                        if param_id in parents_data:
-                            if p_loc_id in parents_data[param_id]:
-                                # Store the older of the changed periods (the end will always be None)
-                                # Only need to check the start date of the first period
-                                if periods[0][0] < parents_data[param_id][p_loc_id][0][0][0]:
-                                    parents_data[param_id][p_loc_id][0] = periods
-                            else:
-                                parents_data[param_id][p_loc_id] = [periods,
-                                                                    loc_level_list[loc_id]
-                                                                    ]
-                        else:
-                            parents_data[param_id] = {p_loc_id : [periods,
-                                                                  loc_level_list[loc_id]
-                                                                  ]
-                                                      }
-
-        # Now that the time aggregate types have been set up correctly,
-        # fire off requests for the location aggregates to be calculated
-        async = current.s3task.async
-        for (param_id, loc_dict) in parents_data.items():
-            total_id = param_total_dict[param_id]
-            for (loc_id, (changed_periods, loc_level)) in loc_dict.items():
-                for (start_date, end_date) in changed_periods:
-                    s, e = str(start_date), str(end_date)
-                    async("stats_demographic_update_aggregate_location",
-                          args = [loc_level, loc_id, param_id, total_id, s, e],
-                          timeout = 1800 # 30m
-                          )
+            for depth, ancestor_id in enumerate(ancestors):
+                dirty = depths.setdefault(depth, {})
+                key = (ancestor_id, parameter_id)
+                if key not in dirty or start_date < dirty[key]:
+                    dirty[key] = start_date
+        if not depths:
+            return
+
+        parameter_ids = set(parameter_id for (location_id, parameter_id) in keys)
+        totals = S3StatsDemographicModel.stats_demographic_totals(parameter_ids)
+        lookup_ids = parameter_ids | set(totals.values())
+
+        total_sum = atable.sum.sum()
+        for depth in sorted(depths, reverse=True):
+            dirty = depths[depth]
+            start = min(dirty.values())
+            parent_ids = list(set(parent_id for (parent_id, parameter_id) in dirty))
+
+            for i in xrange(0, len(parent_ids), chunk_size):
+                chunk = parent_ids[i:i + chunk_size]
+
+                # Sum up the aggregates of all direct children
+                query = (gtable.parent.belongs(chunk)) & \
+                        (gtable.deleted != True) & \
+                        (atable.location_id == gtable.id) & \
+                        (atable.parameter_id.belongs(parameter_ids)) & \
+                        (atable.date >= start)
+                rows = db(query).select(gtable.parent,
+                                        atable.parameter_id,
+                                        atable.date,
+                                        total_sum,
+                                        groupby=[gtable.parent,
+                                                 atable.parameter_id,
+                                                 atable.date,
+                                                 ],
+                                        )
+                values = {}
+                for row in rows:
+                    parent_id = row[gtable.parent]
+                    parameter_id = row[atable.parameter_id]
+                    dt = row[atable.date]
+                    key = (parent_id, parameter_id)
+                    if key not in dirty or dt < dirty[key]:
+                        continue
+                    value = row[total_sum]
+                    if value is not None:
+                        values[(parent_id, parameter_id, dt)] = value
+
+                # Get the existing aggregates for these ancestors
+                query = (atable.location_id.belongs(chunk)) & \
+                        (atable.parameter_id.belongs(lookup_ids))
+                rows = db(query).select(atable.id,
+                                        atable.location_id,
+                                        atable.parameter_id,
+                                        atable.agg_type,
+                                        atable.date,
+                                        atable.sum,
+                                        )
+                existing = {}
+                obsolete = []
+                for row in rows:
+                    location_id = row.location_id
+                    parameter_id = row.parameter_id
+                    dt = row.date
+                    item = (location_id, parameter_id, dt)
+                    existing[item] = row.sum
+                    if item in values:
+                        # Will be replaced
+                        obsolete.append(row.id)
+                    elif row.agg_type == 2:
+                        key = (location_id, parameter_id)
+                        if key in dirty and dt >= dirty[key]:
+                            # No child data anymore
+                            obsolete.append(row.id)
+
+                # Calculate the new aggregates
+                items = []
+                append = items.append
+                for (location_id, parameter_id, dt), value in values.items():
+                    total_id = totals.get(parameter_id)
+                    percentage = None
+                    if total_id:
+                        item = (location_id, total_id, dt)
+                        total = values.get(item, existing.get(item))
+                        if total:
+                            percentage = round(100 * value / total, 3)
+                    if dt != last_period:
+                        end_date = aggregated_period(dt)[1]
+                    else:
+                        end_date = None
+                    append(dict(parameter_id = parameter_id,
+                                location_id = location_id,
+                                agg_type = 2, # Location
+                                date = dt,
+                                end_date = end_date,
+                                sum = value,
+                                percentage = percentage,
+                                ))
+
+                # Replace the old aggregates
+                for j in xrange(0, len(obsolete), chunk_size):
+                    db(atable.id.belongs(obsolete[j:j + chunk_size])).delete()
+                if items:
+                    atable.bulk_insert(items)
 
     # -------------------------------------------------------------------------
     @staticmethod
     def stats_demographic_update_location_aggregate(location_level,
                                                     location_id,
                                                     parameter_id,
-                                                    total_id,
-                                                    start_date,
-                                                    end_date
+                                                    start_date=None,
+                                                    end_date=None
                                                     ):
         """
-            Calculates the stats_demographic_aggregate for a specific parameter at a
-            specific location.
+            Calculates the stats_demographic_aggregate for a specific parameter
+            at a specific location (and all its ancestors) from the aggregates
+            of its child locations.
 
+            @param location_level: the gis level of the data (unused, all
+                                   child locations are taken into account)
             @param location_id: the location record ID
             @param parameter_id: the parameter record ID
-            @param total_id: the parameter record ID for the percentage calculation
-            @param start_date: the start date of the time period (as string)
-            @param end_date: the end date of the time period (as string)
+            @param start_date: the start date of the earliest time period
+                               to update (as string)
+            @param end_date: the end date of the time period (unused)
         """
 
-        db = current.db
-        dtable = current.s3db.stats_demographic_data
-        atable = db.stats_demographic_aggregate
-
-        # Get all the child locations
-        child_locations = current.gis.get_children(location_id, location_level)
-        child_ids = [row.id for row in child_locations]
-
-        # Get the most recent stats_demographic_data record for all child locations
-        query = (dtable.parameter_id == parameter_id) & \
-                (dtable.deleted != True) & \
-                (dtable.approved_by != None) & \
-                (dtable.location_id.belongs(child_ids))
-        if end_date == "None": # converted to string as async parameter
-            end_date = None
+        if start_date and start_date != "None":
+            from dateutil.parser import parse
+            start_date = parse(start_date).date()
         else:
-            query &= (dtable.date <= end_date)
-        rows = db(query).select(dtable.value,
-                                dtable.date,
-                                dtable.location_id,
-                                orderby=(dtable.location_id, ~dtable.date),
-                                # groupby avoids duplicate records for the same
-                                # location, but is slightly slower than just
-                                # skipping the duplicates in the loop below
-                                #groupby=(dtable.location_id)
-                                )
-
-        # Get the most recent aggregate for this location for the total parameter
-        if total_id == "None": # converted to string as async parameter
-            total_id = None
-        
-        # Collect the values, skip duplicate records for the
-        # same location => use the most recent one, which is
-        # the first row for each location as per the orderby
-        # in the query above
-        last_location = None
-        values = []
-        append = values.append
-        for row in rows:
-            new_location_id = row.location_id
-            if new_location_id != last_location:
-                last_location = new_location_id
-                append(row.value)
-
-        # Aggregate the values
-        values_len = len(values)
-        if not values_len:
+            start_date = date.min
+
+        # Rebuilding the aggregates for a child location will process the
+        # requested location (and all its ancestors), so we can just use
+        # any of its children as key
+        gtable = current.db.gis_location
+        query = (gtable.parent == location_id) & \
+                (gtable.deleted != True)
+        child = current.db(query).select(gtable.id, limitby=(0, 1)).first()
+        if not child:
             return
-
-        values_sum = sum(values)
-        #values_min = min(values)
-        #values_max = max(values)
-        #values_avg = float(values_sum) / values_len
-
-        percentage = 100 * values_sum / values_total
-        values_percentage = round(percentage, 3)
-
-        #from numpy import median
-        #values_med = median(values)
-        #values_mad = median([abs(v - values_med) for v in values])
-
-        # Add or update the aggregated values in the database
-
-        # Do we already have a record?
-        query = (atable.location_id == location_id) & \
-                (atable.parameter_id == parameter_id) & \
-                (atable.date == start_date) & \
-                (atable.end_date == end_date)
-        exists = db(query).select(atable.id, limitby=(0, 1)).first()
-
-        attr = dict(agg_type = 2, # Location
-                    #reported_count = values_len,
-                    #ward_count = len(child_ids),
-                    #min = values_min,
-                    #max = values_max,
-                    #mean = values_avg,
-                    #median = values_med,
-                    #mad = values_mad,
-                    sum = values_sum,
-                    percentage = values_percentage,
-                    )
-        if exists:
-            # Update
-            db(query).update(**attr)
-        else:
-            # Insert new
-            atable.insert(parameter_id = parameter_id,
-                          location_id = location_id,
-                          date = start_date,
-                          end_date = end_date,
-                          **attr
-                          )
+        keys = {(child.id, int(parameter_id)): start_date}
+        S3StatsDemographicModel.stats_demographic_location_aggregates(keys)
         return
 
 # =============================================================================
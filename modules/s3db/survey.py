@@ -60,6 +60,8 @@ __all__ = ["S3SurveyTemplateModel",
            "survey_save_answers_for_series",
            "survey_updateMetaData",
            "survey_getAllAnswersForQuestionInSeries",
+           "survey_getAnswerMatrix",
+           "survey_updateAnswerMatrix",
            "survey_getQstnLayoutRules",
            "survey_getSeries",
            "survey_getSeriesName",
@@ -82,6 +84,8 @@ except ImportError:
     except:
         import gluon.contrib.simplejson as json # fallback to pure-Python module
 
+import threading
+
 from gluon import *
 from gluon.dal import Row
 from gluon.storage import Storage
@@ -1825,12 +1829,8 @@ class S3SurveySeriesModel(S3Model):
         response.headers["Content-Type"] = contenttype(".png")
         response.headers["Content-disposition"] = "attachment; filename=\"%s\"" % filename
 
-        chartFile = S3SurveySeriesModel.getChartName()
-        cached = S3Chart.getCachedFile(chartFile)
-        if cached:
-            return cached
-
-        # The cached version doesn't exist so regenerate it
+        # Charts are cached by their content, so this is cheap if
+        # the chart has been rendered before
         output = dict()
         vars = current.request.get_vars
         if "labelQuestion" in vars:
@@ -1872,24 +1872,24 @@ class S3SurveySeriesModel(S3Model):
             series_id = vars.series
         else:
             series_id = r.id
-        chartFile = S3SurveySeriesModel.getChartName()
-        cachePath = S3Chart.getCachedPath(chartFile)
-        if cachePath and request.ajax:
-            return IMG(_src=cachePath)
+        numQstnList = None
+        labelQuestion = None
+        if request.ajax:
+            # Charts are cached by their content, so re-drawing a chart
+            # which has been rendered before is cheap
+            chart_vars = vars
         else:
-            numQstnList = None
-            labelQuestion = None
-            post_vars = request.post_vars
-            if post_vars is not None:
-                if "labelQuestion" in post_vars:
-                    labelQuestion = post_vars.labelQuestion
-                if "numericQuestion" in post_vars:
-                    numQstnList = post_vars.numericQuestion
-                    if not isinstance(numQstnList, (list, tuple)):
-                        numQstnList = [numQstnList]
-                if (numQstnList != None) and (labelQuestion != None):
-                    S3SurveySeriesModel.drawChart(output, series_id, numQstnList,
-                                                  labelQuestion)
+            chart_vars = request.post_vars
+        if chart_vars is not None:
+            if "labelQuestion" in chart_vars:
+                labelQuestion = chart_vars.labelQuestion
+            if "numericQuestion" in chart_vars:
+                numQstnList = chart_vars.numericQuestion
+                if not isinstance(numQstnList, (list, tuple)):
+                    numQstnList = [numQstnList]
+            if (numQstnList != None) and (labelQuestion != None):
+                S3SurveySeriesModel.drawChart(output, series_id, numQstnList,
+                                              labelQuestion)
         if request.ajax == True and "chart" in output:
             return output["chart"]
 
@@ -1998,9 +1998,10 @@ $('#chart_btn').click(function(){
         T = current.T
 
         getAnswers = survey_getAllAnswersForQuestionInSeries
+        matrix = survey_getAnswerMatrix(series_id)
         gqstn = survey_getQuestionFromName(labelQuestion, series_id)
         gqstn_id = gqstn["qstn_id"]
-        ganswers = getAnswers(gqstn_id, series_id)
+        ganswers = getAnswers(gqstn_id, series_id, matrix=matrix)
         dataList = []
         legendLabels = []
         for numericQuestion in numQstnList:
@@ -2016,7 +2017,7 @@ $('#chart_btn').click(function(){
                 qstn = survey_getQuestionFromCode(numericQuestion, series_id)
                 qstn_id = qstn["qstn_id"]
                 qstn_type = qstn["type"]
-                answers = getAnswers(qstn_id, series_id)
+                answers = getAnswers(qstn_id, series_id, matrix=matrix)
                 analysisTool = survey_analysis_type[qstn_type](qstn_id, answers)
                 label = analysisTool.qstnWidget.fullName()
                 if len(label) > 20:
@@ -2499,6 +2500,7 @@ def buildSeriesSummary(series_id, posn_offset):
     header = THEAD(hr)
 
     questions = survey_getAllQuestionsForSeries(series_id)
+    matrix = survey_getAnswerMatrix(series_id)
     line = []
     body = TBODY()
     for question in questions:
@@ -2517,7 +2519,8 @@ def buildSeriesSummary(series_id, posn_offset):
         #br.append(question["name"])
         type = widgetObj.type_represent()
         answers = survey_getAllAnswersForQuestionInSeries(question_id,
-                                                          series_id)
+                                                          series_id,
+                                                          matrix=matrix)
         analysisTool = survey_analysis_type[question["type"]](question_id,
                                                               answers)
         chart = analysisTool.chartButton(series_id)
@@ -2747,13 +2750,12 @@ class S3SurveyCompleteModel(S3Model):
         atable = s3db.survey_answer
         record = rtable[complete_id]
         series_id = record.series_id
-        purgePrefix = "survey_series_%s" % series_id
-        S3Chart.purgeCache(purgePrefix)
         if series_id == None:
             return
         # Save all the answers from answerList in the survey_answer table
         answerList = record.answer_list
         S3SurveyCompleteModel.importAnswers(complete_id, answerList)
+        survey_updateAnswerMatrix(series_id, complete_id)
         # Extract the default template location question and save the
         # answer in the location field
         templateRec = survey_getTemplateFromSeries(series_id)
@@ -2906,6 +2908,11 @@ class S3SurveyCompleteModel(S3Model):
                 query = (atable.question_id == question_id) & \
                         (atable.complete_id == complete_id)
                 current.db(query).update(value = newValue)
+            if vars.id:
+                survey_setAnswerInMatrix(complete_id,
+                                         question_id,
+                                         vars.id,
+                                         newValue)
 
     # -------------------------------------------------------------------------
     @staticmethod
@@ -3040,29 +3047,321 @@ def get_default_location(complete_id):
         return None
 
 # =============================================================================
-def survey_getAllAnswersForQuestionInSeries(question_id, series_id):
+def survey_getAllAnswersForQuestionInSeries(question_id, series_id, matrix=None):
     """
         function to return all the answers for a given question
         from with a specified series
+
+        @param question_id: the survey_question record ID
+        @param series_id: the survey_series record ID
+        @param matrix: the answer matrix of the series (to not look it up
+                       again when called for many questions in a loop)
     """
 
+    if matrix is None:
+        matrix = survey_getAnswerMatrix(series_id)
+    answers = matrix.answers.get(long(question_id))
+    if not answers:
+        return []
+    return [{"answer_id": answer_id,
+             "value": value,
+             "typed": typed,
+             "complete_id": complete_id,
+             } for complete_id, (answer_id, value, typed) in sorted(answers.items())]
+
+# =============================================================================
+# Answer matrices of series, cached process-wide: {series_id: Storage}
+# - cached matrices are never modified, but replaced (copy-on-write), so
+#   that readers can iterate them without holding the lock
+SURVEY_ANSWER_MATRIX = {}
+SURVEY_ANSWER_MATRIX_LOCK = threading.Lock()
+# Maximum number of series to keep in the cache
+SURVEY_ANSWER_MATRIX_SIZE = 10
+
+def survey_getAnswerMatrix(series_id):
+    """
+        Get all answers of all completed forms in a series as matrix
+        question x complete, read with a single query and cached until
+        completed forms of the series or their answers are added,
+        changed or deleted (checked once per request)
+
+        @param series_id: the survey_series record ID
+
+        @return: Storage with
+                 - answers: {question_id: {complete_id: (answer_id, value,
+                                                         typed value)}}
+                 - types: {question_id: question type}
+                 - completes: set of complete_ids with answers
+    """
+
+    series_id = long(series_id)
+
+    with SURVEY_ANSWER_MATRIX_LOCK:
+        matrix = SURVEY_ANSWER_MATRIX.get(series_id)
+    if matrix is not None:
+        verified = survey_verifiedAnswerMatrices()
+        if series_id in verified:
+            return matrix
+        stamp = survey_getAnswerMatrixStamp(series_id)
+        if matrix.stamp == stamp:
+            verified.add(series_id)
+            return matrix
+    else:
+        stamp = survey_getAnswerMatrixStamp(series_id)
+
     s3db = current.s3db
     ctable = s3db.survey_complete
     atable = s3db.survey_answer
-    query = (atable.question_id == question_id) & \
+    qtable = s3db.survey_question
+    query = (ctable.series_id == series_id) & \
+            (ctable.deleted != True) & \
             (atable.complete_id == ctable.id) & \
-            (ctable.series_id == series_id)
+            (atable.deleted != True) & \
+            (qtable.id == atable.question_id)
+    rows = current.db(query).select(atable.id,
+                                    atable.question_id,
+                                    atable.complete_id,
+                                    atable.value,
+                                    qtable.type,
+                                    orderby=atable.id)
+    answers = {}
+    types = {}
+    completes = set()
+    for row in rows:
+        answer = row.survey_answer
+        question_id = answer.question_id
+        complete_id = answer.complete_id
+        if question_id not in answers:
+            answers[question_id] = {}
+            types[question_id] = row.survey_question.type
+        value = answer.value
+        answers[question_id][complete_id] = (answer.id,
+                                             value,
+                                             survey_castAnswer(types[question_id],
+                                                               value))
+        completes.add(complete_id)
+
+    matrix = Storage(stamp=stamp,
+                     answers=answers,
+                     types=types,
+                     completes=completes,
+                     )
+    survey_storeAnswerMatrix(series_id, matrix)
+    return matrix
+
+# -----------------------------------------------------------------------------
+def survey_castAnswer(qtype, value):
+    """
+        Convert a raw answer value into the type of its question widget
+
+        @param qtype: the question type
+        @param value: the raw value (string)
+    """
+
+    if value is None:
+        return None
+    if qtype == "Numeric":
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    elif qtype == "MultiOption":
+        return survey_json2list(value)
+    return value
+
+# -----------------------------------------------------------------------------
+def survey_verifiedAnswerMatrices():
+    """
+        Get the set of series whose cached answer matrix has been verified
+        to be current during this request
+    """
+
+    s3 = current.response.s3
+    verified = s3.survey_answer_matrices
+    if verified is None:
+        verified = s3.survey_answer_matrices = set()
+    return verified
+
+# -----------------------------------------------------------------------------
+def survey_storeAnswerMatrix(series_id, matrix, replace=None):
+    """
+        Store an answer matrix in the cache
+
+        @param series_id: the survey_series record ID
+        @param matrix: the matrix
+        @param replace: the matrix this one is derived from, if given,
+                        the new matrix is only stored if the cache still
+                        holds this one
+
+        @return: True if stored, otherwise False
+    """
+
+    with SURVEY_ANSWER_MATRIX_LOCK:
+        cache = SURVEY_ANSWER_MATRIX
+        if replace is not None and cache.get(series_id) is not replace:
+            return False
+        if series_id not in cache and len(cache) >= SURVEY_ANSWER_MATRIX_SIZE:
+            del cache[cache.keys()[0]]
+        cache[series_id] = matrix
+    survey_verifiedAnswerMatrices().add(series_id)
+    return True
+
+# -----------------------------------------------------------------------------
+def survey_getAnswerMatrixStamp(series_id):
+    """
+        Get the current version stamp of the completed forms and their
+        answers in a series, used to detect changes by other processes
+
+        @param series_id: the survey_series record ID
+
+        @return: tuple (number of completed forms, latest modified_on
+                 of completed forms, number of answers, latest
+                 modified_on of answers)
+    """
+
+    s3db = current.s3db
+
+    ctable = s3db.survey_complete
+    atable = s3db.survey_answer
+    ccount = ctable.id.count(distinct=True)
+    clatest = ctable.modified_on.max()
+    acount = atable.id.count()
+    alatest = atable.modified_on.max()
+
+    query = (ctable.series_id == series_id) & \
+            (ctable.deleted != True)
+    left = atable.on((atable.complete_id == ctable.id) & \
+                     (atable.deleted != True))
+    row = current.db(query).select(ccount, clatest, acount, alatest,
+                                   left=left).first()
+    return (row[ccount], row[clatest], row[acount], row[alatest])
+
+# -----------------------------------------------------------------------------
+def survey_updateAnswerMatrix(series_id, complete_id):
+    """
+        Update the cached answer matrix of a series after the answers
+        of a completed form have been (re-)imported
+
+        @param series_id: the survey_series record ID
+        @param complete_id: the survey_complete record ID
+    """
+
+    series_id = long(series_id)
+    complete_id = long(complete_id)
+
+    with SURVEY_ANSWER_MATRIX_LOCK:
+        matrix = SURVEY_ANSWER_MATRIX.get(series_id)
+    if matrix is None:
+        # Not cached => will be built at the next read
+        return
+
+    s3db = current.s3db
+    atable = s3db.survey_answer
+    qtable = s3db.survey_question
+    query = (atable.complete_id == complete_id) & \
+            (atable.deleted != True) & \
+            (qtable.id == atable.question_id)
     rows = current.db(query).select(atable.id,
+                                    atable.question_id,
                                     atable.value,
-                                    atable.complete_id)
-    answers = []
+                                    qtable.type,
+                                    orderby=atable.id)
+
+    # Copy the matrix, replacing the columns of all questions
+    # the completed form has (or had) answers for
+    answers = dict(matrix.answers)
+    types = dict(matrix.types)
+    for question_id, question_answers in answers.items():
+        if complete_id in question_answers:
+            question_answers = dict(question_answers)
+            del question_answers[complete_id]
+            answers[question_id] = question_answers
+    copied = set()
     for row in rows:
-        answer = {}
-        answer["answer_id"] = row.id
-        answer["value"] = row.value
-        answer["complete_id"] = row.complete_id
-        answers.append(answer)
-    return answers
+        answer = row.survey_answer
+        question_id = answer.question_id
+        if question_id not in copied:
+            answers[question_id] = dict(answers.get(question_id, {}))
+            types[question_id] = row.survey_question.type
+            copied.add(question_id)
+        value = answer.value
+        answers[question_id][complete_id] = (answer.id,
+                                             value,
+                                             survey_castAnswer(types[question_id],
+                                                               value))
+    completes = set(matrix.completes)
+    if rows:
+        completes.add(complete_id)
+    else:
+        completes.discard(complete_id)
+
+    updated = Storage(stamp=survey_getAnswerMatrixStamp(series_id),
+                      answers=answers,
+                      types=types,
+                      completes=completes,
+                      )
+    survey_storeAnswerMatrix(series_id, updated, replace=matrix)
+
+# -----------------------------------------------------------------------------
+def survey_setAnswerInMatrix(complete_id, question_id, answer_id, value):
+    """
+        Update a single answer in the cached answer matrix of the series
+        of the completed form, adding the question and the completed
+        form to the matrix if they are not in it yet
+
+        @param complete_id: the survey_complete record ID
+        @param question_id: the survey_question record ID
+        @param answer_id: the survey_answer record ID
+        @param value: the new value
+    """
+
+    complete_id = long(complete_id)
+    question_id = long(question_id)
+
+    s3db = current.s3db
+    ctable = s3db.survey_complete
+    qtable = s3db.survey_question
+    query = (ctable.id == complete_id) & \
+            (qtable.id == question_id)
+    row = current.db(query).select(ctable.series_id,
+                                   qtable.type,
+                                   limitby=(0, 1)).first()
+    if not row or not row.survey_complete.series_id:
+        return
+    series_id = long(row.survey_complete.series_id)
+
+    with SURVEY_ANSWER_MATRIX_LOCK:
+        matrix = SURVEY_ANSWER_MATRIX.get(series_id)
+    if matrix is None:
+        # Not cached => will be built at the next read
+        return
+
+    # Copy the matrix, replacing the column of the question
+    answers = dict(matrix.answers)
+    types = matrix.types
+    if question_id not in types:
+        types = dict(types)
+        types[question_id] = row.survey_question.type
+    question_answers = dict(answers.get(question_id, {}))
+    question_answers[complete_id] = (answer_id,
+                                     value,
+                                     survey_castAnswer(types[question_id],
+                                                       value))
+    answers[question_id] = question_answers
+    completes = matrix.completes
+    if complete_id not in completes:
+        completes = set(completes)
+        completes.add(complete_id)
+
+    updated = Storage(stamp=survey_getAnswerMatrixStamp(series_id),
+                      answers=answers,
+                      types=types,
+                      completes=completes,
+                      )
+    survey_storeAnswerMatrix(series_id, updated, replace=matrix)
 
 # =============================================================================
 def buildTableFromCompletedList(dataSource):
@@ -3120,33 +3419,40 @@ def buildCompletedList(series_id, question_id_list):
     db = current.db
     qtable = current.s3db.survey_question
 
+    matrix = survey_getAnswerMatrix(series_id)
+    answers = matrix.answers
+    qtypes = matrix.types
+
+    question_ids = [long(question_id) for question_id in question_id_list]
+    rows = db(qtable.id.belongs(question_ids)).select(qtable.id,
+                                                      qtable.name,
+                                                      qtable.type)
+    questions = dict((row.id, row) for row in rows)
+
     headers = []
     happend = headers.append
     types = []
-    items = []
-    qstn_posn = 0
-    rowLen = len(question_id_list)
-    complete_lookup = {}
-    for question_id in question_id_list:
-        answers = survey_getAllAnswersForQuestionInSeries(question_id,
-                                                          series_id)
-        widgetObj = survey_getWidgetFromQuestion(question_id)
-
-        question = db(qtable.id == question_id).select(qtable.name,
-                                                       limitby=(0, 1)).first()
+    columns = []
+    complete_ids = set()
+    for question_id in question_ids:
+        question = questions[question_id]
         happend(question.name)
+        qtype = qtypes.get(question_id, question.type)
+        widgetObj = survey_question_type[qtype](question_id)
         types.append(widgetObj.db_type())
+        question_answers = answers.get(question_id, {})
+        columns.append((widgetObj, question_answers))
+        complete_ids.update(question_answers.keys())
 
-        for answer in answers:
-            complete_id = answer["complete_id"]
-            if complete_id in complete_lookup:
-                row = complete_lookup[complete_id]
+    items = []
+    for complete_id in sorted(complete_ids):
+        item = []
+        for widgetObj, question_answers in columns:
+            if complete_id in question_answers:
+                item.append(widgetObj.repr(question_answers[complete_id][1]))
             else:
-                row = len(complete_lookup)
-                complete_lookup[complete_id]=row
-                items.append([''] * rowLen)
-            items[row][qstn_posn] = widgetObj.repr(answer["value"])
-        qstn_posn += 1
+                item.append("")
+        items.append(item)
 
     return [headers] + [types] + items
 
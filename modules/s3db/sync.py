@@ -310,6 +310,13 @@ class SyncDataModel(S3Model):
                                    readable=True,
                                    writable=False,
                                    label=T("Last push on")),
+                             # Checkpoints of interrupted chunked transfers
+                             Field("pull_cursor",
+                                   readable=False,
+                                   writable=False),
+                             Field("push_cursor",
+                                   readable=False,
+                                   writable=False),
                              Field("mode", "integer",
                                    requires = IS_IN_SET(sync_mode,
                                                         zero=None),
@@ -3214,10 +3214,6 @@ class S3NumericAnalysis(S3AbstractAnalysis):
     def drawChart(self, series_id, output="xml",
                   data=None, label=None, xLabel=None, yLabel=None):
         chartFile = self.getChartName(series_id)
-        cached = S3Chart.getCachedFile(chartFile)
-        if cached:
-            return cached
-
         chart = S3Chart(path=chartFile)
         chart.asInt = True
         if data == None:
@@ -3283,10 +3279,6 @@ class S3OptionAnalysis(S3AbstractAnalysis):
     def drawChart(self, series_id, output="xml",
                   data=None, label=None, xLabel=None, yLabel=None):
         chartFile = self.getChartName(series_id)
-        cached = S3Chart.getCachedFile(chartFile)
-        if cached:
-            return cached
-
         chart = S3Chart(path=chartFile)
         data = []
         label = []
@@ -3411,10 +3403,6 @@ class S3MultiOptionAnalysis(S3OptionAnalysis):
     def drawChart(self, series_id, output="xml",
                   data=None, label=None, xLabel=None, yLabel=None):
         chartFile = self.getChartName(series_id)
-        cached = S3Chart.getCachedFile(chartFile)
-        if cached:
-            return cached
-
         chart = S3Chart(path=chartFile)
         data = []
         label = []
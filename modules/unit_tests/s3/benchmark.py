@@ -46,6 +46,8 @@
 import unittest
 import timeit
 
+from s3.s3model import S3Model
+
 # =============================================================================
 #@unittest.skip("Comment or remove this line in modules/unit_tests/eden/benchmark.py to activate this test")
 class S3PerformanceTests(unittest.TestCase):
@@ -97,6 +99,37 @@ class S3PerformanceTests(unittest.TestCase):
             print "S3Model.__getitem__ = %s µs" % mlt
             self.assertTrue(mlt<10)
 
+    def testS3ModelIndex(self):
+        """ Model lookups with/without the model index """
+
+        s3db = current.s3db
+        INDEX = S3Model.INDEX
+
+        def unindexed(f):
+            # Rebuilding the index on every lookup is equivalent
+            # to scanning the model module
+            INDEX.clear()
+            return f()
+
+        print ""
+        # Names which are not tables always require a model lookup
+        x = lambda: s3db.table("pr_nonexistent")
+        mlt = timeit.Timer(lambda: unindexed(x)).timeit(number=1000)
+        print "S3Model.table(unindexed) = %s ms" % mlt
+        mlt = timeit.Timer(x).timeit(number=1000)
+        print "S3Model.table(indexed) = %s ms" % mlt
+        self.assertTrue(mlt<1)
+
+        current.auth.override = True
+        current.s3db.resource("pr_person")
+        x = lambda: current.s3db.resource("pr_person")
+        mlt = timeit.Timer(lambda: unindexed(x)).timeit(number=1000)
+        print "S3Resource.__init__(unindexed) = %s ms" % mlt
+        mlt = timeit.Timer(x).timeit(number=1000)
+        print "S3Resource.__init__(indexed) = %s ms" % mlt
+        self.assertTrue(mlt<10)
+        current.auth.override = False
+
     def testS3ModelName(self):
 
         s3db = current.s3db
@@ -9,7 +9,7 @@ import unittest
 
 from gluon import *
 from gluon.storage import Storage
-from s3.s3aaa import S3EntityRoleManager, S3Permission
+from s3.s3aaa import S3Audit, S3EntityRoleManager, S3Permission, S3Realm
 
 # =============================================================================
 class AuthUtilsTests(unittest.TestCase):
@@ -1061,6 +1061,56 @@ class ACLManagementTests(unittest.TestCase):
                 del table[acl_id]
             auth.s3_delete_role(group_id)
 
+    # -------------------------------------------------------------------------
+    def testACLCache(self):
+        """ Test caching and invalidation of ACL lookups """
+
+        auth = current.auth
+
+        from s3.s3aaa import S3Permission
+
+        group_id = auth.s3_create_role("Test Role", uid="TEST")
+        acl_id = None
+
+        calls = []
+        def lookup():
+            calls.append(None)
+            return len(calls)
+
+        try:
+            permission = auth.permission
+            key = ("test", group_id)
+
+            # Second lookup must hit the cache
+            self.assertEqual(permission.cached(key, lookup), 1)
+            self.assertEqual(permission.cached(key, lookup), 1)
+
+            # Cache is shared across permission instances (=requests)
+            permission = S3Permission(auth)
+            self.assertEqual(permission.cached(key, lookup), 1)
+
+            # Updating an ACL invalidates the cache
+            acl_id = permission.update_acl(group_id,
+                                           t="pr_person",
+                                           uacl=permission.READ,
+                                           oacl=permission.ALL)
+            self.assertEqual(permission.cached(key, lookup), 2)
+
+            # Deleting an ACL invalidates the cache
+            permission.delete_acl(group_id, t="pr_person")
+            self.assertEqual(permission.cached(key, lookup), 3)
+
+            # Role assignments invalidate the cache
+            user_id = auth.s3_get_user_id("normaluser@example.com")
+            auth.s3_assign_role(user_id, group_id)
+            self.assertEqual(auth.permission.cached(key, lookup), 4)
+            auth.s3_retract_role(user_id, group_id)
+            self.assertEqual(auth.permission.cached(key, lookup), 5)
+        finally:
+            if acl_id:
+                del auth.permission.table[acl_id]
+            auth.s3_delete_role(group_id)
+
     # -------------------------------------------------------------------------
     def testApplicableACLsPolicy8(self):
 
@@ -3892,6 +3942,197 @@ class EntityRoleManagerTests(unittest.TestCase):
     def tearDownClass(cls):
         pass
 
+# =============================================================================
+class RealmTests(unittest.TestCase):
+    """ Tests for compact realms (S3Realm) """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        # Fake OU hierarchy: 1 => 5, 6
+        self.version = "RealmTestsVersion"
+        version = (self.version, current.s3db.table_version("pr_ou_closure"))
+        S3Realm.DESCENDANTS[(1, version)] = [5, 6]
+
+    # -------------------------------------------------------------------------
+    def testEntities(self):
+        """ Test lazy expansion of realm entities """
+
+        realm = S3Realm([1, 9], self.version)
+        S3Realm.DESCENDANTS[(9, (self.version,
+                                 current.s3db.table_version("pr_ou_closure")))] = [6]
+
+        self.assertTrue(realm)
+        self.assertEqual(realm.entities, [1, 9, 5, 6])
+        self.assertEqual(len(realm), 4)
+        self.assertTrue(5 in realm)
+        self.assertFalse(7 in realm)
+        self.assertEqual(realm, [1, 9, 5, 6])
+        self.assertFalse(S3Realm([], self.version))
+
+    # -------------------------------------------------------------------------
+    def testPickle(self):
+        """ Test that realms are pickled as plain lists of their roots """
+
+        import cPickle as pickle
+        realm = S3Realm([1], self.version)
+        self.assertEqual(pickle.loads(pickle.dumps(realm)), [1])
+
+    # -------------------------------------------------------------------------
+    def testEntityQuery(self):
+        """ Test that complete subtrees are queried via the OU closure """
+
+        auth = current.auth
+        permission = S3Permission(auth)
+        field = current.s3db.org_organisation.realm_entity
+
+        # Complete subtree => closure subquery
+        realm = S3Realm([1], self.version)
+        query = permission.entity_query(field, realm)
+        self.assertTrue("pr_ou_closure" in str(query))
+
+        # Incomplete subtree => literal list
+        query = permission.entity_query(field, [1, 5])
+        self.assertFalse("pr_ou_closure" in str(query))
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        for key in S3Realm.DESCENDANTS.keys():
+            if key[1][0] == self.version:
+                del S3Realm.DESCENDANTS[key]
+
+# =============================================================================
+class AuditTests(unittest.TestCase):
+    """ Tests for buffered audit (S3Audit) """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        security = current.deployment_settings.security
+        self.security = dict((key, security.get(key))
+                             for key in ("audit_write",
+                                         "audit_buffer",
+                                         "audit_spool"))
+        security.audit_write = True
+        security.audit_buffer = 3
+        security.audit_spool = None
+
+        self.custom_commit = current.response.custom_commit
+
+    # -------------------------------------------------------------------------
+    def testBuffer(self):
+        """ Test that audit entries are buffered and written in bulk """
+
+        audit = S3Audit()
+        table = audit.table
+        db = current.db
+
+        self.assertEqual(current.response.custom_commit, audit.commit)
+
+        query = (table.tablename == "audit_test")
+        for i in xrange(2):
+            audit("create", "audit", "test", record=i + 1)
+        self.assertEqual(len(audit.buffer), 2)
+        self.assertEqual(db(query).count(), 0)
+
+        # Buffer full => written
+        audit("update", "audit", "test", record=1)
+        self.assertEqual(audit.buffer, [])
+        self.assertEqual(db(query).count(), 3)
+
+        # Written when the request commits
+        audit("delete", "auth", "user", record=0)
+        stats = S3Audit.stats()
+        audit.flush()
+        self.assertEqual(audit.buffer, [])
+        self.assertEqual(S3Audit.stats()["written"], stats["written"] + 1)
+
+    # -------------------------------------------------------------------------
+    def testSpool(self):
+        """ Test that audit entries are spooled only when committing """
+
+        import os
+        import tempfile
+
+        handle, path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+
+        security = current.deployment_settings.security
+        security.audit_buffer = 0
+        security.audit_spool = path
+        security.audit_spool_size = 3
+        try:
+            audit = S3Audit()
+            table = audit.table
+            query = (table.tablename == "audit_test")
+
+            # Kept until the request commits, not spooled
+            for i in xrange(2):
+                audit("create", "audit", "test", record=i + 1)
+            self.assertEqual(len(audit.buffer), 2)
+            self.assertEqual(current.db(query).count(), 0)
+
+            class Adapter(object):
+                committed = False
+                def commit(self):
+                    self.committed = True
+
+            adapter = Adapter()
+            audit.commit(adapter)
+            self.assertTrue(adapter.committed)
+            self.assertEqual(audit.buffer, [])
+            self.assertEqual(current.db(query).count(), 0)
+
+            spool = S3Audit.spool_connect(path)
+            try:
+                size = spool.execute("SELECT COUNT(*) FROM s3_audit_spool") \
+                            .fetchone()[0]
+            finally:
+                spool.close()
+            self.assertEqual(size, 2)
+
+            # Spool full => written into the table
+            for i in xrange(2):
+                audit("update", "audit", "test", record=i + 1)
+            audit.commit(adapter)
+            self.assertEqual(current.db(query).count(), 2)
+        finally:
+            security.pop("audit_spool_size", None)
+            os.remove(path)
+
+    # -------------------------------------------------------------------------
+    def testSpoolEncoding(self):
+        """ Test the encoding of spooled entries """
+
+        import datetime
+        try:
+            import json
+        except ImportError:
+            import gluon.contrib.simplejson as json
+
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        entry = {"timestmp": now,
+                 "method": "update",
+                 "record_id": 1,
+                 "new_value": ["name:Test"],
+                 }
+        output = S3Audit.decode(json.loads(json.dumps(entry,
+                                                      default=S3Audit.encode)))
+        self.assertEqual(output, entry)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        security = current.deployment_settings.security
+        for key, value in self.security.items():
+            if value is None:
+                security.pop(key, None)
+            else:
+                security[key] = value
+        current.response.custom_commit = self.custom_commit
+        current.db.rollback()
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -3920,6 +4161,8 @@ if __name__ == "__main__":
         RealmEntityTests,
         LinkToPersonTests,
         EntityRoleManagerTests,
+        RealmTests,
+        AuditTests,
     )
 
 # END ========================================================================
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# S3Chart Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3chart.py
+#
+import os
+import unittest
+
+from gluon import *
+
+from s3chart import S3Chart
+
+# =============================================================================
+class S3ChartCacheTests(unittest.TestCase):
+    """ Tests for the content-addressed chart cache """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        self.base = current.deployment_settings.base
+        self.cache_size = self.base.get("chart_cache_size")
+        self.keys = []
+
+    # -------------------------------------------------------------------------
+    def testKey(self):
+        """ Test that charts are keyed by their specification """
+
+        def chart(data, title="Test"):
+            chart = S3Chart(path="test_chart")
+            chart.ops.append(("survey_pie", (title, data, ["A", "B"])))
+            return S3Chart.key(chart.spec())
+
+        key = chart([1, 2])
+        self.assertEqual(key, chart([1, 2]))
+        self.assertNotEqual(key, chart([2, 1]))
+        self.assertNotEqual(key, chart([1, 2], title="Other"))
+
+    # -------------------------------------------------------------------------
+    def testLimitCache(self):
+        """ Test that the least recently used charts are removed """
+
+        # Limit the cache to less than two images
+        image = "x" * 600
+        self.base.chart_cache_size = 1000.0 / (1024 * 1024)
+
+        keys = self.keys
+        paths = []
+        for i in xrange(3):
+            key = "s3chart_test_%s" % i
+            keys.append(key)
+            paths.append(S3Chart.storeCachedFile(key, image))
+            self.assertNotEqual(paths[-1], None)
+            # Ensure distinct modification times
+            path = os.path.join(S3Chart.cache_folder(), "%s.png" % key)
+            os.utime(path, (i * 1000, i * 1000))
+
+        self.assertEqual(S3Chart.getCachedPath(keys[0]), None)
+        self.assertEqual(S3Chart.getCachedPath(keys[1]), None)
+        self.assertEqual(S3Chart.getCachedPath(keys[2]), paths[2])
+        self.assertEqual(S3Chart.getCachedFile(keys[2]), image)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        if self.cache_size is None:
+            self.base.pop("chart_cache_size", None)
+        else:
+            self.base.chart_cache_size = self.cache_size
+        S3Chart.purgeCache("s3chart_test_")
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner().run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3ChartCacheTests,
+    )
+
+# END ========================================================================
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# S3 Codecs Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3codecs.py
+#
+import unittest
+
+from gluon import *
+
+from s3.codecs import S3XLS
+from s3.s3resource import S3FieldSelector
+
+# =============================================================================
+class S3XLSExtractTests(unittest.TestCase):
+    """ Tests for the chunked extraction of resources for XLS export """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+        self.chunk_size = S3XLS.CHUNK_SIZE
+
+        otable = current.s3db.org_organisation
+        for i in xrange(5):
+            otable.insert(name="XLSExtractTestOrg%s" % i)
+
+    # -------------------------------------------------------------------------
+    def testChunkedExtraction(self):
+        """ Test that rows are extracted in chunks without gaps or overlaps """
+
+        S3XLS.CHUNK_SIZE = 2
+
+        query = S3FieldSelector("name").like("XLSExtractTestOrg%")
+        resource = current.s3db.resource("org_organisation", filter=query)
+        list_fields = ["id", "name"]
+
+        codec = S3XLS()
+        title, types, lfields, heading, rows = \
+            codec.extractResource(resource, list_fields)
+
+        self.assertEqual(lfields, ["org_organisation.id",
+                                   "org_organisation.name"])
+        self.assertEqual(types[1], "string")
+
+        # Rows are not extracted at once
+        self.assertFalse(isinstance(rows, (list, tuple)))
+
+        names = [row["org_organisation.name"] for row in rows]
+        self.assertEqual(names, ["XLSExtractTestOrg%s" % i for i in xrange(5)])
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        S3XLS.CHUNK_SIZE = self.chunk_size
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner().run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3XLSExtractTests,
+    )
+
+# END ========================================================================
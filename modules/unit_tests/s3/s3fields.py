@@ -1038,6 +1038,143 @@ class S3ExportLazyFKRepresentationTests(unittest.TestCase):
         except:
             pass
 
+# =============================================================================
+class S3RepresentCacheTests(unittest.TestCase):
+    """ Test the shared representation cache """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        s3db = current.s3db
+
+        otable = s3db.org_organisation
+        org = Storage(name="Represent Cache Test Organisation")
+        org_id = otable.insert(**org)
+        org.update(id=org_id)
+        s3db.update_super(otable, org)
+
+        self.org_id = org_id
+        self.cache = S3RepresentCache(size=2, ttl=300)
+
+    # -------------------------------------------------------------------------
+    def testCacheLookup(self):
+        """ Test sharing of representations between instances """
+
+        cache = self.cache
+        r1 = S3Represent(lookup="org_organisation")
+        r1._setup()
+        r1.rcache = cache
+        self.assertEqual(r1(self.org_id), "Represent Cache Test Organisation")
+        self.assertEqual(r1.queries, 1)
+
+        # Second instance with same configuration uses the cache
+        r2 = S3Represent(lookup="org_organisation")
+        r2._setup()
+        r2.rcache = cache
+        self.assertEqual(r2.rkey, r1.rkey)
+        self.assertEqual(r2(self.org_id), "Represent Cache Test Organisation")
+        self.assertEqual(r2.queries, 0)
+
+        # Instance with different fields does not
+        r3 = S3Represent(lookup="org_organisation", fields=["acronym"])
+        r3._setup()
+        self.assertNotEqual(r3.rkey, r1.rkey)
+
+        stats = cache.stats()
+        self.assertEqual(stats["org_organisation"], (1, 1))
+
+    # -------------------------------------------------------------------------
+    def testCacheInvalidation(self):
+        """ Test invalidation of cache entries """
+
+        cache = self.cache
+        renderer = ("renderer",)
+
+        cache.put("org_organisation", renderer, {1: "A", 2: "B"})
+        self.assertEqual(cache.get("org_organisation", renderer, [1, 2]),
+                         {1: "A", 2: "B"})
+
+        cache.invalidate("org_organisation", 1)
+        self.assertEqual(cache.get("org_organisation", renderer, [1, 2]),
+                         {2: "B"})
+
+        cache.invalidate("org_organisation")
+        self.assertEqual(cache.get("org_organisation", renderer, [1, 2]), {})
+
+    # -------------------------------------------------------------------------
+    def testCacheLimits(self):
+        """ Test size and age limits of the cache """
+
+        cache = self.cache
+        renderer = ("renderer",)
+
+        cache.put("org_organisation", renderer, {1: "A", 2: "B"})
+        # Use 1 => 2 is least recently used
+        cache.get("org_organisation", renderer, [1])
+        cache.put("org_organisation", renderer, {3: "C"})
+        self.assertEqual(cache.get("org_organisation", renderer, [1, 2, 3]),
+                         {1: "A", 3: "C"})
+
+        cache.ttl = -1
+        self.assertEqual(cache.get("org_organisation", renderer, [1, 3]), {})
+
+    # -------------------------------------------------------------------------
+    def testCacheSettings(self):
+        """ Test that the shared cache is only used if enabled """
+
+        settings = current.deployment_settings
+        size = settings.get_base_represent_cache_size()
+        instance = S3RepresentCache._instance
+        try:
+            # Disabled
+            settings.base.represent_cache_size = 0
+            S3RepresentCache._instance = None
+            r = S3Represent(lookup="org_organisation")
+            r._setup()
+            self.assertEqual(r.rcache, None)
+
+            # Enabled
+            settings.base.represent_cache_size = 10
+            S3RepresentCache._instance = None
+            r1 = S3Represent(lookup="org_organisation")
+            self.assertEqual(r1(self.org_id),
+                             "Represent Cache Test Organisation")
+            self.assertEqual(r1.queries, 1)
+            self.assertNotEqual(r1.rcache, None)
+
+            # Shared by the next instance
+            r2 = S3Represent(lookup="org_organisation")
+            self.assertEqual(r2(self.org_id),
+                             "Represent Cache Test Organisation")
+            self.assertEqual(r2.queries, 0)
+
+            # Updates invalidate the entries
+            s3db = current.s3db
+            otable = s3db.org_organisation
+            org = Storage(id=self.org_id, name="Represent Cache Test Update")
+            current.db(otable.id == self.org_id).update(name=org.name)
+            s3db.update_super(otable, org)
+            r3 = S3Represent(lookup="org_organisation")
+            self.assertEqual(r3(self.org_id), "Represent Cache Test Update")
+            self.assertEqual(r3.queries, 1)
+
+            # Custom lookups are not cached by default
+            r4 = S3Represent(lookup="org_organisation",
+                             labels=lambda row: row.name)
+            r4._setup()
+            self.assertEqual(r4.rcache, None)
+        finally:
+            settings.base.represent_cache_size = size
+            S3RepresentCache._instance = instance
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -1055,6 +1192,7 @@ if __name__ == "__main__":
 
     run_suite(
         S3RepresentTests,
+        S3RepresentCacheTests,
         S3ExtractLazyFKRepresentationTests,
         S3ExportLazyFKRepresentationTests,
     )
@@ -126,6 +126,95 @@ class S3FilterWidgetTests(unittest.TestCase):
         self.assertTrue("2" in values)
         self.assertTrue("3" in values)
 
+# =============================================================================
+class S3FacetsTests(unittest.TestCase):
+    """ Tests for the facet engine of filter widgets """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        settings = current.deployment_settings
+        self.filter_options_cache = settings.get_search_filter_options_cache()
+        settings.search.filter_options_cache = 60
+
+    # -------------------------------------------------------------------------
+    def testFacets(self):
+        """ Test distinct values and counts with grouped query """
+
+        s3db = current.s3db
+
+        table = s3db.pr_person
+        person_ids = [table.insert(first_name="Test", last_name="Facets",
+                                   gender=gender)
+                      for gender in (2, 2, 3)]
+
+        resource = s3db.resource("pr_person", id=person_ids)
+        facets = dict(S3Facets(resource, "gender")())
+        self.assertEqual(facets, {(2,): 2, (3,): 1})
+
+        # Writes to the table invalidate the cache
+        person_ids.append(table.insert(first_name="Test",
+                                       last_name="Facets",
+                                       gender=3))
+        resource = s3db.resource("pr_person", id=person_ids)
+        facets = dict(S3Facets(resource, "gender")())
+        self.assertEqual(facets, {(2,): 2, (3,): 2})
+
+        # Multiple fields
+        resource = s3db.resource("pr_person", id=person_ids)
+        facets = dict(S3Facets(resource, ["gender", "last_name"])())
+        self.assertEqual(facets, {(2, "Facets"): 2, (3, "Facets"): 2})
+
+    # -------------------------------------------------------------------------
+    def testListFacets(self):
+        """ Test distinct values and counts of list types """
+
+        s3db = current.s3db
+
+        table = s3db.pr_subscription
+        record_ids = [table.insert(method=method)
+                      for method in (["EMAIL", "SMS"],
+                                     ["EMAIL"],
+                                     [],
+                                     ["A|B", "C"])]
+
+        resource = s3db.resource("pr_subscription", id=record_ids)
+        facets = dict(S3Facets(resource, "method")())
+        self.assertEqual(facets, {("EMAIL",): 2,
+                                  ("SMS",): 1,
+                                  ("A|B",): 1,
+                                  ("C",): 1})
+
+    # -------------------------------------------------------------------------
+    def testOptionsFilter(self):
+        """ Test options with counts in S3OptionsFilter """
+
+        s3db = current.s3db
+
+        table = s3db.pr_person
+        person_ids = [table.insert(first_name="Test", last_name="Facets",
+                                   gender=gender)
+                      for gender in (2, 2, 3)]
+
+        resource = s3db.resource("pr_person", id=person_ids)
+        widget = S3OptionsFilter("gender", counts=True)
+        ftype, options, noopt = widget._options(resource)
+        self.assertEqual(noopt, None)
+        self.assertEqual(widget.counts, {2: 2, 3: 1})
+        for key, label in options:
+            self.assertTrue(label.endswith("(%s)" % widget.counts[key]))
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        settings = current.deployment_settings
+        settings.search.filter_options_cache = self.filter_options_cache
+
+        current.db.rollback()
+        current.auth.override = False
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -143,6 +232,7 @@ if __name__ == "__main__":
 
     run_suite(
         S3FilterWidgetTests,
+        S3FacetsTests,
     )
 
 # END ========================================================================
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#
+# GIS Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3gis.py
+#
+import unittest
+
+from gluon import *
+from gluon.storage import Storage
+
+# =============================================================================
+class LocationTreeTests(unittest.TestCase):
+    """ Tests for the bulk rebuild of the Location Tree """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        table = current.s3db.gis_location
+        insert = table.insert
+
+        # Paths & Lx are deliberately left empty
+        L0 = insert(name="Test Country", level="L0",
+                    lat=10.0, lon=20.0)
+        L1 = insert(name="Test Province", level="L1", parent=L0,
+                    wkt="POLYGON((0 0, 2 0, 2 2, 0 2, 0 0))")
+        L3 = insert(name="Test District", level="L3", parent=L1,
+                    inherited=True)
+        site = insert(name="Test Site", parent=L3,
+                      lat=None, lon=None)
+        room = insert(name="Test Room", parent=site)
+
+        self.ids = Storage(L0=L0, L1=L1, L3=L3, site=site, room=room)
+
+    # -------------------------------------------------------------------------
+    def testRebuild(self):
+        """ Test rebuild of path, Lx and inherited Lat/Lon """
+
+        current.gis.rebuild_location_tree(chunk_size=2)
+
+        ids = self.ids
+        table = current.s3db.gis_location
+        rows = current.db(table.id.belongs(ids.values())).select()
+        rows = dict((row.id, row) for row in rows)
+
+        L0 = rows[ids.L0]
+        self.assertEqual(L0.path, str(ids.L0))
+        self.assertEqual(L0.L0, "Test Country")
+
+        L1 = rows[ids.L1]
+        self.assertEqual(L1.path, "%s/%s" % (ids.L0, ids.L1))
+        self.assertEqual(L1.L0, "Test Country")
+        self.assertEqual(L1.L1, "Test Province")
+        self.assertFalse(L1.inherited)
+        if L1.lat is not None:
+            # Polygon centroid & bounds (calculated if Shapely is installed)
+            self.assertEqual(L1.lat, 1.0)
+            self.assertEqual(L1.lon, 1.0)
+            self.assertEqual(L1.lat_min, 0.0)
+            self.assertEqual(L1.lon_min, 0.0)
+            self.assertEqual(L1.lat_max, 2.0)
+            self.assertEqual(L1.lon_max, 2.0)
+
+            # Skipped levels stay empty, Lat/Lon is inherited
+            L3 = rows[ids.L3]
+            self.assertEqual(L3.path, "%s/%s/%s" % (ids.L0, ids.L1, ids.L3))
+            self.assertEqual(L3.L1, "Test Province")
+            self.assertEqual(L3.L2, None)
+            self.assertEqual(L3.L3, "Test District")
+            self.assertTrue(L3.inherited)
+            self.assertEqual(L3.lat, 1.0)
+
+            # Specific locations inherit from their (specific) parents
+            room = rows[ids.room]
+            self.assertEqual(room.path, "%s/%s/%s/%s/%s" % (ids.L0,
+                                                            ids.L1,
+                                                            ids.L3,
+                                                            ids.site,
+                                                            ids.room))
+            self.assertEqual(room.L3, "Test District")
+            self.assertEqual(room.L4, None)
+            self.assertTrue(room.inherited)
+            self.assertEqual(room.lat, 1.0)
+            self.assertEqual(room.wkt, "POINT(1.0 1.0)")
+
+    # -------------------------------------------------------------------------
+    def testPointBounds(self):
+        """ Test that the bounds of Points are recomputed """
+
+        table = current.s3db.gis_location
+        ids = self.ids
+
+        # Stale bounds of a moved Point
+        current.db(table.id == ids.L0).update(lat_min=5.0, lon_min=5.0,
+                                              lat_max=5.0, lon_max=5.0)
+        # Wider bounds of a country Point
+        L0 = table.insert(name="Test Country 2", level="L0",
+                          lat=30.0, lon=40.0,
+                          lat_min=25.0, lon_min=35.0,
+                          lat_max=35.0, lon_max=45.0)
+
+        current.gis.rebuild_location_tree()
+
+        rows = current.db(table.id.belongs((ids.L0, L0))).select()
+        rows = dict((row.id, row) for row in rows)
+
+        row = rows[ids.L0]
+        self.assertEqual((row.lat_min, row.lon_min, row.lat_max, row.lon_max),
+                         (10.0, 20.0, 10.0, 20.0))
+        row = rows[L0]
+        self.assertEqual((row.lat_min, row.lon_min, row.lat_max, row.lon_max),
+                         (25.0, 35.0, 35.0, 45.0))
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner().run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        LocationTreeTests,
+    )
+
+# END ========================================================================
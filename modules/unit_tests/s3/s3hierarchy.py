@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# S3Hierarchy Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3hierarchy.py
+#
+import unittest
+
+from gluon import *
+from gluon.storage import Storage
+
+from s3.s3hierarchy import S3Hierarchy
+
+# =============================================================================
+class S3HierarchyApplyTests(unittest.TestCase):
+    """ Tests for incremental node changes """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+        """ Build a simple hierarchy 1 => (2 => 4, 3) """
+
+        self.roots = set([1])
+        self.nodes = {1: {"p": None, "c": None, "s": set([2, 3])},
+                      2: {"p": 1, "c": None, "s": set([4])},
+                      3: {"p": 1, "c": None, "s": set()},
+                      4: {"p": 2, "c": None, "s": set()},
+                      }
+
+    # -------------------------------------------------------------------------
+    def change(self, node_id, parent_id=None, category=None, removed=False):
+        """ Construct a node change """
+
+        return Storage(node_id=node_id,
+                       parent_id=parent_id,
+                       category=category,
+                       removed=removed,
+                       )
+
+    # -------------------------------------------------------------------------
+    def testAdd(self):
+        """ Test adding nodes """
+
+        assertEqual = self.assertEqual
+
+        roots, nodes = S3Hierarchy._apply(self.roots, self.nodes,
+                                          [self.change(5, parent_id=3, category="X"),
+                                           self.change(6),
+                                           ])
+        assertEqual(roots, set([1, 6]))
+        assertEqual(nodes[5], {"p": 3, "c": "X", "s": set()})
+        assertEqual(nodes[3]["s"], set([5]))
+        assertEqual(nodes[6]["p"], None)
+
+        # Original hierarchy remains unchanged
+        assertEqual(self.roots, set([1]))
+        assertEqual(self.nodes[3]["s"], set())
+        self.assertFalse(5 in self.nodes)
+
+    # -------------------------------------------------------------------------
+    def testMove(self):
+        """ Test moving a node to another parent """
+
+        assertEqual = self.assertEqual
+
+        roots, nodes = S3Hierarchy._apply(self.roots, self.nodes,
+                                          [self.change(2, parent_id=3)])
+        assertEqual(roots, set([1]))
+        assertEqual(nodes[1]["s"], set([3]))
+        assertEqual(nodes[3]["s"], set([2]))
+        assertEqual(nodes[2]["p"], 3)
+        assertEqual(nodes[2]["s"], set([4]))
+
+        # Move to root
+        roots, nodes = S3Hierarchy._apply(roots, nodes,
+                                          [self.change(3)])
+        assertEqual(roots, set([1, 3]))
+        assertEqual(nodes[1]["s"], set())
+
+        # Original hierarchy remains unchanged
+        assertEqual(self.nodes[1]["s"], set([2, 3]))
+        assertEqual(self.nodes[2]["p"], 1)
+
+    # -------------------------------------------------------------------------
+    def testRemove(self):
+        """ Test removing nodes """
+
+        assertEqual = self.assertEqual
+
+        roots, nodes = S3Hierarchy._apply(self.roots, self.nodes,
+                                          [self.change(2, removed=True),
+                                           self.change(7, removed=True),
+                                           ])
+        self.assertFalse(2 in nodes)
+        self.assertFalse(7 in nodes)
+        assertEqual(nodes[1]["s"], set([3]))
+
+        # Orphaned children become roots
+        assertEqual(nodes[4]["p"], None)
+        assertEqual(roots, set([1, 4]))
+
+        # Original hierarchy remains unchanged
+        self.assertTrue(2 in self.nodes)
+        assertEqual(self.nodes[4]["p"], 2)
+
+    # -------------------------------------------------------------------------
+    def testSequence(self):
+        """ Test that changes are applied in order """
+
+        roots, nodes = S3Hierarchy._apply(self.roots, self.nodes,
+                                          [self.change(5, parent_id=4),
+                                           self.change(5, parent_id=3),
+                                           self.change(5, removed=True),
+                                           self.change(5, parent_id=1),
+                                           ])
+        self.assertEqual(nodes[5]["p"], 1)
+        self.assertEqual(nodes[1]["s"], set([2, 3, 5]))
+        self.assertEqual(nodes[3]["s"], set())
+        self.assertEqual(nodes[4]["s"], set())
+
+# =============================================================================
+class S3HierarchyValueTests(unittest.TestCase):
+    """ Tests for the comparison of parent and category values """
+
+    # -------------------------------------------------------------------------
+    def testValue(self):
+        """ Test normalization of form vars and Row values """
+
+        value = S3Hierarchy._value
+
+        self.assertEqual(value(5), value("5"))
+        self.assertEqual(value(5L), value("5"))
+        self.assertEqual(value(None), value(""))
+        self.assertNotEqual(value(None), value(0))
+        self.assertNotEqual(value(5), value(6))
+        self.assertEqual(value("Region"), value("Region"))
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner().run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3HierarchyApplyTests,
+        S3HierarchyValueTests,
+    )
+
+# END ========================================================================
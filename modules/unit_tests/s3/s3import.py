@@ -384,6 +384,229 @@ class FailedReferenceTests(unittest.TestCase):
         current.db.rollback()
         current.auth.override = False
 
+# =============================================================================
+class BulkCommitTests(unittest.TestCase):
+    """ Test pre-fetching of originals and bulk owner/realm updates """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+        settings = current.deployment_settings
+        self.bulk = settings.get_import_bulk_commit()
+
+    # -------------------------------------------------------------------------
+    def testPrefetch(self):
+        """ Test pre-fetching of originals by UID """
+
+        s3db = current.s3db
+
+        table = s3db.gis_location
+        record_id = table.insert(uuid="BCTLOC1", name="BCTLocation1")
+
+        xmlstr = """
+<s3xml>
+    <resource name="gis_location" uuid="BCTLOC1">
+        <data field="name">BCTLocation1Updated</data>
+    </resource>
+    <resource name="gis_location" uuid="BCTLOC2">
+        <data field="name">BCTLocation2</data>
+    </resource>
+</s3xml>"""
+
+        from lxml import etree
+        tree = etree.ElementTree(etree.fromstring(xmlstr))
+
+        from s3.s3import import S3ImportJob
+        job = S3ImportJob(table, tree=tree)
+        job.prefetch()
+
+        lookup = job.originals.get("gis_location")
+        self.assertNotEqual(lookup, None)
+        self.assertEqual(lookup["BCTLOC1"].id, record_id)
+        self.assertTrue("BCTLOC2" in lookup)
+        self.assertEqual(lookup["BCTLOC2"], None)
+
+        element = tree.getroot()[0]
+        original = job.original(table, element)
+        self.assertEqual(original.id, record_id)
+
+        # Committed records are looked up from the database again
+        job.forget("gis_location", "BCTLOC2")
+        self.assertFalse("BCTLOC2" in lookup)
+
+        # Import and check the result
+        resource = s3db.resource("gis_location")
+        resource.import_xml(tree)
+        row = current.db(table.id == record_id).select(table.name,
+                                                      limitby=(0, 1)).first()
+        self.assertEqual(row.name, "BCTLocation1Updated")
+        resource = s3db.resource("gis_location", uid="BCTLOC2")
+        self.assertEqual(resource.count(), 1)
+
+    # -------------------------------------------------------------------------
+    def testFindDuplicates(self):
+        """ Test batch look-up of duplicates for deduplication hooks """
+
+        db = current.db
+        s3db = current.s3db
+
+        table = s3db.org_organisation
+        record_id = table.insert(name="BCTDuplicateOrg")
+
+        xmlstr = """
+<s3xml>
+    <resource name="org_organisation">
+        <data field="name">bctduplicateorg</data>
+    </resource>
+    <resource name="org_organisation">
+        <data field="name">BCTNewOrg</data>
+    </resource>
+</s3xml>"""
+
+        from lxml import etree
+        tree = etree.ElementTree(etree.fromstring(xmlstr))
+
+        from s3.s3import import S3ImportJob
+        job = S3ImportJob(table, tree=tree)
+        fields = [table.id, table.name]
+
+        rows = job.find_duplicates(table, "name", "BCTDUPLICATEORG",
+                                   fields=fields)
+        self.assertEqual([row.id for row in rows], [record_id])
+
+        # All names in the tree have been looked up at once
+        self.assertEqual(len(job.duplicates), 1)
+        matches = job.duplicates.values()[0]
+        self.assertTrue(u"bctneworg" in matches)
+        self.assertEqual(job.find_duplicates(table, "name", "BCTNewOrg",
+                                             fields=fields), [])
+
+        # Committed records are looked up from the database again
+        new_id = table.insert(name="BCTNewOrg")
+        job.forget_duplicates("org_organisation", new_id,
+                              {"name": "BCTNewOrg"})
+        self.assertFalse(u"bctneworg" in matches)
+        rows = job.find_duplicates(table, "name", "BCTNewOrg", fields=fields)
+        self.assertEqual([row.id for row in rows], [new_id])
+
+        # Renamed records are forgotten under their previous name, too
+        db(table.id == record_id).update(name="BCTRenamedOrg")
+        job.forget_duplicates("org_organisation", record_id,
+                              {"name": "BCTRenamedOrg"})
+        self.assertEqual(job.find_duplicates(table, "name", "BCTDuplicateOrg",
+                                             fields=fields), [])
+
+    # -------------------------------------------------------------------------
+    def testBulkOwnership(self):
+        """ Test grouped owner and realm updates after bulk commit """
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+
+        current.deployment_settings["import"].bulk_commit = True
+
+        xmlstr = """
+<s3xml>
+    <resource name="org_organisation" uuid="BCTORG">
+        <data field="name">BCTOrganisation</data>
+        <resource name="org_office" uuid="BCTOFFICE">
+            <data field="name">BCTOffice</data>
+        </resource>
+    </resource>
+</s3xml>"""
+
+        from lxml import etree
+        tree = etree.ElementTree(etree.fromstring(xmlstr))
+
+        resource = s3db.resource("org_organisation")
+        resource.import_xml(tree)
+        self.assertEqual(resource.error, None)
+
+        for tablename, uid in (("org_organisation", "BCTORG"),
+                               ("org_office", "BCTOFFICE")):
+            table = s3db[tablename]
+            row = db(table.uuid == uid).select(table.ALL,
+                                               limitby=(0, 1)).first()
+            self.assertNotEqual(row, None)
+            self.assertEqual(row.realm_entity,
+                             auth.get_realm_entity(table, row))
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.deployment_settings["import"].bulk_commit = self.bulk
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+class BulkImporterTests(unittest.TestCase):
+    """ Test scheduling and chunking of prepopulate tasks """
+
+    # -------------------------------------------------------------------------
+    def testDependencies(self):
+        """ Test detection of dependencies between import tasks """
+
+        import os
+        from s3.s3import import S3BulkImporter
+
+        folder = os.path.join(current.request.folder,
+                              "static", "formats", "s3csv")
+        xsl = lambda prefix, name: os.path.join(folder, prefix, name)
+
+        tasks = [[1, "org", "organisation", "organisation.csv",
+                  xsl("org", "organisation.xsl"), None, None],
+                 [1, "org", "office", "office.csv",
+                  xsl("org", "office.xsl"), None, None],
+                 [1, "gis", "marker", "marker.csv",
+                  xsl("gis", "marker.xsl"), None, None],
+                 [2, "import_role", "roles.csv", None],
+                 [1, "gis", "projection", "projection.csv",
+                  xsl("gis", "projection.xsl"), None, None],
+                 ]
+
+        bi = S3BulkImporter()
+        tables = bi.stylesheet_tables(tasks[1][4])
+        self.assertTrue("org_office" in tables)
+        self.assertTrue("org_organisation" in tables)
+
+        depends = bi.dependencies(tasks)
+        self.assertEqual(depends[0], set())
+        # Offices write (and reference) organisations
+        self.assertEqual(depends[1], set([0]))
+        # Markers are independent of organisations and offices
+        self.assertEqual(depends[2], set())
+        # Special tasks are barriers
+        self.assertEqual(depends[3], set([0, 1, 2]))
+        self.assertEqual(depends[4], set([3]))
+
+    # -------------------------------------------------------------------------
+    def testCSVChunks(self):
+        """ Test splitting of CSV files into chunks """
+
+        from StringIO import StringIO
+        from s3.s3import import S3BulkImporter
+
+        source = StringIO("Name,Comments\n"
+                          "A,first\n"
+                          "B,\"second, with comma\"\n"
+                          "C,third\n"
+                          "D,fourth\n"
+                          "E,fifth\n")
+
+        bi = S3BulkImporter()
+        chunks = [chunk.read().splitlines()
+                  for chunk in bi.csv_chunks(source, 2)]
+
+        self.assertEqual(len(chunks), 3)
+        for chunk in chunks:
+            self.assertEqual(chunk[0], "Name,Comments")
+        self.assertEqual(len(chunks[0]), 3)
+        self.assertEqual(chunks[0][2], "B,\"second, with comma\"")
+        self.assertEqual(len(chunks[2]), 2)
+        self.assertEqual(chunks[2][1], "E,fifth")
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -405,6 +628,8 @@ if __name__ == "__main__":
         ComponentDisambiguationTests,
         PostParseTests,
         FailedReferenceTests,
+        BulkCommitTests,
+        BulkImporterTests,
     )
 
 # END ========================================================================
@@ -6,13 +6,67 @@
 # python web2py.py -S eden -M -R applications/eden/tests/unit_tests/modules/s3/s3model.py
 #
 import unittest
+from gluon import *
 from gluon.dal import Query
+from gluon.storage import Storage
+
+from s3.s3model import S3Model
 
 # =============================================================================
 class S3ModelTests(unittest.TestCase):
 
     pass
 
+# =============================================================================
+class S3ModelIndexTests(unittest.TestCase):
+    """ Tests for the model index """
+
+    # -------------------------------------------------------------------------
+    def testIndex(self):
+        """ Test the index entry for a model module """
+
+        assertEqual = self.assertEqual
+        assertTrue = self.assertTrue
+
+        index = S3Model.index("pr")
+        assertTrue(index is not None)
+        assertTrue(index.module is current.models.pr)
+
+        assertEqual(index.names["pr_person"], "S3PersonModel")
+        assertEqual(index.names["pr_person_represent"], "S3PersonModel")
+        assertTrue("S3PersonModel" in index.models)
+        assertTrue("pr_rheader" in index.objects)
+        assertTrue("S3PersonModel" not in index.objects)
+
+        # Index is process-wide
+        assertTrue(S3Model.index("pr") is index)
+
+        # No such module
+        assertEqual(S3Model.index("xyz"), None)
+
+    # -------------------------------------------------------------------------
+    def testReload(self):
+        """ Test that the index entry is rebuilt for reloaded modules """
+
+        index = S3Model.index("pr")
+        try:
+            S3Model.INDEX["pr"] = Storage(index, module=None)
+            self.assertTrue(S3Model.index("pr").module is current.models.pr)
+        finally:
+            S3Model.INDEX["pr"] = index
+
+    # -------------------------------------------------------------------------
+    def testLookup(self):
+        """ Test table and name lookups via the index """
+
+        s3db = current.s3db
+
+        table = s3db.table("pr_person")
+        self.assertEqual(table._tablename, "pr_person")
+        self.assertEqual(s3db.table("pr_nonexistent"), None)
+        self.assertTrue(s3db.get("pr_person_represent") is not None)
+        self.assertTrue(s3db.table("pr_rheader") is current.models.pr.pr_rheader)
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -30,6 +84,7 @@ if __name__ == "__main__":
 
     run_suite(
         S3ModelTests,
+        S3ModelIndexTests,
     )
 
 # END ========================================================================
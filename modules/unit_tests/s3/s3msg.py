@@ -13,6 +13,8 @@ from gluon.storage import Storage
 from gluon.dal import Row
 from s3.s3resource import *
 from s3.s3fields import s3_meta_fields
+from s3.s3aaa import S3Permission
+from s3.s3notify import S3Notifications
 
 # =============================================================================
 class S3OutboxTests(unittest.TestCase):
@@ -325,6 +327,289 @@ class S3OutboxTests(unittest.TestCase):
         current.db.rollback()
         self.msg.send_email = self.save_email
 
+# =============================================================================
+class S3MsgDispatcherTests(unittest.TestCase):
+    """ Tests for concurrent message dispatch """
+
+    # -------------------------------------------------------------------------
+    def testDispatch(self):
+        """ Test dispatch through multiple workers """
+
+        from s3.s3msg import S3MsgDispatcher
+
+        senders = []
+        class Sender(object):
+            def __init__(self):
+                self.sent = []
+                self.closed = False
+                senders.append(self)
+            def send(self, to, subject, message):
+                if to == "error@example.com":
+                    raise RuntimeError
+                self.sent.append(to)
+                return to != "fail@example.com"
+            def close(self):
+                self.closed = True
+
+        jobs = [(i, "test%s@example.com" % i, "Subject", "Message")
+                for i in xrange(20)]
+        jobs.append((20, "fail@example.com", "Subject", "Message"))
+        jobs.append((21, "error@example.com", "Subject", "Message"))
+
+        dispatcher = S3MsgDispatcher(Sender, workers=4)
+        status = dispatcher.dispatch(jobs)
+
+        # One sender per worker, all closed
+        self.assertEqual(len(senders), 4)
+        for sender in senders:
+            self.assertTrue(sender.closed)
+
+        # Every message sent exactly once
+        sent = []
+        for sender in senders:
+            sent.extend(sender.sent)
+        self.assertEqual(len(sent), 21)
+        self.assertEqual(len(set(sent)), 21)
+
+        self.assertEqual(len(status), 22)
+        for i in xrange(20):
+            self.assertTrue(status[i])
+        self.assertFalse(status[20])
+        self.assertFalse(status[21])
+
+    # -------------------------------------------------------------------------
+    def testRateLimit(self):
+        """ Test rate limitation """
+
+        import time
+        from s3.s3msg import S3MsgDispatcher
+
+        class Sender(object):
+            def send(self, to, subject, message):
+                return True
+            def close(self):
+                pass
+
+        jobs = [(i, "test%s@example.com" % i, "Subject", "Message")
+                for i in xrange(5)]
+
+        dispatcher = S3MsgDispatcher(Sender, workers=2, rate=20)
+        start = time.time()
+        status = dispatcher.dispatch(jobs)
+        duration = time.time() - start
+
+        self.assertEqual(len(status), 5)
+        # 5 messages at 20/sec need at least 4 intervals of 0.05 sec
+        self.assertTrue(duration >= 0.19)
+
+    # -------------------------------------------------------------------------
+    def testSMTPConnectionReuse(self):
+        """ Test reuse of the SMTP connection, and reconnect """
+
+        import smtplib
+        from s3.s3msg import S3SMTPSender
+
+        connections = []
+        class Connection(object):
+            def __init__(self):
+                self.sent = []
+                self.closed = False
+                connections.append(self)
+            def sendmail(self, sender, to, payload):
+                if self.closed:
+                    raise smtplib.SMTPServerDisconnected
+                self.sent.extend(to)
+            def quit(self):
+                self.closed = True
+
+        mail = Storage(settings=Storage(server="localhost:25",
+                                        sender="sender@example.com",
+                                        login=None,
+                                        tls=False))
+        sender = S3SMTPSender(mail)
+        def connect():
+            sender.connection = Connection()
+        sender.connect = connect
+
+        self.assertTrue(sender.send("test1@example.com", "Subject", "Message"))
+        self.assertTrue(sender.send("test2@example.com", "Subject", "Message"))
+        self.assertEqual(len(connections), 1)
+        self.assertEqual(connections[0].sent,
+                         ["test1@example.com", "test2@example.com"])
+
+        # Disconnected by the server => reconnect
+        connections[0].closed = True
+        self.assertTrue(sender.send("test3@example.com", "Subject", "Message"))
+        self.assertEqual(len(connections), 2)
+        self.assertEqual(connections[1].sent, ["test3@example.com"])
+
+        sender.close()
+        self.assertTrue(connections[1].closed)
+
+    # -------------------------------------------------------------------------
+    def testParseWebAPIResult(self):
+        """ Test parsing of Web API responses """
+
+        from s3.s3msg import S3HTTPSender
+
+        parse = S3HTTPSender.parse
+        self.assertTrue(parse(200, "OK"))
+        self.assertTrue(parse(202, '<response success="true"></response>'))
+        self.assertFalse(parse(200, '<response success="false">'
+                                    '<error id="1" message="Error"/>'
+                                    '</response>'))
+        self.assertFalse(parse(302, ""))
+        self.assertFalse(parse(500, "OK"))
+
+# =============================================================================
+class S3NotificationsGroupedTests(unittest.TestCase):
+    """ Tests for grouped update notifications """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        db = current.db
+        s3db = current.s3db
+        auth = current.auth
+
+        # Record the messages instead of sending them
+        self.sent = sent = []
+        self._send = S3Notifications.__dict__["_send"]
+        def send(pe_id, subject, message, method):
+            sent.append((pe_id, method))
+            return True, None
+        S3Notifications._send = staticmethod(send)
+
+        # Record the subscriptions notified by request
+        self.requested = requested = []
+        self.notify = S3Notifications.__dict__["notify"]
+        def notify(resource_id):
+            requested.append(resource_id)
+        S3Notifications.notify = staticmethod(notify)
+
+        # Keep the test data uncommitted
+        self.commit = db.commit
+        db.commit = lambda: None
+
+        self.policy = current.deployment_settings.get_security_policy()
+        self.permission = auth.permission
+
+        # Subscribers with user accounts
+        utable = auth.settings.table_user
+        ltable = s3db.pr_person_user
+        self.user_ids = {}
+        self.pe_ids = {}
+        for email in ("admin@example.com", "normaluser@example.com"):
+            query = (utable.email == email) & \
+                    (ltable.user_id == utable.id)
+            row = db(query).select(utable.id,
+                                   ltable.pe_id,
+                                   limitby=(0, 1)).first()
+            self.user_ids[email] = row[utable.id]
+            self.pe_ids[email] = row[ltable.pe_id]
+
+        # Subscriber without user account
+        otable = s3db.org_organisation
+        record = {"id": otable.insert(name="NotifyTestSubscriber")}
+        s3db.update_super(otable, record)
+        self.pe_ids[None] = record["pe_id"]
+
+        # Subscriptions to the same resource
+        stable = s3db.pr_subscription
+        rtable = s3db.pr_subscription_resource
+        since = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+        self.resource_ids = {}
+        for key, pe_id in self.pe_ids.items():
+            subscription_id = stable.insert(pe_id=pe_id,
+                                            notify_on=["new"],
+                                            method=["EMAIL"],
+                                            frequency="daily")
+            resource_id = rtable.insert(subscription_id=subscription_id,
+                                        resource="org_organisation",
+                                        url="org/organisation",
+                                        locked=True,
+                                        last_check_time=since)
+            self.resource_ids[key] = resource_id
+
+        # New records to notify about, one of them owned by normaluser
+        otable.insert(name="NotifyTestOrg1")
+        otable.insert(name="NotifyTestOrg2",
+                      owned_by_user=self.user_ids["normaluser@example.com"])
+
+    # -------------------------------------------------------------------------
+    def testNotifyGrouped(self):
+        """ Test that subscribers receiving the same updates share messages """
+
+        auth = current.auth
+        current.deployment_settings.security.policy = 1
+        auth.permission = S3Permission(auth)
+
+        S3Notifications.notify_grouped(self.resource_ids.values())
+
+        pe_ids = self.pe_ids
+        self.assertEqual(len(self.sent), 1)
+        recipients, method = self.sent[0]
+        self.assertEqual(sorted(recipients),
+                         sorted([pe_ids["admin@example.com"],
+                                 pe_ids["normaluser@example.com"]]))
+        self.assertEqual(method, "EMAIL")
+
+        # Subscriber without user account notified by request
+        self.assertEqual(self.requested, [self.resource_ids[None]])
+
+        # Time stamps updated and unlocked
+        rtable = current.s3db.pr_subscription_resource
+        query = (rtable.id.belongs(self.resource_ids.values())) & \
+                (rtable.id != self.resource_ids[None])
+        rows = current.db(query).select(rtable.locked,
+                                        rtable.last_check_time,
+                                        rtable.next_check_time)
+        self.assertEqual(len(rows), 2)
+        for row in rows:
+            self.assertFalse(row.locked)
+            self.assertEqual(row.last_check_time, rows.first().last_check_time)
+            self.assertTrue(row.next_check_time > row.last_check_time)
+
+    # -------------------------------------------------------------------------
+    def testNotifyGroupedPermissions(self):
+        """ Test that subscribers with different permissions are separated """
+
+        auth = current.auth
+        current.deployment_settings.security.policy = 5
+        auth.permission = S3Permission(auth)
+        acl = auth.permission
+        # Authenticated users can only read their own organisations
+        acl.update_acl("AUTHENTICATED",
+                       t="org_organisation",
+                       uacl=acl.NONE,
+                       oacl=acl.READ)
+
+        S3Notifications.notify_grouped([self.resource_ids["admin@example.com"],
+                                        self.resource_ids["normaluser@example.com"],
+                                        ])
+
+        pe_ids = self.pe_ids
+        recipients = sorted(tuple(pe_id) for pe_id, method in self.sent)
+        self.assertEqual(recipients,
+                         sorted([(pe_ids["admin@example.com"],),
+                                 (pe_ids["normaluser@example.com"],),
+                                 ]))
+        self.assertEqual(self.requested, [])
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        auth = current.auth
+        auth.s3_impersonate(None)
+        current.deployment_settings.security.policy = self.policy
+        auth.permission = self.permission
+
+        S3Notifications._send = self._send
+        S3Notifications.notify = self.notify
+        db = current.db
+        db.commit = self.commit
+        db.rollback()
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -342,6 +627,8 @@ if __name__ == "__main__":
 
     run_suite(
         S3OutboxTests,
+        S3MsgDispatcherTests,
+        S3NotificationsGroupedTests,
     )
 
 # END ========================================================================
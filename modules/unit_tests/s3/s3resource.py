@@ -1671,6 +1671,108 @@ class ResourceAxisFilterTests(unittest.TestCase):
             except:
                 pass
 
+# =============================================================================
+class ResourcePivotTableTests(unittest.TestCase):
+    """ Test pivot table aggregation in the database """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        tablename = "pivot_aggregation"
+        db = current.db
+        self.table = db.define_table(tablename,
+                                     Field("category"),
+                                     Field("status", "integer"),
+                                     Field("value", "integer"),
+                                     *s3_meta_fields())
+        for category, status, value in (("A", 1, 3),
+                                        ("A", 1, 4),
+                                        ("A", 2, None),
+                                        ("B", 2, 5),
+                                        ("B", 2, 5)):
+            self.table.insert(category=category, status=status, value=value)
+
+    # -------------------------------------------------------------------------
+    def testDBAggregation(self):
+        """ Test database aggregation against record extraction """
+
+        s3db = current.s3db
+        tablename = str(self.table)
+
+        # A value in several cells (A/1, A/2 and B/1)
+        for category, status in (("A", 2), ("B", 1)):
+            self.table.insert(category=category, status=status, value=3)
+
+        layers = [("value", "sum"),
+                  ("value", "count"),
+                  ("value", "min"),
+                  ("value", "avg"),
+                  ("id", "count")]
+
+        resource = s3db.resource(tablename)
+        extracted = resource.pivottable("category", "status", list(layers),
+                                        aggregate=False)
+        resource = s3db.resource(tablename)
+        aggregated = resource.pivottable("category", "status", list(layers),
+                                         aggregate=True)
+
+        self.assertEqual(aggregated.records, None)
+        self.assertEqual(len(aggregated), 7)
+        self.assertEqual(aggregated.numrows, extracted.numrows)
+        self.assertEqual(aggregated.numcols, extracted.numcols)
+
+        rindex = lambda pt: dict((r.value, i) for i, r in enumerate(pt.row))
+        cindex = lambda pt: dict((c.value, i) for i, c in enumerate(pt.col))
+        er, ec = rindex(extracted), cindex(extracted)
+        ar, ac = rindex(aggregated), cindex(aggregated)
+
+        for layer in aggregated.layers:
+            self.assertEqual(aggregated.totals[layer],
+                             extracted.totals[layer])
+            for r in er:
+                self.assertEqual(aggregated.row[ar[r]][layer],
+                                 extracted.row[er[r]][layer])
+                for c in ec:
+                    self.assertEqual(aggregated.cell[ar[r]][ac[c]][layer],
+                                     extracted.cell[er[r]][ec[c]][layer])
+            for c in ec:
+                self.assertEqual(aggregated.col[ac[c]][layer],
+                                 extracted.col[ec[c]][layer])
+
+        # Count totals are the sums of the cells: A/1 {3, 4}, A/2 {3},
+        # B/1 {3}, B/2 {5}
+        layer = aggregated.layers[1]
+        self.assertEqual(aggregated.totals[layer], 5)
+        self.assertEqual(aggregated.row[ar["A"]][layer], 3)
+        self.assertEqual(aggregated.col[ac[1]][layer], 3)
+
+        # Drill-down values for count layers
+        rfield = aggregated.rfields[aggregated.layers[1][0]]
+        cell = aggregated.cell[ar["B"]][ac[2]]
+        self.assertEqual(aggregated._cell_values(cell, rfield), [5])
+
+    # -------------------------------------------------------------------------
+    def testDBAggregationFallback(self):
+        """ Test fallback to record extraction for unsupported methods """
+
+        s3db = current.s3db
+        tablename = str(self.table)
+
+        resource = s3db.resource(tablename)
+        pt = resource.pivottable("category", "status", [("value", "list")],
+                                 aggregate=True)
+        self.assertNotEqual(pt.records, None)
+        self.assertEqual(len(pt), 5)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        try:
+            self.table.drop()
+        except:
+            pass
+        current.db.rollback()
+
 # =============================================================================
 class ResourceDataTableFilterTests(unittest.TestCase):
     """ Test datatable_filter """
@@ -1730,7 +1832,100 @@ class ResourceDataTableFilterTests(unittest.TestCase):
                                                             "competency_id"],
                                                             vars)
         self.assertEqual(orderby, "hrm_competency_rating.priority desc")
-        
+
+# =============================================================================
+class ResourceDataTablePaginationTests(unittest.TestCase):
+    """ Test cached counts and keyset pagination of data tables """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        ptable = current.s3db.pr_person
+        for i in xrange(5):
+            ptable.insert(first_name="PaginationTest%s" % i,
+                          last_name="Person")
+
+    # -------------------------------------------------------------------------
+    def select(self, start, limit, orderby="pr_person.first_name asc"):
+        """ Select a page of the test persons """
+
+        query = S3FieldSelector("first_name").like("PaginationTest%")
+        resource = current.s3db.resource("pr_person", filter=query)
+        data = resource.select(["id", "first_name"],
+                               start=start,
+                               limit=limit,
+                               orderby=orderby,
+                               count=True,
+                               count_cache=30)
+        names = [row["pr_person.first_name"] for row in data["rows"]]
+        return names, data["numrows"]
+
+    # -------------------------------------------------------------------------
+    def testKeyset(self):
+        """ Test sort keys for keyset pagination """
+
+        resource = current.s3db.resource("pr_person")
+        table = resource.table
+
+        keyset = lambda keys: [(str(f), d) for f, d in resource._keyset(keys)]
+
+        keys = keyset([(table.first_name, True)])
+        self.assertEqual(keys, [("pr_person.first_name", True),
+                                ("pr_person.id", False)])
+
+        keys = keyset([(table.id, True), (table.first_name, False)])
+        self.assertEqual(keys, [("pr_person.id", True)])
+
+        # Not indexed or nullable
+        self.assertEqual(resource._keyset([(table.last_name, False)]), None)
+        self.assertEqual(resource._keyset([]), None)
+
+    # -------------------------------------------------------------------------
+    def testPagination(self):
+        """ Test that paging through a data table is consistent """
+
+        expected = ["PaginationTest%s" % i for i in xrange(5)]
+
+        # Repeat to page from the bookmarks of the first run
+        for run in xrange(2):
+            names = []
+            for start in xrange(0, 6, 2):
+                page, numrows = self.select(start, 2)
+                self.assertEqual(numrows, 5)
+                names.extend(page)
+            self.assertEqual(names, expected)
+
+        # Descending order
+        names = []
+        for start in xrange(0, 6, 2):
+            page, numrows = self.select(start, 2,
+                                        orderby="pr_person.first_name desc")
+            names.extend(page)
+        self.assertEqual(names, list(reversed(expected)))
+
+    # -------------------------------------------------------------------------
+    def testCountInvalidation(self):
+        """ Test that writes invalidate the cached count """
+
+        page, numrows = self.select(0, 2)
+        self.assertEqual(numrows, 5)
+
+        current.s3db.pr_person.insert(first_name="PaginationTest5",
+                                      last_name="Person")
+        page, numrows = self.select(0, 2)
+        self.assertEqual(numrows, 6)
+
+        page, numrows = self.select(4, 2)
+        self.assertEqual(page, ["PaginationTest4", "PaginationTest5"])
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
 # =============================================================================
 class ResourceExportTests(unittest.TestCase):
     """ Test XML export of resources """
@@ -3796,7 +3991,9 @@ if __name__ == "__main__":
 
         ResourceDataAccessTests,
         ResourceAxisFilterTests,
+        ResourcePivotTableTests,
         ResourceDataTableFilterTests,
+        ResourceDataTablePaginationTests,
         ResourceGetTests,
         #ResourceInsertTest,
         #ResourceSelectTests,
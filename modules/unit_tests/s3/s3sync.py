@@ -5,6 +5,7 @@
 # To run this script use:
 # python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3sync.py
 #
+import datetime
 import unittest
 from gluon import current
 from gluon.dal import Query
@@ -438,6 +439,67 @@ class ImportMergeWithoutExistingRecords(unittest.TestCase):
         current.auth.override = False
         current.db.rollback()
 
+# =============================================================================
+class ChunkedExportTests(unittest.TestCase):
+    """ Test chunked export with cursors """
+
+    def setUp(self):
+
+        current.auth.override = True
+
+        # Five records with the same mtime to test the uuid tie-break
+        otable = current.s3db.org_organisation
+        mtime = datetime.datetime(2013, 1, 1, 12, 0, 0)
+        for i in xrange(5):
+            otable.insert(name="TestSyncChunkOrganisation%s" % i,
+                          uuid="TESTSYNCCHUNK%s" % i,
+                          modified_on=mtime)
+
+    def testCursorEncoding(self):
+        """ Test encoding and decoding of cursors """
+
+        sync = current.sync
+
+        cursor = (datetime.datetime(2013, 1, 1, 12, 0, 0), "urn:uuid:a,b")
+        encoded = sync.encode_cursor(cursor)
+        self.assertEqual(sync.decode_cursor(encoded), cursor)
+
+        self.assertEqual(sync.encode_cursor(None), None)
+        self.assertEqual(sync.decode_cursor(None), ())
+        self.assertEqual(sync.decode_cursor("invalid,cursor"), ())
+
+    def testChunkedExport(self):
+        """ Test that chunks cover all records without overlaps """
+
+        s3db = current.s3db
+        REF = current.xml.ATTRIBUTE.ref
+
+        uuids = []
+        cursor = ()
+        chunks = 0
+        while True:
+            resource = s3db.resource("org_organisation",
+                                     uid=["TESTSYNCCHUNK%s" % i
+                                          for i in xrange(5)])
+            tree = resource.export_xml(limit=2,
+                                       cursor=cursor,
+                                       as_tree=True)
+            uuids.extend([element.get("uuid")
+                          for element in tree.getroot().findall("resource")
+                          if element.get(REF) != "True"])
+            chunks += 1
+            cursor = resource.cursor
+            if not cursor:
+                break
+
+        self.assertEqual(chunks, 3)
+        self.assertEqual(uuids, ["TESTSYNCCHUNK%s" % i for i in xrange(5)])
+
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -459,7 +521,8 @@ if __name__ == "__main__":
         ImportMergeWithExistingRecords,
         ImportMergeWithExistingOriginal,
         ImportMergeWithExistingDuplicate,
-        ImportMergeWithoutExistingRecords
+        ImportMergeWithoutExistingRecords,
+        ChunkedExportTests,
     )
 
 # END ========================================================================
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+# S3Track Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3/s3track.py
+#
+import unittest
+import datetime
+
+from gluon import *
+from gluon.storage import Storage
+
+from s3.s3track import S3Trackable
+
+# =============================================================================
+class S3TrackableLocationTests(unittest.TestCase):
+    """ Tests for the set-based location lookup of S3Trackable """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+        """ Create test persons and locations """
+
+        current.auth.override = True
+
+        s3db = current.s3db
+
+        gtable = s3db.gis_location
+        self.location_ids = [gtable.insert(name="Test Location %s" % i,
+                                           lat=10.0 + i,
+                                           lon=20.0 + i)
+                             for i in xrange(2)]
+
+        ptable = s3db.pr_person
+        person_ids = []
+        for i in xrange(4):
+            record = Storage(first_name="Test", last_name="Trackable%s" % i)
+            record.id = ptable.insert(**record)
+            s3db.update_super(ptable, record)
+            person_ids.append(record.id)
+        self.person_ids = person_ids
+
+        # Base location of the last person
+        current.db(ptable.id == person_ids[-1]).update(
+                                        location_id=self.location_ids[1])
+
+    # -------------------------------------------------------------------------
+    def tracker(self, index=None):
+        """ Get a tracker for one or all test persons """
+
+        table = current.s3db.pr_person
+        if index is None:
+            return S3Trackable(table=table, record_ids=self.person_ids)
+        else:
+            return S3Trackable(table=table, record_id=self.person_ids[index])
+
+    # -------------------------------------------------------------------------
+    def testInterlocks(self):
+        """ Test resolving interlocks for multiple trackables """
+
+        assertEqual = self.assertEqual
+
+        location_ids = self.location_ids
+        person_ids = self.person_ids
+
+        timestmp = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+
+        # 0 is at location 0, 1 checked-in to 0, 2 checked-in to 1
+        self.tracker(0).set_location(location_ids[0], timestmp=timestmp)
+        self.tracker(1).check_in("pr_person", person_ids[0], timestmp=timestmp)
+        self.tracker(2).check_in("pr_person", person_ids[1], timestmp=timestmp)
+
+        locations = self.tracker().get_location()
+        assertEqual(len(locations), 4)
+        for index in xrange(3):
+            assertEqual(locations[index].id, location_ids[0])
+        # 3 has no presence => base location
+        assertEqual(locations[3].id, location_ids[1])
+
+        # Circular check-in falls back to base locations
+        self.tracker(0).check_in("pr_person", person_ids[2])
+        locations = self.tracker().get_location(_fields=[current.s3db.gis_location.lat])
+        assertEqual(locations[0].lat, None)
+        assertEqual(locations[2].lat, None)
+
+        # Check-out of 1 => location of 0 at that time
+        self.tracker(1).check_out("pr_person", person_ids[0],
+                                  timestmp=timestmp + datetime.timedelta(minutes=1))
+        presence = S3Trackable.latest_presence([self.tracker(1).records.first().track_id])
+        row = presence.values()[0]
+        assertEqual(row.interlock, None)
+        assertEqual(row.location_id, location_ids[0])
+
+    # -------------------------------------------------------------------------
+    def testLatestPresence(self):
+        """ Test the latest presence projection """
+
+        assertEqual = self.assertEqual
+
+        settings = current.deployment_settings
+        setting = settings.gis.get("latest_presence")
+        settings.gis.latest_presence = True
+        try:
+            location_ids = self.location_ids
+            trackable = self.tracker(0)
+            track_id = trackable.records.first().track_id
+
+            now = datetime.datetime.utcnow()
+            trackable.set_location(location_ids[0],
+                                   timestmp=now - datetime.timedelta(hours=2))
+            trackable.set_location(location_ids[1],
+                                   timestmp=now - datetime.timedelta(hours=1))
+            # Older entry must not replace the latest presence
+            trackable.set_location(location_ids[0],
+                                   timestmp=now - datetime.timedelta(hours=3))
+
+            table = current.s3db.sit_presence_latest
+            rows = current.db(table.track_id == track_id).select()
+            assertEqual(len(rows), 1)
+            assertEqual(rows.first().location_id, location_ids[1])
+
+            location = trackable.get_location()[0]
+            assertEqual(location.id, location_ids[1])
+
+            # Past locations are still looked up in the presence log
+            location = trackable.get_location(
+                            timestmp=now - datetime.timedelta(minutes=90))[0]
+            assertEqual(location.id, location_ids[0])
+        finally:
+            settings.gis.latest_presence = setting
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.override = False
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner().run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        S3TrackableLocationTests,
+    )
+
+# END ========================================================================
@@ -9,6 +9,7 @@ import unittest
 from gluon import current
 from gluon.dal import Query
 from s3.s3fields import *
+from s3.s3validators import IS_ONE_OF_EMPTY
 
 # =============================================================================
 class ISLatTest(unittest.TestCase):
@@ -135,6 +136,87 @@ class ISONEOFLazyRepresentationTests(unittest.TestCase):
         current.auth.override = False
         current.db.rollback()
 
+# =============================================================================
+class ISONEOFBatchValidationTests(unittest.TestCase):
+    """ Test batch validation of foreign keys with IS_ONE_OF """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        current.auth.override = True
+
+        table = current.s3db.org_organisation
+        self.ids = [table.insert(name="ISONEOFBatch%s" % i)
+                    for i in xrange(3)]
+        current.db(table.id == self.ids[2]).update(deleted=True)
+
+    # -------------------------------------------------------------------------
+    def testValidateBatch(self):
+        """ Test validation of a column of foreign keys """
+
+        db = current.db
+        ids = self.ids
+        validator = IS_ONE_OF(db, "org_organisation.id")
+
+        values = [ids[0], str(ids[1]), ids[0], ids[2], "invalid"]
+        result = validator.validate_batch(values)
+        errors = [error is not None for value, error in result]
+        self.assertEqual(errors, [False, False, False, True, True])
+
+        # Results are remembered for the individual validation
+        prevalidated = validator.prevalidated
+        self.assertTrue(prevalidated[str(ids[0])])
+        self.assertFalse(prevalidated[str(ids[2])])
+        self.assertEqual(validator(ids[1])[1], None)
+
+        # ...until cleared
+        prevalidated.clear()
+        self.assertNotEqual(validator(ids[2])[1], None)
+
+    # -------------------------------------------------------------------------
+    def testValidateBatchFilterby(self):
+        """ Test batch validation with filterby """
+
+        db = current.db
+        ids = self.ids
+        validator = IS_ONE_OF(db, "org_organisation.id",
+                              filterby="name",
+                              filter_opts=["ISONEOFBatch1"])
+
+        result = validator.validate_batch([ids[0], ids[1]])
+        self.assertNotEqual(result[0][1], None)
+        self.assertEqual(result[1][1], None)
+
+    # -------------------------------------------------------------------------
+    def testValidateBatchMultiple(self):
+        """ Test batch validation with multiple=True """
+
+        db = current.db
+        ids = self.ids
+        validator = IS_ONE_OF(db, "org_organisation.id", multiple=True)
+
+        result = validator.validate_batch([[ids[0], ids[1]], [ids[2]]])
+        self.assertEqual(result[0], ([str(ids[0]), str(ids[1])], None))
+        self.assertNotEqual(result[1][1], None)
+
+    # -------------------------------------------------------------------------
+    def testValidators(self):
+        """ Test lookup of the IS_ONE_OF validators of a field """
+
+        db = current.db
+        validator = IS_ONE_OF(db, "org_organisation.id")
+        field = Field("organisation_id", requires=IS_EMPTY_OR(validator))
+        self.assertEqual(IS_ONE_OF_EMPTY.validators(field), [validator])
+
+        field = Field("name", requires=IS_NOT_EMPTY())
+        self.assertEqual(IS_ONE_OF_EMPTY.validators(field), [])
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.auth.override = False
+        current.db.rollback()
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -154,6 +236,7 @@ if __name__ == "__main__":
         ISLatTest,
         ISLonTest,
         ISONEOFLazyRepresentationTests,
+        ISONEOFBatchValidationTests,
     )
 
 # END ========================================================================
@@ -7,7 +7,7 @@ import unittest
 
 from gluon import *
 from gluon.storage import Storage
-from s3.s3widgets import S3OptionsMatrixWidget, s3_checkboxes_widget, s3_grouped_checkboxes_widget
+from s3.s3widgets import S3LocationSelectorWidget2, S3OptionsMatrixWidget, s3_checkboxes_widget, s3_grouped_checkboxes_widget
 from gluon.contrib.simplejson.ordered_dict import OrderedDict
 
 # =============================================================================
@@ -550,6 +550,26 @@ class TestS3GroupedCheckboxesWidget(unittest.TestCase):
                                          _class="s3-grouped-checkboxes-widget",
                                          _name="f_widget"))))
 
+# =============================================================================
+class TestS3LocationSelectorWidget2(unittest.TestCase):
+    """ Test the versioning of the location hierarchy data """
+
+    def testDataVersion(self):
+        """ Test that the version changes when locations are modified """
+
+        version = S3LocationSelectorWidget2.data_version()
+        self.assertEqual(S3LocationSelectorWidget2.data_version(), version)
+
+        translated = S3LocationSelectorWidget2.data_version("de")
+        self.assertTrue(translated.startswith("de-"))
+
+        current.s3db.gis_location.insert(name="LocationSelectorTest")
+        self.assertNotEqual(S3LocationSelectorWidget2.data_version(), version)
+
+    def tearDown(self):
+
+        current.db.rollback()
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -569,6 +589,7 @@ if __name__ == "__main__":
         TestS3OptionsMatrixWidget,
         TestS3CheckboxesWidget,
         TestS3GroupedCheckboxesWidget,
+        TestS3LocationSelectorWidget2,
     )
 
 # END ========================================================================
@@ -5,6 +5,7 @@
 # To run this script use:
 # python web2py.py -S eden -M -R applications/eden/tests/unit_tests/modules/s3/s3xml.py
 #
+import os
 import unittest
 from gluon import *
 from gluon.contrib import simplejson as json
@@ -16,6 +17,7 @@ except:
 
 from lxml import etree
 
+from s3.codecs import S3GeoJSON
 from s3.s3xml import S3XMLFormat
 
 # =============================================================================
@@ -263,6 +265,186 @@ class S3XMLFormatTests(unittest.TestCase):
         self.assertEqual(len(root), 0)
         self.assertEqual(root.text, "Test")
 
+# =============================================================================
+class S3XSLTCacheTests(unittest.TestCase):
+    """ Test caching of compiled XSLT stylesheets """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        import tempfile
+        stylesheet = """<?xml version="1.0"?>
+<xsl:stylesheet xmlns:xsl="http://www.w3.org/1999/XSL/Transform" version="1.0">
+    <xsl:template match="/">
+        <test>%s</test>
+    </xsl:template>
+</xsl:stylesheet>"""
+
+        self.template = stylesheet
+        handle, self.path = tempfile.mkstemp(suffix=".xsl")
+        os.write(handle, stylesheet % "Test1")
+        os.close(handle)
+
+        self.tree = etree.ElementTree(etree.fromstring("<root/>"))
+
+    # -------------------------------------------------------------------------
+    def testTransformerCaching(self):
+        """ Test re-use of compiled transformers """
+
+        xml = current.xml
+
+        transformer = xml.transformer(self.path)
+        self.assertNotEqual(transformer, None)
+        self.assertTrue(xml.transformer(self.path) is transformer)
+
+        result = xml.transform(self.tree, self.path)
+        self.assertEqual(result.getroot().text, "Test1")
+
+    # -------------------------------------------------------------------------
+    def testTransformerUpdate(self):
+        """ Test re-compilation of modified stylesheets """
+
+        xml = current.xml
+
+        transformer = xml.transformer(self.path)
+
+        with open(self.path, "w") as f:
+            f.write(self.template % "Test2")
+        mtime = os.path.getmtime(self.path) + 1
+        os.utime(self.path, (mtime, mtime))
+
+        self.assertFalse(xml.transformer(self.path) is transformer)
+        result = xml.transform(self.tree, self.path)
+        self.assertEqual(result.getroot().text, "Test2")
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+# =============================================================================
+class S3GeoJSONTests(unittest.TestCase):
+    """ Tests for the native GeoJSON encoder """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+
+        tablename = "org_office"
+        self.tablename = tablename
+        self.locations = {
+            "latlons": {tablename: {1: (10.0, 20.0),
+                                    2: (None, None),
+                                    }},
+            "wkts": {tablename: {}},
+            "geojsons": {tablename: {}},
+            "markers": {tablename: {"image": "marker.png",
+                                    "height": 40,
+                                    "width": 30,
+                                    }},
+            "tooltips": {tablename: {1: u"Office 1"}},
+            "attributes": {tablename: {1: {"type": "HQ"}}},
+        }
+
+    # -------------------------------------------------------------------------
+    def testEncodePoint(self):
+        """ Test encoding of a point feature """
+
+        feature = S3GeoJSON.encode_feature(1,
+                                           "urn:uuid:1234",
+                                           self.tablename,
+                                           self.locations,
+                                           popup_url="/eden/org/office",
+                                           marker_url="/eden/static/img/markers")
+        feature = json.loads(feature)
+
+        self.assertEqual(feature["type"], "Feature")
+        self.assertEqual(feature["geometry"], {"type": "Point",
+                                               "coordinates": [20.0, 10.0],
+                                               })
+        properties = feature["properties"]
+        self.assertEqual(properties["id"], "1234")
+        self.assertEqual(properties["popup"], "Office 1")
+        self.assertEqual(properties["url"], "/eden/org/office/1.plain")
+        self.assertEqual(properties["marker_url"],
+                         "/eden/static/img/markers/marker.png")
+        self.assertEqual(properties["marker_height"], "40")
+        self.assertEqual(properties["marker_width"], "30")
+        self.assertEqual(properties["type"], "HQ")
+
+    # -------------------------------------------------------------------------
+    def testEncodePolygon(self):
+        """ Test encoding of a pre-simplified polygon """
+
+        tablename = self.tablename
+        geometry = '{"type":"Polygon","coordinates":[[[0,0],[1,0],[1,1],[0,0]]]}'
+        locations = {"geojsons": {tablename: {3: geometry}}}
+
+        feature = S3GeoJSON.encode_feature(3, None, tablename, locations)
+        feature = json.loads(feature)
+        self.assertEqual(feature["geometry"], json.loads(geometry))
+        self.assertFalse("id" in feature["properties"])
+
+    # -------------------------------------------------------------------------
+    def testFeatureCollection(self):
+        """ Test chunked output of the FeatureCollection """
+
+        ids = [(1, "urn:uuid:1"), (2, "urn:uuid:2"), (3, "urn:uuid:3")]
+
+        chunk_size = S3GeoJSON.CHUNK_SIZE
+        S3GeoJSON.CHUNK_SIZE = 1
+        try:
+            chunks = list(S3GeoJSON.features(ids,
+                                             self.tablename,
+                                             self.locations))
+        finally:
+            S3GeoJSON.CHUNK_SIZE = chunk_size
+
+        output = json.loads("".join(chunks))
+        self.assertEqual(output["type"], "FeatureCollection")
+
+        # Features without coordinates must be skipped
+        features = output["features"]
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]["properties"]["id"], "1")
+
+    # -------------------------------------------------------------------------
+    def testFallback(self):
+        """ Test encoding of records without pre-prepared location data """
+
+        tablename = self.tablename
+        geometry = '{"type":"Polygon","coordinates":[[[0,0],[1,0],[1,1],[0,0]]]}'
+        fallback = {3: (30.0, 40.0), 4: geometry}
+
+        # Lat/Lon of the location is encoded as Point with marker
+        feature = S3GeoJSON.encode_feature(3, None, tablename,
+                                           self.locations,
+                                           marker_url="/eden/static/img/markers",
+                                           fallback=fallback)
+        feature = json.loads(feature)
+        self.assertEqual(feature["geometry"], {"type": "Point",
+                                               "coordinates": [40.0, 30.0],
+                                               })
+        self.assertEqual(feature["properties"]["marker_url"],
+                         "/eden/static/img/markers/marker.png")
+
+        # Polygon of the location is dropped in as-is, without marker
+        feature = S3GeoJSON.encode_feature(4, None, tablename,
+                                           self.locations,
+                                           marker_url="/eden/static/img/markers",
+                                           fallback=fallback)
+        feature = json.loads(feature)
+        self.assertEqual(feature["geometry"], json.loads(geometry))
+        self.assertFalse("marker_url" in feature["properties"])
+
+        # Records without location are still skipped
+        feature = S3GeoJSON.encode_feature(5, None, tablename,
+                                           self.locations,
+                                           fallback=fallback)
+        self.assertEqual(feature, None)
+
 # =============================================================================
 def run_suite(*test_classes):
     """ Run the test suite """
@@ -282,6 +464,8 @@ if __name__ == "__main__":
         S3TreeBuilderTests,
         S3JSONMessageTests,
         S3XMLFormatTests,
+        S3XSLTCacheTests,
+        S3GeoJSONTests,
     )
 
 # END ========================================================================
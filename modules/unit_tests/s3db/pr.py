@@ -138,6 +138,47 @@ class PRTests(unittest.TestCase):
         users = s3db.pr_realm_users(None)
         self.assertTrue(all([u in users for u in all_users]))
 
+    # -------------------------------------------------------------------------
+    def testOUClosure(self):
+        """ Test descendant lookups from the OU closure table """
+
+        auth = current.auth
+        s3db = current.s3db
+
+        auth.s3_impersonate("normaluser@example.com")
+        user_pe_id = auth.s3_user_pe_id(auth.user.id)
+        auth.s3_impersonate(None)
+
+        org1 = self.org1
+        org2 = self.org2
+
+        # Org2 is a branch of Org1, the user is staff of Org2
+        s3db.pr_add_affiliation(org1, org2, role="Branches")
+        s3db.pr_add_affiliation(org2, user_pe_id, role="Staff")
+
+        descendants = s3db.pr_get_descendants(org1)
+        self.assertTrue(org2 in descendants)
+        self.assertTrue(user_pe_id in descendants)
+
+        descendants = s3db.pr_get_descendants(org1,
+                                              entity_types="org_organisation")
+        self.assertEqual(descendants, [org2])
+
+        # pr_descendants skips persons
+        descendants = s3db.pr_descendants([org1, org2])
+        self.assertEqual(descendants, {org1: [org2]})
+
+        # Closure is the same after a rebuild
+        s3db.pr_rebuild_closure()
+        descendants = s3db.pr_get_descendants(org1)
+        self.assertTrue(org2 in descendants)
+        self.assertTrue(user_pe_id in descendants)
+
+        # Removing the branch removes all its descendants from Org1
+        s3db.pr_remove_affiliation(org1, org2, role="Branches")
+        self.assertEqual(s3db.pr_get_descendants(org1), [])
+        self.assertEqual(s3db.pr_get_descendants(org2), [user_pe_id])
+
     # -------------------------------------------------------------------------
     def tearDown(self):
 
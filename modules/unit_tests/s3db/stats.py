@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+# Stats Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3db/stats.py
+#
+import unittest
+import datetime
+import json
+
+from gluon import *
+from gluon.storage import Storage
+
+# =============================================================================
+@unittest.skipIf(not current.deployment_settings.has_module("stats"),
+                 "Stats module deactivated")
+class StatsDemographicAggregateTests(unittest.TestCase):
+    """ Tests for the incremental demographic aggregation """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+        """ Set up location, parameter and data records """
+
+        auth = current.auth
+        auth.s3_impersonate("admin@example.com")
+
+        s3db = current.s3db
+        update_super = s3db.update_super
+
+        # Location hierarchy: code, name, level, parent
+        gtable = s3db.gis_location
+        location_ids = Storage()
+        location_ids["gis0"] = gtable.insert(name="Test Country", level="L0")
+        gis_test_data = [("gis1", "Test Province", "L1", "gis0"),
+                         ("gis2_1", "Test District 1", "L2", "gis1"),
+                         ("gis2_2", "Test District 2", "L2", "gis1"),
+                         ]
+        update_location_tree = current.gis.update_location_tree
+        for code, name, level, parent in gis_test_data:
+            location_id = gtable.insert(name=name,
+                                        level=level,
+                                        parent=location_ids[parent],
+                                        )
+            update_location_tree(dict(id=location_id, level=level))
+            location_ids[code] = location_id
+        self.location_ids = location_ids
+
+        # Parameters: a total and a demographic relative to it
+        table = s3db.stats_demographic
+        parameters = Storage()
+        for name in ("Test Total Population", "Test Female Population"):
+            record = Storage(name=name)
+            if name == "Test Female Population":
+                record.total_id = parameters.total
+            record_id = table.insert(**record)
+            record.id = record_id
+            update_super(table, record)
+            parameter_id = record.parameter_id
+            if parameters.total is None:
+                parameters.total = parameter_id
+            else:
+                parameters.female = parameter_id
+        self.parameters = parameters
+
+    # -------------------------------------------------------------------------
+    def add_data(self, location, parameter, value, year):
+        """
+            Add an approved stats_demographic_data record
+
+            @param location: the location code
+            @param parameter: the parameter key
+            @param value: the value
+            @param year: the year of the data
+
+            @return: the data_id
+        """
+
+        s3db = current.s3db
+        table = s3db.stats_demographic_data
+        record = Storage(location_id=self.location_ids[location],
+                         parameter_id=self.parameters[parameter],
+                         value=value,
+                         date=datetime.date(year, 6, 1),
+                         approved_by=current.auth.user.id,
+                         )
+        record_id = table.insert(**record)
+        record.id = record_id
+        s3db.update_super(table, record)
+        return record.data_id
+
+    # -------------------------------------------------------------------------
+    def get_aggregate(self, location, parameter, year):
+        """ Read the aggregate for a location, parameter and year """
+
+        atable = current.s3db.stats_demographic_aggregate
+        query = (atable.location_id == self.location_ids[location]) & \
+                (atable.parameter_id == self.parameters[parameter]) & \
+                (atable.date == datetime.date(year, 1, 1))
+        rows = current.db(query).select(atable.agg_type,
+                                        atable.sum,
+                                        atable.percentage,
+                                        )
+        self.assertTrue(len(rows) <= 1)
+        return rows.first()
+
+    # -------------------------------------------------------------------------
+    def testIncrementalAggregates(self):
+        """ Test time, copy and location aggregates """
+
+        s3db = current.s3db
+        update_aggregates = s3db.stats_demographic_update_aggregates
+
+        this_year = datetime.date.today().year
+        year = this_year - 2
+
+        data_ids = [self.add_data("gis2_1", "total", 1000, year),
+                    self.add_data("gis2_1", "female", 400, year),
+                    self.add_data("gis2_2", "total", 500, year),
+                    self.add_data("gis2_2", "female", 300, year + 1),
+                    ]
+        update_aggregates(data_ids)
+
+        # Time aggregates
+        row = self.get_aggregate("gis2_1", "female", year)
+        self.assertEqual(row.agg_type, 1)
+        self.assertEqual(row.sum, 400)
+        self.assertEqual(row.percentage, 40)
+
+        # Copy aggregates up to the current year
+        row = self.get_aggregate("gis2_1", "female", this_year)
+        self.assertEqual(row.agg_type, 3)
+        self.assertEqual(row.sum, 400)
+        self.assertEqual(self.get_aggregate("gis2_2", "female", year), None)
+        row = self.get_aggregate("gis2_2", "female", year + 1)
+        self.assertEqual(row.percentage, 60)
+
+        # Location aggregates are rolled up the whole hierarchy
+        for location in ("gis1", "gis0"):
+            row = self.get_aggregate(location, "total", year)
+            self.assertEqual(row.agg_type, 2)
+            self.assertEqual(row.sum, 1500)
+            row = self.get_aggregate(location, "female", year)
+            self.assertEqual(row.sum, 400)
+            row = self.get_aggregate(location, "female", year + 1)
+            self.assertEqual(row.sum, 700)
+            self.assertEqual(row.percentage, round(100 * 700 / 1500.0, 3))
+
+        # Changing a total updates the dependent percentages
+        data_id = self.add_data("gis2_1", "total", 2000, year + 1)
+        update_aggregates(json.dumps([data_id]))
+
+        row = self.get_aggregate("gis2_1", "female", year + 1)
+        self.assertEqual(row.percentage, 20)
+        row = self.get_aggregate("gis0", "total", year + 1)
+        self.assertEqual(row.sum, 2500)
+        row = self.get_aggregate("gis0", "female", year + 1)
+        self.assertEqual(row.percentage, 28)
+
+        # Deleting data removes its aggregates
+        dtable = s3db.stats_demographic_data
+        current.db(dtable.data_id == data_ids[3]).update(deleted=True)
+        update_aggregates([data_ids[3]])
+
+        self.assertEqual(self.get_aggregate("gis2_2", "female", year + 1), None)
+        row = self.get_aggregate("gis0", "female", year + 1)
+        self.assertEqual(row.sum, 400)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        current.db.rollback()
+        current.auth.s3_impersonate(None)
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner().run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        StatsDemographicAggregateTests,
+    )
+
+# END ========================================================================
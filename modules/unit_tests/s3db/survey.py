@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+# Survey Unit Tests
+#
+# To run this script use:
+# python web2py.py -S eden -M -R applications/eden/modules/unit_tests/s3db/survey.py
+#
+import unittest
+
+from gluon import *
+from gluon.storage import Storage
+
+from s3db.survey import SURVEY_ANSWER_MATRIX, survey_setAnswerInMatrix
+
+# =============================================================================
+@unittest.skipIf(not current.deployment_settings.has_module("survey"),
+                 "Survey module deactivated")
+class SurveyAnswerMatrixTests(unittest.TestCase):
+    """ Tests for the answer matrix of survey series """
+
+    # -------------------------------------------------------------------------
+    def setUp(self):
+        """ Set up a series with two questions and two completed forms """
+
+        current.auth.s3_impersonate("admin@example.com")
+
+        s3db = current.s3db
+        template_id = s3db.survey_template.insert(name="Test Template")
+        self.series_id = s3db.survey_series.insert(name="Test Series",
+                                                   template_id=template_id)
+
+        qtable = s3db.survey_question
+        self.questions = Storage()
+        for code in ("TQ-1", "TQ-2"):
+            self.questions[code] = qtable.insert(name="Question %s" % code,
+                                                 code=code,
+                                                 type="String")
+
+        self.completes = []
+        self.add_complete({"TQ-1": "A", "TQ-2": "B"})
+        self.add_complete({"TQ-1": "C"})
+
+    # -------------------------------------------------------------------------
+    def add_complete(self, answers):
+        """
+            Add a completed form with answers
+
+            @param answers: dict {question code: value}
+
+            @return: the complete_id
+        """
+
+        s3db = current.s3db
+        complete_id = s3db.survey_complete.insert(series_id=self.series_id)
+        atable = s3db.survey_answer
+        for code, value in answers.items():
+            atable.insert(complete_id=complete_id,
+                          question_id=self.questions[code],
+                          value=value)
+        self.completes.append(complete_id)
+        return complete_id
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def new_request():
+        """ Forget which matrices have been verified in this request """
+
+        current.response.s3.survey_answer_matrices = None
+
+    # -------------------------------------------------------------------------
+    def testMatrix(self):
+        """ Test building and reading the answer matrix """
+
+        s3db = current.s3db
+        q1, q2 = self.questions["TQ-1"], self.questions["TQ-2"]
+        c1, c2 = self.completes
+
+        matrix = s3db.survey_getAnswerMatrix(self.series_id)
+        self.assertEqual(matrix.completes, set([c1, c2]))
+        self.assertEqual(matrix.types[q1], "String")
+        self.assertEqual(matrix.answers[q1][c1][1], "A")
+        self.assertEqual(matrix.answers[q1][c2][1], "C")
+        self.assertEqual(matrix.answers[q2].keys(), [c1])
+
+        # Cached as long as the completed forms do not change
+        self.new_request()
+        self.assertTrue(s3db.survey_getAnswerMatrix(self.series_id) is matrix)
+
+        answers = s3db.survey_getAllAnswersForQuestionInSeries(q1,
+                                                               self.series_id)
+        self.assertEqual([(a["complete_id"], a["value"]) for a in answers],
+                         [(c1, "A"), (c2, "C")])
+        answers = s3db.survey_getAllAnswersForQuestionInSeries(q1,
+                                                               self.series_id,
+                                                               matrix=matrix)
+        self.assertEqual([a["typed"] for a in answers], ["A", "C"])
+
+        completed = s3db.buildCompletedList(self.series_id, [q1, q2])
+        self.assertEqual(completed[0], ["Question TQ-1", "Question TQ-2"])
+        self.assertEqual(completed[1], ["string", "string"])
+        self.assertEqual(completed[2:], [["A", "B"], ["C", ""]])
+
+    # -------------------------------------------------------------------------
+    def testUpdate(self):
+        """ Test that the matrix follows changes of completed forms """
+
+        s3db = current.s3db
+        q2 = self.questions["TQ-2"]
+        c1, c2 = self.completes
+
+        matrix = s3db.survey_getAnswerMatrix(self.series_id)
+
+        # New completed form => rebuilt in the next request
+        c3 = self.add_complete({"TQ-2": "D"})
+        self.assertTrue(s3db.survey_getAnswerMatrix(self.series_id) is matrix)
+        self.new_request()
+        matrix = s3db.survey_getAnswerMatrix(self.series_id)
+        self.assertTrue(c3 in matrix.completes)
+        self.assertEqual(matrix.answers[q2][c3][1], "D")
+
+        # Re-imported answers => updated incrementally
+        atable = s3db.survey_answer
+        current.db(atable.complete_id == c2).update(question_id=q2, value="E")
+        s3db.survey_updateAnswerMatrix(self.series_id, c2)
+        updated = s3db.survey_getAnswerMatrix(self.series_id)
+        self.assertFalse(updated is matrix)
+        self.assertFalse(c2 in updated.answers[self.questions["TQ-1"]])
+        self.assertEqual(updated.answers[q2][c2][1], "E")
+        # Copy-on-write => previous matrix unchanged
+        self.assertEqual(matrix.answers[self.questions["TQ-1"]][c2][1], "C")
+        # Still current in the next request
+        self.new_request()
+        self.assertTrue(s3db.survey_getAnswerMatrix(self.series_id) is updated)
+
+        # Deleted completed form => rebuilt
+        ctable = s3db.survey_complete
+        current.db(ctable.id == c3).update(deleted=True)
+        self.new_request()
+        matrix = s3db.survey_getAnswerMatrix(self.series_id)
+        self.assertFalse(c3 in matrix.completes)
+
+    # -------------------------------------------------------------------------
+    def testAnswerChanges(self):
+        """ Test that the matrix follows changes of single answers """
+
+        s3db = current.s3db
+        q1, q2 = self.questions["TQ-1"], self.questions["TQ-2"]
+        c1, c2 = self.completes
+
+        matrix = s3db.survey_getAnswerMatrix(self.series_id)
+        self.assertFalse(c2 in matrix.answers[q2])
+
+        # New answer for an existing completed form => rebuilt
+        atable = s3db.survey_answer
+        answer_id = atable.insert(complete_id=c2, question_id=q2, value="D")
+        self.new_request()
+        matrix = s3db.survey_getAnswerMatrix(self.series_id)
+        self.assertEqual(matrix.answers[q2][c2], (answer_id, "D", "D"))
+
+        # Answer for a question not in the matrix yet => added, typed
+        qtable = s3db.survey_question
+        q3 = qtable.insert(name="Question TQ-3", code="TQ-3", type="Numeric")
+        answer_id = atable.insert(complete_id=c1, question_id=q3, value="5")
+        survey_setAnswerInMatrix(c1, q3, answer_id, "5")
+        updated = s3db.survey_getAnswerMatrix(self.series_id)
+        self.assertFalse(q3 in matrix.answers)
+        self.assertEqual(updated.types[q3], "Numeric")
+        self.assertEqual(updated.answers[q3][c1], (answer_id, "5", 5))
+        self.new_request()
+        self.assertTrue(s3db.survey_getAnswerMatrix(self.series_id) is updated)
+
+    # -------------------------------------------------------------------------
+    def tearDown(self):
+
+        SURVEY_ANSWER_MATRIX.pop(self.series_id, None)
+        current.db.rollback()
+        current.auth.s3_impersonate(None)
+
+# =============================================================================
+def run_suite(*test_classes):
+    """ Run the test suite """
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for test_class in test_classes:
+        tests = loader.loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    if suite is not None:
+        unittest.TextTestRunner().run(suite)
+    return
+
+if __name__ == "__main__":
+
+    run_suite(
+        SurveyAnswerMatrixTests,
+    )
+
+# END ========================================================================
@@ -34,6 +34,19 @@ settings = current.deployment_settings
 # Unless doing a manual DB migration, where prepopulate = 0
 # In Production, prepopulate = 0 (to save 1x DAL hit every page)
 #settings.base.prepopulate = 1
+# Number of worker processes to run independent prepopulate tasks concurrently
+# (requires PostgreSQL or MySQL)
+#settings.base.prepopulate_workers = 4
+
+# Number of worker processes to render charts in (0 to render within requests)
+#settings.base.chart_workers = 2
+# Maximum size of the cache of rendered charts (in MB)
+#settings.base.chart_cache_size = 20
+
+# Number of foreign key representations to share across requests in each
+# server process (default 0 = disabled), and their maximum age (in seconds)
+#settings.base.represent_cache_size = 10000
+#settings.base.represent_cache_ttl = 300
 
 # Theme (folder to use for views/layout.html)
 #settings.base.theme = "default"
@@ -41,6 +54,9 @@ settings = current.deployment_settings
 # Enable Guided Tours
 settings.base.guided_tour = True
 
+# Uncomment to set record owners and realms in bulk after imports
+#settings["import"].bulk_commit = True
+
 # Authentication settings
 # These settings should be changed _after_ the 1st (admin) user is
 # registered in order to secure the deployment
@@ -234,8 +250,14 @@ settings.L10n.decimal_separator = "."
 #settings.gis.layer_tree_expanded = False
 # Uncomment to have custom folders in the LayerTree use Radio Buttons
 #settings.gis.layer_tree_radio = True
+# Uncomment to maintain a table of the latest presence of trackables (speeds up mapping of tracked resources)
+#settings.gis.latest_presence = True
 # Uncomment to display the Map Legend as a floating DIV
 #settings.gis.legend = "float"
+# Uncomment to export Feature Layers with a native GeoJSON encoder rather than via the XSLT stylesheet
+#settings.gis.geojson_direct = True
+# Uncomment to use multiple processes when rebuilding the whole Location Tree
+#settings.gis.location_tree_workers = 4
 # Mouse Position: 'normal', 'mgrs' or None
 #settings.gis.mouse_position = "mgrs"
 # Uncomment to hide the Overview map
@@ -254,6 +276,13 @@ settings.L10n.decimal_separator = "."
 # Messaging Settings
 # If you wish to use a parser.py in another folder than "default"
 #settings.msg.parser = "mytemplatefolder"
+# Number of worker threads to send outbox messages concurrently
+#settings.msg.outbox_workers = 8
+# Maximum number of messages per second to send through each gateway
+#settings.msg.send_rate = {"EMAIL": 20, "WEB_API": 5}
+# Send update notifications from the scheduler task, extracting the data
+# once per group of subscriptions with the same filters and permissions
+#settings.msg.notify_engine = "grouped"
 
 # Use 'soft' deletes
 #settings.security.archive_not_delete = False
@@ -283,6 +312,12 @@ settings.L10n.decimal_separator = "."
 # NB Auditing (especially Reads) slows system down & consumes diskspace
 #settings.security.audit_read = True
 #settings.security.audit_write = True
+# Buffer audit entries and write them in bulk when the request commits
+#settings.security.audit_buffer = 100
+# Spool audit entries in an SQLite file, to be transferred into the audit
+# table by the s3_audit_flush task (up to audit_spool_size entries)
+#settings.security.audit_spool = "databases/audit_spool.db"
+#settings.security.audit_spool_size = 100000
 
 # Lock-down access to Map Editing
 #settings.security.map = True
@@ -310,6 +345,10 @@ settings.L10n.decimal_separator = "."
 #settings.ui.social_buttons = True
 # Enable this to show pivot table options form by default
 #settings.ui.hide_report_options = False
+# Uncomment to compute pivot table reports in the database where possible
+#settings.ui.report_db_aggregation = True
+# Number of seconds to cache the record counts of paginated data tables (0 to disable)
+#settings.ui.datatables_count_cache = 30
 # Uncomment to show created_by/modified_by using Names not Emails
 #settings.ui.auth_user_represent = "name"
 # Uncomment to restrict the export formats available
@@ -592,6 +631,9 @@ settings.L10n.decimal_separator = "."
 # Save Search Widget
 # New S3Filter
 #settings.search.filter_manager = False
+# Number of seconds to cache the options of filter widgets (default 0 = disabled)
+# - other processes see changes only after this time
+#settings.search.filter_options_cache = 60
 # Old S3Search
 #settings.search.save_widget = False
 
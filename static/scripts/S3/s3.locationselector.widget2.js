@@ -10,6 +10,7 @@
  *             'f' : parent
  *             }}
  *  n = same but temporary for new content retrieved from /gis/ldata
+ *  lv = version of the data in /gis/ldata (to allow caching)
  *  hdata = Labels Hierarchy (@ToDo)
  */
 
@@ -368,8 +369,13 @@
 
         // Download Location Data
         var url = S3.Ap.concat('/gis/ldata/' + id);
+        if (typeof lv != 'undefined') {
+            // Versioned URL, can be cached
+            url += '?v=' + lv;
+        }
         $.ajaxS3({
             async: false,
+            cache: true,
             url: url,
             dataType: 'script',
             success: function(data) {
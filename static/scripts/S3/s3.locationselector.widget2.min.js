@@ -3,7 +3,7 @@ q&&u.data("specific",q);u.data("hide_lx",a);if(d)r(b,0,d);else{B.removeClass("hi
 0)});$(g+"_L1").change(function(){r(b,1)});$(g+"_L2").change(function(){r(b,2)});$(g+"_L3").change(function(){r(b,3)});$(g+"_L4").change(function(){r(b,4)});$(g+"_L5").change(function(){r(b,5)})};var r=function(b,a,c){var d="#"+b,e=$(d).data("hide_lx");c?$(d+"_L"+a).val(c):c=parseInt($(d+"_L"+a).val());if(0===a){var k=h[c];if(void 0==k){var f=S3.Ap.concat("/gis/hdata/"+c);$.ajaxS3({async:!1,url:f,dataType:"script",success:function(a){k={};for(var b in n)k[b]=n[b];h[c]=k;n=null},error:function(a,b,
 d){msg="UNAUTHORIZED"==d?i18n.gis_requires_login:a.responseText;s3_debug(msg)}})}for(var p=h.d,m,q,g=["1","2","3","4","5"],f=0;5>f;f++)m=g[f],q=k[m]||p[m],m=$(d+"_L"+m+"__row label"),m.hasClass("required")?m.html("<div>"+q+':<span class="req"> *</span></div>'):m.html(q+":")}if(c){for(m=a+1;6>m;m++)p=d+"_L"+m,e?$(p+"__row").hide():$(p+" option").remove('[value != ""]'),$(p).val("");s(b);a+=1;e=$(d+"_L"+a+"__row");if(e.length){e.removeClass("hide").show();e=!0;for(f in l)l[f].f==c&&(e=!1);e&&J(b,a,
 c);e=[];for(f in l)v=l[f],v.l==a&&v.f==c&&(v.i=f,e.push(v));e.sort(H);p=$(d+"_L"+a);$(d+"_L"+a+" option").remove('[value != ""]');f=0;for(a=e.length;f<a;f++)m=e[f],d=m.i,q=c==d?' selected="selected"':"",d='<option value="'+d+'"'+q+">"+m.n+"</option>",p.append(d)}else $(d+"_geocode button").length&&y(b)}else for(0===a?c="d":(c=$(d+"_L"+(a-1)).val())||(c="d"),s(b),m=a+1;6>m;m++)p=d+"_L"+m,e?$(p+"__row").hide():$(p+" option").remove('[value != ""]'),$(p).val("");z(b,c)},H=function(b,a){b=b.n;var c=[b,
-a.n];c.sort();return c[0]==b?-1:1},J=function(b,a,c){b="#"+b;var d=$(b+"_L"+a);d.hide();var e=$(b+"_L"+a+"__throbber");e.removeClass("hide").show();a=S3.Ap.concat("/gis/ldata/"+c);$.ajaxS3({async:!1,url:a,dataType:"script",success:function(a){for(var b in n)l[b]=n[b];n=null;e.hide();d.removeClass("hide").show()},error:function(a,b,c){msg="UNAUTHORIZED"==c?i18n.gis_requires_login:a.responseText;s3_debug(msg);alert(msg);e.hide();d.removeClass("hide").show()}})},t=function(b){b="#"+b+"_L";for(var a,
+a.n];c.sort();return c[0]==b?-1:1},J=function(b,a,c){b="#"+b;var d=$(b+"_L"+a);d.hide();var e=$(b+"_L"+a+"__throbber");e.removeClass("hide").show();a=S3.Ap.concat("/gis/ldata/"+c);"undefined"!=typeof lv&&(a+="?v="+lv);$.ajaxS3({async:!1,cache:!0,url:a,dataType:"script",success:function(a){for(var b in n)l[b]=n[b];n=null;e.hide();d.removeClass("hide").show()},error:function(a,b,c){msg="UNAUTHORIZED"==c?i18n.gis_requires_login:a.responseText;s3_debug(msg);alert(msg);e.hide();d.removeClass("hide").show()}})},t=function(b){b="#"+b+"_L";for(var a,
 c=5;-1<c;c--)if(a=$(b+c).val())return a;return l.d.id},s=function(b){var a="#"+b,c=$(a+"_parent"),d=$(a);if(d.data("specific"))d=t(b),c.val(d);else{var e=$(a+"_address").val(),k=$(a+"_postcode").val(),f=$(a+"_lat").val(),p=$(a+"_lon").val(),a=$(a+"_wkt").val();e||k||f||p||a?(d.val("dummy"),d=t(b),c.val(d)):(b=t(b),d.val(b),c.val(""))}},I=function(b){var a="#"+b;$(a+"_address__row").removeClass("hide").show();$(a+"_postcode__row").removeClass("hide").show();$(a+"_geocode button").length&&$(a+"_address,"+
 a+"_postcode").change(function(){y(b)})},y=function(b){var a="#"+b;if($(a+"_address").val()){var c,d,e=["1","2","3","4","5"];for(c=0;5>c;c++)if(d=e[c],d=$(a+"_L"+d),d.length&&!d.val())return;$(a).data("manually_geocoded")?($(a+"_geocode .geocode_success").hide(),$(a+"_geocode .geocode_fail").hide(),$(a+"_geocode button").removeClass("hide").show().click(function(){$(this).hide();A(b);s(b)})):A(b);s(b)}},A=function(b){var a="#"+b,c=$(a+"_geocode .geocode_fail"),d=$(a+"_geocode .geocode_success");c.hide();
 d.hide();var e=$(a+"_geocode .throbber");e.removeClass("hide").show();var k={address:$(a+"_address").val()},f=$(a+"_postcode").val();f&&(k.postcode=f);if(f=$(a+"_L0").val())k.L0=f;if(f=$(a+"_L1").val())k.L1=f;if(f=$(a+"_L2").val())k.L2=f;if(f=$(a+"_L3").val())k.L3=f;if(f=$(a+"_L4").val())k.L4=f;if(f=$(a+"_L5").val())k.L5=f;f=S3.Ap.concat("/gis/geocode");$.ajaxS3({async:!1,url:f,type:"POST",data:k,dataType:"json",success:function(k){var f=k.lat,q=k.lon;if(f||q){$(a+"_lat").val(f);$(a+"_lon").val(q);
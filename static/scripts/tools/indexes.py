@@ -37,3 +37,17 @@ try:
 except:
     # Index already present
     pass
+
+tablename = "pr_ou_closure"
+field = "ancestor"
+try:
+    db.executesql("CREATE INDEX %s_%s__idx on %s(%s);" % (tablename, field, tablename, field))
+except:
+    # Index already present
+    pass
+field = "descendant"
+try:
+    db.executesql("CREATE INDEX %s_%s__idx on %s(%s);" % (tablename, field, tablename, field))
+except:
+    # Index already present
+    pass